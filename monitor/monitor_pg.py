@@ -1,14 +1,39 @@
 #!/usr/bin/env python3
 import os
+import re
 import sys
+import csv
+import glob
+import io
 import json
+import hashlib
 import time
+import queue
+import random
+import threading
+import http.client
 import ssl
 import traceback
+import heapq
+import contextlib
 import logging
+import math
+import sqlite3
+import socketserver
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from datetime import datetime
-from urllib import request, error
-from typing import Any, Dict, List, Optional, Tuple
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib import parse
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple, Union
+
+
+SQLParams = Optional[Union[Tuple[Any, ...], Dict[str, Any]]]
+
+# 每个实例的缺省连接数:快照之后仍自行查询的采集项(bloat、statements)可并发执行,
+# 再加上等待事件采样与自定义查询各一条,采集项不必在连接池上排队耗掉截止时间
+DEFAULT_POOL_SIZE = 4
 
 
 class ConfigError(Exception):
@@ -27,32 +52,191 @@ def load_config(path: str) -> Dict[str, Any]:
     return data
 
 
+def _validate_db_section(db: Dict[str, Any], section: str) -> Dict[str, Any]:
+    """校验单个数据库连接段并补全实例名"""
+    for k in ["host", "port", "dbname", "user"]:
+        if k not in db:
+            raise ConfigError("{} 段缺少字段: {}".format(section, k))
+    if "password" not in db and "password_env" not in db:
+        db["password"] = ""
+    db.setdefault("name", "{}:{}/{}".format(db["host"], db["port"], db["dbname"]))
+    db.setdefault("connect_timeout_seconds", 5)
+    db.setdefault("keepalives_idle_seconds", 30)
+    db.setdefault("keepalives_interval_seconds", 10)
+    db.setdefault("keepalives_count", 3)
+    db.setdefault("pool_size", DEFAULT_POOL_SIZE)
+    db.setdefault("reconnect_backoff_base_seconds", 1.0)
+    db.setdefault("reconnect_backoff_max_seconds", 60.0)
+    return db
+
+
+# 各采集项的缺省采集周期(秒):廉价且变化快的指标高频采集,代价高、变化慢的低频采集
+DEFAULT_SCHEDULE_SECONDS = {
+    "connections": 15,
+    "locks": 5,
+    "deadlocks": 60,
+    "cpu": 60,
+    "temp": 60,
+    "shared_buffers": 3600,
+    "slow_queries": 15,
+    "bloat": 3600,
+    "replication": 15,
+    "vacuum": 60,
+    "disk": 900,
+    "statements": 300,
+    "host": 30,
+    "wait_events": 60,
+    "logs": 15,
+}
+
+# 默认学习基线的指标;阈值中配置了 deviation 的指标会自动加入
+BASELINE_SERIES = (
+    "connections_total", "connections_active", "lock_blocked_sessions", "slow_query_count", "cpu_time_delta_ms",
+    "temp_bytes_delta", "top_statement_exec_ms", "host_cpu_pct", "wait_aas_total",
+)
+
+
 def validate_config(cfg: Dict[str, Any]) -> Dict[str, Any]:
     """验证配置并填充缺省值"""
-    required_sections = ["db", "webhook", "thresholds"]
+    required_sections = ["webhook", "thresholds"]
+    if not cfg.get("db_targets"):
+        required_sections.insert(0, "db")
     for s in required_sections:
         if s not in cfg:
             raise ConfigError("缺少必须配置段: {}".format(s))
-    db = cfg["db"]
-    for k in ["host", "port", "dbname", "user"]:
-        if k not in db:
-            raise ConfigError("db 段缺少字段: {}".format(k))
-    if "password" not in db and "password_env" not in db:
-        db["password"] = ""
+    if cfg.get("db_targets"):
+        # db 段作为各目标的公共缺省值(账号、SSL 等),目标内同名字段优先
+        base = {k: v for k, v in cfg.get("db", {}).items() if k != "name"}
+        targets = []
+        names = set()
+        for i, t in enumerate(cfg["db_targets"]):
+            merged = dict(base)
+            merged.update(t)
+            merged = _validate_db_section(merged, "db_targets[{}]".format(i))
+            if merged["name"] in names:
+                raise ConfigError("db_targets 实例名重复: {}".format(merged["name"]))
+            names.add(merged["name"])
+            targets.append(merged)
+        cfg["db_targets"] = targets
+    else:
+        _validate_db_section(cfg["db"], "db")
     cfg.setdefault("interval_seconds", 300)
     cfg.setdefault("templates", {})
     cfg["templates"].setdefault("title", "[{severity}] PostgreSQL 监控告警 - {metric}")
     cfg["templates"].setdefault(
         "body",
-        "时间: {timestamp}\n指标: {metric}\n当前值: {value}\n阈值: {threshold}\n级别: {severity}\n详情: {details}\n建议: {action}"
+        "时间: {timestamp}\n实例: {instance}\n指标: {metric}\n当前值: {value}\n阈值: {threshold}\n级别: {severity}\n详情: {details}\n建议: {action}"
     )
     cfg.setdefault("log_file", "/var/log/monitor_pg/monitor_pg.log")
+    cfg.setdefault("state_dir", "/var/lib/monitor_pg")
+    hook = cfg["webhook"]
+    hook.setdefault("timeout_seconds", 10)
+    hook.setdefault("queue_size", 1000)
+    hook.setdefault("max_retries", 5)
+    hook.setdefault("backoff_base_seconds", 1.0)
+    hook.setdefault("backoff_max_seconds", 60.0)
+    hook.setdefault("outbox_path", os.path.join(cfg["state_dir"], "alert_outbox.jsonl"))
+    hook.setdefault("outbox_max_attempts", 10)
+    hook.setdefault("outbox_max_age_seconds", 86400)
+    hook.setdefault("outbox_max_bytes", 10 * 1024 * 1024)
+    store = cfg.setdefault("store", {})
+    store.setdefault("enabled", True)
+    store.setdefault("path", os.path.join(cfg["state_dir"], "metrics.db"))
+    store.setdefault("raw_retention_hours", 48)
+    store.setdefault("rollup_seconds", 3600)
+    store.setdefault("rollup_retention_days", 90)
+    store.setdefault("compact_interval_seconds", 3600)
+    store.setdefault("seed_max_age_seconds", 3600)
+    timeouts = cfg.setdefault("timeouts", {})
+    timeouts.setdefault("statement_timeout_ms", 10000)
+    timeouts.setdefault("lock_timeout_ms", 2000)
+    timeouts.setdefault("cycle_seconds", 120)
+    timeouts.setdefault("collectors", {})
+    sched = cfg.setdefault("schedule", {})
+    sched.setdefault("enabled", True)
+    sched.setdefault("jitter_pct", 10)
+    sched.setdefault("coalesce_seconds", 1.0)
+    sched_collectors = sched.setdefault("collectors", {})
+    for name in sched_collectors:
+        if name not in DEFAULT_SCHEDULE_SECONDS:
+            raise ConfigError("schedule.collectors 中的采集项不存在: {}".format(name))
+    for name, seconds in DEFAULT_SCHEDULE_SECONDS.items():
+        c = sched_collectors.setdefault(name, {})
+        c.setdefault("interval_seconds", seconds)
+        if float(c["interval_seconds"]) <= 0:
+            raise ConfigError("schedule.collectors.{}.interval_seconds 必须大于 0".format(name))
+    sizes = cfg.setdefault("size_tracking", {})
+    sizes.setdefault("min_refresh_seconds", 300)
+    sizes.setdefault("max_refresh_seconds", 21600)
+    sizes.setdefault("refresh_growth_pct", 1.0)
+    host = cfg.setdefault("host", {})
+    host.setdefault("enabled", True)
+    host.setdefault("interval_seconds", 5)
+    host.setdefault("retention_seconds", 3600)
+    host.setdefault("mounts", ["/"])
+    host.setdefault("disks", [])
+    host.setdefault("backend_attribution", True)
+    ws = cfg.setdefault("wait_sampling", {})
+    ws.setdefault("enabled", True)
+    ws.setdefault("interval_seconds", 1.0)
+    ws.setdefault("window_seconds", 300)
+    ws.setdefault("buckets", 30)
+    ws.setdefault("capacity", 512)
+    ws.setdefault("top_n", 10)
+    ws.setdefault("use_pg_wait_sampling", True)
+    ws.setdefault("statement_timeout_ms", 1000)
+    lc = cfg.setdefault("csvlog", {})
+    lc.setdefault("enabled", False)
+    lc.setdefault("directory", "")
+    lc.setdefault("pattern", "*.csv")
+    lc.setdefault("state_path", "")
+    lc.setdefault("start_at_end", True)
+    lc.setdefault("capacity", 2000)
+    lc.setdefault("top_n", 10)
+    lc.setdefault("chunk_bytes", 4 * 1024 * 1024)
+    lc.setdefault("max_bytes_per_poll", 64 * 1024 * 1024)
+    lc.setdefault("max_seconds_per_poll", 0)
+    cfg.setdefault("replication", {}).setdefault("wal_path", "")
+    ss = cfg.setdefault("self_stats", {})
+    ss.setdefault("enabled", True)
+    ss.setdefault("status_path", os.path.join(cfg["state_dir"], "status.json"))
+    ss.setdefault("write_interval_seconds", 60)
+    bl = cfg.setdefault("baseline", {})
+    bl.setdefault("enabled", True)
+    bl.setdefault("series", list(BASELINE_SERIES))
+    bl.setdefault("halflife_seconds", 3600)
+    bl.setdefault("seasonal_halflife_weeks", 4)
+    bl.setdefault("sketch_halflife_days", 7)
+    bl.setdefault("min_samples", 30)
+    bl.setdefault("state_path", "")
+    bl.setdefault("save_interval_seconds", 300)
+    bloat = cfg.setdefault("bloat_scan", {})
+    bloat.setdefault("budget_pages", 262144)
+    bloat.setdefault("budget_seconds", 20)
+    bloat.setdefault("stale_after_seconds", 86400)
+    bloat.setdefault("candidates_refresh_seconds", 900)
+    bloat.setdefault("statement_timeout_ms", 15000)
+    bloat.setdefault("lock_timeout_ms", 1000)
+    exp = cfg.setdefault("exporter", {})
+    exp.setdefault("enabled", False)
+    exp.setdefault("listen", "127.0.0.1")
+    exp.setdefault("port", 9188)
+    exp.setdefault("queries_path", "")
+    exp.setdefault("custom_queries", [])
+    exp.setdefault("custom_queries_interval_seconds", 60)
     cfg.setdefault("options", {})
     opts = cfg["options"]
     opts.setdefault("use_pg_stat_kcache", True)
     opts.setdefault("use_pg_stat_statements", True)
     opts.setdefault("collect_bloat", True)
     opts.setdefault("enable_replication_check", True)
+    opts.setdefault("collect_vacuum", True)
+    opts.setdefault("fleet_max_workers", 16)
+    opts.setdefault("collector_max_workers", 64)
+    opts.setdefault("metadata_cache_ttl_seconds", 3600)
+    opts.setdefault("statements_capacity", 20000)
+    opts.setdefault("statements_top_n", 10)
+    opts.setdefault("fingerprint_cache_size", 10000)
     return cfg
 
 
@@ -74,40 +258,446 @@ def setup_logger(log_file: str) -> logging.Logger:
 
 
 class AlertSender:
-    """企业微信告警发送器"""
+    """企业微信告警发送器(复用 keep-alive 连接)"""
     def __init__(self, webhook_url: str, timeout: int = 10) -> None:
         self.webhook_url = webhook_url
         self.timeout = timeout
         self._ctx = ssl.create_default_context()
+        self._url = parse.urlsplit(webhook_url)
+        self._conn: Optional[http.client.HTTPConnection] = None
+        self._lock = threading.Lock()
+        self.stats: Optional["SelfStats"] = None
 
-    def send_text(self, content: str) -> Tuple[bool, Optional[str]]:
-        """发送文本消息到企业微信机器人"""
-        payload = json.dumps({"msgtype": "text", "text": {"content": content}}).encode("utf-8")
-        req = request.Request(self.webhook_url, data=payload, headers={"Content-Type": "application/json"})
-        try:
-            with request.urlopen(req, timeout=self.timeout, context=self._ctx) as resp:
+    def _connection(self) -> http.client.HTTPConnection:
+        """返回持久连接,不存在时新建"""
+        if self._conn is None:
+            if self._url.scheme == "https":
+                self._conn = http.client.HTTPSConnection(self._url.netloc, timeout=self.timeout, context=self._ctx)
+            else:
+                self._conn = http.client.HTTPConnection(self._url.netloc, timeout=self.timeout)
+        return self._conn
+
+    def close(self) -> None:
+        """关闭持久连接"""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _post(self, payload: bytes) -> Tuple[int, str]:
+        """在持久连接上 POST,连接被服务端关闭时重建一次"""
+        path = self._url.path or "/"
+        if self._url.query:
+            path += "?" + self._url.query
+        headers = {"Content-Type": "application/json", "Connection": "keep-alive"}
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.request("POST", path, body=payload, headers=headers)
+                resp = conn.getresponse()
                 data = resp.read().decode("utf-8", errors="ignore")
-                return True, data
-        except error.URLError as e:
-            return False, str(e)
+                if resp.getheader("Connection", "").lower() == "close":
+                    self.close()
+                return resp.status, data
+            except (http.client.RemoteDisconnected, http.client.CannotSendRequest,
+                    BrokenPipeError, ConnectionResetError):
+                self.close()
+                if attempt:
+                    raise
+            except Exception:
+                self.close()
+                raise
+        raise ConnectionError("webhook 连接不可用")
+
+    def send_payload(self, message: Dict[str, Any]) -> Tuple[bool, Optional[str]]:
+        """发送任意企业微信消息体,errcode 非 0 视为失败"""
+        payload = json.dumps(message).encode("utf-8")
+        start = time.perf_counter()
+        try:
+            with self._lock:
+                status, data = self._post(payload)
         except Exception as e:
+            if self.stats is not None:
+                self.stats.observe("webhook", "post", time.perf_counter() - start, errors=1)
             return False, str(e)
+        if self.stats is not None:
+            self.stats.observe("webhook", "post", time.perf_counter() - start, errors=int(status != 200))
+        if status != 200:
+            return False, "HTTP {}: {}".format(status, data[:200])
+        try:
+            errcode = json.loads(data).get("errcode", 0)
+        except ValueError:
+            errcode = 0
+        if errcode:
+            return False, data[:200]
+        return True, data
+
+    def send_text(self, content: str) -> Tuple[bool, Optional[str]]:
+        """发送文本消息到企业微信机器人"""
+        return self.send_payload({"msgtype": "text", "text": {"content": content}})
+
+    def submit(self, message: Dict[str, Any], retries: int = 3, backoff_seconds: int = 2) -> None:
+        """带重试的同步消息体发送"""
+        for i in range(retries):
+            ok, err = self.send_payload(message)
+            if ok or not webhook_error_retryable(err):
+                return
+            time.sleep(backoff_seconds * (i + 1))
 
     def safe_send(self, content: str, retries: int = 3, backoff_seconds: int = 2) -> None:
         """带重试的告警发送"""
-        for i in range(retries):
-            ok, err = self.send_text(content)
+        self.submit({"msgtype": "text", "text": {"content": content}}, retries, backoff_seconds)
+
+
+# 企业微信可重试的 errcode:系统繁忙、调用频率或并发超限;其余非 0 errcode(key 无效、消息格式错误等)重试也不会成功
+WEBHOOK_RETRYABLE_ERRCODES = {-1, 45009, 45033}
+
+
+def webhook_error_retryable(err: Optional[str]) -> bool:
+    """send_payload 的失败是否值得重试:网络错误、5xx/429 与限流类 errcode 可重试,其余 4xx 与 errcode 为永久失败"""
+    if not err:
+        return True
+    m = re.match(r"HTTP (\d+):", err)
+    if m:
+        status = int(m.group(1))
+        return status >= 500 or status in (408, 429)
+    try:
+        errcode = json.loads(err).get("errcode", 0)
+    except (ValueError, AttributeError):
+        return True
+    return errcode in WEBHOOK_RETRYABLE_ERRCODES
+
+
+def backoff_delay(attempt: int, base_seconds: float, max_seconds: float) -> float:
+    """带完全抖动的指数退避时长: uniform(0, min(max, base * 2^attempt))"""
+    cap = min(max_seconds, base_seconds * (2 ** attempt))
+    return random.uniform(0, cap)
+
+
+class AlertDispatcher:
+    """后台告警投递器:有界队列 + 单发送线程,投递失败或队列满时落盘到 outbox;
+    outbox 记录投递轮数与首次提交时间,超过 outbox_max_attempts 轮或 outbox_max_age_seconds 的消息丢弃,
+    文件超过 outbox_max_bytes 时只保留最新的记录"""
+    def __init__(self, sender: AlertSender, logger: logging.Logger, queue_size: int = 1000,
+                 outbox_path: str = "", max_retries: int = 5,
+                 backoff_base_seconds: float = 1.0, backoff_max_seconds: float = 60.0,
+                 outbox_max_attempts: int = 10, outbox_max_age_seconds: float = 86400.0,
+                 outbox_max_bytes: int = 10 * 1024 * 1024) -> None:
+        self.sender = sender
+        self.logger = logger
+        self.outbox_path = outbox_path
+        self.max_retries = max_retries
+        self.backoff_base_seconds = backoff_base_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.outbox_max_attempts = max(1, outbox_max_attempts)
+        self.outbox_max_age_seconds = outbox_max_age_seconds
+        self.outbox_max_bytes = outbox_max_bytes
+        # 队列元素为 (消息体, 已投递轮数, 首次提交时间)
+        self.queue: "queue.Queue[Tuple[Dict[str, Any], int, float]]" = queue.Queue(maxsize=max(1, queue_size))
+        self.sent = 0
+        self.spilled = 0
+        self.dropped = 0
+        self.stats: Optional["SelfStats"] = None
+        self._stop = threading.Event()
+        self._outbox_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """启动发送线程"""
+        if self._thread is None:
+            self._replay_outbox()
+            self._thread = threading.Thread(target=self._worker, name="alert-dispatcher", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 30.0) -> None:
+        """等待队列在 timeout 内投递完毕,剩余告警写入 outbox"""
+        deadline = time.monotonic() + timeout
+        while self._thread is not None and self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(max(0.0, deadline - time.monotonic()) + 1.0)
+        while True:
+            try:
+                self._spill(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+    def submit(self, message: Dict[str, Any]) -> None:
+        """非阻塞提交消息体,队列满时直接落盘"""
+        item = (message, 0, time.time())
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.logger.warning("告警队列已满,写入 outbox")
+            self._spill(item)
+
+    def safe_send(self, content: str, retries: int = 3, backoff_seconds: int = 2) -> None:
+        """兼容 AlertSender.safe_send 的非阻塞入口"""
+        self.submit({"msgtype": "text", "text": {"content": content}})
+
+    def _deliver(self, message: Dict[str, Any]) -> str:
+        """带抖动指数退避的投递,停止信号到来时放弃重试;返回 sent、retry(可稍后重试)或 rejected(永久失败)"""
+        start = time.perf_counter()
+        attempt = 0
+        for attempt in range(self.max_retries):
+            ok, err = self.sender.send_payload(message)
             if ok:
+                self.sent += 1
+                if self.stats is not None:
+                    # 含退避等待的端到端投递耗时
+                    self.stats.observe("webhook", "deliver", time.perf_counter() - start, retries=attempt)
+                return "sent"
+            if not webhook_error_retryable(err):
+                self.logger.error("告警被 webhook 拒绝,不再重试: %s", err)
+                if self.stats is not None:
+                    self.stats.observe("webhook", "deliver", time.perf_counter() - start, retries=attempt, rejected=1)
+                return "rejected"
+            self.logger.warning("告警发送失败(第 %d 次): %s", attempt + 1, err)
+            if attempt + 1 < self.max_retries:
+                if self._stop.wait(backoff_delay(attempt, self.backoff_base_seconds, self.backoff_max_seconds)):
+                    break
+        if self.stats is not None:
+            self.stats.observe("webhook", "deliver", time.perf_counter() - start, retries=attempt, failed=1)
+        return "retry"
+
+    def _worker(self) -> None:
+        """发送线程主循环"""
+        while not self._stop.is_set():
+            try:
+                item = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                message, attempts, first_ts = item
+                result = self._deliver(message)
+                if result == "sent":
+                    self._replay_outbox()
+                elif result == "retry":
+                    self._spill((message, attempts + 1, first_ts))
+                else:
+                    self._drop(1)
+            finally:
+                self.queue.task_done()
+
+    def _drop(self, n: int) -> None:
+        """记录被丢弃(永久失败、超过轮数/时长或超出 outbox 上限)的消息数"""
+        self.dropped += n
+        if self.stats is not None:
+            self.stats.observe("webhook", "outbox", dropped=n)
+
+    def _spill(self, item: Tuple[Dict[str, Any], int, float]) -> None:
+        """把未投递的消息连同投递轮数与首次提交时间追加到 outbox 文件"""
+        self.spilled += 1
+        if self.stats is not None:
+            self.stats.observe("webhook", "outbox", spilled=1)
+        if not self.outbox_path:
+            self.logger.error("告警未投递且未配置 outbox,已丢弃")
+            return
+        message, attempts, first_ts = item
+        self._append_outbox([json.dumps({"ts": time.time(), "first_ts": first_ts, "attempts": attempts,
+                                         "message": message}, ensure_ascii=False) + "\n"])
+
+    def _append_outbox(self, lines: List[str]) -> None:
+        """追加若干 outbox 记录行;文件超过 outbox_max_bytes 时丢弃最旧的记录"""
+        try:
+            with self._outbox_lock:
+                os.makedirs(os.path.dirname(self.outbox_path) or ".", exist_ok=True)
+                with open(self.outbox_path, "a", encoding="utf-8") as f:
+                    f.writelines(lines)
+                if self.outbox_max_bytes and os.path.getsize(self.outbox_path) > self.outbox_max_bytes:
+                    self._trim_outbox()
+        except Exception as e:
+            self.logger.error("写入告警 outbox 失败: %s", str(e))
+
+    def _trim_outbox(self) -> None:
+        """保留不超过 outbox_max_bytes 的最新记录(调用方持有锁)"""
+        with open(self.outbox_path, "r", encoding="utf-8") as f:
+            lines = f.readlines()
+        kept: List[str] = []
+        size = 0
+        for line in reversed(lines):
+            size += len(line.encode("utf-8"))
+            if size > self.outbox_max_bytes:
+                break
+            kept.append(line)
+        tmp = self.outbox_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.writelines(reversed(kept))
+        os.replace(tmp, self.outbox_path)
+        self.logger.error("告警 outbox 超过 %d 字节,丢弃最旧的 %d 条", self.outbox_max_bytes, len(lines) - len(kept))
+        self._drop(len(lines) - len(kept))
+
+    def _replay_outbox(self) -> None:
+        """把 outbox 中的积压告警移回发送队列,队列放不下的留在 outbox"""
+        if not self.outbox_path or not os.path.isfile(self.outbox_path):
+            return
+        with self._outbox_lock:
+            try:
+                with open(self.outbox_path, "r", encoding="utf-8") as f:
+                    lines = f.readlines()
+                os.remove(self.outbox_path)
+            except Exception as e:
+                self.logger.error("读取告警 outbox 失败: %s", str(e))
                 return
-            time.sleep(backoff_seconds * (i + 1))
+        requeued = expired = 0
+        now = time.time()
+        for i, line in enumerate(lines):
+            try:
+                rec = json.loads(line)
+                message = rec["message"]
+            except (ValueError, KeyError):
+                continue
+            first_ts = float(rec.get("first_ts", rec.get("ts", now)))
+            attempts = int(rec.get("attempts", 0))
+            if attempts >= self.outbox_max_attempts or now - first_ts > self.outbox_max_age_seconds:
+                expired += 1
+                continue
+            try:
+                self.queue.put_nowait((message, attempts, first_ts))
+                requeued += 1
+            except queue.Full:
+                self._append_outbox(lines[i:])
+                break
+        if expired:
+            self.logger.error("outbox 中 %d 条告警超过投递轮数或保留时长,已丢弃", expired)
+            self._drop(expired)
+        if requeued:
+            self.logger.info("补发 outbox 积压告警 %d 条", requeued)
+
+
+class AlertManager:
+    """告警状态机:按 (实例, 指标) 跟踪触发/恢复,窗口内抑制重复,同一轮告警合并为一条 markdown 消息"""
+    _COLORS = {"CRITICAL": "warning", "WARNING": "comment", "RESOLVED": "info"}
+
+    def __init__(self, sender: Union[AlertSender, AlertDispatcher], logger: logging.Logger,
+                 repeat_interval_seconds: float = 3600.0, send_resolved: bool = True,
+                 max_message_bytes: int = 4000) -> None:
+        self.sender = sender
+        self.logger = logger
+        self.repeat_interval_seconds = repeat_interval_seconds
+        self.send_resolved = send_resolved
+        self.max_message_bytes = max_message_bytes
+        self.suppressed = 0
+        # (instance, metric) -> {"severity", "since", "last_sent"}
+        self.firing: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._cycle: Dict[str, set] = {}
+        self._pending: List[Tuple[str, str]] = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, cfg: Dict[str, Any], sender: Union[AlertSender, AlertDispatcher],
+                    logger: logging.Logger) -> "AlertManager":
+        """按 alerting 配置段构建"""
+        a = cfg.get("alerting", {})
+        return cls(
+            sender, logger,
+            repeat_interval_seconds=float(a.get("repeat_interval_seconds", 3600)),
+            send_resolved=bool(a.get("send_resolved", True)),
+            max_message_bytes=int(a.get("max_message_bytes", 4000)),
+        )
+
+    def begin_cycle(self, instance: str) -> None:
+        """开始一个实例的评估周期"""
+        with self._lock:
+            self._cycle[instance] = set()
+
+    def fire(self, instance: str, metric: str, severity: str, text: str, now: Optional[float] = None) -> None:
+        """登记一条触发中的告警,首次触发、级别变化或超过重复窗口时才进入待发送列表"""
+        now = time.time() if now is None else now
+        key = (instance, metric)
+        with self._lock:
+            self._cycle.setdefault(instance, set()).add(metric)
+            state = self.firing.get(key)
+            if state is None:
+                state = {"severity": severity, "since": now, "last_sent": None}
+                self.firing[key] = state
+            elif state["severity"] != severity:
+                state["severity"] = severity
+                state["last_sent"] = None
+            if state["last_sent"] is not None and now - state["last_sent"] < self.repeat_interval_seconds:
+                self.suppressed += 1
+                return
+            state["last_sent"] = now
+            self._pending.append((severity, text))
+
+    def hold(self, instance: str, metrics: Iterable[str]) -> None:
+        """本轮未能采集的指标保持原状态,不视为恢复"""
+        with self._lock:
+            self._cycle.setdefault(instance, set()).update(metrics)
+
+    def end_cycle(self, instance: str, now: Optional[float] = None) -> None:
+        """结束评估周期:本轮未再触发的告警视为恢复"""
+        now = time.time() if now is None else now
+        with self._lock:
+            fired = self._cycle.pop(instance, set())
+            for key in [k for k in self.firing if k[0] == instance and k[1] not in fired]:
+                state = self.firing.pop(key)
+                if self.send_resolved and state["last_sent"] is not None:
+                    text = "[RESOLVED] {} 已恢复\n实例: {}\n原级别: {}\n持续: {}".format(
+                        key[1], instance, state["severity"], format_duration(now - state["since"]))
+                    self._pending.append(("RESOLVED", text))
+
+    def flush(self) -> int:
+        """把待发送告警合并为 markdown 消息提交给发送器,返回消息条数"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return 0
+        firing = sum(1 for sev, _ in pending if sev != "RESOLVED")
+        header = "**PostgreSQL 监控告警** {}\n> 触发 {} 条,恢复 {} 条\n".format(now_ts(), firing, len(pending) - firing)
+        blocks = ['<font color="{}">{}</font>'.format(self._COLORS.get(sev, "comment"), text) for sev, text in pending]
+        messages = 0
+        for content in self._chunk(header, blocks):
+            self.sender.submit({"msgtype": "markdown", "markdown": {"content": content}})
+            messages += 1
+        return messages
+
+    def _chunk(self, header: str, blocks: List[str]) -> List[str]:
+        """按企业微信 markdown 长度限制把告警块切分为若干消息"""
+        chunks: List[str] = []
+        current = header
+        for block in blocks:
+            candidate = current + "\n" + block
+            if len(candidate.encode("utf-8")) > self.max_message_bytes and current != header:
+                chunks.append(current)
+                candidate = header + "\n" + block
+            current = candidate
+        chunks.append(current)
+        return chunks
+
+
+class DBUnavailableError(Exception):
+    """数据库暂不可用(重连退避中或连接池耗尽)"""
+
+
+class QueryBudget(NamedTuple):
+    """单次查询的服务端超时预算(ms)"""
+    statement_timeout_ms: int
+    lock_timeout_ms: int
 
 
 class DBClient:
-    """PostgreSQL 数据库客户端"""
+    """PostgreSQL 数据库客户端:小连接池,断线自动重连(指数退避),按采集项设置语句/锁超时"""
     def __init__(self, cfg: Dict[str, Any], logger: logging.Logger) -> None:
         self.cfg = cfg
         self.logger = logger
         self.conn = None
+        self.generation = 0
+        db = cfg["db"]
+        t = cfg.get("timeouts", {})
+        self.pool_size = max(1, int(db.get("pool_size", DEFAULT_POOL_SIZE)))
+        self.default_budget = QueryBudget(int(t.get("statement_timeout_ms", 10000)), int(t.get("lock_timeout_ms", 2000)))
+        self._all: List[Any] = []
+        self._idle: List[Any] = []
+        self._applied: Dict[int, QueryBudget] = {}
+        # 使用中的连接 -> 取用时线程声明的归属(采集项),超时取消只针对归属方
+        self._owners: Dict[int, Any] = {}
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._failures = 0
+        self._retry_at = 0.0
+        # 自监控统计,由 main 在启用时设置
+        self.stats: Optional["SelfStats"] = None
 
     def _resolve_password(self) -> str:
         """解析数据库密码来源"""
@@ -116,47 +706,225 @@ class DBClient:
             return os.environ.get(db["password_env"], "")
         return db.get("password", "")
 
-    def connect(self) -> None:
-        """建立数据库连接"""
-        try:
-            import psycopg2
-            import psycopg2.extras
-        except Exception as e:
-            raise ConfigError("缺少 psycopg2 依赖: {}".format(str(e)))
-        sslmode = self.cfg["db"].get("sslmode")
+    def _dsn(self) -> str:
+        """构造连接串:连接超时、TCP keepalive 与缺省语句/锁超时在建连时一并设置"""
+        db = self.cfg["db"]
         dsn = (
             "host={host} port={port} dbname={dbname} user={user} password={password}".format(
-                host=self.cfg["db"]["host"],
-                port=self.cfg["db"]["port"],
-                dbname=self.cfg["db"]["dbname"],
-                user=self.cfg["db"]["user"],
+                host=db["host"],
+                port=db["port"],
+                dbname=db["dbname"],
+                user=db["user"],
                 password=self._resolve_password(),
             )
         )
+        dsn += " connect_timeout={} keepalives=1 keepalives_idle={} keepalives_interval={} keepalives_count={}".format(
+            int(db.get("connect_timeout_seconds", 5)),
+            int(db.get("keepalives_idle_seconds", 30)),
+            int(db.get("keepalives_interval_seconds", 10)),
+            int(db.get("keepalives_count", 3)),
+        )
+        dsn += " application_name=monitor_pg options='-c statement_timeout={} -c lock_timeout={}'".format(
+            self.default_budget.statement_timeout_ms, self.default_budget.lock_timeout_ms)
+        sslmode = db.get("sslmode")
         if sslmode:
             dsn += " sslmode={}".format(sslmode)
             for key in ["sslrootcert", "sslcert", "sslkey"]:
-                if self.cfg["db"].get(key):
-                    dsn += " {}={}".format(key, self.cfg["db"][key])
-        import psycopg2
-        self.conn = psycopg2.connect(dsn)
-        self.conn.autocommit = True
+                if db.get(key):
+                    dsn += " {}={}".format(key, db[key])
+        return dsn
+
+    def _open(self) -> Any:
+        """建立一条新连接(autocommit,游标返回字典行)"""
+        try:
+            import psycopg2
+            import psycopg2.extras
+        except Exception as e:
+            raise ConfigError("缺少 psycopg2 依赖: {}".format(str(e)))
+        conn = psycopg2.connect(self._dsn(), cursor_factory=psycopg2.extras.RealDictCursor)
+        conn.autocommit = True
+        return conn
+
+    def connect(self) -> None:
+        """建立数据库连接,旧连接全部作废,连接代次加一"""
+        conn = self._open()
+        with self._cond:
+            self._discard_all()
+            self.conn = conn
+            self._all = [conn]
+            self._idle = [conn]
+            self._applied[id(conn)] = self.default_budget
+            self.generation += 1
+            self._failures = 0
+            self._cond.notify_all()
+
+    def _discard_all(self) -> None:
+        """关闭空闲连接并作废整个连接池;使用中的连接在归还时关闭"""
+        for conn in self._idle:
+            self._applied.pop(id(conn), None)
+            try:
+                conn.close()
+            except Exception:
+                pass
+        self.conn = None
+        self._all = []
+        self._idle = []
+
+    def close(self) -> None:
+        """关闭数据库连接"""
+        with self._cond:
+            self._discard_all()
+            self._cond.notify_all()
+
+    def _reconnect(self) -> None:
+        """主连接不可用时重连,失败后按指数退避推迟下一次尝试(调用方持有锁)"""
+        now = time.monotonic()
+        if now < self._retry_at:
+            raise DBUnavailableError("数据库不可用,{:.1f}s 后重试连接".format(self._retry_at - now))
+        db = self.cfg["db"]
+        try:
+            self.connect()
+        except ConfigError:
+            raise
+        except Exception as e:
+            self._failures += 1
+            self._retry_at = now + backoff_delay(self._failures, float(db.get("reconnect_backoff_base_seconds", 1.0)),
+                                                 float(db.get("reconnect_backoff_max_seconds", 60.0)))
+            self.logger.warning("数据库连接失败(第 %d 次): %s", self._failures, str(e))
+            raise DBUnavailableError("数据库连接失败: {}".format(str(e)))
+        if self.generation > 1:
+            self.logger.info("数据库已重新连接")
+
+    def _acquire(self, budget: QueryBudget) -> Any:
+        """从连接池取一条连接;池满时最多等待一个语句超时"""
+        deadline = time.monotonic() + budget.statement_timeout_ms / 1000.0
+        with self._cond:
+            while True:
+                if self.conn is None:
+                    self._reconnect()
+                if self._idle and self._idle[-1].closed:
+                    # 空闲期间被服务端断开(keepalive 探测失败或实例重启)
+                    self._discard_all()
+                    continue
+                if self._idle:
+                    conn = self._idle.pop()
+                    self._owners[id(conn)] = getattr(self._local, "owner", None)
+                    return conn
+                if len(self._all) < self.pool_size:
+                    conn = self._open()
+                    self._all.append(conn)
+                    self._applied[id(conn)] = self.default_budget
+                    self._owners[id(conn)] = getattr(self._local, "owner", None)
+                    return conn
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    raise DBUnavailableError("连接池已满({} 条)".format(self.pool_size))
+                self._cond.wait(left)
+
+    def _release(self, conn: Any) -> None:
+        """归还连接;已断开的连接丢弃并作废整个池,下次使用时重连"""
+        with self._cond:
+            self._owners.pop(id(conn), None)
+            if conn not in self._all:
+                self._applied.pop(id(conn), None)
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            elif conn.closed:
+                self._all.remove(conn)
+                self._applied.pop(id(conn), None)
+                # 一条连接断开通常意味着主备切换或实例重启,其余连接也不再可信
+                self._discard_all()
+            else:
+                self._idle.append(conn)
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def budget(self, budget: Optional[QueryBudget]) -> Iterator[None]:
+        """在当前线程内临时指定查询超时预算"""
+        prev = getattr(self._local, "budget", None)
+        self._local.budget = budget
+        try:
+            yield
+        finally:
+            self._local.budget = prev
 
-    def execute(self, sql: str, params: Optional[Tuple[Any, ...]] = None) -> List[Dict[str, Any]]:
+    @contextlib.contextmanager
+    def owner(self, owner: Any) -> Iterator[None]:
+        """在当前线程内声明此后取用连接的归属,供 cancel 只取消该归属的查询"""
+        prev = getattr(self._local, "owner", None)
+        self._local.owner = owner
+        try:
+            yield
+        finally:
+            self._local.owner = prev
+
+    def cancel(self, owners: Optional[Iterable[Any]] = None) -> int:
+        """向正在执行的连接发送取消请求,指定 owners 时只取消归属其中的连接,返回取消数"""
+        wanted = None if owners is None else list(owners)
+        with self._cond:
+            busy = [c for c in self._all if c not in self._idle
+                    and (wanted is None or any(self._owners.get(id(c)) is o for o in wanted))]
+        for conn in busy:
+            try:
+                conn.cancel()
+            except Exception:
+                pass
+        return len(busy)
+
+    def _run(self, sql: str, params: SQLParams, one: bool) -> Any:
+        """执行查询;启用自监控时按采集项与语句记录耗时、返回行数与失败次数"""
+        stats = self.stats
+        if stats is None:
+            return self._query(sql, params, one)
+        key = stats.query_key(sql)
+        start = time.perf_counter()
+        try:
+            result = self._query(sql, params, one)
+        except Exception:
+            stats.observe("query", key, time.perf_counter() - start, errors=1)
+            raise
+        rows = len(result) if isinstance(result, list) else int(result is not None)
+        stats.observe("query", key, time.perf_counter() - start, rows=rows)
+        return result
+
+    def _query(self, sql: str, params: SQLParams, one: bool) -> Any:
+        """执行查询;连接在执行中断开时重连并重试一次(查询均为只读)"""
+        budget = getattr(self._local, "budget", None) or self.default_budget
+        for attempt in range(2):
+            conn = self._acquire(budget)
+            try:
+                with conn.cursor() as cur:
+                    if self._applied.get(id(conn)) != budget:
+                        cur.execute("SET statement_timeout = %s; SET lock_timeout = %s",
+                                    (budget.statement_timeout_ms, budget.lock_timeout_ms))
+                        self._applied[id(conn)] = budget
+                    cur.execute(sql, params or ())
+                    if one:
+                        row = cur.fetchone()
+                        return dict(row) if row else None
+                    return [dict(r) for r in cur.fetchall()]
+            except Exception:
+                if attempt or not conn.closed:
+                    raise
+                self.logger.warning("数据库连接已断开,重连后重试")
+            finally:
+                self._release(conn)
+
+    def execute(self, sql: str, params: SQLParams = None) -> List[Dict[str, Any]]:
         """执行 SQL 并返回字典列表"""
-        import psycopg2.extras
-        with self.conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            cur.execute(sql, params or ())
-            rows = cur.fetchall()
-            return [dict(r) for r in rows]
+        return self._run(sql, params, one=False)
 
-    def execute_one(self, sql: str, params: Optional[Tuple[Any, ...]] = None) -> Optional[Dict[str, Any]]:
+    def execute_one(self, sql: str, params: SQLParams = None) -> Optional[Dict[str, Any]]:
         """执行 SQL 并返回单行字典"""
-        import psycopg2.extras
-        with self.conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            cur.execute(sql, params or ())
-            row = cur.fetchone()
-            return dict(row) if row else None
+        return self._run(sql, params, one=True)
+
+    def execute_guarded(self, sql: str, params: SQLParams = None, statement_timeout_ms: int = 15000,
+                        lock_timeout_ms: int = 1000) -> List[Dict[str, Any]]:
+        """以指定的 statement_timeout/lock_timeout 执行重查询"""
+        with self.budget(QueryBudget(int(statement_timeout_ms), int(lock_timeout_ms))):
+            return self.execute(sql, params)
 
 
 def severity_of(value: float, threshold: Dict[str, Any]) -> Optional[str]:
@@ -170,316 +938,4040 @@ def severity_of(value: float, threshold: Dict[str, Any]) -> Optional[str]:
     return None
 
 
+_UNIT_BYTES = {"b": 1, "kb": 1024, "mb": 1024 ** 2, "gb": 1024 ** 3, "tb": 1024 ** 4}
+
+
+def setting_to_bytes(setting: Any, unit: Optional[str]) -> int:
+    """把 pg_settings 的 setting/unit(如 16384/8kB)换算为字节"""
+    m = re.match(r"^\s*(\d*)\s*([A-Za-z]+)\s*$", unit or "")
+    if not m:
+        return int(setting)
+    scale = int(m.group(1) or 1) * _UNIT_BYTES.get(m.group(2).lower(), 1)
+    return int(setting) * scale
+
+
+def format_duration(seconds: float) -> str:
+    """把秒数格式化为易读时长"""
+    seconds = int(max(0, seconds))
+    if seconds < 60:
+        return "{}s".format(seconds)
+    if seconds < 3600:
+        return "{}m{}s".format(seconds // 60, seconds % 60)
+    return "{}h{}m".format(seconds // 3600, seconds % 3600 // 60)
+
+
+def format_bytes(n: float) -> str:
+    """把字节数格式化为易读大小"""
+    n = float(n)
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(n) < 1024:
+            return "{:.1f}{}".format(n, unit) if unit != "B" else "{}B".format(int(n))
+        n /= 1024.0
+    return "{:.1f}TB".format(n)
+
+
 def now_ts() -> str:
     """返回当前时间戳字符串"""
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 
-class Monitor:
-    """核心监控器"""
-    def __init__(self, cfg: Dict[str, Any], db: DBClient, sender: AlertSender, logger: logging.Logger) -> None:
-        self.cfg = cfg
-        self.db = db
-        self.sender = sender
-        self.logger = logger
-        self.prev_state: Dict[str, Any] = {}
+CONNECTION_COUNTS_SQL = """
+SELECT
+  COUNT(*) FILTER (WHERE pid != pg_backend_pid()) AS total,
+  COUNT(*) FILTER (WHERE state = 'active') AS active,
+  COUNT(*) FILTER (WHERE state = 'idle') AS idle
+FROM pg_stat_activity
+"""
 
-    def _ext_installed(self, ext_name: str) -> bool:
-        """检测扩展是否安装"""
-        row = self.db.execute_one(
-            "SELECT EXISTS(SELECT 1 FROM pg_available_extensions WHERE name=%s AND installed_version IS NOT NULL) AS ok",
-            (ext_name,)
-        )
-        return bool(row and row.get("ok"))
+# 只对处于锁等待的会话调用 pg_blocking_pids(),并带回其阻塞者的会话信息;等待图在 Python 中分析
+LOCK_WAITS_SQL = """
+WITH waiting AS (
+  SELECT pid, pg_blocking_pids(pid) AS blocked_by
+  FROM pg_catalog.pg_stat_activity
+  WHERE wait_event_type = 'Lock'
+)
+SELECT a.pid,
+       COALESCE(w.blocked_by, '{}'::int[]) AS blocked_by,
+       CASE WHEN w.pid IS NULL THEN 0
+            ELSE EXTRACT(EPOCH FROM (now() - a.query_start)) * 1000 END AS wait_ms,
+       a.state,
+       a.wait_event,
+       a.usename,
+       a.datname,
+       COALESCE(EXTRACT(EPOCH FROM (now() - a.xact_start)), 0) AS xact_age_s,
+       substring(a.query, 1, 200) AS query
+FROM pg_catalog.pg_stat_activity a
+LEFT JOIN waiting w ON w.pid = a.pid
+WHERE w.pid IS NOT NULL
+   OR a.pid IN (SELECT unnest(blocked_by) FROM waiting)
+"""
 
-    def get_connection_counts(self) -> Dict[str, int]:
-        """采集连接数统计"""
-        sql = """
-        SELECT
-          COUNT(*) FILTER (WHERE pid != pg_backend_pid()) AS total,
-          COUNT(*) FILTER (WHERE state = 'active') AS active,
-          COUNT(*) FILTER (WHERE state = 'idle') AS idle
-        FROM pg_stat_activity
-        """
-        row = self.db.execute_one(sql) or {"total": 0, "active": 0, "idle": 0}
-        return {"total": int(row["total"]), "active": int(row["active"]), "idle": int(row["idle"])}
+SLOW_QUERIES_SQL = """
+SELECT
+  pid, usename, datname,
+  EXTRACT(EPOCH FROM (now() - query_start)) * 1000 AS runtime_ms,
+  substring(query, 1, 400) AS query
+FROM pg_stat_activity
+WHERE state = 'active'
+  AND query NOT LIKE '%%pg_stat_activity%%'
+  AND query NOT LIKE ALL (%(slow_query_excludes)s::text[])
+  AND now() - query_start > (make_interval(secs => %(slow_query_ms)s/1000.0))
+ORDER BY query_start ASC
+LIMIT 200
+"""
 
-    def get_lock_contention(self) -> Dict[str, Any]:
-        """采集锁竞争信息"""
-        sql = """
-        SELECT blocked.pid AS blocked_pid,
-               blocker.pid AS blocking_pid,
-               EXTRACT(EPOCH FROM (now() - blocked.query_start)) * 1000 AS blocked_ms,
-               substring(blocked.query, 1, 200) AS blocked_query
-        FROM pg_catalog.pg_locks blocked_l
-        JOIN pg_catalog.pg_stat_activity blocked ON blocked.pid = blocked_l.pid
-        JOIN pg_catalog.pg_locks blocker_l ON blocker_l.locktype = blocked_l.locktype
-          AND (blocker_l.database, blocker_l.relation) IS NOT DISTINCT FROM (blocked_l.database, blocked_l.relation)
-          AND blocker_l.pid <> blocked_l.pid
-        JOIN pg_catalog.pg_stat_activity blocker ON blocker.pid = blocker_l.pid
-        WHERE NOT blocked_l.granted
-          AND blocker_l.granted
-        ORDER BY blocked.query_start ASC
-        LIMIT 20
-        """
-        rows = self.db.execute(sql)
-        max_wait = max([float(r["blocked_ms"]) for r in rows], default=0.0)
-        return {"blocking": rows, "max_wait_ms": max_wait}
+TABLE_BLOAT_SQL = """
+SELECT
+  schemaname, relname,
+  n_live_tup, n_dead_tup,
+  CASE WHEN (n_live_tup + n_dead_tup) = 0 THEN 0
+       ELSE round(100.0 * n_dead_tup / (n_live_tup + n_dead_tup), 2)
+  END AS dead_ratio
+FROM pg_stat_user_tables
+ORDER BY dead_ratio DESC
+LIMIT 20
+"""
 
-    def get_deadlocks_delta(self) -> int:
-        """采集死锁增量"""
-        sql = "SELECT COALESCE(SUM(deadlocks),0)::bigint AS deadlocks FROM pg_stat_database"
-        row = self.db.execute_one(sql) or {"deadlocks": 0}
-        total = int(row["deadlocks"])
-        last = int(self.prev_state.get("deadlocks_total", 0))
-        self.prev_state["deadlocks_total"] = total
-        return max(0, total - last)
+# 全量容量刷新按对象自适应安排:fresh_* 列表中的对象本周期不调用 *_size()(返回 NULL,使用估算值)
+DATABASE_SIZE_SQL = """
+SELECT datname,
+       CASE WHEN datname::text = ANY(%(fresh_databases)s) THEN NULL
+            ELSE pg_database_size(datname) END AS size_bytes
+FROM pg_database
+WHERE datname NOT IN ('template0','template1')
+"""
 
-    def get_slow_queries(self, threshold_ms: int, excludes: List[str]) -> List[Dict[str, Any]]:
-        """采集慢查询列表"""
-        sql = """
-        SELECT
-          pid, usename, datname,
-          EXTRACT(EPOCH FROM (now() - query_start)) * 1000 AS runtime_ms,
-          substring(query, 1, 400) AS query
-        FROM pg_stat_activity
-        WHERE state = 'active'
-          AND query NOT LIKE '%pg_stat_activity%'
-          AND now() - query_start > (make_interval(secs => %s/1000.0))
-        ORDER BY query_start ASC
-        LIMIT 50
-        """
-        rows = self.db.execute(sql, (threshold_ms,))
-        filtered = []
-        for r in rows:
-            q = r.get("query", "") or ""
-            if any(pat in q for pat in excludes):
+TABLESPACE_SIZE_SQL = """
+SELECT spcname,
+       CASE WHEN spcname::text = ANY(%(fresh_tablespaces)s) THEN NULL
+            ELSE pg_tablespace_size(oid) END AS size_bytes
+FROM pg_tablespace
+"""
+
+# 当前库按 pg_class.relpages 估算的占用,只读目录不访问数据文件,用于两次全量刷新之间的估算
+RELPAGES_ESTIMATE_SQL = """
+SELECT current_database()::text AS datname,
+       COALESCE(SUM(relpages), 0)::bigint * current_setting('block_size')::bigint AS bytes
+FROM pg_class
+"""
+
+
+# 同机部署时用于把 /proc/<pid> 的 CPU 与 I/O 归因到会话
+BACKENDS_SQL = """
+SELECT pid, datname::text AS datname, usename::text AS usename, state,
+       EXTRACT(EPOCH FROM backend_start) AS backend_start,
+       substring(query, 1, 200) AS query
+FROM pg_stat_activity
+WHERE backend_type = 'client backend'
+  AND pid <> pg_backend_pid()
+"""
+
+
+# 复制位置与各备库/复制槽的字节差:主库以当前写入位置为基准,备库以已接收位置为基准;
+# 复制槽的 wal_status/safe_wal_size 只在 PG13+ 存在,经 to_jsonb 读取以兼容旧版本
+REPLICATION_SQL = """
+WITH pos AS (
+  SELECT pg_is_in_recovery() AS standby,
+         CASE WHEN pg_is_in_recovery()
+              THEN COALESCE(pg_last_wal_receive_lsn(), pg_last_wal_replay_lsn())
+              ELSE pg_current_wal_lsn() END AS lsn
+)
+SELECT
+  pos.standby,
+  pg_wal_lsn_diff(pos.lsn, '0/0')::float8 AS wal_lsn_bytes,
+  CASE WHEN pos.standby
+    THEN COALESCE(GREATEST(0, EXTRACT(EPOCH FROM (now() - pg_last_xact_replay_timestamp()))), 0)
+    ELSE (SELECT COALESCE(MAX(GREATEST(
+            COALESCE(EXTRACT(EPOCH FROM write_lag),0),
+            COALESCE(EXTRACT(EPOCH FROM flush_lag),0),
+            COALESCE(EXTRACT(EPOCH FROM replay_lag),0))),0)
+          FROM pg_stat_replication)
+  END::float8 AS lag_s,
+  CASE WHEN pos.standby THEN pg_wal_lsn_diff(pos.lsn, pg_last_wal_replay_lsn())::float8 END AS local_replay_lag_bytes,
+  (SELECT COALESCE(json_agg(r), '[]'::json) FROM (
+     SELECT COALESCE(application_name, '')::text AS name, COALESCE(host(client_addr), 'local') AS client, state::text AS state,
+            pg_wal_lsn_diff(pos.lsn, sent_lsn)::float8 AS sent_lag_bytes,
+            pg_wal_lsn_diff(pos.lsn, write_lsn)::float8 AS write_lag_bytes,
+            pg_wal_lsn_diff(pos.lsn, flush_lsn)::float8 AS flush_lag_bytes,
+            pg_wal_lsn_diff(pos.lsn, replay_lsn)::float8 AS replay_lag_bytes,
+            pg_wal_lsn_diff(replay_lsn, '0/0')::float8 AS replay_lsn_bytes,
+            EXTRACT(EPOCH FROM replay_lag)::float8 AS replay_lag_s
+     FROM pg_stat_replication) r) AS standbys,
+  (SELECT COALESCE(json_agg(r), '[]'::json) FROM (
+     SELECT slot_name::text AS slot_name, slot_type, COALESCE(database::text, '') AS database, active,
+            COALESCE(to_jsonb(s) ->> 'wal_status', '') AS wal_status,
+            (to_jsonb(s) ->> 'safe_wal_size')::float8 AS safe_wal_size,
+            pg_wal_lsn_diff(pos.lsn, restart_lsn)::float8 AS retained_bytes,
+            pg_wal_lsn_diff(pos.lsn, confirmed_flush_lsn)::float8 AS confirmed_lag_bytes
+     FROM pg_replication_slots s) r) AS slots
+FROM pos
+"""
+
+
+# 冻结年龄、vacuum 进度与 xmin 视界持有者:会话(长事务/长快照)、复制槽、预备事务与开启 hot_standby_feedback 的备库;
+# next_xid 取快照上界(不分配新的事务号),用于计算事务号消耗速率
+# 会话只有已分配事务号或处于空闲事务时才从事务开始持有同一 xmin,其余(如读已提交的长事务,每条语句推进 backend_xmin)不返回 since
+VACUUM_SQL = """
+SELECT
+  txid_snapshot_xmax(txid_current_snapshot())::float8 AS next_xid,
+  (SELECT COALESCE(json_agg(d), '[]'::json) FROM (
+     SELECT datname::text AS datname, age(datfrozenxid)::bigint AS xid_age, mxid_age(datminmxid)::bigint AS mxid_age
+     FROM pg_database
+     WHERE datallowconn) d) AS databases,
+  (SELECT COALESCE(json_agg(v), '[]'::json) FROM (
+     SELECT p.pid, p.datname::text AS datname, p.relid::regclass::text AS relname, p.phase,
+            p.heap_blks_total::float8 AS heap_blks_total, p.heap_blks_scanned::float8 AS heap_blks_scanned,
+            p.heap_blks_vacuumed::float8 AS heap_blks_vacuumed, p.index_vacuum_count::int AS index_vacuum_count,
+            COALESCE(a.backend_type = 'autovacuum worker', false) AS auto,
+            EXTRACT(EPOCH FROM (now() - a.xact_start))::float8 AS running_s
+     FROM pg_stat_progress_vacuum p
+     LEFT JOIN pg_stat_activity a ON a.pid = p.pid) v) AS vacuums,
+  (SELECT COALESCE(json_agg(h), '[]'::json) FROM (
+     SELECT 'backend' AS kind, pid::text AS id, COALESCE(datname::text, '') AS datname,
+            COALESCE(backend_xmin, backend_xid)::text AS xmin, age(COALESCE(backend_xmin, backend_xid))::bigint AS xmin_age,
+            CASE WHEN backend_xid IS NOT NULL OR state LIKE 'idle in transaction%%'
+                 THEN EXTRACT(EPOCH FROM xact_start) END::float8 AS since,
+            COALESCE(state, '') || ' ' || COALESCE(usename::text, '') || ' ' || substring(COALESCE(query, ''), 1, 200) AS detail
+     FROM pg_stat_activity
+     WHERE COALESCE(backend_xmin, backend_xid) IS NOT NULL AND pid <> pg_backend_pid()
+     UNION ALL
+     SELECT 'slot', slot_name::text, COALESCE(database::text, ''), x::text, age(x)::bigint, NULL::float8,
+            slot_type || CASE WHEN active THEN '' ELSE ' inactive' END
+     FROM pg_replication_slots,
+          LATERAL (SELECT CASE WHEN catalog_xmin IS NULL OR (xmin IS NOT NULL AND age(xmin) >= age(catalog_xmin))
+                               THEN xmin ELSE catalog_xmin END AS x) s
+     WHERE x IS NOT NULL
+     UNION ALL
+     SELECT 'prepared', gid, database::text, transaction::text, age(transaction)::bigint,
+            EXTRACT(EPOCH FROM prepared)::float8, owner::text
+     FROM pg_prepared_xacts
+     UNION ALL
+     SELECT 'standby', COALESCE(application_name, '')::text, '', backend_xmin::text, age(backend_xmin)::bigint, NULL::float8,
+            COALESCE(host(client_addr), 'local')
+     FROM pg_stat_replication
+     WHERE backend_xmin IS NOT NULL
+     ORDER BY 5 DESC
+     LIMIT 20) h) AS holders
+"""
+
+
+def _json_rows(sql: str) -> str:
+    """把返回多行的查询包装为单列 JSON 数组子查询"""
+    return "(SELECT COALESCE(json_agg(t), '[]'::json) FROM ({}) t)".format(sql.strip())
+
+
+# 快照片段: 字段名 -> 标量子查询;一个周期内所有片段合并为一条 SELECT 一次往返取回
+SNAPSHOT_FRAGMENTS: Dict[str, str] = {
+    "connections": "(SELECT row_to_json(c) FROM ({}) c)".format(CONNECTION_COUNTS_SQL.strip()),
+    "locks": _json_rows(LOCK_WAITS_SQL),
+    "deadlocks_total": "(SELECT COALESCE(SUM(deadlocks),0)::bigint FROM pg_stat_database)",
+    "temp_bytes_total": "(SELECT COALESCE(SUM(temp_bytes),0)::bigint FROM pg_stat_database)",
+    "cpu_ms_total": "(SELECT COALESCE(SUM(user_time + system_time),0)::bigint FROM pg_stat_kcache)",
+    "postmaster_start_time": "EXTRACT(EPOCH FROM pg_postmaster_start_time())",
+    "slow_queries": _json_rows(SLOW_QUERIES_SQL),
+    "table_bloat": _json_rows(TABLE_BLOAT_SQL),
+    "replication": "(SELECT row_to_json(r) FROM ({}) r)".format(REPLICATION_SQL.strip()),
+    "vacuum": "(SELECT row_to_json(v) FROM ({}) v)".format(VACUUM_SQL.strip()),
+    "databases": _json_rows(DATABASE_SIZE_SQL),
+    "tablespaces": _json_rows(TABLESPACE_SIZE_SQL),
+    "relpages_estimate": "(SELECT row_to_json(r) FROM ({}) r)".format(RELPAGES_ESTIMATE_SQL.strip()),
+    "backends": _json_rows(BACKENDS_SQL),
+}
+
+
+def analyze_lock_waits(rows: List[Dict[str, Any]], limit: int = 20) -> Dict[str, Any]:
+    """分析锁等待图(等待者 -> pg_blocking_pids):根阻塞者、等待链深度、环路及每个根阻塞者身后的等待会话数"""
+    sessions = {int(r["pid"]): r for r in rows}
+    blockers: Dict[int, List[int]] = {}
+    waiters: Dict[int, List[int]] = {}
+    for pid, r in sessions.items():
+        # pid 0 表示持锁的预备事务(PREPARE TRANSACTION),作为普通节点参与分析
+        out = list(dict.fromkeys(int(b) for b in (r.get("blocked_by") or [])))
+        if not out:
+            continue
+        blockers[pid] = out
+        for b in out:
+            waiters.setdefault(b, []).append(pid)
+
+    # Tarjan 强连通分量(迭代实现);阻塞者所在分量总是先于等待者输出
+    index: Dict[int, int] = {}
+    low: Dict[int, int] = {}
+    on_stack = set()
+    stack: List[int] = []
+    sccs: List[List[int]] = []
+    for start in blockers:
+        if start in index:
+            continue
+        index[start] = low[start] = len(index)
+        stack.append(start)
+        on_stack.add(start)
+        work = [(start, 0)]
+        while work:
+            v, i = work[-1]
+            out = blockers.get(v, [])
+            if i < len(out):
+                work[-1] = (v, i + 1)
+                w = out[i]
+                if w not in index:
+                    index[w] = low[w] = len(index)
+                    stack.append(w)
+                    on_stack.add(w)
+                    work.append((w, 0))
+                elif w in on_stack:
+                    low[v] = min(low[v], index[w])
                 continue
-            filtered.append(r)
-        return filtered
+            work.pop()
+            if work:
+                u = work[-1][0]
+                low[u] = min(low[u], low[v])
+            if low[v] == index[v]:
+                comp = []
+                while True:
+                    w = stack.pop()
+                    on_stack.discard(w)
+                    comp.append(w)
+                    if w == v:
+                        break
+                sccs.append(comp)
 
-    def get_cpu_time_delta_ms(self) -> float:
-        """采集 CPU 时间增量(ms)"""
-        if not self.cfg["options"].get("use_pg_stat_kcache"):
-            return 0.0
-        if not self._ext_installed("pg_stat_kcache"):
-            return 0.0
-        row = self.db.execute_one("SELECT COALESCE(SUM(user_time + system_time),0)::bigint AS cpu_ms FROM pg_stat_kcache")
-        total = float(row["cpu_ms"]) if row else 0.0
-        last = float(self.prev_state.get("cpu_ms_total", 0.0))
-        self.prev_state["cpu_ms_total"] = total
-        return max(0.0, total - last)
+    depth: Dict[int, int] = {}
+    comp_of: Dict[int, int] = {}
+    cycles: List[List[int]] = []
+    for cid, comp in enumerate(sccs):
+        for p in comp:
+            comp_of[p] = cid
+        cyclic = len(comp) > 1 or comp[0] in blockers.get(comp[0], [])
+        d = 1 if cyclic else 0
+        for p in comp:
+            for b in blockers.get(p, []):
+                if comp_of[b] != cid:
+                    d = max(d, depth[b] + 1)
+        for p in comp:
+            depth[p] = d
+        if cyclic:
+            cycles.append(sorted(comp))
 
-    def get_memory_pressure_delta_bytes(self) -> int:
-        """采集临时文件字节增量以评估内存压力"""
-        row = self.db.execute_one("SELECT COALESCE(SUM(temp_bytes),0)::bigint AS temp_bytes FROM pg_stat_database")
-        total = int(row["temp_bytes"]) if row else 0
-        last = int(self.prev_state.get("temp_bytes_total", 0))
-        self.prev_state["temp_bytes_total"] = total
-        return max(0, total - last)
+    def wait_ms(pid: int) -> float:
+        return float(sessions[pid].get("wait_ms") or 0.0) if pid in sessions else 0.0
 
-    def get_shared_buffers_bytes(self) -> int:
-        """获取 shared_buffers 配置值(字节)"""
-        row = self.db.execute_one("SELECT setting, unit FROM pg_settings WHERE name='shared_buffers'")
-        if not row:
-            return 0
-        setting = int(row["setting"])
-        unit = str(row.get("unit") or "").lower()
-        if unit == "8kB":
-            return setting * 8 * 1024
-        if unit.endswith("kB"):
-            return setting * 1024
-        if unit.endswith("MB"):
-            return setting * 1024 * 1024
-        if unit.endswith("GB"):
-            return setting * 1024 * 1024 * 1024
-        return setting
+    roots = []
+    for root in waiters:
+        if root in blockers:
+            continue
+        seen = {root}
+        queue_ = [root]
+        for p in queue_:
+            for w in waiters.get(p, []):
+                if w not in seen:
+                    seen.add(w)
+                    queue_.append(w)
+        seen.discard(root)
+        info = sessions.get(root, {})
+        roots.append({
+            "pid": root,
+            "blocked_count": len(seen),
+            "direct_count": len(waiters[root]),
+            "max_depth": max(depth[p] for p in seen),
+            "max_wait_ms": max(wait_ms(p) for p in seen),
+            "state": "prepared transaction" if root == 0 else info.get("state") or "",
+            "xact_age_s": float(info.get("xact_age_s") or 0.0),
+            "usename": info.get("usename") or "",
+            "query": info.get("query") or "",
+        })
+    roots.sort(key=lambda r: (r["blocked_count"], r["max_wait_ms"]), reverse=True)
+    waits = [{
+        "blocked_pid": pid,
+        "blocking_pids": out,
+        "blocked_ms": wait_ms(pid),
+        "depth": depth[pid],
+        "blocked_query": sessions[pid].get("query") or "",
+    } for pid, out in blockers.items()]
+    waits.sort(key=lambda w: w["blocked_ms"], reverse=True)
+    return {
+        "blocking": waits[:limit],
+        "roots": roots[:limit],
+        "root_total": len(roots),
+        "cycles": cycles,
+        "blocked_total": len(blockers),
+        "max_depth": max(depth.values(), default=0),
+        "max_wait_ms": max((w["blocked_ms"] for w in waits), default=0.0),
+    }
 
-    def get_bloat(self) -> Dict[str, Any]:
-        """采集表/索引膨胀估计"""
-        if not self.cfg["options"].get("collect_bloat"):
-            return {"table": [], "index": [], "max_pct": 0.0}
-        rows = self.db.execute("""
-        SELECT
-          schemaname, relname,
-          n_live_tup, n_dead_tup,
-          CASE WHEN (n_live_tup + n_dead_tup) = 0 THEN 0
-               ELSE round(100.0 * n_dead_tup / (n_live_tup + n_dead_tup), 2)
-          END AS dead_ratio
-        FROM pg_stat_user_tables
-        ORDER BY dead_ratio DESC
-        LIMIT 20
-        """)
-        max_pct = max([float(r["dead_ratio"]) for r in rows], default=0.0)
-        idx_rows: List[Dict[str, Any]] = []
-        if self._ext_installed("pgstattuple"):
-            try:
-                idx_rows = self.db.execute("""
-                SELECT
-                  schemaname, relname, indexrelname,
-                  round(100.0 * (pgstattuple_approx(indexrelid)).approximate_bloat_ratio, 2) AS bloat_pct
-                FROM pg_stat_user_indexes
-                ORDER BY bloat_pct DESC
-                LIMIT 20
-                """)
-                max_pct = max(max_pct, max([float(r["bloat_pct"]) for r in idx_rows], default=0.0))
-            except Exception:
-                pass
-        return {"table": rows, "index": idx_rows, "max_pct": max_pct}
 
-    def get_replication_lag(self) -> float:
-        """采集复制延迟(秒)"""
-        if not self.cfg["options"].get("enable_replication_check"):
-            return 0.0
-        row = self.db.execute_one("SELECT pg_is_in_recovery() AS standby")
-        standby = bool(row and row.get("standby"))
-        if standby:
-            r = self.db.execute_one(
-                "SELECT GREATEST(0, EXTRACT(EPOCH FROM (now() - pg_last_xact_replay_timestamp()))) AS lag_s"
-            )
-            return float(r["lag_s"]) if r else 0.0
-        rows = self.db.execute("""
-        SELECT
-          COALESCE(EXTRACT(EPOCH FROM write_lag),0) AS write_lag_s,
-          COALESCE(EXTRACT(EPOCH FROM flush_lag),0) AS flush_lag_s,
-          COALESCE(EXTRACT(EPOCH FROM replay_lag),0) AS replay_lag_s
-        FROM pg_stat_replication
-        """)
-        vals = []
-        for r in rows:
-            for k in ["write_lag_s", "flush_lag_s", "replay_lag_s"]:
-                try:
-                    vals.append(float(r.get(k) or 0.0))
-                except Exception:
-                    pass
-        return max(vals) if vals else 0.0
+class MetadataCache:
+    """目录/配置元数据缓存:条目带 TTL,连接重建或 postmaster 重启后整体失效"""
+    def __init__(self, ttl_seconds: float = 3600.0) -> None:
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries: Dict[str, Tuple[float, Any]] = {}
+        self._generation: Optional[int] = None
+        self._postmaster_start: Optional[float] = None
+        # 采集项与后台采样线程并发读取;同一键同时缺失时只加载一次
+        self._lock = threading.Lock()
+        self._loading: Dict[str, threading.Lock] = {}
 
-    def get_disk_usage(self) -> Dict[str, Any]:
-        """采集数据库与表空间占用"""
-        db_rows = self.db.execute("""
-        SELECT datname, pg_database_size(datname) AS size_bytes
-        FROM pg_database
-        WHERE datname NOT IN ('template0','template1')
-        """)
-        ts_rows = self.db.execute("""
-        SELECT spcname, pg_tablespace_size(oid) AS size_bytes
-        FROM pg_tablespace
-        """)
-        db_total = sum([int(r["size_bytes"]) for r in db_rows]) if db_rows else 0
-        ts_max = max([int(r["size_bytes"]) for r in ts_rows], default=0)
-        return {"databases": db_rows, "tablespaces": ts_rows, "db_total_bytes": db_total, "ts_max_bytes": ts_max}
+    def _cached(self, key: str) -> Tuple[bool, Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl_seconds:
+                self.hits += 1
+                return True, entry[1]
+            return False, self._loading.setdefault(key, threading.Lock())
 
-    def build_message(self, metric: str, value: Any, threshold: Any, severity: str, details: str, action: str) -> str:
-        """构建告警消息文本"""
-        title = self.cfg["templates"]["title"].format(severity=severity, metric=metric)
-        body = self.cfg["templates"]["body"].format(
-            timestamp=now_ts(),
-            metric=metric,
-            value=value,
-            threshold=threshold,
-            severity=severity,
-            details=details,
-            action=action,
-        )
-        return "{}\n{}".format(title, body)
+    def get(self, key: str, loader: Callable[[], Any]) -> Any:
+        """读取缓存,缺失或过期时调用 loader 加载"""
+        found, value = self._cached(key)
+        if found:
+            return value
+        with value:
+            found, value = self._cached(key)
+            if found:
+                return value
+            with self._lock:
+                self.misses += 1
+            value = loader()
+            with self._lock:
+                self._entries[key] = (time.monotonic(), value)
+            return value
+
+    def validate(self, generation: int, postmaster_start: Optional[float] = None) -> None:
+        """连接代次或 postmaster 启动时间变化时清空缓存"""
+        changed = self._generation is not None and generation != self._generation
+        if postmaster_start is not None:
+            changed = changed or (self._postmaster_start is not None and postmaster_start != self._postmaster_start)
+            self._postmaster_start = postmaster_start
+        self._generation = generation
+        if changed:
+            self.invalidate()
+
+    def invalidate(self) -> None:
+        """清空全部缓存条目"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        """返回命中/未命中计数与条目数"""
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
 
-    def evaluate_and_alert(self) -> None:
-        """评估各项指标并发送告警"""
-        counts = self.get_connection_counts()
-        locks = self.get_lock_contention()
-        deadlocks_delta = self.get_deadlocks_delta()
-        cpu_delta_ms = self.get_cpu_time_delta_ms()
-        mem_temp_delta = self.get_memory_pressure_delta_bytes()
-        shared_buffers_bytes = self.get_shared_buffers_bytes()
-        slow_queries = self.get_slow_queries(
-            int(self.cfg["thresholds"].get("slow_query_ms", {}).get("warning", 5000)),
-            self.cfg.get("slow_query_exclude_patterns", []),
+
+# 需要跨重启保存上次值以计算增量的累计计数器
+COUNTER_METRICS = ("deadlocks_total", "cpu_ms_total", "temp_bytes_total")
+
+
+class MetricStore:
+    """本地追加式时序存储(SQLite WAL):原始点按保留期降采样为小时桶,过期桶删除"""
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS series (
+      id INTEGER PRIMARY KEY,
+      instance TEXT NOT NULL,
+      metric TEXT NOT NULL,
+      UNIQUE (instance, metric)
+    );
+    CREATE TABLE IF NOT EXISTS samples (
+      series_id INTEGER NOT NULL,
+      ts INTEGER NOT NULL,
+      value REAL NOT NULL,
+      PRIMARY KEY (series_id, ts)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS rollups (
+      series_id INTEGER NOT NULL,
+      bucket INTEGER NOT NULL,
+      count INTEGER NOT NULL,
+      sum REAL NOT NULL,
+      min REAL NOT NULL,
+      max REAL NOT NULL,
+      last REAL NOT NULL,
+      PRIMARY KEY (series_id, bucket)
+    ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path: str, raw_retention_hours: float = 48, rollup_seconds: int = 3600,
+                 rollup_retention_days: float = 90, compact_interval_seconds: float = 3600) -> None:
+        self.path = path
+        self.raw_retention_seconds = int(raw_retention_hours * 3600)
+        self.rollup_seconds = max(1, int(rollup_seconds))
+        self.rollup_retention_seconds = int(rollup_retention_days * 86400)
+        self.compact_interval_seconds = compact_interval_seconds
+        self._series: Dict[Tuple[str, str], int] = {}
+        self._lock = threading.Lock()
+        self._last_compact = 0.0
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # auto_vacuum 只能在建表前设置;incremental 模式下压缩后归还空闲页
+        self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+
+    @classmethod
+    def from_config(cls, cfg: Dict[str, Any]) -> Optional["MetricStore"]:
+        """按 store 配置段构建,未启用时返回 None"""
+        sc = cfg.get("store", {})
+        if not sc.get("enabled", False):
+            return None
+        return cls(
+            sc.get("path") or os.path.join(cfg.get("state_dir", "/var/lib/monitor_pg"), "metrics.db"),
+            raw_retention_hours=float(sc.get("raw_retention_hours", 48)),
+            rollup_seconds=int(sc.get("rollup_seconds", 3600)),
+            rollup_retention_days=float(sc.get("rollup_retention_days", 90)),
+            compact_interval_seconds=float(sc.get("compact_interval_seconds", 3600)),
         )
-        bloat = self.get_bloat()
-        repl_lag = self.get_replication_lag()
-        disk = self.get_disk_usage()
 
-        t = self.cfg["thresholds"]
-        try:
-            sev = severity_of(counts["total"], t.get("connections_total", {}))
-            if sev:
-                details = "total={} active={} idle={}".format(counts["total"], counts["active"], counts["idle"])
-                msg = self.build_message("连接总数", counts["total"], t.get("connections_total", {}), sev, details, "启用连接池或减少长连接")
-                self.sender.safe_send(msg)
-            sev = severity_of(counts["active"], t.get("connections_active", {}))
-            if sev:
-                details = "active={} idle={}".format(counts["active"], counts["idle"])
-                msg = self.build_message("活跃连接", counts["active"], t.get("connections_active", {}), sev, details, "排查慢查询与热点锁等待")
-                self.sender.safe_send(msg)
-            sev = severity_of(locks["max_wait_ms"], t.get("lock_wait_ms", {}))
-            if sev:
-                detail_query = locks["blocking"][0]["blocked_query"] if locks["blocking"] else ""
-                msg = self.build_message("锁等待", int(locks["max_wait_ms"]), t.get("lock_wait_ms", {}), sev, detail_query, "定位阻塞会话并优化或终止")
-                self.sender.safe_send(msg)
-            sev = severity_of(float(deadlocks_delta), t.get("deadlocks", {}))
-            if sev:
-                msg = self.build_message("死锁次数(增量)", deadlocks_delta, t.get("deadlocks", {}), sev, "最近周期发生死锁", "检查并优化并发事务顺序")
-                self.sender.safe_send(msg)
-            sev = severity_of(float(len(slow_queries)), t.get("slow_query_count", {}))
-            if sev and slow_queries:
-                q = slow_queries[0]
-                detail = "[{}] {}ms {}".format(q.get("datname", ""), int(q["runtime_ms"]), q["query"])
-                msg = self.build_message("慢查询数量", len(slow_queries), t.get("slow_query_count", {}), sev, detail, "为慢查询添加索引或重写SQL")
-                self.sender.safe_send(msg)
-            sev = severity_of(bloat["max_pct"], t.get("bloat_pct", {}))
-            if sev:
-                msg = self.build_message("膨胀比例(最大)", bloat["max_pct"], t.get("bloat_pct", {}), sev, "建议对高膨胀表执行 VACUUM/重建索引", "规划维护窗口执行整理")
-                self.sender.safe_send(msg)
-            sev = severity_of(repl_lag, t.get("replication_lag_sec", {}))
-            if sev:
-                msg = self.build_message("复制延迟(秒)", int(repl_lag), t.get("replication_lag_sec", {}), sev, "主备延迟升高", "检查网络/磁盘性能与WAL生成速率")
-                self.sender.safe_send(msg)
-            sev = severity_of(float(disk["db_total_bytes"]), t.get("disk_usage_database_bytes", {}))
-            if sev:
-                msg = self.build_message("数据库总占用(字节)", disk["db_total_bytes"], t.get("disk_usage_database_bytes", {}), sev, "数据库体量增长较快", "考虑分区归档或扩容存储")
-                self.sender.safe_send(msg)
-            sev = severity_of(float(disk["ts_max_bytes"]), t.get("disk_usage_tablespace_bytes", {}))
-            if sev:
-                msg = self.build_message("表空间占用最大(字节)", disk["ts_max_bytes"], t.get("disk_usage_tablespace_bytes", {}), sev, "单表空间压力较大", "扩容或迁移热数据到新表空间")
-                self.sender.safe_send(msg)
-            sev = severity_of(float(cpu_delta_ms), t.get("cpu_time_delta_ms", {}))
-            if sev and cpu_delta_ms > 0:
-                msg = self.build_message("CPU时间增量(ms)", int(cpu_delta_ms), t.get("cpu_time_delta_ms", {}), sev, "周期 CPU 累计时间较高", "优化高 CPU 消耗查询或增加并行度")
-                self.sender.safe_send(msg)
-            sev = severity_of(float(mem_temp_delta), t.get("work_mem_pressure_bytes", {}))
-            if sev and mem_temp_delta > 0:
-                msg = self.build_message("临时文件增量(字节)", int(mem_temp_delta), t.get("work_mem_pressure_bytes", {}), sev, "排序/哈希溢出到磁盘", "增大 work_mem 或优化查询管道")
-                self.sender.safe_send(msg)
-        except Exception as e:
-            self.logger.error("评估告警失败: %s", str(e))
+    def close(self) -> None:
+        """关闭存储"""
+        with self._lock:
+            self.conn.close()
 
-        self.prev_state["shared_buffers_bytes"] = shared_buffers_bytes
+    def _series_id(self, instance: str, metric: str, create: bool = True) -> Optional[int]:
+        """返回序列 id,必要时登记新序列(调用方持锁)"""
+        key = (instance, metric)
+        sid = self._series.get(key)
+        if sid is None:
+            row = self.conn.execute("SELECT id FROM series WHERE instance=? AND metric=?", key).fetchone()
+            if row is None:
+                if not create:
+                    return None
+                sid = self.conn.execute("INSERT INTO series (instance, metric) VALUES (?, ?)", key).lastrowid
+            else:
+                sid = row[0]
+            self._series[key] = sid
+        return sid
 
-    def run(self, once: bool = False) -> None:
-        """运行监控循环"""
-        interval = int(self.cfg.get("interval_seconds", 300))
-        while True:
-            start = time.time()
+    def append(self, instance: str, values: Dict[str, float], ts: Optional[float] = None) -> None:
+        """追加一个时间点的多个指标值"""
+        ts = int(time.time() if ts is None else ts)
+        with self._lock:
+            rows = [(self._series_id(instance, m), ts, float(v)) for m, v in values.items() if v is not None]
+            self.conn.execute("BEGIN")
             try:
-                self.evaluate_and_alert()
-            except Exception as e:
-                self.logger.error("监控执行异常: %s\n%s", str(e), traceback.format_exc())
-            dur = time.time() - start
-            self.logger.info("采集周期完成,耗时 %.2fs", dur)
-            if once:
-                break
-            sleep_left = max(1.0, interval - dur)
-            time.sleep(sleep_left)
+                self.conn.executemany("INSERT OR REPLACE INTO samples (series_id, ts, value) VALUES (?, ?, ?)", rows)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        if ts - self._last_compact >= self.compact_interval_seconds:
+            self.compact(ts)
 
+    def latest(self, instance: str, metric: str) -> Optional[Tuple[float, float]]:
+        """返回序列最新的 (ts, value),优先原始点,其次降采样桶"""
+        with self._lock:
+            sid = self._series_id(instance, metric, create=False)
+            if sid is None:
+                return None
+            row = self.conn.execute(
+                "SELECT ts, value FROM samples WHERE series_id=? ORDER BY ts DESC LIMIT 1", (sid,)).fetchone()
+            if row is None:
+                row = self.conn.execute(
+                    "SELECT bucket, last FROM rollups WHERE series_id=? ORDER BY bucket DESC LIMIT 1", (sid,)).fetchone()
+        return (float(row[0]), float(row[1])) if row else None
 
-def main(argv: List[str]) -> int:
-    """主函数入口"""
-    import argparse
+    def query_range(self, instance: str, metric: str, start: float, end: float) -> List[Tuple[float, float]]:
+        """查询时间窗口内的点:已降采样部分返回桶起点与均值,其余为原始点"""
+        with self._lock:
+            sid = self._series_id(instance, metric, create=False)
+            if sid is None:
+                return []
+            rolled = self.conn.execute(
+                "SELECT bucket, sum / count FROM rollups WHERE series_id=? AND bucket >= ? AND bucket <= ? ORDER BY bucket",
+                (sid, int(start) - int(start) % self.rollup_seconds, int(end))).fetchall()
+            raw = self.conn.execute(
+                "SELECT ts, value FROM samples WHERE series_id=? AND ts >= ? AND ts <= ? ORDER BY ts",
+                (sid, int(start), int(end))).fetchall()
+        return [(float(t), float(v)) for t, v in rolled + raw]
+
+    def compact(self, now: Optional[float] = None) -> None:
+        """把超出原始保留期的点合并进降采样桶,删除超出保留期的桶"""
+        now = int(time.time() if now is None else now)
+        cutoff = now - self.raw_retention_seconds
+        cutoff -= cutoff % self.rollup_seconds
+        with self._lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.execute("""
+                INSERT INTO rollups (series_id, bucket, count, sum, min, max, last)
+                SELECT series_id, ts - ts % :step AS bucket, COUNT(*), SUM(value), MIN(value), MAX(value),
+                       (SELECT s2.value FROM samples s2 WHERE s2.series_id = s.series_id
+                          AND s2.ts >= s.ts - s.ts % :step AND s2.ts < s.ts - s.ts % :step + :step
+                          AND s2.ts < :cutoff
+                        ORDER BY s2.ts DESC LIMIT 1)
+                FROM samples s WHERE ts < :cutoff
+                GROUP BY series_id, bucket
+                ON CONFLICT (series_id, bucket) DO UPDATE SET
+                  count = count + excluded.count,
+                  sum = sum + excluded.sum,
+                  min = MIN(min, excluded.min),
+                  max = MAX(max, excluded.max),
+                  last = excluded.last
+                """, {"step": self.rollup_seconds, "cutoff": cutoff})
+                self.conn.execute("DELETE FROM samples WHERE ts < ?", (cutoff,))
+                self.conn.execute("DELETE FROM rollups WHERE bucket < ?", (now - self.rollup_retention_seconds,))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("PRAGMA incremental_vacuum")
+            self._last_compact = now
+
+
+class MetricFamily(NamedTuple):
+    """Prometheus 指标族:名称、类型、说明与 (标签, 值) 样本"""
+    name: str
+    type: str
+    help: str
+    samples: List[Tuple[Dict[str, str], float]]
+
+
+# 阈值名与对应的标量指标名不一致时的映射,未列出的同名
+THRESHOLD_SERIES = {
+    "lock_wait_ms": "lock_max_wait_ms",
+    "deadlocks": "deadlocks_delta",
+    "bloat_pct": "bloat_max_pct",
+    "replication_lag_sec": "replication_lag_s",
+    "replication_slot_retained_bytes": "replication_slot_retained_bytes_max",
+    "disk_usage_database_bytes": "disk_db_total_bytes",
+    "disk_usage_tablespace_bytes": "disk_ts_max_bytes",
+    "work_mem_pressure_bytes": "temp_bytes_delta",
+    "wait_event_aas": "wait_top_event_aas",
+    "log_slow_p95_ms": "log_slow_p95_ms_max",
+    "xmin_holder_seconds": "xmin_holder_max_s",
+    "vacuum_eta_seconds": "vacuum_eta_max_s",
+}
+
+
+def hour_of_week(ts: float) -> int:
+    """本地时间的周内小时序号(周一 0 点为 0)"""
+    t = time.localtime(ts)
+    return t.tm_wday * 24 + t.tm_hour
+
+
+class BaselineEngine:
+    """流式基线:每条序列在定长数组中占固定槽位,包括全局 EWMA 均值/方差、按周内小时分桶的季节性 EWMA
+    和前向衰减的对数分桶分位数草图;内存只与序列数有关,update 一遍循环更新全部序列"""
+    SEASONS = 168
+
+    def __init__(self, series: Iterable[str], halflife_seconds: float = 3600, seasonal_halflife_weeks: float = 4,
+                 sketch_halflife_seconds: float = 7 * 86400, max_gap_seconds: float = 300, min_samples: int = 30,
+                 sketch_min: float = 0.01, sketch_growth: float = 1.2, sketch_buckets: int = 216) -> None:
+        self.names = list(dict.fromkeys(series))
+        self._index = {name: i for i, name in enumerate(self.names)}
+        self.halflife_seconds = halflife_seconds
+        # 季节桶每周只覆盖一小时,半衰期按该桶内累计经过的时间计
+        self.seasonal_halflife_seconds = seasonal_halflife_weeks * 3600.0
+        self.sketch_halflife_seconds = sketch_halflife_seconds
+        self.max_gap_seconds = max_gap_seconds
+        self.min_samples = min_samples
+        self.sketch_min = sketch_min
+        self.sketch_growth = sketch_growth
+        self.sketch_buckets = sketch_buckets
+        self._log_growth = math.log(sketch_growth)
+        n = len(self.names)
+        self._mean = array("d", bytes(8 * n))
+        self._var = array("d", bytes(8 * n))
+        self._count = array("d", bytes(8 * n))
+        self._last_ts = array("d", bytes(8 * n))
+        self._s_mean = array("d", bytes(8 * n * self.SEASONS))
+        self._s_var = array("d", bytes(8 * n * self.SEASONS))
+        self._s_count = array("d", bytes(8 * n * self.SEASONS))
+        self._sketch = array("d", bytes(8 * n * sketch_buckets))
+        self._sketch_t0 = 0.0
+        self._lock = threading.Lock()
+
+    def _arrays(self) -> List[Tuple[str, array, int]]:
+        """(名称, 数组, 每条序列的槽位数),决定持久化文件中的布局"""
+        return [("mean", self._mean, 1), ("var", self._var, 1), ("count", self._count, 1), ("last_ts", self._last_ts, 1),
+                ("s_mean", self._s_mean, self.SEASONS), ("s_var", self._s_var, self.SEASONS),
+                ("s_count", self._s_count, self.SEASONS), ("sketch", self._sketch, self.sketch_buckets)]
+
+    def _rescale_sketch(self, ts: float) -> None:
+        """前向衰减的权重随时间指数增长,定期把参考时间移到 ts 并整体缩小已有权重"""
+        factor = 2.0 ** (-(ts - self._sketch_t0) / self.sketch_halflife_seconds)
+        sk = self._sketch
+        for k in range(len(sk)):
+            sk[k] *= factor
+        self._sketch_t0 = ts
+
+    def update(self, values: Dict[str, Any], ts: Optional[float] = None) -> int:
+        """把一次采集的标量指标计入基线,返回更新的序列数"""
+        ts = time.time() if ts is None else ts
+        how = hour_of_week(ts)
+        updated = 0
+        with self._lock:
+            if not self._sketch_t0:
+                self._sketch_t0 = ts
+            w = 2.0 ** ((ts - self._sketch_t0) / self.sketch_halflife_seconds)
+            if w > 2.0 ** 20:
+                self._rescale_sketch(ts)
+                w = 1.0
+            mean, var, count, last_ts = self._mean, self._var, self._count, self._last_ts
+            s_mean, s_var, s_count, sketch = self._s_mean, self._s_var, self._s_count, self._sketch
+            index, seasons, buckets = self._index, self.SEASONS, self.sketch_buckets
+            for name, value in values.items():
+                i = index.get(name)
+                if i is None or value is None or ts <= last_ts[i]:
+                    continue
+                x = float(value)
+                # 采集间隔不同的序列按实际经过时间衰减;停机造成的长间隔按 max_gap 计,避免一次性遗忘
+                dt = min(ts - last_ts[i], self.max_gap_seconds) if last_ts[i] else self.max_gap_seconds
+                last_ts[i] = ts
+                c = count[i] + 1
+                count[i] = c
+                a = max(1.0 - 2.0 ** (-dt / self.halflife_seconds), 1.0 / c)
+                d = x - mean[i]
+                mean[i] += a * d
+                var[i] = (1.0 - a) * (var[i] + d * a * d)
+                j = i * seasons + how
+                c = s_count[j] + 1
+                s_count[j] = c
+                a = max(1.0 - 2.0 ** (-dt / self.seasonal_halflife_seconds), 1.0 / c)
+                d = x - s_mean[j]
+                s_mean[j] += a * d
+                s_var[j] = (1.0 - a) * (s_var[j] + d * a * d)
+                if x <= self.sketch_min:
+                    k = 0
+                else:
+                    k = min(buckets - 1, 1 + int(math.log(x / self.sketch_min) / self._log_growth))
+                sketch[i * buckets + k] += w
+                updated += 1
+        return updated
+
+    def _quantiles(self, i: int, qs: Tuple[float, ...]) -> List[float]:
+        """从草图估算分位数,取所在桶的几何中点(调用方持锁)"""
+        b = self.sketch_buckets
+        counts = self._sketch[i * b:(i + 1) * b]
+        total = sum(counts)
+        out = []
+        for q in qs:
+            if total <= 0:
+                out.append(0.0)
+                continue
+            rank, seen = q * total, 0.0
+            for k, c in enumerate(counts):
+                seen += c
+                if seen >= rank:
+                    break
+            out.append(0.0 if k == 0 else self.sketch_min * self.sketch_growth ** (k - 0.5))
+        return out
+
+    def expected(self, name: str, ts: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """返回序列在 ts 所处周内小时的基线;该小时样本不足时退回全局 EWMA,全局也不足时返回 None"""
+        i = self._index.get(name)
+        if i is None:
+            return None
+        j = i * self.SEASONS + hour_of_week(time.time() if ts is None else ts)
+        with self._lock:
+            if self._s_count[j] >= self.min_samples:
+                mean, var, samples, seasonal = self._s_mean[j], self._s_var[j], self._s_count[j], True
+            elif self._count[i] >= self.min_samples:
+                mean, var, samples, seasonal = self._mean[i], self._var[i], self._count[i], False
+            else:
+                return None
+            p50, p99 = self._quantiles(i, (0.5, 0.99))
+        return {"mean": mean, "std": math.sqrt(max(var, 0.0)), "p50": p50, "p99": p99,
+                "samples": int(samples), "seasonal": seasonal}
+
+    def save(self, path: str) -> None:
+        """把全部状态写入 path:一行 JSON 头加各数组的原始字节,先写临时文件再原子替换"""
+        with self._lock:
+            header = {"version": 1, "series": self.names, "seasons": self.SEASONS, "buckets": self.sketch_buckets,
+                      "sketch_min": self.sketch_min, "sketch_growth": self.sketch_growth, "sketch_t0": self._sketch_t0,
+                      "arrays": [name for name, _, _ in self._arrays()]}
+            blobs = [arr.tobytes() for _, arr, _ in self._arrays()]
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(json.dumps(header).encode("utf-8") + b"\n")
+            for blob in blobs:
+                f.write(blob)
+        os.replace(tmp, path)
+
+    def load(self, path: str) -> int:
+        """从 save 写出的文件恢复状态,按序列名对齐(增删序列不影响其余序列),返回恢复的序列数"""
+        with open(path, "rb") as f:
+            header = json.loads(f.readline().decode("utf-8"))
+            data = f.read()
+        if (header.get("version") != 1 or header.get("seasons") != self.SEASONS or header.get("buckets") != self.sketch_buckets
+                or header.get("sketch_min") != self.sketch_min or header.get("sketch_growth") != self.sketch_growth
+                or header.get("arrays") != [name for name, _, _ in self._arrays()]):
+            raise ValueError("基线状态文件格式不匹配")
+        saved = header["series"]
+        n = len(saved)
+        pos = 0
+        restored = [name for name in saved if name in self._index]
+        with self._lock:
+            for _, arr, width in self._arrays():
+                size = 8 * n * width
+                old = array("d")
+                old.frombytes(data[pos:pos + size])
+                pos += size
+                if len(old) != n * width:
+                    raise ValueError("基线状态文件被截断")
+                for j, name in enumerate(saved):
+                    i = self._index.get(name)
+                    if i is not None:
+                        arr[i * width:(i + 1) * width] = old[j * width:(j + 1) * width]
+            self._sketch_t0 = float(header.get("sketch_t0") or 0.0)
+        return len(restored)
+
+
+def baseline_severity(value: float, deviation: Dict[str, Any], base: Dict[str, Any]) -> Optional[str]:
+    """按高于基线均值的标准差倍数计算严重级别;绝对偏离不足 min_delta 时不告警"""
+    delta = float(value) - base["mean"]
+    if delta <= 0 or delta < float(deviation.get("min_delta", 0)):
+        return None
+    # 方差接近 0 的平稳序列用均值的一定比例兜底,避免极小波动放大成很大的倍数
+    sigma = max(base["std"], abs(base["mean"]) * float(deviation.get("min_std_pct", 5)) / 100.0, 1e-9)
+    return severity_of(delta / sigma, deviation)
+
+
+def baseline_families(instance: str, engine: BaselineEngine, prefix: str = "pg_monitor_baseline") -> List[MetricFamily]:
+    """把已就绪序列的当前基线(均值、标准差、p50、p99)转换为按指标与统计量标注的指标族"""
+    samples = []
+    now = time.time()
+    for name in engine.names:
+        base = engine.expected(name, now)
+        if base is None:
+            continue
+        for stat in ("mean", "std", "p50", "p99"):
+            samples.append(({"instance": instance, "metric": name, "stat": stat}, base[stat]))
+    return [MetricFamily(prefix, "gauge", "Learned baseline of each tracked metric for the current hour of week", samples)]
+
+
+def _escape_label(value: str) -> str:
+    """转义 Prometheus 标签值"""
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def render_prometheus(families: List[MetricFamily]) -> bytes:
+    """把指标族渲染为 Prometheus 文本格式,同名指标族合并输出"""
+    merged: Dict[str, MetricFamily] = {}
+    for fam in families:
+        if fam.name in merged:
+            merged[fam.name].samples.extend(fam.samples)
+        else:
+            merged[fam.name] = MetricFamily(fam.name, fam.type, fam.help, list(fam.samples))
+    lines: List[str] = []
+    for name in sorted(merged):
+        fam = merged[name]
+        lines.append("# HELP {} {}".format(name, fam.help.replace("\n", " ")))
+        lines.append("# TYPE {} {}".format(name, fam.type))
+        for labels, value in fam.samples:
+            if labels:
+                label_text = ",".join('{}="{}"'.format(k, _escape_label(str(v))) for k, v in sorted(labels.items()))
+                lines.append("{}{{{}}} {}".format(name, label_text, repr(float(value))))
+            else:
+                lines.append("{} {}".format(name, repr(float(value))))
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class PrometheusExporter:
+    """/metrics 导出器:采集侧更新时预渲染,抓取只返回缓存字节,从不访问数据库"""
+    def __init__(self, logger: logging.Logger) -> None:
+        self.logger = logger
+        self.scrape_durations: Deque[float] = deque(maxlen=1024)
+        # /status 返回的 JSON 状态,未设置时 404
+        self.status: Optional[Callable[[], Dict[str, Any]]] = None
+        self._sources: Dict[str, List[MetricFamily]] = {}
+        self._payload = b"\n"
+        self._lock = threading.Lock()
+        self._server: Optional[HTTPServer] = None
+
+    def update(self, source: str, families: List[MetricFamily]) -> None:
+        """替换某个来源(实例核心指标或自定义查询)的指标族并重新渲染"""
+        with self._lock:
+            self._sources[source] = families
+            payload = render_prometheus([f for fams in self._sources.values() for f in fams])
+            self._payload = payload
+
+    def payload(self) -> bytes:
+        """返回最近一次渲染的文本"""
+        return self._payload
+
+    def serve(self, host: str, port: int) -> Tuple[str, int]:
+        """在后台线程启动 HTTP 服务,返回实际监听地址"""
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # 头与正文分两次写出,关闭 Nagle 避免与客户端延迟 ACK 叠加出 40ms 停顿
+            disable_nagle_algorithm = True
+
+            def do_GET(self) -> None:
+                start = time.perf_counter()
+                path = self.path.split("?", 1)[0]
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+                if path == "/metrics":
+                    body = exporter.payload()
+                    self.send_response(200)
+                elif path == "/status" and exporter.status is not None:
+                    body = json.dumps(exporter.status(), ensure_ascii=False).encode("utf-8")
+                    content_type = "application/json; charset=utf-8"
+                    self.send_response(200)
+                else:
+                    body = b"not found\n"
+                    self.send_response(404)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                exporter.scrape_durations.append(time.perf_counter() - start)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        self._server = _ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True).start()
+        self.logger.info("Prometheus 指标端点已启动: http://%s:%d/metrics", host, self._server.server_address[1])
+        return self._server.server_address[0], self._server.server_address[1]
+
+    def shutdown(self) -> None:
+        """停止 HTTP 服务"""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def load_custom_queries(path: str, names: Optional[List[str]] = None) -> Dict[str, Dict[str, Any]]:
+    """加载 postgres_exporter 格式的 queries.yaml,names 非空时只保留指定查询"""
+    try:
+        import yaml
+    except Exception as e:
+        raise ConfigError("缺少 PyYAML 依赖,无法加载自定义查询: {}".format(str(e)))
+    if not os.path.isfile(path):
+        raise ConfigError("自定义查询文件不存在: {}".format(path))
+    with open(path, "r", encoding="utf-8") as f:
+        data = yaml.safe_load(f) or {}
+    if names:
+        data = {k: v for k, v in data.items() if k in names}
+    return data
+
+
+class CustomQueryRunner:
+    """按独立周期执行 queries.yaml 中的自定义查询,结果只写入导出器缓存"""
+    def __init__(self, exporter: PrometheusExporter, targets: List[Tuple[str, Any]],
+                 queries: Dict[str, Dict[str, Any]], interval_seconds: float, logger: logging.Logger) -> None:
+        self.exporter = exporter
+        self.targets = targets
+        self.queries = queries
+        self.interval_seconds = interval_seconds
+        self.logger = logger
+        self._failures: Dict[Tuple[str, str], int] = {}
+        self._generations: Dict[str, int] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """启动后台执行线程"""
+        self._thread = threading.Thread(target=self._loop, name="custom-queries", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """停止后台线程"""
+        self._stop.set()
+
+    def _loop(self) -> None:
+        """后台循环"""
+        while not self._stop.is_set():
+            start = time.monotonic()
+            self.run_once()
+            self._stop.wait(max(1.0, self.interval_seconds - (time.monotonic() - start)))
+
+    def run_once(self) -> None:
+        """对所有实例执行一轮自定义查询"""
+        for instance, db in self.targets:
+            if getattr(db, "conn", None) is None:
+                continue
+            # 重连后(可能已升级或切换到其他节点)重新尝试之前停用的查询
+            generation = getattr(db, "generation", 0)
+            if self._generations.get(instance) != generation:
+                self._generations[instance] = generation
+                for key in [k for k in self._failures if k[0] == instance]:
+                    del self._failures[key]
+            families: List[MetricFamily] = []
+            for qname, spec in self.queries.items():
+                key = (instance, qname)
+                # 连续失败(多为版本不支持的视图)3 次后停用,直到连接重建
+                if self._failures.get(key, 0) >= 3:
+                    continue
+                try:
+                    rows = db.execute(spec["query"])
+                    self._failures.pop(key, None)
+                except Exception as e:
+                    self._failures[key] = self._failures.get(key, 0) + 1
+                    self.logger.warning("[%s] 自定义查询 %s 失败: %s", instance, qname, str(e))
+                    continue
+                families.extend(self.to_families(instance, qname, spec, rows))
+            self.exporter.update("custom:" + instance, families)
+
+    @staticmethod
+    def to_families(instance: str, qname: str, spec: Dict[str, Any], rows: List[Dict[str, Any]]) -> List[MetricFamily]:
+        """按 metrics 定义把查询结果转换为指标族(LABEL 列作为标签)"""
+        columns: List[Tuple[str, Dict[str, Any]]] = []
+        for item in spec.get("metrics", []):
+            for col, meta in item.items():
+                columns.append((col, meta or {}))
+        label_cols = [c for c, m in columns if str(m.get("usage", "")).upper() == "LABEL"]
+        families = []
+        for col, meta in columns:
+            usage = str(meta.get("usage", "GAUGE")).upper()
+            if usage not in ("GAUGE", "COUNTER"):
+                continue
+            samples = []
+            for r in rows:
+                if r.get(col) is None:
+                    continue
+                labels = {"instance": instance}
+                labels.update({c: str(r.get(c, "")) for c in label_cols})
+                samples.append((labels, float(r[col])))
+            families.append(MetricFamily("{}_{}".format(qname, col), usage.lower(), str(meta.get("description", col)), samples))
+        return families
+
+
+# 核心指标在 /metrics 中的说明;以 _total 结尾的累计值导出为 counter
+EXPORT_HELP: Dict[str, str] = {
+    "connections_total": "Backends connected (excluding the monitor)",
+    "connections_active": "Active backends",
+    "connections_idle": "Idle backends",
+    "lock_max_wait_ms": "Longest current lock wait in milliseconds",
+    "lock_blocked_sessions": "Sessions currently waiting on a lock held by another session",
+    "lock_root_blockers": "Sessions blocking others while not waiting themselves",
+    "lock_max_chain_depth": "Longest lock wait-for chain",
+    "deadlocks_delta": "Deadlocks since the previous cycle",
+    "slow_query_count": "Running statements over the slow query threshold",
+    "bloat_max_pct": "Highest table/index bloat percentage",
+    "replication_lag_s": "Replication lag in seconds",
+    "replication_lag_bytes": "Largest replay lag in bytes among standbys (or of this standby itself)",
+    "wal_bytes_per_second": "WAL generated (received on a standby) per second since the previous collection",
+    "replication_standbys": "Standbys currently connected to this server",
+    "replication_slot_retained_bytes_max": "Most WAL retained by a single replication slot in bytes",
+    "replication_slots_inactive": "Replication slots without a connected consumer",
+    "xid_age_max": "Largest age(datfrozenxid) among databases",
+    "mxid_age_max": "Largest mxid_age(datminmxid) among databases",
+    "wraparound_pct": "Highest XID or MultiXact age as a percentage of the 2^31 wraparound limit",
+    "xid_per_second": "Transaction IDs consumed per second since the previous collection",
+    "hours_to_wraparound": "Estimated hours until the oldest database reaches XID wraparound at the current rate",
+    "vacuum_running": "Vacuums currently reported by pg_stat_progress_vacuum",
+    "vacuum_eta_max_s": "Longest estimated remaining time among running vacuums in seconds",
+    "xmin_horizon_age": "Transaction age of the oldest xmin held by a session, slot, prepared transaction or standby",
+    "xmin_holder_max_s": "Longest time a single holder has held the same xmin in seconds",
+    "disk_db_total_bytes": "Total size of all databases in bytes",
+    "disk_ts_max_bytes": "Largest tablespace size in bytes",
+    "disk_db_growth_bytes_per_hour": "Growth rate of all databases in bytes per hour",
+    "disk_ts_growth_bytes_per_hour": "Growth rate of the largest tablespace in bytes per hour",
+    "disk_db_hours_to_critical": "Hours until total database size reaches the critical threshold at the current growth rate",
+    "disk_ts_hours_to_critical": "Hours until the first tablespace reaches the critical threshold at the current growth rate",
+    "host_cpu_pct": "Host CPU utilisation averaged over the cycle",
+    "host_cpu_pct_max": "Highest host CPU utilisation sample in the cycle",
+    "host_iowait_pct": "Host iowait averaged over the cycle",
+    "host_mem_used_pct": "Host memory in use (MemTotal - MemAvailable) percentage",
+    "host_swap_used_pct": "Host swap in use percentage",
+    "host_load1": "Host 1-minute load average",
+    "host_disk_read_bps": "Host disk read bytes per second averaged over the cycle",
+    "host_disk_write_bps": "Host disk write bytes per second averaged over the cycle",
+    "host_disk_busy_pct_max": "Highest per-disk busy percentage sample in the cycle",
+    "host_fs_used_pct": "Highest filesystem usage percentage among monitored mounts",
+    "backend_cpu_ms": "CPU time of the top backends since the previous cycle (/proc/<pid>/stat)",
+    "cpu_time_delta_ms": "Backend CPU time since the previous cycle (pg_stat_kcache)",
+    "temp_bytes_delta": "Temporary file bytes since the previous cycle",
+    "shared_buffers_bytes": "shared_buffers setting in bytes",
+    "top_statement_exec_ms": "Execution time of the most expensive statement since the previous cycle",
+    "deadlocks_total": "Cumulative deadlocks (pg_stat_database)",
+    "cpu_ms_total": "Cumulative backend CPU time in milliseconds (pg_stat_kcache)",
+    "temp_bytes_total": "Cumulative temporary file bytes (pg_stat_database)",
+    "wait_aas_total": "Average active sessions over the wait sampling window (waiting or on CPU)",
+    "wait_top_event_aas": "Average active sessions waiting on the busiest non-CPU wait event",
+    "log_slow_count": "Statements logged by log_min_duration_statement since the previous collection",
+    "log_slow_p95_ms_max": "Highest per-fingerprint p95 duration among logged statements since the previous collection",
+    "log_temp_files": "Temporary files logged since the previous collection",
+    "log_temp_bytes": "Temporary file bytes logged since the previous collection",
+    "log_lock_waits": "Lock waits logged by log_lock_waits since the previous collection",
+    "log_lock_wait_max_ms": "Longest logged lock wait in milliseconds since the previous collection",
+    "log_autovacuum_count": "Autovacuum/autoanalyze runs logged since the previous collection",
+    "log_autovacuum_max_s": "Longest logged autovacuum/autoanalyze run in seconds since the previous collection",
+    "csvlog_lag_bytes": "Bytes of the current csvlog file not yet parsed",
+}
+
+
+def metric_families(instance: str, values: Dict[str, float], prefix: str = "pg_monitor_") -> List[MetricFamily]:
+    """把一个实例的标量指标转换为指标族"""
+    families = [MetricFamily(prefix + "last_collect_timestamp_seconds", "gauge",
+                             "Unix time of the last completed collection", [({"instance": instance}, time.time())])]
+    for key, value in values.items():
+        if value is None:
+            continue
+        kind = "counter" if key.endswith("_total") and key in COUNTER_METRICS else "gauge"
+        families.append(MetricFamily(prefix + key, kind, EXPORT_HELP.get(key, key), [({"instance": instance}, float(value))]))
+    return families
+
+
+STATEMENTS_SQL = """
+SELECT s.queryid,
+       SUM(s.calls)::float8 AS calls,
+       SUM(s.total_exec_time)::float8 AS exec_ms,
+       SUM(s.temp_blks_read + s.temp_blks_written)::float8 AS temp_blks,
+       {cpu} AS cpu_ms
+FROM pg_stat_statements s
+{join}
+WHERE s.queryid IS NOT NULL
+GROUP BY s.queryid
+ORDER BY exec_ms DESC
+LIMIT %(limit)s
+"""
+
+STATEMENTS_KCACHE_JOIN = (
+    "LEFT JOIN pg_stat_kcache() k ON k.queryid = s.queryid AND k.userid = s.userid"
+    " AND k.dbid = s.dbid AND k.top = s.toplevel"
+)
+
+
+class StatementsTracker:
+    """pg_stat_statements 周期增量与 Top-N:
+    每个 queryid 的上次累计值存放在预分配的定长数组槽位中,本周期未出现的槽位回收,
+    条目超过 capacity 时只跟踪累计耗时最高的 capacity 个,
+    排名用大小为 N 的最小堆,常驻内存只与 capacity 有关,与实例上的 queryid 总数无关"""
+    DIMENSIONS = ("exec_ms", "calls", "temp_blks", "cpu_ms")
+
+    def __init__(self, capacity: int = 20000, top_n: int = 10) -> None:
+        self.capacity = max(1, capacity)
+        self.top_n = max(1, top_n)
+        self.cycle = 0
+        self.dropped = 0
+        # 上一周期是否完整跟踪了全部条目;有截断时无法区分新建条目与刚进入前 capacity 的旧条目
+        self._complete = False
+        self._slot_of: Dict[int, int] = {}
+        self._queryid = array("q", [0]) * self.capacity
+        self._prev = {d: array("d", [0.0]) * self.capacity for d in self.DIMENSIONS}
+        self._free = list(range(self.capacity - 1, -1, -1))
+
+    def __len__(self) -> int:
+        return len(self._slot_of)
+
+    def update(self, rows: Iterable[Tuple[int, float, float, float, float]]) -> Dict[str, List[Dict[str, Any]]]:
+        """输入 (queryid, calls, exec_ms, temp_blks, cpu_ms) 累计值,返回各维度增量 Top-N"""
+        self.cycle += 1
+        baseline = not self._complete
+        rows = list(rows)
+        truncated = len(rows) > self.capacity
+        if truncated:
+            # 超出容量时按累计耗时保留最重的条目,而不是先到先得
+            self.dropped += len(rows) - self.capacity
+            rows = heapq.nlargest(self.capacity, rows, key=lambda r: r[2])
+        # 先回收本周期已不在结果中的槽位,保证新进入的条目都有槽位
+        self._reclaim({r[0] for r in rows})
+        heaps: Dict[str, List[Tuple[float, int, Tuple[float, float, float, float]]]] = {d: [] for d in self.DIMENSIONS}
+        prev_calls, prev_exec = self._prev["calls"], self._prev["exec_ms"]
+        prev_temp, prev_cpu = self._prev["temp_blks"], self._prev["cpu_ms"]
+        n = self.top_n
+        for qid, calls, exec_ms, temp_blks, cpu_ms in rows:
+            slot = self._slot_of.get(qid)
+            if slot is None:
+                slot = self._free.pop()
+                self._slot_of[qid] = slot
+                self._queryid[slot] = qid
+                if baseline:
+                    d = None
+                else:
+                    # 上周期完整跟踪时,新出现的条目是两次采集之间新建的,累计值即增量
+                    d = (calls, exec_ms, temp_blks, cpu_ms)
+            else:
+                d = (calls - prev_calls[slot], exec_ms - prev_exec[slot],
+                     temp_blks - prev_temp[slot], cpu_ms - prev_cpu[slot])
+                if d[0] < 0 or d[1] < 0:
+                    # pg_stat_statements_reset() 之后计数从 0 重新开始
+                    d = (calls, exec_ms, temp_blks, cpu_ms)
+            prev_calls[slot] = calls
+            prev_exec[slot] = exec_ms
+            prev_temp[slot] = temp_blks
+            prev_cpu[slot] = cpu_ms
+            if d is None or d[0] <= 0:
+                continue
+            for value, heap in ((d[1], heaps["exec_ms"]), (d[0], heaps["calls"]),
+                                (d[2], heaps["temp_blks"]), (d[3], heaps["cpu_ms"])):
+                if value <= 0:
+                    continue
+                if len(heap) < n:
+                    heapq.heappush(heap, (value, qid, d))
+                elif value > heap[0][0]:
+                    heapq.heapreplace(heap, (value, qid, d))
+        self._complete = not truncated
+        top: Dict[str, List[Dict[str, Any]]] = {}
+        for dim, heap in heaps.items():
+            items = []
+            for _, qid, d in sorted(heap, reverse=True):
+                items.append({
+                    "queryid": qid,
+                    "calls": d[0],
+                    "exec_ms": d[1],
+                    "temp_blks": d[2],
+                    "cpu_ms": d[3],
+                    "mean_ms": d[1] / d[0] if d[0] else 0.0,
+                })
+            top[dim] = items
+        return top
+
+    def _reclaim(self, present: Set[int]) -> None:
+        """回收本周期未出现(已被 pg_stat_statements 淘汰或跌出前 capacity)的槽位"""
+        for qid, slot in list(self._slot_of.items()):
+            if qid not in present:
+                del self._slot_of[qid]
+                self._free.append(slot)
+
+
+def statement_families(instance: str, top: Dict[str, List[Dict[str, Any]]],
+                       prefix: str = "pg_monitor_statement_") -> List[MetricFamily]:
+    """把 Top-N 语句增量转换为按 queryid 标注的指标族"""
+    families = []
+    for dim in StatementsTracker.DIMENSIONS:
+        samples = [({"instance": instance, "queryid": str(q["queryid"])}, q[dim]) for q in top.get(dim, [])]
+        families.append(MetricFamily(prefix + dim + "_delta", "gauge",
+                                     "Top statements by {} since the previous cycle".format(dim), samples))
+    return families
+
+
+# pg_stat_activity 轮询:服务端按 (等待事件, 库, queryid) 聚合,活跃但未等待的会话记为 CPU
+WAIT_ACTIVITY_SQL = """
+SELECT COALESCE(wait_event_type || ':' || wait_event, 'CPU') AS event,
+       COALESCE(datname, '') AS datname,
+       {queryid} AS queryid,
+       count(*)::float8 AS n
+FROM pg_stat_activity
+WHERE state = 'active' AND backend_type = 'client backend' AND pid <> pg_backend_pid()
+GROUP BY 1, 2, 3
+"""
+
+# pg_wait_sampling 已在服务端按 profile_period(默认 10ms)采样,这里读取累计计数做差
+WAIT_PROFILE_SQL = """
+SELECT p.pid,
+       COALESCE(p.event_type || ':' || p.event, 'CPU') AS event,
+       COALESCE(p.queryid, 0) AS queryid,
+       COALESCE(a.datname, '') AS datname,
+       p.count::float8 AS n,
+       COALESCE(current_setting('pg_wait_sampling.profile_period', true), '10')::float8 AS period_ms
+FROM pg_wait_sampling_profile p
+LEFT JOIN pg_stat_activity a ON a.pid = p.pid
+"""
+
+
+class WaitEventWindow:
+    """等待事件滚动窗口:键 (event, queryid, datname) 映射到定长槽位,每个槽位在 array('d') 中占 buckets 个桶,
+    过期的桶整列清零后复用,常驻内存只与 capacity × buckets 有关;槽位用尽时计入 Other"""
+    OTHER = ("Other", 0, "")
+
+    def __init__(self, capacity: int = 512, window_seconds: float = 300.0, buckets: int = 30) -> None:
+        self.capacity = max(2, capacity)
+        self.buckets = max(1, buckets)
+        self.window_seconds = max(1.0, window_seconds)
+        self.bucket_seconds = self.window_seconds / self.buckets
+        self.dropped = 0
+        self._counts = array("d", bytes(8 * self.capacity * self.buckets))
+        self._totals = array("d", bytes(8 * self.capacity))
+        self._keys: List[Optional[Tuple[str, int, str]]] = [None] * self.capacity
+        self._slot_of: Dict[Tuple[str, int, str], int] = {self.OTHER: 0}
+        self._keys[0] = self.OTHER
+        self._free = list(range(self.capacity - 1, 0, -1))
+        self._current: Optional[int] = None
+
+    def __len__(self) -> int:
+        return len(self._slot_of)
+
+    def _advance(self, now: float) -> None:
+        """移动到 now 所在的桶,清零其间过期的桶,并回收计数归零的槽位"""
+        idx = int(now // self.bucket_seconds)
+        if self._current is None:
+            self._current = idx
+            return
+        steps = min(idx - self._current, self.buckets)
+        if steps <= 0:
+            return
+        counts, totals, b = self._counts, self._totals, self.buckets
+        slots = list(self._slot_of.values())
+        for k in range(1, steps + 1):
+            col = (self._current + k) % b
+            for slot in slots:
+                v = counts[slot * b + col]
+                if v:
+                    totals[slot] -= v
+                    counts[slot * b + col] = 0.0
+        self._current = idx
+        for key, slot in list(self._slot_of.items()):
+            if slot and totals[slot] <= 1e-9:
+                totals[slot] = 0.0
+                del self._slot_of[key]
+                self._keys[slot] = None
+                self._free.append(slot)
+
+    def add(self, key: Tuple[str, int, str], seconds: float, now: float) -> None:
+        """把 seconds 个会话·秒计入 key 的当前桶"""
+        self._advance(now)
+        slot = self._slot_of.get(key)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+                self._slot_of[key] = slot
+                self._keys[slot] = key
+            else:
+                self.dropped += 1
+                slot = 0
+        self._counts[slot * self.buckets + (self._current or 0) % self.buckets] += seconds
+        self._totals[slot] += seconds
+
+    def top(self, n: int, now: float) -> List[Tuple[Tuple[str, int, str], float]]:
+        """窗口内会话·秒最多的 n 个键"""
+        self._advance(now)
+        totals = self._totals
+        return heapq.nlargest(n, ((key, totals[slot]) for key, slot in self._slot_of.items() if totals[slot] > 1e-9),
+                              key=lambda kv: kv[1])
+
+    def by_event(self, now: float) -> Dict[str, float]:
+        """窗口内按等待事件汇总的会话·秒"""
+        self._advance(now)
+        out: Dict[str, float] = {}
+        for key, slot in self._slot_of.items():
+            v = self._totals[slot]
+            if v > 1e-9:
+                out[key[0]] = out.get(key[0], 0.0) + v
+        return out
+
+
+class WaitEventSampler:
+    """等待事件采样:后台线程按亚秒到秒级间隔轮询 pg_stat_activity(或读取 pg_wait_sampling_profile),
+    按会话·秒累加到滚动窗口"""
+    def __init__(self, db: "DBClient", source: Callable[[], Tuple[str, str]], interval_seconds: float = 1.0,
+                 window: Optional[WaitEventWindow] = None, budget: QueryBudget = QueryBudget(1000, 500),
+                 logger: Optional[logging.Logger] = None, name: str = "") -> None:
+        self.db = db
+        self.source = source
+        self.interval_seconds = max(0.2, interval_seconds)
+        self.window = window or WaitEventWindow()
+        self.budget = budget
+        self.logger = logger
+        self.name = name
+        self.samples = 0
+        self.mode = ""
+        self._last: Optional[float] = None
+        self._since: Optional[float] = None
+        self._prev_profile: Optional[Dict[Tuple[int, str, int], float]] = None
+        self._failing = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        """启动后台采样线程"""
+        self._thread = threading.Thread(target=self._loop, name="wait-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """停止后台线程"""
+        self._stop.set()
+
+    def _loop(self) -> None:
+        """后台循环;数据库不可用时只在状态变化时记录日志"""
+        while not self._stop.is_set():
+            start = time.monotonic()
+            try:
+                self.sample()
+                if self._failing and self.logger is not None:
+                    self.logger.info("[%s] 等待事件采样已恢复", self.name)
+                self._failing = False
+            except Exception as e:
+                if not self._failing and self.logger is not None:
+                    self.logger.warning("[%s] 等待事件采样失败: %s", self.name, str(e))
+                self._failing = True
+            self._stop.wait(max(0.05, self.interval_seconds - (time.monotonic() - start)))
+
+    def sample(self, now: Optional[float] = None) -> int:
+        """采样一次,返回读取的行数"""
+        mode, sql = self.source()
+        with self.db.budget(self.budget):
+            rows = self.db.execute(sql)
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if mode != self.mode:
+                self._prev_profile = None
+                self.mode = mode
+            if self._since is None:
+                # 轮询的第一次观测代表之前一个间隔;profile 模式第一次只建立基线
+                self._since = now if mode == "profile" else now - self.interval_seconds
+            if mode == "profile":
+                self._add_profile(rows, now)
+            else:
+                # 每个会话的一次观测代表距上次采样的这段时间;长时间中断后不把整段空档记到一次观测上
+                elapsed = self.interval_seconds if self._last is None else min(now - self._last, 2 * self.interval_seconds)
+                for r in rows:
+                    self.window.add((r["event"], int(r["queryid"] or 0), r["datname"] or ""), float(r["n"]) * elapsed, now)
+            self._last = now
+            self.samples += 1
+        return len(rows)
+
+    def _add_profile(self, rows: List[Dict[str, Any]], now: float) -> None:
+        """pg_wait_sampling 累计计数按 (pid, event, queryid) 做差,第一次只建立基线"""
+        current: Dict[Tuple[int, str, int], float] = {}
+        prev = self._prev_profile
+        for r in rows:
+            k = (int(r["pid"] or 0), r["event"], int(r["queryid"] or 0))
+            n = float(r["n"] or 0)
+            current[k] = n
+            if prev is None:
+                continue
+            d = n - prev.get(k, 0.0)
+            if d > 0:
+                self.window.add((r["event"], k[2], r["datname"] or ""), d * float(r["period_ms"] or 10) / 1000.0, now)
+        self._prev_profile = current
+
+    def report(self, top_n: int = 10, now: Optional[float] = None) -> Dict[str, Any]:
+        """窗口内按等待事件与 (事件, queryid, 库) 的平均活跃会话数(会话·秒 / 窗口时长)"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            covered = 0.0 if self._since is None else min(self.window.window_seconds, now - self._since)
+            events = sorted(self.window.by_event(now).items(), key=lambda kv: kv[1], reverse=True)
+            top = self.window.top(top_n, now)
+        if covered <= 0:
+            return {"events": [], "top": [], "aas_total": 0.0, "window_s": 0.0, "mode": self.mode}
+        return {
+            "events": [{"event": e, "seconds": round(v, 3), "aas": round(v / covered, 3)} for e, v in events],
+            "top": [{"event": k[0], "queryid": k[1], "datname": k[2], "seconds": round(v, 3), "aas": round(v / covered, 3)}
+                    for k, v in top],
+            "aas_total": round(sum(v for _, v in events) / covered, 3),
+            "window_s": round(covered, 1),
+            "mode": self.mode,
+        }
+
+
+def wait_event_families(instance: str, waits: Dict[str, Any], prefix: str = "pg_monitor_wait_") -> List[MetricFamily]:
+    """把等待事件窗口汇总转换为按事件及 (事件, queryid, 库) 标注的指标族"""
+    return [
+        MetricFamily(prefix + "event_aas", "gauge", "Average active sessions per wait event over the sampling window",
+                     [({"instance": instance, "event": e["event"]}, e["aas"]) for e in waits.get("events", [])]),
+        MetricFamily(prefix + "query_aas", "gauge", "Average active sessions of the top (wait event, queryid, database) over the sampling window",
+                     [({"instance": instance, "event": q["event"], "queryid": str(q["queryid"]), "datname": q["datname"]}, q["aas"])
+                      for q in waits.get("top", [])]),
+    ]
+
+
+# pgstattuple 支持的索引访问方法;GIN、SP-GiST、BRIN 会报 "index is not supported",不作为候选
+BLOAT_INDEX_AMS = ("btree", "hash", "gist")
+
+BLOAT_CANDIDATES_SQL = """
+SELECT c.oid::bigint AS relid,
+       n.nspname AS schemaname,
+       c.relname,
+       c.relkind::text AS relkind,
+       COALESCE(am.amname, '') AS amname,
+       c.relpages::bigint AS relpages,
+       GREATEST(c.reltuples, 0)::float8 AS reltuples,
+       COALESCE(t.n_dead_tup, 0)::bigint AS n_dead_tup
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+LEFT JOIN pg_am am ON am.oid = c.relam
+LEFT JOIN pg_index i ON i.indexrelid = c.oid
+LEFT JOIN pg_stat_all_tables t ON t.relid = COALESCE(i.indrelid, c.oid)
+WHERE c.relkind IN ('r', 'm', 'i')
+  AND (c.relkind <> 'i' OR am.amname IN ({ams}))
+  AND c.relpersistence <> 't'
+  AND c.relpages > 0
+  AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+  AND n.nspname !~ '^pg_toast'
+""".format(ams=", ".join("'{}'".format(a) for a in BLOAT_INDEX_AMS))
+
+# 表用 pgstattuple_approx(跳过全可见页),btree 用 pgstatindex 的叶子密度,其余索引(GiST 等)用 pgstattuple
+BLOAT_SCAN_SQL: Dict[str, str] = {
+    "table": "SELECT approx_free_percent + dead_tuple_percent AS bloat_pct FROM pgstattuple_approx(%s::oid::regclass)",
+    "btree": "SELECT CASE WHEN avg_leaf_density = 'NaN' THEN 0 ELSE GREATEST(0, 100 - avg_leaf_density) END AS bloat_pct"
+             " FROM pgstatindex(%s::oid::regclass)",
+    "index": "SELECT free_percent + dead_tuple_percent AS bloat_pct FROM pgstattuple(%s::oid::regclass)",
+}
+
+
+class BloatScanner:
+    """增量膨胀扫描:每周期在页数/时间预算内挑选最值得扫描的关系,结果按关系缓存并记录扫描时间"""
+    def __init__(self, budget_pages: int = 262144, budget_seconds: float = 20.0,
+                 stale_after_seconds: float = 86400.0, candidates_refresh_seconds: float = 900.0) -> None:
+        self.budget_pages = budget_pages
+        self.budget_seconds = budget_seconds
+        self.stale_after_seconds = stale_after_seconds
+        self.candidates_refresh_seconds = candidates_refresh_seconds
+        self.candidates: Dict[int, Dict[str, Any]] = {}
+        self.cache: Dict[int, Dict[str, Any]] = {}
+        self._candidates_at: Optional[float] = None
+
+    def candidates_due(self, now: float) -> bool:
+        """候选列表是否需要刷新"""
+        return self._candidates_at is None or now - self._candidates_at >= self.candidates_refresh_seconds
+
+    def set_candidates(self, rows: List[Dict[str, Any]], now: float) -> None:
+        """更新候选关系,已删除关系的缓存一并清理;pgstattuple 不支持的索引不作为候选"""
+        self.candidates = {int(r["relid"]): r for r in rows
+                           if r["relkind"] != "i" or r.get("amname") in BLOAT_INDEX_AMS}
+        self._candidates_at = now
+        for relid in [k for k in self.cache if k not in self.candidates]:
+            del self.cache[relid]
+
+    @staticmethod
+    def method_of(cand: Dict[str, Any]) -> str:
+        """选择扫描函数"""
+        if cand["relkind"] != "i":
+            return "table"
+        return "btree" if cand.get("amname") == "btree" else "index"
+
+    def priority(self, cand: Dict[str, Any], now: float) -> float:
+        """扫描优先级:从未扫描的按大小优先;已扫描的按过期程度 x 大小 x 扫描后新增死元组比例"""
+        pages = float(cand["relpages"])
+        size_weight = math.log2(pages + 2)
+        entry = self.cache.get(int(cand["relid"]))
+        if entry is None:
+            return 1e9 + pages
+        age = now - entry["scanned_at"]
+        churn = max(0.0, float(cand["n_dead_tup"]) - entry["dead_at_scan"]) / max(1.0, float(cand["reltuples"]))
+        return size_weight * (age / self.stale_after_seconds) * (1.0 + 10.0 * churn)
+
+    def plan(self, now: float) -> List[Dict[str, Any]]:
+        """按优先级挑选本周期要扫描的关系,累计页数不超过预算(第一个总会入选)"""
+        ranked = sorted(self.candidates.values(), key=lambda c: self.priority(c, now), reverse=True)
+        picked: List[Dict[str, Any]] = []
+        pages = 0
+        for cand in ranked:
+            entry = self.cache.get(int(cand["relid"]))
+            if entry is not None and now - entry["scanned_at"] < self.stale_after_seconds * 0.05:
+                continue
+            if picked and pages + int(cand["relpages"]) > self.budget_pages:
+                continue
+            picked.append(cand)
+            pages += int(cand["relpages"])
+        return picked
+
+    def record(self, cand: Dict[str, Any], bloat_pct: Optional[float], now: float) -> None:
+        """记录扫描结果;失败(超时等)时记录空值,等过期后再重试"""
+        self.cache[int(cand["relid"])] = {
+            "schemaname": cand["schemaname"],
+            "relname": cand["relname"],
+            "kind": "index" if cand["relkind"] == "i" else "table",
+            "relpages": int(cand["relpages"]),
+            "bloat_pct": None if bloat_pct is None else round(float(bloat_pct), 2),
+            "scanned_at": now,
+            "dead_at_scan": float(cand["n_dead_tup"]),
+        }
+
+    def report(self, now: float, limit: int = 20) -> List[Dict[str, Any]]:
+        """按膨胀比例返回缓存结果,附带结果年龄"""
+        rows = [dict(e, age_s=int(now - e["scanned_at"])) for e in self.cache.values() if e["bloat_pct"] is not None]
+        rows.sort(key=lambda r: r["bloat_pct"], reverse=True)
+        return rows[:limit]
+
+    def max_pct(self) -> float:
+        """缓存中的最大膨胀比例"""
+        return max([e["bloat_pct"] for e in self.cache.values() if e["bloat_pct"] is not None], default=0.0)
+
+
+class RingBuffer:
+    """定长环形缓冲:预分配 array('d'),每行为固定字段,写满后覆盖最旧的行"""
+    def __init__(self, fields: Tuple[str, ...], capacity: int) -> None:
+        self.fields = fields
+        self.capacity = max(1, capacity)
+        self._width = len(fields)
+        self._data = array("d", bytes(8 * self._width * self.capacity))
+        self._next = 0
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, row: Iterable[float]) -> None:
+        """追加一行(按 fields 顺序)"""
+        base = self._next * self._width
+        for i, v in enumerate(row):
+            self._data[base + i] = v
+        self._next = (self._next + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def rows(self, since: float = float("-inf")) -> List[Tuple[float, ...]]:
+        """按时间顺序返回首字段(时间戳)大于 since 的行"""
+        out = []
+        start = (self._next - self._count) % self.capacity
+        for k in range(self._count):
+            base = ((start + k) % self.capacity) * self._width
+            if self._data[base] > since:
+                out.append(tuple(self._data[base:base + self._width]))
+        return out
+
+    def latest(self) -> Optional[Dict[str, float]]:
+        """最新一行"""
+        if not self._count:
+            return None
+        base = ((self._next - 1) % self.capacity) * self._width
+        return dict(zip(self.fields, self._data[base:base + self._width]))
+
+
+HOST_FIELDS = (
+    "ts", "cpu_pct", "iowait_pct", "steal_pct", "mem_used_pct", "swap_used_pct",
+    "load1", "load5", "load15", "disk_read_bps", "disk_write_bps", "disk_busy_pct", "fs_used_pct",
+)
+
+
+# 不计入磁盘吞吐的块设备:虚拟设备,以及 I/O 会在下层物理磁盘重复计数的叠加设备
+SKIP_DISK_PREFIXES = ("loop", "ram", "zram", "dm-", "md")
+
+
+class HostSampler:
+    """进程内主机采样:直接读取 /proc 与 statvfs,按秒级间隔写入环形缓冲,不派生子进程"""
+    def __init__(self, interval_seconds: float = 5.0, retention_seconds: float = 3600.0,
+                 mounts: Optional[List[str]] = None, disks: Optional[List[str]] = None,
+                 proc_root: str = "/proc", logger: Optional[logging.Logger] = None, sys_root: str = "/sys") -> None:
+        self.interval_seconds = max(1.0, interval_seconds)
+        self.mounts = mounts or ["/"]
+        self.proc_root = proc_root
+        self.logger = logger
+        self.ring = RingBuffer(HOST_FIELDS, int(retention_seconds / self.interval_seconds) + 1)
+        self.filesystems: List[Dict[str, Any]] = []
+        self._disks = set(disks) if disks else None
+        self._prev: Optional[Tuple[float, Tuple[int, ...], Tuple[int, int, Dict[str, int]]]] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        if self._disks is None:
+            self._disks = self._physical_disks(os.path.join(sys_root, "block"))
+
+    @staticmethod
+    def _physical_disks(block_dir: str) -> Optional[Set[str]]:
+        """只统计底层整块磁盘:分区不在 /sys/block 中,loop/ram 设备不是真实 I/O,
+        device-mapper(LVM)与 md 等叠加设备的 slaves 非空,其 I/O 已计入下层磁盘"""
+        try:
+            names = os.listdir(block_dir)
+        except OSError:
+            return None
+        disks = set()
+        for d in names:
+            if d.startswith(SKIP_DISK_PREFIXES):
+                continue
+            try:
+                if os.listdir(os.path.join(block_dir, d, "slaves")):
+                    continue
+            except OSError:
+                pass
+            disks.add(d)
+        return disks
+
+    def start(self) -> None:
+        """启动后台采样线程"""
+        self._thread = threading.Thread(target=self._loop, name="host-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """停止后台线程"""
+        self._stop.set()
+
+    def _loop(self) -> None:
+        """后台循环"""
+        while not self._stop.is_set():
+            start = time.monotonic()
+            try:
+                self.sample()
+            except Exception as e:
+                if self.logger is not None:
+                    self.logger.warning("主机采样失败: %s", str(e))
+            self._stop.wait(max(0.1, self.interval_seconds - (time.monotonic() - start)))
+
+    def _read(self, name: str) -> str:
+        with open(os.path.join(self.proc_root, name)) as f:
+            return f.read()
+
+    def _cpu(self) -> Tuple[int, ...]:
+        """/proc/stat 汇总行: user nice system idle iowait irq softirq steal"""
+        fields = self._read("stat").split("\n", 1)[0].split()
+        return tuple(int(v) for v in fields[1:9])
+
+    def _disk(self) -> Tuple[int, int, Dict[str, int]]:
+        """/proc/diskstats: 读/写扇区数合计与各磁盘 io_ticks(ms)"""
+        read = write = 0
+        ticks: Dict[str, int] = {}
+        for line in self._read("diskstats").splitlines():
+            f = line.split()
+            if len(f) < 13:
+                continue
+            name = f[2]
+            if self._disks is not None and name not in self._disks:
+                continue
+            if self._disks is None and name.startswith(SKIP_DISK_PREFIXES):
+                continue
+            read += int(f[5])
+            write += int(f[9])
+            ticks[name] = int(f[12])
+        return read, write, ticks
+
+    def _memory(self) -> Tuple[float, float]:
+        """/proc/meminfo: 内存与交换区使用率(%)"""
+        info: Dict[str, int] = {}
+        for line in self._read("meminfo").splitlines():
+            key, _, rest = line.partition(":")
+            parts = rest.split()
+            if parts:
+                info[key] = int(parts[0])
+        total = info.get("MemTotal", 0)
+        avail = info.get("MemAvailable", info.get("MemFree", 0) + info.get("Buffers", 0) + info.get("Cached", 0))
+        swap_total = info.get("SwapTotal", 0)
+        mem_pct = 100.0 * (total - avail) / total if total else 0.0
+        swap_pct = 100.0 * (swap_total - info.get("SwapFree", 0)) / swap_total if swap_total else 0.0
+        return mem_pct, swap_pct
+
+    def _filesystems(self) -> float:
+        """statvfs: 各挂载点使用率(与 df 相同口径),返回最大值"""
+        result = []
+        for mount in self.mounts:
+            try:
+                st = os.statvfs(mount)
+            except OSError:
+                continue
+            used = st.f_blocks - st.f_bfree
+            usable = used + st.f_bavail
+            result.append({
+                "mount": mount,
+                "total_bytes": st.f_blocks * st.f_frsize,
+                "avail_bytes": st.f_bavail * st.f_frsize,
+                "used_pct": round(100.0 * used / usable, 2) if usable else 0.0,
+            })
+        self.filesystems = result
+        return max((r["used_pct"] for r in result), default=0.0)
+
+    def sample(self, now: Optional[float] = None) -> Optional[Dict[str, float]]:
+        """采样一次;首次只建立基线,之后按与上次的差值计算速率并写入环形缓冲"""
+        now = time.time() if now is None else now
+        cpu = self._cpu()
+        disk = self._disk()
+        prev, self._prev = self._prev, (now, cpu, disk)
+        if prev is None or now <= prev[0]:
+            return None
+        dt = now - prev[0]
+        d = [c - p for c, p in zip(cpu, prev[1])]
+        total = sum(d) or 1
+        idle = d[3] + d[4]
+        busy = max([100.0 * (disk[2][k] - prev[2][2].get(k, disk[2][k])) / (dt * 1000.0) for k in disk[2]], default=0.0)
+        load = self._read("loadavg").split()
+        mem_pct, swap_pct = self._memory()
+        row = (
+            now,
+            100.0 * (total - idle) / total,
+            100.0 * d[4] / total,
+            100.0 * d[7] / total,
+            mem_pct,
+            swap_pct,
+            float(load[0]), float(load[1]), float(load[2]),
+            (disk[0] - prev[2][0]) * 512 / dt,
+            (disk[1] - prev[2][1]) * 512 / dt,
+            min(100.0, busy),
+            self._filesystems(),
+        )
+        self.ring.append(row)
+        return dict(zip(HOST_FIELDS, row))
+
+    def summary(self, since: float) -> Optional[Dict[str, float]]:
+        """汇总 since 之后的采样:CPU/iowait 取平均与最大,其余取最新值或最大值"""
+        rows = self.ring.rows(since)
+        if not rows:
+            return None
+        col = {name: [r[i] for r in rows] for i, name in enumerate(HOST_FIELDS)}
+        last = rows[-1]
+        return {
+            "samples": len(rows),
+            "cpu_pct": round(sum(col["cpu_pct"]) / len(rows), 2),
+            "cpu_pct_max": round(max(col["cpu_pct"]), 2),
+            "iowait_pct": round(sum(col["iowait_pct"]) / len(rows), 2),
+            "steal_pct": round(sum(col["steal_pct"]) / len(rows), 2),
+            "mem_used_pct": round(last[HOST_FIELDS.index("mem_used_pct")], 2),
+            "swap_used_pct": round(last[HOST_FIELDS.index("swap_used_pct")], 2),
+            "load1": last[HOST_FIELDS.index("load1")],
+            "disk_read_bps": round(sum(col["disk_read_bps"]) / len(rows), 1),
+            "disk_write_bps": round(sum(col["disk_write_bps"]) / len(rows), 1),
+            "disk_busy_pct_max": round(max(col["disk_busy_pct"]), 2),
+            "fs_used_pct": round(last[HOST_FIELDS.index("fs_used_pct")], 2),
+        }
+
+
+class BackendUsage:
+    """按 pg_stat_activity 中的后端 pid 读取 /proc/<pid>/stat 与 /proc/<pid>/io,计算两次采集之间每个后端的 CPU 与 I/O"""
+    def __init__(self, proc_root: str = "/proc") -> None:
+        self.proc_root = proc_root
+        self.ticks_per_second = float(os.sysconf("SC_CLK_TCK")) if hasattr(os, "sysconf") else 100.0
+        self.io_available = True
+        self._prev: Dict[int, Tuple[int, float, int, int]] = {}
+        self._prev_at: Optional[float] = None
+
+    def _read_pid(self, pid: int) -> Optional[Tuple[int, float, int, int]]:
+        """返回 (starttime, cpu_ms, read_bytes, write_bytes),进程已退出时返回 None"""
+        try:
+            with open(os.path.join(self.proc_root, str(pid), "stat")) as f:
+                # comm 可能含空格与括号,从最后一个 ')' 之后开始按字段切分
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            return None
+        cpu_ms = (int(fields[11]) + int(fields[12])) * 1000.0 / self.ticks_per_second
+        read_bytes = write_bytes = 0
+        if self.io_available:
+            try:
+                with open(os.path.join(self.proc_root, str(pid), "io")) as f:
+                    io = dict(line.split(": ", 1) for line in f.read().splitlines() if ": " in line)
+                read_bytes, write_bytes = int(io.get("read_bytes", 0)), int(io.get("write_bytes", 0))
+            except PermissionError:
+                # /proc/<pid>/io 只对同一用户(或 CAP_SYS_PTRACE)可读,监控账号不是 postgres 时只统计 CPU
+                self.io_available = False
+            except OSError:
+                pass
+        return int(fields[19]), cpu_ms, read_bytes, write_bytes
+
+    def update(self, backends: List[Dict[str, Any]], now: Optional[float] = None, limit: int = 10) -> List[Dict[str, Any]]:
+        """按 CPU 增量降序返回各后端的 CPU(ms) 与读写字节增量"""
+        now = time.time() if now is None else now
+        current: Dict[int, Tuple[int, float, int, int]] = {}
+        usage = []
+        for b in backends:
+            pid = int(b["pid"])
+            stat = self._read_pid(pid)
+            if stat is None:
+                continue
+            current[pid] = stat
+            prev = self._prev.get(pid)
+            if prev is None or prev[0] != stat[0]:
+                # 新出现的后端:上次采集之后才启动的全部计入本周期,否则只建立基线
+                started = float(b.get("backend_start") or 0.0)
+                if self._prev_at is None or started < self._prev_at:
+                    continue
+                prev = (stat[0], 0.0, 0, 0)
+            usage.append({
+                "pid": pid,
+                "datname": b.get("datname") or "",
+                "usename": b.get("usename") or "",
+                "state": b.get("state") or "",
+                "query": b.get("query") or "",
+                "cpu_ms": round(stat[1] - prev[1], 1),
+                "read_bytes": stat[2] - prev[2],
+                "write_bytes": stat[3] - prev[3],
+            })
+        self._prev = current
+        self._prev_at = now
+        usage.sort(key=lambda u: (u["cpu_ms"], u["read_bytes"] + u["write_bytes"]), reverse=True)
+        return usage[:limit]
+
+
+def is_local_host(host: str) -> bool:
+    """数据库是否与监控进程同机(本机地址或 Unix socket 目录)"""
+    return host.startswith("/") or host in ("localhost", "127.0.0.1", "::1", "")
+
+
+class LogHistogram:
+    """对数分桶直方图:第 i 个桶覆盖 [min_value·growth^(i-1), min_value·growth^i),分位数相对误差约 growth-1;
+    计数存放在定长 array 中,内存与样本数无关"""
+    def __init__(self, min_value: float = 0.1, growth: float = 1.1, buckets: int = 250) -> None:
+        self.min_value = min_value
+        self.growth = growth
+        self._log_growth = math.log(growth)
+        self._counts = array("L", bytes(array("L").itemsize * buckets))
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.min = math.inf
+
+    def add(self, value: float) -> None:
+        """记录一个样本"""
+        if value <= self.min_value:
+            i = 0
+        else:
+            i = min(len(self._counts) - 1, 1 + int(math.log(value / self.min_value) / self._log_growth))
+        self._counts[i] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        if value < self.min:
+            self.min = value
+
+    def quantile(self, q: float) -> float:
+        """估算分位数:取所在桶的几何中点,并限制在实际最小/最大值之间"""
+        if not self.count:
+            return 0.0
+        if q >= 1.0:
+            return self.max
+        rank = q * (self.count - 1) + 1
+        seen = 0
+        for i, c in enumerate(self._counts):
+            seen += c
+            if seen >= rank:
+                if i == 0:
+                    est = self.min_value
+                else:
+                    est = self.min_value * self.growth ** (i - 0.5)
+                return max(self.min, min(self.max, est))
+        return self.max
+
+
+class SelfStats:
+    """监控进程自身的运行统计:按 (类别, 名称) 记录耗时对数直方图与计数(采集项、查询、告警投递、整轮采集),
+    附带进程 RSS/CPU,可写成 JSON 状态文件;--profile 期间对指定轮数的采集做 cProfile/tracemalloc 剖析"""
+    def __init__(self, logger: Optional[logging.Logger] = None, status_path: str = "",
+                 write_interval_seconds: float = 60.0) -> None:
+        self.logger = logger
+        self.status_path = status_path
+        self.write_interval_seconds = write_interval_seconds
+        self.started_at = time.time()
+        self._timings: Dict[Tuple[str, str], LogHistogram] = {}
+        self._counts: Dict[Tuple[str, str], Dict[str, float]] = {}
+        self._info: Dict[Tuple[str, str], Dict[str, str]] = {}
+        self._query_keys: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._written = time.monotonic()
+        self._cpu_prev: Optional[Tuple[float, float]] = None
+        self._profile_cycles = 0
+        self._profile_dir = ""
+        self._profiles: List[Any] = []
+        self._profiled = 0
+
+    def observe(self, kind: str, name: str, seconds: Optional[float] = None, **counts: float) -> None:
+        """记录一次耗时(毫秒直方图)并累加计数,例如 rows、errors、retries"""
+        key = (kind, name)
+        with self._lock:
+            if seconds is not None:
+                hist = self._timings.get(key)
+                if hist is None:
+                    hist = self._timings[key] = LogHistogram(min_value=0.01, growth=1.1, buckets=250)
+                hist.add(seconds * 1000.0)
+            if counts:
+                c = self._counts.setdefault(key, {})
+                for k, v in counts.items():
+                    c[k] = c.get(k, 0) + v
+
+    @contextlib.contextmanager
+    def timed(self, kind: str, name: str, scope: bool = False) -> Iterator[None]:
+        """计时一段代码,异常计入 errors;scope 时把名称设为当前线程的采集项,供查询统计归属"""
+        prev = getattr(self._local, "scope", None)
+        if scope:
+            self._local.scope = name
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.observe(kind, name, time.perf_counter() - start, errors=1)
+            raise
+        finally:
+            if scope:
+                self._local.scope = prev
+        self.observe(kind, name, time.perf_counter() - start)
+
+    def query_key(self, sql: str) -> str:
+        """查询统计的键:当前采集项 + 语句文本摘要;首次出现时保存压缩空白后的语句开头"""
+        scope = getattr(self._local, "scope", None) or "background"
+        digest = self._query_keys.get(sql)
+        if digest is None:
+            digest = hashlib.sha1(sql.encode("utf-8", "replace")).hexdigest()[:8]
+            if len(self._query_keys) >= 1000:
+                self._query_keys.clear()
+            self._query_keys[sql] = digest
+        key = "{}:{}".format(scope, digest)
+        if ("query", key) not in self._info:
+            with self._lock:
+                self._info[("query", key)] = {"collector": scope, "sql": " ".join(sql.split())[:160]}
+        return key
+
+    def process(self) -> Dict[str, Any]:
+        """进程 RSS、峰值 RSS、CPU 时间与距上次读取以来的 CPU 占用"""
+        t = os.times()
+        cpu = t.user + t.system
+        now = time.monotonic()
+        out: Dict[str, Any] = {"pid": os.getpid(), "cpu_user_s": round(t.user, 3), "cpu_system_s": round(t.system, 3),
+                               "cpu_pct": None, "rss_bytes": None, "max_rss_bytes": None,
+                               "threads": threading.active_count()}
+        if self._cpu_prev is not None and now > self._cpu_prev[0]:
+            out["cpu_pct"] = round(100.0 * (cpu - self._cpu_prev[1]) / (now - self._cpu_prev[0]), 2)
+        self._cpu_prev = (now, cpu)
+        try:
+            with open("/proc/self/statm") as f:
+                out["rss_bytes"] = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, IndexError):
+            pass
+        try:
+            import resource
+            # Linux 上 ru_maxrss 单位为 KB
+            out["max_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        except (ImportError, OSError):
+            pass
+        return out
+
+    def status(self) -> Dict[str, Any]:
+        """汇总为可 JSON 序列化的状态:各类别下每个名称的次数、p50/p95/p99/最大耗时(毫秒)、总耗时与计数"""
+        out: Dict[str, Any] = {"ts": time.time(), "started_at": self.started_at,
+                               "uptime_s": round(time.time() - self.started_at, 1), "process": self.process()}
+        with self._lock:
+            keys = set(self._timings) | set(self._counts)
+            for kind, name in sorted(keys):
+                entry: Dict[str, Any] = dict(self._info.get((kind, name), {}))
+                hist = self._timings.get((kind, name))
+                if hist is not None:
+                    entry.update(count=hist.count, total_s=round(hist.total / 1000.0, 3),
+                                 p50_ms=round(hist.quantile(0.5), 3), p95_ms=round(hist.quantile(0.95), 3),
+                                 p99_ms=round(hist.quantile(0.99), 3), max_ms=round(hist.max, 3))
+                entry.update(self._counts.get((kind, name), {}))
+                out.setdefault(kind, {})[name] = entry
+        return out
+
+    def write(self, path: Optional[str] = None) -> None:
+        """把状态原子地写入 JSON 文件(先写临时文件再改名)"""
+        path = path or self.status_path
+        if not path:
+            return
+        tmp = "{}.{}.tmp".format(path, threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.status(), f, ensure_ascii=False, indent=1)
+            os.replace(tmp, path)
+        except Exception as e:
+            if self.logger is not None:
+                self.logger.warning("写入自监控状态文件失败: %s", str(e))
+
+    def start_profile(self, cycles: int, out_dir: str) -> None:
+        """开始剖析接下来的 cycles 轮采集:各线程的 cProfile 结果合并,tracemalloc 记录分配位置"""
+        import tracemalloc
+        self._profile_cycles = max(1, int(cycles))
+        self._profile_dir = out_dir
+        self._profiles = []
+        self._profiled = 0
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+
+    def call(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """执行 fn;剖析期间在当前线程用 cProfile 记录。Python 3.12+ 的剖析器对所有线程生效,
+        已有剖析器在运行时直接执行,由外层的剖析器覆盖"""
+        if not self._profile_cycles:
+            return fn(*args)
+        import cProfile
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:
+            return fn(*args)
+        try:
+            return fn(*args)
+        finally:
+            prof.disable()
+            with self._lock:
+                self._profiles.append(prof)
+
+    def cycle_done(self) -> None:
+        """一轮采集结束:剖析满指定轮数时写出结果,并按 write_interval_seconds 刷新状态文件"""
+        if self._profile_cycles:
+            with self._lock:
+                self._profiled += 1
+                finished = self._profiled >= self._profile_cycles
+            if finished:
+                self.finish_profile()
+        if self.status_path and time.monotonic() - self._written >= self.write_interval_seconds:
+            self._written = time.monotonic()
+            self.write()
+
+    def finish_profile(self) -> Optional[str]:
+        """停止剖析并写出 <目录>/profile_<时间>.pstats 与同名 .txt 摘要,返回 .txt 路径;未在剖析时返回 None"""
+        import pstats
+        import tracemalloc
+        with self._lock:
+            if not self._profile_cycles:
+                return None
+            profiles, cycles = self._profiles, self._profiled
+            self._profile_cycles, self._profiles = 0, []
+        snapshot = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+        current, peak = tracemalloc.get_traced_memory() if snapshot is not None else (0, 0)
+        tracemalloc.stop()
+        base = os.path.join(self._profile_dir or ".", "profile_{}".format(datetime.now().strftime("%Y%m%d_%H%M%S")))
+        buf = io.StringIO()
+        buf.write("剖析轮数: {}\n\n".format(cycles))
+        try:
+            os.makedirs(self._profile_dir or ".", exist_ok=True)
+            if profiles:
+                stats = pstats.Stats(profiles[0], stream=buf)
+                for prof in profiles[1:]:
+                    stats.add(prof)
+                stats.dump_stats(base + ".pstats")
+                stats.sort_stats("cumulative").print_stats(40)
+            if snapshot is not None:
+                buf.write("tracemalloc 当前 {} 峰值 {}\n".format(format_bytes(current), format_bytes(peak)))
+                for stat in snapshot.statistics("lineno")[:25]:
+                    buf.write("{}\n".format(stat))
+            with open(base + ".txt", "w", encoding="utf-8") as f:
+                f.write(buf.getvalue())
+        except Exception as e:
+            if self.logger is not None:
+                self.logger.error("写入剖析结果失败: %s", str(e))
+            return None
+        if self.logger is not None:
+            self.logger.info("剖析完成(%d 轮),结果已写入 %s.txt / .pstats", cycles, base)
+        return base + ".txt"
+
+
+_FP_COMMENTS = re.compile(r"/\*.*?\*/|--[^\n]*", re.S)
+_FP_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_FP_NUMBERS = re.compile(r"\b\d+(?:\.\d+)?\b|\$\d+")
+_FP_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_FP_SPACES = re.compile(r"\s+")
+
+
+def normalize_query(sql: str) -> str:
+    """语句归一化:去注释,字面量与参数替换为 ?,IN 列表折叠,空白压缩并转小写"""
+    sql = _FP_COMMENTS.sub(" ", sql)
+    sql = _FP_STRINGS.sub("?", sql)
+    sql = _FP_NUMBERS.sub("?", sql)
+    sql = _FP_LISTS.sub("(...)", sql)
+    return _FP_SPACES.sub(" ", sql).strip().rstrip(";").lower()
+
+
+def query_fingerprint(normalized: str) -> str:
+    """归一化语句的短指纹,用作指标标签"""
+    return hashlib.sha1(normalized.encode("utf-8", "replace")).hexdigest()[:16]
+
+
+def like_contains(pattern: str) -> str:
+    """子串匹配模式转为 LIKE 模式:转义 \\ % _ 后两端加 %"""
+    return "%" + pattern.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+# 归一化语句保留的最大长度(用于告警与报表展示);指纹按完整文本计算
+NORMALIZED_TEXT_MAX = 2048
+
+
+class QueryNormalizer:
+    """带 LRU 缓存的语句归一化:同一语句文本只做一次正则替换与哈希,
+    慢查询与 csvlog 跟踪共用;缓存条目数固定,超出时淘汰最久未用的。
+    以原文摘要为键、只保存截断后的归一化文本,数 MB 的语句也只占固定大小"""
+    def __init__(self, capacity: int = 10000) -> None:
+        self.capacity = max(1, capacity)
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[bytes, Tuple[str, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def fingerprint(self, sql: str) -> Tuple[str, str]:
+        """返回 (归一化语句, 指纹),归一化语句至多 NORMALIZED_TEXT_MAX 个字符"""
+        key = hashlib.blake2b(sql.encode("utf-8", "replace"), digest_size=16).digest()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+        norm = normalize_query(sql)
+        entry = (norm[:NORMALIZED_TEXT_MAX], query_fingerprint(norm))
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = entry
+            if len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+        return entry
+
+    def stats(self) -> Dict[str, int]:
+        """返回命中/未命中计数与条目数"""
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+def group_slow_queries(rows: List[Dict[str, Any]], normalizer: QueryNormalizer) -> List[Dict[str, Any]]:
+    """按指纹归并运行中的慢语句,按最长运行时间降序"""
+    groups: Dict[str, Dict[str, Any]] = {}
+    for r in rows:
+        norm, fp = normalizer.fingerprint(r.get("query") or "")
+        runtime = float(r.get("runtime_ms") or 0.0)
+        g = groups.get(fp)
+        if g is None:
+            g = groups[fp] = {"fingerprint": fp, "query": norm[:300], "count": 0, "max_runtime_ms": runtime,
+                              "datname": r.get("datname") or "", "pids": []}
+        g["count"] += 1
+        if runtime > g["max_runtime_ms"]:
+            g["max_runtime_ms"] = runtime
+            g["datname"] = r.get("datname") or ""
+        if len(g["pids"]) < 5:
+            g["pids"].append(r.get("pid"))
+    return sorted(groups.values(), key=lambda g: g["max_runtime_ms"], reverse=True)
+
+
+# csvlog 列序号(PG9.0 起前 23 列固定,后续版本只在末尾追加)
+CSV_DATABASE, CSV_SEVERITY, CSV_MESSAGE, CSV_QUERY = 2, 11, 13, 19
+_LOG_DURATION = re.compile(r"duration: ([\d.]+) ms(?:\s+(?:statement|(?:execute|parse|bind) [^:]*): (.*))?", re.S)
+_LOG_TEMP = re.compile(r'temporary file: path "[^"]*", size (\d+)')
+_LOG_LOCK = re.compile(r"process \d+ (still waiting for|acquired) .* after ([\d.]+) ms", re.S)
+_LOG_AUTOVACUUM = re.compile(r'automatic (vacuum|analyze) of table "([^"]+)"')
+_LOG_ELAPSED = re.compile(r"elapsed: ([\d.]+) s")
+
+
+class CsvLogFollower:
+    """增量跟踪 csvlog:只读取新增字节,在引号成对的换行处切出完整记录交给 csv 模块解析;
+    按 (设备, inode) 识别轮转与截断,读取位置持久化到 state_path,重启后从原位置继续"""
+    def __init__(self, directory: str, pattern: str = "*.csv", state_path: str = "", capacity: int = 2000,
+                 chunk_bytes: int = 4 * 1024 * 1024, max_bytes_per_poll: int = 64 * 1024 * 1024,
+                 max_seconds_per_poll: float = 0.0, start_at_end: bool = True, logger: Optional[logging.Logger] = None,
+                 normalizer: Optional[QueryNormalizer] = None) -> None:
+        self.directory = directory
+        self.pattern = pattern
+        self.state_path = state_path
+        self.capacity = max(1, capacity)
+        self.chunk_bytes = max(4096, chunk_bytes)
+        self.max_bytes_per_poll = max(self.chunk_bytes, max_bytes_per_poll)
+        # 单次读取的时间预算(0 表示不限),剩余字节留到下次,保证在采集截止时间内返回
+        self.max_seconds_per_poll = max(0.0, max_seconds_per_poll)
+        # poll 与 drain 在同一把锁内完成,上一次尚未返回时不会并发推进读取位置
+        self.lock = threading.Lock()
+        self.start_at_end = start_at_end
+        self.logger = logger
+        self.normalizer = normalizer if normalizer is not None else QueryNormalizer()
+        self.path: Optional[str] = None
+        self.ident: Optional[Tuple[int, int]] = None
+        self.offset = 0
+        self.lag_bytes = 0
+        self.malformed = 0
+        self._load_state()
+        self._reset()
+
+    def _reset(self) -> None:
+        """清空本周期聚合"""
+        self.bytes_read = 0
+        self.records = 0
+        self.queries: Dict[str, List[Any]] = {}
+        self.dropped = 0
+        self.temp_files = 0
+        self.temp_bytes = 0
+        self.lock_waits = 0
+        self.lock_wait_max_ms = 0.0
+        self.lock_samples: List[str] = []
+        self.autovacuum: Dict[str, float] = {}
+        self.autovacuum_count = 0
+
+    def _files(self) -> List[Tuple[float, str]]:
+        out = []
+        for path in glob.glob(os.path.join(self.directory, self.pattern)):
+            try:
+                out.append((os.stat(path).st_mtime, path))
+            except OSError:
+                continue
+        return sorted(out)
+
+    def _load_state(self) -> None:
+        if not self.state_path or not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                st = json.load(f)
+            self.path, self.offset = st["path"], int(st["offset"])
+            self.ident = (int(st["dev"]), int(st["ino"]))
+        except Exception as e:
+            if self.logger is not None:
+                self.logger.warning("csvlog 读取位置文件无效,重新定位: %s", str(e))
+            self.path, self.ident, self.offset = None, None, 0
+
+    def _save_state(self) -> None:
+        if not self.state_path or self.path is None or self.ident is None:
+            return
+        tmp = self.state_path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"path": self.path, "dev": self.ident[0], "ino": self.ident[1], "offset": self.offset}, f)
+            os.replace(tmp, self.state_path)
+        except OSError as e:
+            if self.logger is not None:
+                self.logger.warning("csvlog 读取位置保存失败: %s", str(e))
+
+    def _open_file(self, path: str, at_end: bool) -> bool:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        self.path, self.ident = path, (st.st_dev, st.st_ino)
+        self.offset = st.st_size if at_end else 0
+        return True
+
+    def _next_file(self) -> Optional[str]:
+        """当前文件之后(按修改时间与文件名排序)的下一个日志文件"""
+        names = [p for _, p in self._files()]
+        if self.path in names:
+            i = names.index(self.path)
+            return names[i + 1] if i + 1 < len(names) else None
+        # 当前文件已被清理:log_filename 带时间戳,按文件名取其后的第一个文件
+        later = sorted(p for p in names if self.path is None or p > self.path)
+        return later[0] if later else None
+
+    @staticmethod
+    def complete_prefix(data: bytes) -> int:
+        """data 中完整记录的字节数:只在引号成对(不在带引号字段内)的换行处切分"""
+        end = pos = parity = 0
+        while True:
+            nl = data.find(b"\n", pos)
+            if nl < 0:
+                return end
+            parity ^= data.count(b'"', pos, nl) & 1
+            pos = nl + 1
+            if not parity:
+                end = pos
+
+    def poll(self) -> int:
+        """读取所有新增的完整记录并累加到本周期聚合,返回读取的字节数"""
+        read = 0
+        stop_at = time.monotonic() + self.max_seconds_per_poll if self.max_seconds_per_poll else None
+        if self.path is None:
+            files = self._files()
+            if not files or not self._open_file(files[-1][1], self.start_at_end):
+                return 0
+        while read < self.max_bytes_per_poll:
+            assert self.path is not None
+            try:
+                st = os.stat(self.path)
+            except OSError:
+                st = None
+            if st is None or (st.st_dev, st.st_ino) != self.ident or st.st_size < self.offset:
+                if st is not None:
+                    # 同名文件被替换或截断(log_truncate_on_rotation):从头读取
+                    self._open_file(self.path, False)
+                    continue
+                nxt = self._next_file()
+                if nxt is None or not self._open_file(nxt, False):
+                    break
+                continue
+            n = self._read(st.st_size) if st.st_size > self.offset else 0
+            if n:
+                read += n
+                if stop_at is not None and time.monotonic() >= stop_at:
+                    break
+                continue
+            nxt = self._next_file()
+            if nxt is None or nxt == self.path:
+                # 末尾是尚未写完的记录,或没有新内容:等下次再读
+                break
+            try:
+                if os.stat(self.path).st_size > st.st_size:
+                    continue
+            except OSError:
+                pass
+            # 已轮转到新文件,旧文件不会再写入,末尾残缺的记录丢弃
+            if not self._open_file(nxt, False):
+                break
+        self._save_state()
+        try:
+            self.lag_bytes = max(0, os.stat(self.path).st_size - self.offset) if self.path else 0
+        except OSError:
+            self.lag_bytes = 0
+        return read
+
+    def _read(self, size: int) -> int:
+        """从当前位置读取至多一个 chunk,解析其中的完整记录,返回消费的字节数"""
+        assert self.path is not None
+        want = min(self.chunk_bytes, size - self.offset)
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read(want)
+            end = self.complete_prefix(data)
+            while not end and len(data) == want and self.offset + want < size:
+                # 单条记录超过 chunk:扩大读取范围直到包含完整记录
+                more = f.read(want)
+                if not more:
+                    break
+                data += more
+                want *= 2
+                end = self.complete_prefix(data)
+        if not end:
+            return 0
+        text = data[:end].decode("utf-8", "replace")
+        del data
+        for row in csv.reader(io.StringIO(text)):
+            self._record(row)
+        self.offset += end
+        self.bytes_read += end
+        return end
+
+    def _query(self, key: str, sql: str) -> List[Any]:
+        entry = self.queries.get(key)
+        if entry is None:
+            if len(self.queries) >= self.capacity:
+                self.dropped += 1
+                key, sql = "other", "(其他语句)"
+                entry = self.queries.get(key)
+            if entry is None:
+                # [直方图, 示例语句, 临时文件字节, 临时文件个数]
+                entry = self.queries[key] = [LogHistogram(), sql[:300], 0, 0]
+        return entry
+
+    def _record(self, row: List[str]) -> None:
+        """把一条 csvlog 记录计入聚合"""
+        if len(row) <= CSV_QUERY:
+            self.malformed += 1
+            return
+        self.records += 1
+        msg = row[CSV_MESSAGE]
+        if msg.startswith("duration: "):
+            m = _LOG_DURATION.match(msg)
+            if not m:
+                return
+            sql = m.group(2) or row[CSV_QUERY]
+            if not sql:
+                return
+            norm, fp = self.normalizer.fingerprint(sql)
+            self._query(fp, norm)[0].add(float(m.group(1)))
+        elif msg.startswith("temporary file: "):
+            m = _LOG_TEMP.match(msg)
+            if not m:
+                return
+            size = int(m.group(1))
+            self.temp_files += 1
+            self.temp_bytes += size
+            if row[CSV_QUERY]:
+                norm, fp = self.normalizer.fingerprint(row[CSV_QUERY])
+                entry = self._query(fp, norm)
+                entry[2] += size
+                entry[3] += 1
+        elif msg.startswith("process "):
+            m = _LOG_LOCK.match(msg)
+            if not m:
+                return
+            wait_ms = float(m.group(2))
+            if m.group(1) == "still waiting for":
+                self.lock_waits += 1
+                if len(self.lock_samples) < 5:
+                    self.lock_samples.append("[{}] {}".format(row[CSV_DATABASE], msg[:200]))
+            self.lock_wait_max_ms = max(self.lock_wait_max_ms, wait_ms)
+        elif msg.startswith("automatic "):
+            m = _LOG_AUTOVACUUM.match(msg)
+            if not m:
+                return
+            e = _LOG_ELAPSED.search(msg)
+            elapsed = float(e.group(1)) if e else 0.0
+            self.autovacuum_count += 1
+            key = "{} {}".format(m.group(1), m.group(2))
+            self.autovacuum[key] = max(self.autovacuum.get(key, 0.0), elapsed)
+
+    def drain(self, top_n: int = 10) -> Dict[str, Any]:
+        """返回自上次 drain 以来的聚合并清空:按总耗时取 Top 语句的 p50/p95/p99,临时文件、锁等待与 autovacuum"""
+        slow = []
+        for key, (hist, sql, temp_bytes, temp_files) in self.queries.items():
+            if hist.count:
+                slow.append({"fingerprint": key, "query": sql, "count": hist.count, "total_ms": round(hist.total, 1),
+                             "p50_ms": round(hist.quantile(0.5), 1), "p95_ms": round(hist.quantile(0.95), 1),
+                             "p99_ms": round(hist.quantile(0.99), 1), "max_ms": round(hist.max, 1)})
+        temp = [{"fingerprint": key, "query": sql, "bytes": b, "files": n}
+                for key, (_, sql, b, n) in self.queries.items() if n]
+        report = {
+            "slow": heapq.nlargest(top_n, slow, key=lambda q: q["total_ms"]),
+            "slow_count": sum(q["count"] for q in slow),
+            "slow_p95_ms_max": max((q["p95_ms"] for q in slow), default=0.0),
+            "temp_files": self.temp_files,
+            "temp_bytes": self.temp_bytes,
+            "temp_top": heapq.nlargest(top_n, temp, key=lambda q: q["bytes"]),
+            "lock_waits": self.lock_waits,
+            "lock_wait_max_ms": self.lock_wait_max_ms,
+            "lock_samples": self.lock_samples,
+            "autovacuum_count": self.autovacuum_count,
+            "autovacuum_max_s": max(self.autovacuum.values(), default=0.0),
+            "autovacuum_top": [{"table": k, "elapsed_s": v} for k, v in heapq.nlargest(
+                top_n, self.autovacuum.items(), key=lambda kv: kv[1])],
+            "records": self.records,
+            "bytes_read": self.bytes_read,
+            "lag_bytes": self.lag_bytes,
+            "dropped": self.dropped,
+        }
+        self._reset()
+        return report
+
+
+def log_families(instance: str, logs: Dict[str, Any], prefix: str = "pg_monitor_log_") -> List[MetricFamily]:
+    """把 csvlog 周期聚合中的 Top 语句转换为按指纹标注的指标族"""
+    samples = []
+    for q in logs.get("slow", []):
+        for quantile in ("p50", "p95", "p99"):
+            samples.append(({"instance": instance, "fingerprint": q["fingerprint"], "quantile": quantile}, q[quantile + "_ms"]))
+    return [
+        MetricFamily(prefix + "query_duration_ms", "gauge",
+                     "Logged statement duration quantiles per query fingerprint since the previous collection", samples),
+        MetricFamily(prefix + "query_temp_bytes", "gauge", "Temporary file bytes per query fingerprint since the previous collection",
+                     [({"instance": instance, "fingerprint": q["fingerprint"]}, q["bytes"]) for q in logs.get("temp_top", [])]),
+    ]
+
+
+# 各采集项:失败/超时时的缺省结果、对应的告警指标名与写入存储的指标键
+COLLECTORS: Dict[str, Tuple[Callable[[], Any], Tuple[str, ...], Tuple[str, ...]]] = {
+    "connections": (lambda: {"total": 0, "active": 0, "idle": 0}, ("连接总数", "活跃连接"),
+                    ("connections_total", "connections_active", "connections_idle")),
+    "locks": (lambda: {"blocking": [], "roots": [], "root_total": 0, "cycles": [], "blocked_total": 0, "max_depth": 0, "max_wait_ms": 0.0},
+              ("锁等待", "锁阻塞会话数"),
+              ("lock_max_wait_ms", "lock_blocked_sessions", "lock_root_blockers", "lock_max_chain_depth")),
+    "deadlocks": (lambda: 0, ("死锁次数(增量)",), ("deadlocks_delta", "deadlocks_total")),
+    "cpu": (lambda: 0.0, ("CPU时间增量(ms)",), ("cpu_time_delta_ms", "cpu_ms_total")),
+    "temp": (lambda: 0, ("临时文件增量(字节)",), ("temp_bytes_delta", "temp_bytes_total")),
+    "shared_buffers": (lambda: 0, (), ("shared_buffers_bytes",)),
+    "slow_queries": (lambda: [], ("慢查询数量",), ("slow_query_count",)),
+    "bloat": (lambda: {"table": [], "index": [], "scanned": [], "max_pct": 0.0}, ("膨胀比例(最大)",), ("bloat_max_pct",)),
+    "replication": (lambda: {"standby": False, "lag_s": 0.0, "lag_bytes": 0.0, "wal_bps": None, "standbys": [], "slots": [],
+                             "slot_retained_bytes_max": 0.0, "slots_inactive": 0, "wal_free_bytes": None},
+                    ("复制延迟(秒)", "复制延迟(字节)", "复制槽保留WAL(字节)"),
+                    ("replication_lag_s", "replication_lag_bytes", "wal_bytes_per_second", "replication_standbys",
+                     "replication_slot_retained_bytes_max", "replication_slots_inactive")),
+    "vacuum": (lambda: {"databases": [], "xid_age_max": 0, "mxid_age_max": 0, "wraparound_pct": 0.0, "xid_per_second": None,
+                        "hours_to_wraparound": None, "vacuums": [], "vacuum_eta_max_s": 0.0, "holders": [],
+                        "xmin_horizon_age": 0, "xmin_holder_max_s": 0.0},
+               ("事务ID回卷余量(%)", "xmin视界持有(秒)", "vacuum预计剩余(秒)"),
+               ("xid_age_max", "mxid_age_max", "wraparound_pct", "xid_per_second", "hours_to_wraparound", "vacuum_running",
+                "vacuum_eta_max_s", "xmin_horizon_age", "xmin_holder_max_s")),
+    "disk": (lambda: {"databases": [], "tablespaces": [], "db_total_bytes": 0, "ts_max_bytes": 0,
+                      "db_growth_bytes_per_hour": 0.0, "ts_max_growth_bytes_per_hour": 0.0,
+                      "db_hours_to_critical": None, "ts_hours_to_critical": None},
+             ("数据库总占用(字节)", "表空间占用最大(字节)"),
+             ("disk_db_total_bytes", "disk_ts_max_bytes", "disk_db_growth_bytes_per_hour",
+              "disk_ts_growth_bytes_per_hour", "disk_db_hours_to_critical", "disk_ts_hours_to_critical")),
+    "statements": (lambda: {}, ("单类语句耗时(ms)",), ("top_statement_exec_ms",)),
+    "host": (lambda: {"summary": None, "filesystems": [], "backends": []},
+             ("主机CPU使用率(%)", "主机内存使用率(%)", "文件系统使用率(%)"),
+             ("host_cpu_pct", "host_cpu_pct_max", "host_iowait_pct", "host_mem_used_pct", "host_swap_used_pct",
+              "host_load1", "host_disk_read_bps", "host_disk_write_bps", "host_disk_busy_pct_max", "host_fs_used_pct",
+              "backend_cpu_ms")),
+    "wait_events": (lambda: {"events": [], "top": [], "aas_total": 0.0, "window_s": 0.0, "mode": ""},
+                    ("等待事件",), ("wait_aas_total", "wait_top_event_aas")),
+    "logs": (lambda: {"slow": [], "slow_count": 0, "slow_p95_ms_max": 0.0, "temp_files": 0, "temp_bytes": 0, "temp_top": [],
+                      "lock_waits": 0, "lock_wait_max_ms": 0.0, "lock_samples": [], "autovacuum_count": 0,
+                      "autovacuum_max_s": 0.0, "autovacuum_top": [], "records": 0, "bytes_read": 0, "lag_bytes": 0, "dropped": 0},
+             ("日志慢语句P95(ms)", "日志临时文件(字节)", "日志锁等待次数"),
+             ("log_slow_count", "log_slow_p95_ms_max", "log_temp_files", "log_temp_bytes", "log_lock_waits",
+              "log_lock_wait_max_ms", "log_autovacuum_count", "log_autovacuum_max_s", "csvlog_lag_bytes")),
+}
+
+# 只读进程内缓冲、不访问数据库的采集项,不参与“数据库采集项全部失败”的判断
+LOCAL_COLLECTORS = ("host", "wait_events", "logs")
+
+
+# 各采集项依赖的快照片段,只有到期的采集项所需片段才并入本次批量语句
+COLLECTOR_FRAGMENTS: Dict[str, Tuple[str, ...]] = {
+    "connections": ("connections",),
+    "locks": ("locks",),
+    "deadlocks": ("deadlocks_total",),
+    "cpu": ("cpu_ms_total",),
+    "temp": ("temp_bytes_total",),
+    "slow_queries": ("slow_queries",),
+    "bloat": ("table_bloat",),
+    "replication": ("replication",),
+    "vacuum": ("vacuum",),
+    "disk": ("databases", "tablespaces", "relpages_estimate"),
+    "host": ("backends",),
+}
+
+
+def hours_to_threshold(size_bytes: float, growth_bytes_per_hour: float, threshold: Optional[float]) -> Optional[float]:
+    """按当前增长速率估算到达阈值的小时数;无阈值或不增长时返回 None,已超过时返回 0"""
+    if threshold is None:
+        return None
+    if size_bytes >= threshold:
+        return 0.0
+    if growth_bytes_per_hour <= 0:
+        return None
+    return round((threshold - size_bytes) / growth_bytes_per_hour, 1)
+
+
+class SizeTracker:
+    """数据库/表空间容量跟踪:每个对象按自身增长速度安排全量刷新,两次刷新之间用估算值"""
+    # 增长速率的 EWMA 平滑系数
+    ALPHA = 0.5
+
+    def __init__(self, min_refresh_seconds: float = 300.0, max_refresh_seconds: float = 21600.0,
+                 refresh_growth_pct: float = 1.0) -> None:
+        self.min_refresh_seconds = min_refresh_seconds
+        self.max_refresh_seconds = max_refresh_seconds
+        self.refresh_growth_pct = refresh_growth_pct
+        self.objects: Dict[str, Dict[str, Dict[str, Any]]] = {"database": {}, "tablespace": {}}
+
+    def fresh(self, kind: str, now: float) -> List[str]:
+        """本周期无需全量刷新的对象名"""
+        return [name for name, o in self.objects[kind].items() if o["next_refresh_at"] > now]
+
+    def _interval(self, o: Dict[str, Any]) -> float:
+        """下一次全量刷新的间隔:预计增长 refresh_growth_pct 所需时间,限制在 [min, max] 之间"""
+        rate = o["rate"]
+        if rate is None:
+            return self.min_refresh_seconds
+        if rate == 0:
+            return self.max_refresh_seconds
+        seconds = o["full_bytes"] * self.refresh_growth_pct / 100.0 / abs(rate) * 3600.0
+        return min(self.max_refresh_seconds, max(self.min_refresh_seconds, seconds))
+
+    def update(self, kind: str, rows: List[Tuple[str, Optional[float]]], now: float,
+               relpages: Optional[Dict[str, float]] = None) -> None:
+        """合并一次查询结果:size 非空为全量值,为空时估算;relpages 为可用 pg_class 估算的对象"""
+        objs = self.objects[kind]
+        relpages = relpages or {}
+        seen = set()
+        for name, size in rows:
+            seen.add(name)
+            o = objs.get(name)
+            if size is not None:
+                size = float(size)
+                if o is not None and now > o["full_at"]:
+                    rate = (size - o["full_bytes"]) / ((now - o["full_at"]) / 3600.0)
+                    o["rate"] = rate if o["rate"] is None else self.ALPHA * rate + (1 - self.ALPHA) * o["rate"]
+                else:
+                    o = objs[name] = {"rate": None}
+                o.update(full_bytes=size, full_at=now, bytes=size, estimated=False, relpages_at_full=relpages.get(name))
+                o["next_refresh_at"] = now + self._interval(o)
+            elif o is not None:
+                base = o["relpages_at_full"]
+                if name in relpages and base is not None:
+                    o["bytes"] = max(0.0, o["full_bytes"] + relpages[name] - base)
+                else:
+                    o["bytes"] = max(0.0, o["full_bytes"] + (o["rate"] or 0.0) * (now - o["full_at"]) / 3600.0)
+                o["estimated"] = True
+        for name in [n for n in objs if n not in seen]:
+            del objs[name]
+
+    def report(self, kind: str, now: float) -> List[Dict[str, Any]]:
+        """各对象当前大小、是否估算、距上次全量刷新的秒数与增长速率(字节/小时)"""
+        key = "datname" if kind == "database" else "spcname"
+        return [{
+            key: name,
+            "size_bytes": int(o["bytes"]),
+            "estimated": o["estimated"],
+            "age_s": int(now - o["full_at"]),
+            "growth_bytes_per_hour": round(o["rate"] or 0.0, 1),
+            "next_refresh_s": int(max(0.0, o["next_refresh_at"] - now)),
+        } for name, o in sorted(self.objects[kind].items())]
+
+
+class ReplicationTracker:
+    """复制吞吐跟踪:按相邻两次采集的 LSN 字节差计算 WAL 生成速率、各备库回放速率与追平时间,
+    以及各复制槽保留 WAL 的增长速率和到达 safe_wal_size/WAL 所在卷写满的预计时间"""
+    def __init__(self) -> None:
+        self._ts: Optional[float] = None
+        self._wal: Optional[float] = None
+        self._replay: Dict[str, float] = {}
+        self._retained: Dict[str, float] = {}
+
+    @staticmethod
+    def _rate(cur: Optional[float], prev: Optional[float], dt: float) -> Optional[float]:
+        """字节/秒;缺少上次值、时间未前进或位置回退(备库重建、槽重建)时返回 None"""
+        if cur is None or prev is None or dt <= 0 or cur < prev:
+            return None
+        return (cur - prev) / dt
+
+    def update(self, row: Dict[str, Any], now: float, wal_free_bytes: Optional[float] = None) -> Dict[str, Any]:
+        """合并一次 REPLICATION_SQL 结果,返回带速率与预计时间的汇总"""
+        dt = now - self._ts if self._ts is not None else 0.0
+        wal = row.get("wal_lsn_bytes")
+        wal_bps = self._rate(wal, self._wal, dt)
+        standbys, replay = [], {}
+        for s in row.get("standbys") or []:
+            key = "{}@{}".format(s.get("name", ""), s.get("client", ""))
+            if s.get("replay_lsn_bytes") is not None:
+                replay[key] = float(s["replay_lsn_bytes"])
+            apply_bps = self._rate(replay.get(key), self._replay.get(key), dt)
+            lag = s.get("replay_lag_bytes")
+            catchup_s = None
+            if lag is not None and lag <= 0:
+                catchup_s = 0.0
+            elif lag is not None and apply_bps is not None and wal_bps is not None and apply_bps > wal_bps:
+                catchup_s = round(lag / (apply_bps - wal_bps), 1)
+            standbys.append(dict(s, apply_bps=apply_bps, catchup_s=catchup_s))
+        slots, retained = [], {}
+        for s in row.get("slots") or []:
+            size = s.get("retained_bytes")
+            if size is not None:
+                retained[s["slot_name"]] = float(size)
+            growth = self._rate(retained.get(s["slot_name"]), self._retained.get(s["slot_name"]), dt)
+            per_hour = growth * 3600.0 if growth else 0.0
+            safe = s.get("safe_wal_size")
+            slots.append(dict(
+                s, growth_bps=growth,
+                hours_to_lost=hours_to_threshold(0.0, per_hour, safe) if safe is not None else None,
+                hours_to_full=hours_to_threshold(0.0, per_hour, wal_free_bytes) if wal_free_bytes is not None else None,
+            ))
+        self._ts, self._wal, self._replay, self._retained = now, wal, replay, retained
+        standbys.sort(key=lambda s: s.get("replay_lag_bytes") or 0.0, reverse=True)
+        slots.sort(key=lambda s: s.get("retained_bytes") or 0.0, reverse=True)
+        standby = bool(row.get("standby"))
+        lags = [s["replay_lag_bytes"] for s in standbys if s.get("replay_lag_bytes") is not None]
+        if standby and row.get("local_replay_lag_bytes") is not None:
+            lags.append(row["local_replay_lag_bytes"])
+        return {
+            "standby": standby,
+            "lag_s": float(row.get("lag_s") or 0.0),
+            "lag_bytes": max(lags, default=0.0),
+            "wal_bps": wal_bps,
+            "standbys": standbys,
+            "slots": slots,
+            "slot_retained_bytes_max": max((s.get("retained_bytes") or 0.0 for s in slots), default=0.0),
+            "slots_inactive": sum(1 for s in slots if not s.get("active")),
+            "wal_free_bytes": wal_free_bytes,
+        }
+
+
+def replication_families(instance: str, repl: Dict[str, Any], prefix: str = "pg_monitor_replication_") -> List[MetricFamily]:
+    """把各备库与复制槽的字节差、回放速率与保留 WAL 转换为按备库/复制槽标注的指标族"""
+    lag_samples, apply_samples, catchup_samples = [], [], []
+    for s in repl.get("standbys", []):
+        labels = {"instance": instance, "standby": s.get("name", ""), "client": s.get("client", "")}
+        for kind in ("sent", "write", "flush", "replay"):
+            if s.get(kind + "_lag_bytes") is not None:
+                lag_samples.append((dict(labels, kind=kind), s[kind + "_lag_bytes"]))
+        if s.get("apply_bps") is not None:
+            apply_samples.append((labels, s["apply_bps"]))
+        if s.get("catchup_s") is not None:
+            catchup_samples.append((labels, s["catchup_s"]))
+    retained, growth = [], []
+    for s in repl.get("slots", []):
+        labels = {"instance": instance, "slot": s["slot_name"], "slot_type": s.get("slot_type", ""),
+                  "active": "1" if s.get("active") else "0"}
+        if s.get("retained_bytes") is not None:
+            retained.append((labels, s["retained_bytes"]))
+        if s.get("growth_bps") is not None:
+            growth.append((labels, s["growth_bps"]))
+    return [
+        MetricFamily(prefix + "standby_lag_bytes", "gauge", "Bytes between the current WAL position and each standby's sent/write/flush/replay position", lag_samples),
+        MetricFamily(prefix + "standby_apply_bytes_per_second", "gauge", "Replay throughput of each standby since the previous collection", apply_samples),
+        MetricFamily(prefix + "standby_catchup_seconds", "gauge", "Estimated seconds until each standby catches up at the current replay and WAL rates", catchup_samples),
+        MetricFamily(prefix + "slot_retained_bytes", "gauge", "WAL retained by each replication slot (current position minus restart_lsn)", retained),
+        MetricFamily(prefix + "slot_retained_growth_bytes_per_second", "gauge", "Growth of WAL retained by each replication slot since the previous collection", growth),
+    ]
+
+
+class VacuumTracker:
+    """冻结年龄与 vacuum 跟踪:按相邻两次快照计算事务号消耗速率与回卷前剩余时间、各 vacuum 的块处理速率与预计剩余时间,
+    并记录每个 xmin 视界持有者从何时起持有同一个 xmin"""
+    # 事务号/MultiXact 年龄达到 2^31 时回卷
+    XID_LIMIT = 2 ** 31
+
+    def __init__(self) -> None:
+        self._ts: Optional[float] = None
+        self._next_xid: Optional[float] = None
+        self._progress: Dict[Tuple[Any, str, str], Tuple[float, float]] = {}
+        self._holders: Dict[Tuple[str, str], Tuple[str, float]] = {}
+
+    @staticmethod
+    def _done(v: Dict[str, Any]) -> Optional[float]:
+        """当前阶段已处理的堆块数:扫描阶段看 heap_blks_scanned,回收阶段看 heap_blks_vacuumed,其余阶段没有块进度"""
+        if v.get("phase") == "scanning heap":
+            return v.get("heap_blks_scanned")
+        if v.get("phase") == "vacuuming heap":
+            return v.get("heap_blks_vacuumed")
+        return None
+
+    def update(self, row: Dict[str, Any], now: float) -> Dict[str, Any]:
+        """合并一次 VACUUM_SQL 结果,返回回卷余量、vacuum 进度与 xmin 视界持有者汇总"""
+        dt = now - self._ts if self._ts is not None else 0.0
+        next_xid = row.get("next_xid")
+        xid_rate = None
+        if next_xid is not None and self._next_xid is not None and dt > 0 and next_xid >= self._next_xid:
+            xid_rate = (next_xid - self._next_xid) / dt
+        databases = []
+        for d in row.get("databases") or []:
+            xid_age, mxid_age = float(d.get("xid_age") or 0), float(d.get("mxid_age") or 0)
+            databases.append(dict(d, xid_pct=round(100.0 * xid_age / self.XID_LIMIT, 2),
+                                  mxid_pct=round(100.0 * mxid_age / self.XID_LIMIT, 2)))
+        databases.sort(key=lambda d: max(d["xid_pct"], d["mxid_pct"]), reverse=True)
+        oldest = databases[0] if databases else None
+        hours_to_wraparound = None
+        if oldest is not None and xid_rate:
+            hours_to_wraparound = round((self.XID_LIMIT - float(oldest["xid_age"] or 0)) / xid_rate / 3600.0, 1)
+
+        vacuums, progress = [], {}
+        for v in row.get("vacuums") or []:
+            key = (v.get("pid"), v.get("relname", ""), v.get("phase", ""))
+            done, total = self._done(v), v.get("heap_blks_total") or 0.0
+            rate = eta = None
+            if done is not None:
+                progress[key] = (now, done)
+                prev = self._progress.get(key)
+                if prev is not None and now > prev[0] and done >= prev[1]:
+                    rate = (done - prev[1]) / (now - prev[0])
+                elif v.get("phase") == "scanning heap" and (v.get("running_s") or 0) > 0:
+                    # 首次见到时按启动以来的平均速率估计
+                    rate = done / v["running_s"]
+                if rate:
+                    eta = round(max(0.0, total - done) / rate, 1)
+            pct = round(100.0 * (done if done is not None else v.get("heap_blks_scanned") or 0.0) / total, 1) if total else 0.0
+            vacuums.append(dict(v, blks_per_s=rate, eta_s=eta, pct=pct))
+        self._progress = progress
+        vacuums.sort(key=lambda v: v["eta_s"] or 0.0, reverse=True)
+
+        holders, seen = [], {}
+        for h in row.get("holders") or []:
+            key = (h.get("kind", ""), h.get("id", ""))
+            prev = self._holders.get(key)
+            if prev is not None and prev[0] == h.get("xmin"):
+                since = prev[1]
+            else:
+                # 首次见到时,已分配事务号或空闲事务中的会话取事务开始时间、预备事务取 PREPARE 时间,
+                # 其余会话与复制槽、备库只能从本次开始计
+                since = h.get("since") if h.get("since") and (prev is None or h["since"] > prev[1]) else now
+                since = min(since, now)
+            seen[key] = (h.get("xmin"), since)
+            holders.append(dict(h, held_s=round(now - since, 1)))
+        self._holders = seen
+        holders.sort(key=lambda h: h.get("xmin_age") or 0, reverse=True)
+        self._ts, self._next_xid = now, next_xid
+        return {
+            "databases": databases,
+            "xid_age_max": max((d["xid_age"] or 0 for d in databases), default=0),
+            "mxid_age_max": max((d["mxid_age"] or 0 for d in databases), default=0),
+            "wraparound_pct": max((max(d["xid_pct"], d["mxid_pct"]) for d in databases), default=0.0),
+            "xid_per_second": xid_rate,
+            "hours_to_wraparound": hours_to_wraparound,
+            "vacuums": vacuums,
+            "vacuum_eta_max_s": max((v["eta_s"] or 0.0 for v in vacuums), default=0.0),
+            "holders": holders,
+            "xmin_horizon_age": max((h.get("xmin_age") or 0 for h in holders), default=0),
+            "xmin_holder_max_s": max((h["held_s"] for h in holders), default=0.0),
+        }
+
+
+def vacuum_families(instance: str, vac: Dict[str, Any], prefix: str = "pg_monitor_") -> List[MetricFamily]:
+    """把各库冻结年龄、各 vacuum 进度与 xmin 视界持有者转换为指标族"""
+    return [
+        MetricFamily(prefix + "database_xid_age", "gauge", "age(datfrozenxid) per database",
+                     [({"instance": instance, "datname": d["datname"]}, d["xid_age"] or 0) for d in vac.get("databases", [])]),
+        MetricFamily(prefix + "database_mxid_age", "gauge", "mxid_age(datminmxid) per database",
+                     [({"instance": instance, "datname": d["datname"]}, d["mxid_age"] or 0) for d in vac.get("databases", [])]),
+        MetricFamily(prefix + "vacuum_progress_pct", "gauge", "Heap blocks processed in the current phase as a percentage of the table for each running vacuum",
+                     [({"instance": instance, "pid": str(v.get("pid")), "datname": v.get("datname") or "", "relname": v.get("relname") or "",
+                        "phase": v.get("phase") or ""}, v["pct"]) for v in vac.get("vacuums", [])]),
+        MetricFamily(prefix + "vacuum_heap_blocks_per_second", "gauge", "Heap blocks processed per second in the current phase of each running vacuum",
+                     [({"instance": instance, "pid": str(v.get("pid")), "relname": v.get("relname") or ""}, v["blks_per_s"])
+                      for v in vac.get("vacuums", []) if v["blks_per_s"] is not None]),
+        MetricFamily(prefix + "xmin_holder_age", "gauge", "Transaction age of the xmin held back by each horizon holder",
+                     [({"instance": instance, "kind": h.get("kind", ""), "id": h.get("id", "")}, h.get("xmin_age") or 0)
+                      for h in vac.get("holders", [])]),
+        MetricFamily(prefix + "xmin_holder_seconds", "gauge", "Seconds each horizon holder has held the same xmin",
+                     [({"instance": instance, "kind": h.get("kind", ""), "id": h.get("id", "")}, h["held_s"])
+                      for h in vac.get("holders", [])]),
+    ]
+
+
+class CollectorSchedule:
+    """采集项调度:基于单调时钟的到期堆,每个采集项有独立的周期、抖动与截止时间"""
+    def __init__(self, intervals: Dict[str, float], deadlines: Dict[str, float], jitter_pct: float = 0.0,
+                 coalesce_seconds: float = 0.0, now: Optional[float] = None,
+                 rnd: Optional[random.Random] = None) -> None:
+        self.intervals = intervals
+        self.deadlines = deadlines
+        self.jitter_pct = jitter_pct
+        self.coalesce_seconds = coalesce_seconds
+        self._rnd = rnd or random.Random()
+        now = time.monotonic() if now is None else now
+        # 计划时间不含抖动,抖动只加在触发时间上,长期平均周期不漂移
+        self._planned: Dict[str, float] = {name: now for name in intervals}
+        self._heap: List[Tuple[float, str]] = [(now, name) for name in sorted(intervals)]
+        heapq.heapify(self._heap)
+
+    @classmethod
+    def from_config(cls, cfg: Dict[str, Any], now: Optional[float] = None) -> "CollectorSchedule":
+        """按 schedule 配置构建;未启用时所有采集项都按 interval_seconds 采集"""
+        sc = cfg.get("schedule", {})
+        enabled = sc.get("enabled", True)
+        base = float(cfg.get("interval_seconds", 300))
+        cycle = float(cfg.get("timeouts", {}).get("cycle_seconds", 120))
+        intervals: Dict[str, float] = {}
+        deadlines: Dict[str, float] = {}
+        for name in COLLECTORS:
+            c = sc.get("collectors", {}).get(name, {}) if enabled else {}
+            intervals[name] = max(1.0, float(c.get("interval_seconds", base)))
+            deadlines[name] = float(c.get("deadline_seconds", min(intervals[name], cycle)))
+        return cls(intervals, deadlines, float(sc.get("jitter_pct", 0)) if enabled else 0.0,
+                   float(sc.get("coalesce_seconds", 0)) if enabled else 0.0, now=now)
+
+    def next_due(self) -> float:
+        """最近一次到期的单调时钟时间"""
+        return self._heap[0][0] if self._heap else math.inf
+
+    def pop_due(self, now: Optional[float] = None) -> List[str]:
+        """取出已到期(含 coalesce_seconds 内即将到期)的采集项并安排下一次;落后超过一个周期时跳过错过的轮次"""
+        now = time.monotonic() if now is None else now
+        due: List[str] = []
+        while self._heap and self._heap[0][0] <= now + self.coalesce_seconds:
+            _, name = heapq.heappop(self._heap)
+            due.append(name)
+            interval = self.intervals[name]
+            planned = self._planned[name] + interval
+            if planned <= now:
+                planned = now + interval
+            self._planned[name] = planned
+            heapq.heappush(self._heap, (planned + self._rnd.uniform(0, interval * self.jitter_pct / 100.0), name))
+        return due
+
+    def deadline(self, names: Iterable[str]) -> float:
+        """一批采集项中最长的截止时间(秒)"""
+        return max((self.deadlines[n] for n in names), default=0.0)
+
+
+class MetricSnapshot(NamedTuple):
+    """单次往返采集得到的指标快照,未采集的字段为 None"""
+    collected_at: float
+    connections: Optional[Dict[str, int]] = None
+    locks: Optional[List[Dict[str, Any]]] = None
+    deadlocks_total: Optional[int] = None
+    temp_bytes_total: Optional[int] = None
+    cpu_ms_total: Optional[float] = None
+    postmaster_start_time: Optional[float] = None
+    slow_queries: Optional[List[Dict[str, Any]]] = None
+    table_bloat: Optional[List[Dict[str, Any]]] = None
+    replication: Optional[Dict[str, Any]] = None
+    vacuum: Optional[Dict[str, Any]] = None
+    databases: Optional[List[Dict[str, Any]]] = None
+    tablespaces: Optional[List[Dict[str, Any]]] = None
+    relpages_estimate: Optional[Dict[str, Any]] = None
+    backends: Optional[List[Dict[str, Any]]] = None
+
+
+class Monitor:
+    """核心监控器"""
+    def __init__(self, cfg: Dict[str, Any], db: DBClient, sender: Union[AlertSender, AlertDispatcher],
+                 logger: logging.Logger, alerts: Optional["AlertManager"] = None,
+                 store: Optional["MetricStore"] = None, exporter: Optional["PrometheusExporter"] = None,
+                 host: Optional[HostSampler] = None, stats: Optional[SelfStats] = None,
+                 collector_pool: Optional[ThreadPoolExecutor] = None) -> None:
+        self.cfg = cfg
+        self.db = db
+        self.sender = sender
+        self.logger = logger
+        # 多实例模式下共享同一个告警管理器,由调度器在整轮结束后统一 flush
+        self._owns_alerts = alerts is None
+        self.alerts = alerts if alerts is not None else AlertManager.from_config(cfg, sender, logger)
+        self.prev_state: Dict[str, Any] = {}
+        self.latest_values: Dict[str, float] = {}
+        self.store = store
+        self.exporter = exporter
+        # 自监控统计在进程内共享,未启用时为 None,各埋点只做一次判空
+        self.stats = stats
+        opts = cfg["options"]
+        bc = cfg.get("bloat_scan", {})
+        self.bloat_scanner = BloatScanner(
+            budget_pages=int(bc.get("budget_pages", 262144)),
+            budget_seconds=float(bc.get("budget_seconds", 20)),
+            stale_after_seconds=float(bc.get("stale_after_seconds", 86400)),
+            candidates_refresh_seconds=float(bc.get("candidates_refresh_seconds", 900)),
+        )
+        # 主机采样由进程内共享;只有数据库与监控同机时才能按后端 pid 读取 /proc
+        self.host = host
+        self._host_since = time.time()
+        hc = cfg.get("host", {})
+        # 主机采样描述的是监控进程所在的机器,只归属于同机的实例;经网络地址连接本机实例时用 db.host_shared 声明
+        self.host_local = host is not None and (
+            is_local_host(str(cfg["db"].get("host", ""))) or bool(cfg["db"].get("host_shared")))
+        self.backend_usage = BackendUsage() if (self.host_local and hc.get("backend_attribution", True)) else None
+        st = cfg.get("size_tracking", {})
+        self.sizes = SizeTracker(
+            min_refresh_seconds=float(st.get("min_refresh_seconds", 300)),
+            max_refresh_seconds=float(st.get("max_refresh_seconds", 21600)),
+            refresh_growth_pct=float(st.get("refresh_growth_pct", 1.0)),
+        )
+        self.statements = StatementsTracker(
+            int(opts.get("statements_capacity", 20000)), int(opts.get("statements_top_n", 10))
+        ) if opts.get("use_pg_stat_statements") else None
+        self.snapshot: Optional[MetricSnapshot] = None
+        self.normalizer = QueryNormalizer(int(opts.get("fingerprint_cache_size", 10000)))
+        self.meta = MetadataCache(float(cfg["options"].get("metadata_cache_ttl_seconds", 3600)))
+        self.instance = str(cfg["db"].get("name") or "{}:{}/{}".format(
+            cfg["db"].get("host"), cfg["db"].get("port"), cfg["db"].get("dbname")))
+        # 各采集项并发执行;只读快照的采集项不占数据库连接,线程数按采集项数量而非连接池大小。
+        # 多实例模式下由 build_fleet 传入所有实例共享的有界线程池
+        self._owns_pool = collector_pool is None
+        self._collector_pool = collector_pool if collector_pool is not None else ThreadPoolExecutor(
+            max_workers=len(COLLECTORS), thread_name_prefix="collector")
+        self.schedule = CollectorSchedule.from_config(cfg)
+        # 未到期的采集项不重新生成语句指标,导出时沿用上次的结果
+        self._statement_families: List[MetricFamily] = []
+        self._wait_families: List[MetricFamily] = []
+        self._log_families: List[MetricFamily] = []
+        self.baselines, self._baseline_path = self._init_baselines()
+        self.replication = ReplicationTracker()
+        self.vacuum = VacuumTracker()
+        self._replication_families: List[MetricFamily] = []
+        self._vacuum_families: List[MetricFamily] = []
+        self._baseline_saved = time.monotonic()
+        wc = cfg.get("wait_sampling", {})
+        self.waits = WaitEventSampler(
+            db, self._wait_sampling_source, float(wc.get("interval_seconds", 1.0)),
+            WaitEventWindow(int(wc.get("capacity", 512)), float(wc.get("window_seconds", 300)), int(wc.get("buckets", 30))),
+            budget=QueryBudget(int(wc.get("statement_timeout_ms", 1000)), 500), logger=logger, name=self.instance,
+        ) if wc.get("enabled", True) else None
+        # 日志只能在数据库主机上读取;多实例模式下按目标配置 db.csvlog_directory
+        lc = cfg.get("csvlog", {})
+        log_dir = cfg["db"].get("csvlog_directory") or ("" if cfg.get("db_targets") else lc.get("directory", ""))
+        self.logs = CsvLogFollower(
+            log_dir, lc.get("pattern", "*.csv"),
+            state_path=lc.get("state_path") or os.path.join(cfg.get("state_dir", "/var/lib/monitor_pg"), "csvlog_{}.json".format(
+                re.sub(r"[^\w.-]", "_", self.instance))),
+            capacity=int(lc.get("capacity", 2000)), chunk_bytes=int(lc.get("chunk_bytes", 4 * 1024 * 1024)),
+            max_bytes_per_poll=int(lc.get("max_bytes_per_poll", 64 * 1024 * 1024)),
+            max_seconds_per_poll=float(lc.get("max_seconds_per_poll") or self.schedule.deadlines["logs"] / 2),
+            start_at_end=bool(lc.get("start_at_end", True)), logger=logger, normalizer=self.normalizer,
+        ) if lc.get("enabled") and log_dir else None
+        self._seed_counters()
+
+    def snapshot_fragments(self, collectors: Optional[Iterable[str]] = None) -> List[str]:
+        """返回本次需要批量采集的快照片段;指定采集项时只包含它们依赖的片段"""
+        opts = self.cfg["options"]
+        names = [
+            "connections", "locks", "deadlocks_total", "temp_bytes_total",
+            "postmaster_start_time", "slow_queries", "databases", "tablespaces", "relpages_estimate",
+        ]
+        if opts.get("collect_bloat"):
+            names.append("table_bloat")
+        if self.backend_usage is not None:
+            names.append("backends")
+        if opts.get("enable_replication_check"):
+            names.append("replication")
+        if opts.get("collect_vacuum"):
+            names.append("vacuum")
+        # pg_stat_kcache 视图不存在时整条语句会失败,只有确认已安装后才并入批量语句
+        if opts.get("use_pg_stat_kcache") and self._ext_installed("pg_stat_kcache"):
+            names.append("cpu_ms_total")
+        if collectors is None:
+            return names
+        # postmaster_start_time 用于校验元数据缓存,每次快照都带上
+        wanted = {"postmaster_start_time"}
+        for name in collectors:
+            wanted.update(COLLECTOR_FRAGMENTS.get(name, ()))
+        return [n for n in names if n in wanted]
+
+    def collect_snapshot(self, fragments: Optional[List[str]] = None,
+                         collectors: Optional[Iterable[str]] = None) -> Optional[MetricSnapshot]:
+        """一次往返批量采集指标快照(未指定片段时取 collectors 依赖的片段),失败时清空快照使各采集项回退逐项查询"""
+        self.meta.validate(getattr(self.db, "generation", 0))
+        names = fragments if fragments is not None else self.snapshot_fragments(collectors)
+        sql = "SELECT\n" + ",\n".join("{} AS {}".format(SNAPSHOT_FRAGMENTS[n], n) for n in names)
+        params = self._snapshot_params()
+        try:
+            row = self.db.execute_one(sql, params) or {}
+        except Exception as e:
+            self.logger.warning("[%s] 批量快照采集失败,回退逐项查询: %s", self.instance, str(e))
+            self.snapshot = None
+            # 失败可能源于过期的扩展信息(例如扩展已被删除),下次重新加载
+            self.meta.invalidate()
+            return None
+        values = {n: row.get(n) for n in names}
+        self.snapshot = MetricSnapshot(collected_at=time.time(), **values)
+        if self.snapshot.postmaster_start_time is not None:
+            self.meta.validate(getattr(self.db, "generation", 0), self.snapshot.postmaster_start_time)
+        return self.snapshot
+
+    def _snapshot_params(self) -> Dict[str, Any]:
+        """快照与回退查询共用的参数"""
+        now = time.time()
+        return {
+            "slow_query_ms": self._slow_query_threshold_ms(),
+            "slow_query_excludes": [like_contains(p) for p in self.cfg.get("slow_query_exclude_patterns", []) if p],
+            "fresh_databases": self.sizes.fresh("database", now),
+            "fresh_tablespaces": self.sizes.fresh("tablespace", now),
+        }
+
+    def _from_snapshot(self, field: str) -> Any:
+        """读取当前快照字段,未采集时返回 None"""
+        if self.snapshot is None:
+            return None
+        return getattr(self.snapshot, field)
+
+    def _slow_query_threshold_ms(self) -> int:
+        """慢查询判定阈值(ms),取 slow_query_ms 的 warning 值"""
+        return int(self.cfg["thresholds"].get("slow_query_ms", {}).get("warning", 5000))
+
+    def _installed_extensions(self) -> List[str]:
+        """返回当前库已安装的扩展列表(经元数据缓存)"""
+        def load() -> List[str]:
+            return [r["extname"] for r in self.db.execute("SELECT extname::text AS extname FROM pg_extension")]
+        return self.meta.get("extensions", load)
+
+    def _counter_delta(self, key: str, total: float) -> float:
+        """累计计数器的周期增量;没有上次值时只建立基线,计数器回绕或重置时记 0"""
+        last = self.prev_state.get(key)
+        self.prev_state[key] = total
+        if last is None:
+            return 0
+        return max(0, total - last)
+
+    def _init_baselines(self) -> Tuple[Optional[BaselineEngine], str]:
+        """按 baseline 配置构建基线引擎并从状态文件恢复;未启用时返回 None"""
+        bc = self.cfg.get("baseline", {})
+        if not bc.get("enabled", True):
+            return None, ""
+        series = list(bc.get("series", BASELINE_SERIES))
+        for key, th in self.cfg["thresholds"].items():
+            if isinstance(th, dict) and th.get("deviation"):
+                series.append(THRESHOLD_SERIES.get(key, key))
+        engine = BaselineEngine(
+            series, halflife_seconds=float(bc.get("halflife_seconds", 3600)),
+            seasonal_halflife_weeks=float(bc.get("seasonal_halflife_weeks", 4)),
+            sketch_halflife_seconds=float(bc.get("sketch_halflife_days", 7)) * 86400,
+            min_samples=int(bc.get("min_samples", 30)),
+        )
+        path = bc.get("state_path") or os.path.join(self.cfg.get("state_dir", "/var/lib/monitor_pg"), "baseline_{}.bin".format(
+            re.sub(r"[^\w.-]", "_", self.instance)))
+        if self.cfg.get("db_targets") and bc.get("state_path"):
+            # 多实例共用同一配置时按实例区分状态文件
+            root, ext = os.path.splitext(path)
+            path = "{}_{}{}".format(root, re.sub(r"[^\w.-]", "_", self.instance), ext)
+        if os.path.exists(path):
+            try:
+                restored = engine.load(path)
+                self.logger.info("[%s] 已恢复 %d 条指标基线", self.instance, restored)
+            except Exception as e:
+                self.logger.warning("[%s] 基线状态文件无效,重新学习: %s", self.instance, str(e))
+        return engine, path
+
+    def save_baselines(self) -> None:
+        """把基线状态写入状态文件"""
+        if self.baselines is None:
+            return
+        try:
+            self.baselines.save(self._baseline_path)
+        except OSError as e:
+            self.logger.warning("[%s] 基线状态保存失败: %s", self.instance, str(e))
+        self._baseline_saved = time.monotonic()
+
+    def _severity(self, key: str, value: float) -> Optional[str]:
+        """按阈值计算严重级别;阈值配置了 deviation 且基线已就绪时改按偏离基线的程度判定"""
+        th = self.cfg["thresholds"].get(key, {})
+        if th.get("deviation") and self.baselines is not None:
+            base = self.baselines.expected(THRESHOLD_SERIES.get(key, key))
+            if base is not None:
+                return baseline_severity(value, th["deviation"], base)
+        return severity_of(value, th)
+
+    def _threshold(self, key: str) -> Dict[str, Any]:
+        """告警中展示的阈值,按基线判定时附带当前基线"""
+        th = self.cfg["thresholds"].get(key, {})
+        if th.get("deviation") and self.baselines is not None:
+            base = self.baselines.expected(THRESHOLD_SERIES.get(key, key))
+            if base is not None:
+                return dict(th, baseline="{}均值 {:.6g} σ {:.3g} p50 {:.3g} p99 {:.3g}".format(
+                    "同时段" if base["seasonal"] else "近期", base["mean"], base["std"], base["p50"], base["p99"]))
+        return th
+
+    def _seed_counters(self) -> None:
+        """从时序存储恢复上次的累计计数器,使重启后的第一个增量仍然正确"""
+        if self.store is None:
+            return
+        max_age = float(self.cfg.get("store", {}).get("seed_max_age_seconds", 3600))
+        for key in COUNTER_METRICS:
+            latest = self.store.latest(self.instance, key)
+            if latest is not None and time.time() - latest[0] <= max_age:
+                self.prev_state.setdefault(key, latest[1])
+
+    def record_metrics(self, values: Dict[str, float], families: Optional[List[MetricFamily]] = None) -> None:
+        """保存本次采集的标量指标,写入时序存储并刷新导出缓存;导出缓存保留未到期采集项的上次值"""
+        self.latest_values = dict(self.latest_values, **values)
+        if self.baselines is not None:
+            self.baselines.update(values)
+            families = (families or []) + baseline_families(self.instance, self.baselines)
+            if time.monotonic() - self._baseline_saved >= float(self.cfg.get("baseline", {}).get("save_interval_seconds", 300)):
+                self.save_baselines()
+        if self.exporter is not None:
+            self.exporter.update("core:" + self.instance, metric_families(self.instance, self.latest_values) + (families or []))
+        if self.store is None:
+            return
+        try:
+            self.store.append(self.instance, values)
+        except Exception as e:
+            self.logger.error("[%s] 写入时序存储失败: %s", self.instance, str(e))
+
+    def _ext_installed(self, ext_name: str) -> bool:
+        """检测扩展是否安装"""
+        return ext_name in self._installed_extensions()
+
+    def get_connection_counts(self) -> Dict[str, int]:
+        """采集连接数统计"""
+        row = self._from_snapshot("connections")
+        if row is None:
+            row = self.db.execute_one(CONNECTION_COUNTS_SQL) or {"total": 0, "active": 0, "idle": 0}
+        return {"total": int(row["total"]), "active": int(row["active"]), "idle": int(row["idle"])}
+
+    def get_lock_contention(self) -> Dict[str, Any]:
+        """采集锁竞争信息"""
+        rows = self._from_snapshot("locks")
+        if rows is None:
+            rows = self.db.execute(LOCK_WAITS_SQL)
+        return analyze_lock_waits(rows)
+
+    def get_deadlocks_delta(self) -> int:
+        """采集死锁增量"""
+        total = self._from_snapshot("deadlocks_total")
+        if total is None:
+            sql = "SELECT COALESCE(SUM(deadlocks),0)::bigint AS deadlocks FROM pg_stat_database"
+            row = self.db.execute_one(sql) or {"deadlocks": 0}
+            total = row["deadlocks"]
+        return int(self._counter_delta("deadlocks_total", int(total)))
+
+    def get_slow_queries(self) -> List[Dict[str, Any]]:
+        """采集慢查询并按语句指纹归并(排除模式已在 SQL 中过滤)"""
+        rows = self._from_snapshot("slow_queries")
+        if rows is None:
+            params = self._snapshot_params()
+            rows = self.db.execute(SLOW_QUERIES_SQL, {k: params[k] for k in ("slow_query_ms", "slow_query_excludes")})
+        return group_slow_queries(rows, self.normalizer)
+
+    def get_cpu_time_delta_ms(self) -> float:
+        """采集 CPU 时间增量(ms)"""
+        if not self.cfg["options"].get("use_pg_stat_kcache"):
+            return 0.0
+        total = self._from_snapshot("cpu_ms_total")
+        if total is None:
+            if not self._ext_installed("pg_stat_kcache"):
+                return 0.0
+            row = self.db.execute_one("SELECT COALESCE(SUM(user_time + system_time),0)::bigint AS cpu_ms FROM pg_stat_kcache")
+            total = row["cpu_ms"] if row else 0.0
+        return float(self._counter_delta("cpu_ms_total", float(total)))
+
+    def get_memory_pressure_delta_bytes(self) -> int:
+        """采集临时文件字节增量以评估内存压力"""
+        total = self._from_snapshot("temp_bytes_total")
+        if total is None:
+            row = self.db.execute_one("SELECT COALESCE(SUM(temp_bytes),0)::bigint AS temp_bytes FROM pg_stat_database")
+            total = row["temp_bytes"] if row else 0
+        return int(self._counter_delta("temp_bytes_total", int(total)))
+
+    def get_shared_buffers_bytes(self) -> int:
+        """获取 shared_buffers 配置值(字节)"""
+        def load() -> int:
+            row = self.db.execute_one("SELECT setting, unit FROM pg_settings WHERE name='shared_buffers'")
+            if not row:
+                return 0
+            return setting_to_bytes(row["setting"], row.get("unit"))
+        return int(self.meta.get("shared_buffers_bytes", load))
+
+    def get_bloat(self) -> Dict[str, Any]:
+        """采集表/索引膨胀估计"""
+        if not self.cfg["options"].get("collect_bloat"):
+            return {"table": [], "index": [], "max_pct": 0.0}
+        rows = self._from_snapshot("table_bloat")
+        if rows is None:
+            rows = self.db.execute(TABLE_BLOAT_SQL)
+        max_pct = max([float(r["dead_ratio"]) for r in rows], default=0.0)
+        scanned: List[Dict[str, Any]] = []
+        if self._ext_installed("pgstattuple"):
+            try:
+                self.scan_bloat_slice()
+            except Exception as e:
+                self.logger.warning("[%s] 膨胀增量扫描失败: %s", self.instance, str(e))
+            scanned = self.bloat_scanner.report(time.time())
+            max_pct = max(max_pct, self.bloat_scanner.max_pct())
+        idx_rows = [r for r in scanned if r["kind"] == "index"]
+        return {"table": rows, "index": idx_rows, "scanned": scanned, "max_pct": max_pct}
+
+    def scan_bloat_slice(self) -> int:
+        """在预算内扫描一批关系的 pgstattuple 膨胀,每次扫描带 statement_timeout/lock_timeout 保护"""
+        scanner = self.bloat_scanner
+        bc = self.cfg.get("bloat_scan", {})
+        now = time.time()
+        if scanner.candidates_due(now):
+            scanner.set_candidates(self.db.execute(BLOAT_CANDIDATES_SQL), now)
+        deadline = time.monotonic() + scanner.budget_seconds
+        scanned = 0
+        for cand in scanner.plan(now):
+            if scanned and time.monotonic() >= deadline:
+                break
+            sql = BLOAT_SCAN_SQL[scanner.method_of(cand)]
+            try:
+                rows = self.db.execute_guarded(
+                    sql, (int(cand["relid"]),),
+                    statement_timeout_ms=int(bc.get("statement_timeout_ms", 15000)),
+                    lock_timeout_ms=int(bc.get("lock_timeout_ms", 1000)),
+                )
+                pct = rows[0]["bloat_pct"] if rows else None
+            except Exception as e:
+                pct = None
+                self.logger.warning("[%s] 膨胀扫描 %s.%s 失败: %s", self.instance, cand["schemaname"], cand["relname"], str(e))
+            scanner.record(cand, pct, time.time())
+            scanned += 1
+        return scanned
+
+    def get_replication(self) -> Dict[str, Any]:
+        """采集复制状态:各备库与复制槽的字节差,以及按 LSN 增量计算的 WAL 生成速率、回放速率与追平时间"""
+        if not self.cfg["options"].get("enable_replication_check"):
+            return COLLECTORS["replication"][0]()
+        row = self._from_snapshot("replication")
+        if row is None:
+            row = self.db.execute_one(REPLICATION_SQL) or {}
+        # WAL 所在卷的剩余空间只用于估算复制槽写满时间
+        return self.replication.update(row, time.time(), self._wal_free_bytes() if row.get("slots") else None)
+
+    def get_vacuum(self) -> Dict[str, Any]:
+        """采集各库冻结年龄、运行中 vacuum 的进度速率与预计剩余时间,以及 xmin 视界持有者及其持有时长"""
+        if not self.cfg["options"].get("collect_vacuum"):
+            return COLLECTORS["vacuum"][0]()
+        row = self._from_snapshot("vacuum")
+        if row is None:
+            row = self.db.execute_one(VACUUM_SQL) or {}
+        return self.vacuum.update(row, time.time())
+
+    def _wal_free_bytes(self) -> Optional[float]:
+        """WAL 所在卷的剩余空间:配置了 replication.wal_path 或与数据库同机且能读取 data_directory 时可用"""
+        path = self.cfg.get("replication", {}).get("wal_path", "")
+        if not path and is_local_host(str(self.cfg["db"].get("host", ""))):
+            def load() -> str:
+                # data_directory 需要超级用户或 pg_read_all_settings,读取失败时不再重试直到缓存过期
+                try:
+                    row = self.db.execute_one("SELECT current_setting('data_directory') AS data_directory")
+                except Exception:
+                    return ""
+                return str((row or {}).get("data_directory") or "")
+            data_dir = self.meta.get("data_directory", load)
+            path = os.path.join(data_dir, "pg_wal") if data_dir else ""
+        if not path:
+            return None
+        try:
+            st = os.statvfs(path)
+        except OSError:
+            return None
+        return float(st.f_bavail * st.f_frsize)
+
+    def get_statement_deltas(self) -> Dict[str, List[Dict[str, Any]]]:
+        """采集 pg_stat_statements(及 pg_stat_kcache)周期增量 Top-N,未启用或未安装时返回空"""
+        if self.statements is None or not self._ext_installed("pg_stat_statements"):
+            return {}
+        if self.cfg["options"].get("use_pg_stat_kcache") and self._ext_installed("pg_stat_kcache"):
+            sql = STATEMENTS_SQL.format(
+                cpu="COALESCE(SUM(k.exec_user_time + k.exec_system_time), 0)::float8 * 1000",
+                join=STATEMENTS_KCACHE_JOIN)
+        else:
+            sql = STATEMENTS_SQL.format(cpu="0::float8", join="")
+        # 多取一行,用于判断实例上的条目是否超过了跟踪容量
+        rows = self.db.execute(sql, {"limit": self.statements.capacity + 1})
+        top = self.statements.update(
+            (int(r["queryid"]), float(r["calls"] or 0), float(r["exec_ms"] or 0),
+             float(r["temp_blks"] or 0), float(r["cpu_ms"] or 0))
+            for r in rows
+        )
+        del rows
+        ids = sorted({item["queryid"] for items in top.values() for item in items})
+        texts: Dict[int, str] = {}
+        if ids:
+            for r in self.db.execute(
+                "SELECT DISTINCT ON (queryid) queryid, left(query, 300) AS query "
+                "FROM pg_stat_statements WHERE queryid = ANY(%s)", (ids,)
+            ):
+                texts[int(r["queryid"])] = r["query"] or ""
+        for items in top.values():
+            for item in items:
+                item["query"] = texts.get(item["queryid"], "")
+        return top
+
+    def _wait_sampling_source(self) -> Tuple[str, str]:
+        """等待事件采样语句:安装 pg_wait_sampling 时读取其 profile,否则轮询 pg_stat_activity(PG14+ 带 query_id)"""
+        if self.cfg.get("wait_sampling", {}).get("use_pg_wait_sampling", True) and self._ext_installed("pg_wait_sampling"):
+            return "profile", WAIT_PROFILE_SQL
+        version = self.meta.get("server_version_num", lambda: int(
+            (self.db.execute_one("SELECT current_setting('server_version_num')::int AS v") or {}).get("v") or 0))
+        return "activity", WAIT_ACTIVITY_SQL.format(queryid="COALESCE(query_id, 0)" if version >= 140000 else "0::bigint")
+
+    def get_wait_events(self) -> Dict[str, Any]:
+        """等待事件窗口汇总,只读后台采样线程的结果,不增加本周期的数据库往返"""
+        if self.waits is None:
+            return COLLECTORS["wait_events"][0]()
+        return self.waits.report(int(self.cfg.get("wait_sampling", {}).get("top_n", 10)))
+
+    def get_log_events(self) -> Dict[str, Any]:
+        """读取 csvlog 新增记录,返回自上次采集以来的慢语句分位数、临时文件、锁等待与 autovacuum 聚合"""
+        if self.logs is None:
+            return COLLECTORS["logs"][0]()
+        if not self.logs.lock.acquire(blocking=False):
+            # 上一次超过截止时间仍在读取:本次跳过,其聚合留给下次
+            raise RuntimeError("上一次 csvlog 读取尚未结束")
+        try:
+            self.logs.poll()
+            return self.logs.drain(int(self.cfg.get("csvlog", {}).get("top_n", 10)))
+        finally:
+            self.logs.lock.release()
+
+    def get_disk_usage(self) -> Dict[str, Any]:
+        """采集数据库与表空间占用:到期的对象全量刷新,其余用估算值,并给出增长速率与到达阈值的预计时间"""
+        params = None
+        db_rows = self._from_snapshot("databases")
+        if db_rows is None:
+            params = self._snapshot_params()
+            db_rows = self.db.execute(DATABASE_SIZE_SQL, params)
+        ts_rows = self._from_snapshot("tablespaces")
+        if ts_rows is None:
+            ts_rows = self.db.execute(TABLESPACE_SIZE_SQL, params or self._snapshot_params())
+        est = self._from_snapshot("relpages_estimate")
+        if est is None:
+            est = self.db.execute_one(RELPAGES_ESTIMATE_SQL) or {}
+        now = time.time()
+        relpages = {est["datname"]: float(est["bytes"])} if est.get("datname") else {}
+        self.sizes.update("database", [(r["datname"], r["size_bytes"]) for r in db_rows], now, relpages)
+        self.sizes.update("tablespace", [(r["spcname"], r["size_bytes"]) for r in ts_rows], now)
+        t = self.cfg["thresholds"]
+        databases = self.sizes.report("database", now)
+        tablespaces = self.sizes.report("tablespace", now)
+        db_total = sum(r["size_bytes"] for r in databases)
+        db_growth = sum(r["growth_bytes_per_hour"] for r in databases)
+        ts_top = max(tablespaces, key=lambda r: r["size_bytes"], default=None)
+        ts_soonest = min((hours_to_threshold(r["size_bytes"], r["growth_bytes_per_hour"], t.get("disk_usage_tablespace_bytes", {}).get("critical"))
+                          for r in tablespaces), key=lambda h: float("inf") if h is None else h, default=None)
+        return {
+            "databases": databases,
+            "tablespaces": tablespaces,
+            "db_total_bytes": db_total,
+            "ts_max_bytes": ts_top["size_bytes"] if ts_top else 0,
+            "db_growth_bytes_per_hour": db_growth,
+            "ts_max_growth_bytes_per_hour": ts_top["growth_bytes_per_hour"] if ts_top else 0.0,
+            "db_hours_to_critical": hours_to_threshold(db_total, db_growth, t.get("disk_usage_database_bytes", {}).get("critical")),
+            "ts_hours_to_critical": ts_soonest,
+        }
+
+    def get_host_usage(self) -> Dict[str, Any]:
+        """汇总上个周期以来的主机采样,同机部署时按后端 pid 归因 CPU 与 I/O;远程实例不附带主机指标"""
+        if self.host is None or not self.host_local:
+            return {"summary": None, "filesystems": [], "backends": []}
+        now = time.time()
+        summary = self.host.summary(self._host_since)
+        self._host_since = now
+        backends: List[Dict[str, Any]] = []
+        if self.backend_usage is not None:
+            rows = self._from_snapshot("backends")
+            if rows is None:
+                rows = self.db.execute(BACKENDS_SQL)
+            backends = self.backend_usage.update(rows, now)
+        return {"summary": summary, "filesystems": self.host.filesystems, "backends": backends}
+
+    def build_message(self, metric: str, value: Any, threshold: Any, severity: str, details: str, action: str) -> str:
+        """构建告警消息文本"""
+        title = self.cfg["templates"]["title"].format(severity=severity, metric=metric, instance=self.instance)
+        body = self.cfg["templates"]["body"].format(
+            timestamp=now_ts(),
+            instance=self.instance,
+            metric=metric,
+            value=value,
+            threshold=threshold,
+            severity=severity,
+            details=details,
+            action=action,
+        )
+        return "{}\n{}".format(title, body)
+
+    def query_budget(self, collector: str) -> QueryBudget:
+        """采集项的语句/锁超时预算,timeouts.collectors 中的单项配置优先"""
+        t = self.cfg.get("timeouts", {})
+        c = t.get("collectors", {}).get(collector, {})
+        return QueryBudget(int(c.get("statement_timeout_ms", t.get("statement_timeout_ms", 10000))),
+                           int(c.get("lock_timeout_ms", t.get("lock_timeout_ms", 2000))))
+
+    def _run_collector(self, name: str, fn: Callable[[], Any]) -> Any:
+        """在采集项自己的超时预算下执行,启用自监控时记录耗时并把其中的查询归属到该采集项"""
+        with self.db.budget(self.query_budget(name)):
+            if self.stats is None:
+                return fn()
+            with self.stats.timed("collector", name, scope=True):
+                return self.stats.call(fn)
+
+    def _submit_collector(self, owners: Dict[Future, object], name: str, fn: Callable[[], Any]) -> Future:
+        """提交采集项到线程池,其取用的连接归属于新的标记"""
+        owner = object()
+
+        def run() -> Any:
+            with self.db.owner(owner):
+                return self._run_collector(name, fn)
+
+        fut = self._collector_pool.submit(run)
+        owners[fut] = owner
+        return fut
+
+    def _collectors(self, names: Optional[Iterable[str]] = None) -> List[Tuple[str, Callable[[], Any]]]:
+        """本次要执行的采集项,未指定时为全部"""
+        collectors = [
+            ("connections", self.get_connection_counts),
+            ("locks", self.get_lock_contention),
+            ("deadlocks", self.get_deadlocks_delta),
+            ("cpu", self.get_cpu_time_delta_ms),
+            ("temp", self.get_memory_pressure_delta_bytes),
+            ("shared_buffers", self.get_shared_buffers_bytes),
+            ("slow_queries", self.get_slow_queries),
+            ("bloat", self.get_bloat),
+            ("replication", self.get_replication),
+            ("vacuum", self.get_vacuum),
+            ("disk", self.get_disk_usage),
+            ("statements", self.get_statement_deltas),
+            ("host", self.get_host_usage),
+            ("wait_events", self.get_wait_events),
+            ("logs", self.get_log_events),
+        ]
+        if names is None:
+            return collectors
+        wanted = set(names)
+        return [(name, fn) for name, fn in collectors if name in wanted]
+
+    def collect_all(self, due: Optional[Iterable[str]] = None) -> Tuple[Dict[str, Any], Dict[str, str]]:
+        """先批量快照,再并发执行采集项;未指定 due 时执行全部且整轮不超过 timeouts.cycle_seconds,
+        否则只执行到期的采集项,每项不超过各自的截止时间;失败或超时的采集项取缺省值"""
+        names = [name for name in COLLECTORS if due is None or name in due]
+        start = time.monotonic()
+        cycle_seconds = float(self.cfg.get("timeouts", {}).get("cycle_seconds", 120))
+        deadlines = {name: start + (cycle_seconds if due is None else self.schedule.deadlines[name]) for name in names}
+        errors: Dict[str, str] = {}
+        self.snapshot = None
+        # 每次提交一个归属标记,超时只取消这些采集项自己的查询,不波及等待事件采样与自定义查询
+        owners: Dict[Future, object] = {}
+        snap = self._submit_collector(owners, "snapshot", lambda: self.collect_snapshot(
+            collectors=None if due is None else names))
+        futures: Dict[Future, str] = {}
+        if wait([snap], timeout=max(0.0, max(deadlines.values(), default=start) - time.monotonic())).done:
+            futures = {self._submit_collector(owners, name, fn): name for name, fn in self._collectors(names)}
+            pending = set(futures)
+            while pending:
+                now = time.monotonic()
+                live = [f for f in pending if deadlines[futures[f]] > now]
+                if not live:
+                    break
+                done, _ = wait(live, timeout=max(0.0, min(deadlines[futures[f]] for f in live) - now),
+                               return_when=FIRST_COMPLETED)
+                pending -= done
+            pending = {f for f in pending if not f.done()}
+        else:
+            pending = {snap}
+        results: Dict[str, Any] = {}
+        for name in names:
+            fut = next((f for f, n in futures.items() if n == name), None)
+            if fut is not None and fut not in pending and fut.exception() is None:
+                results[name] = fut.result()
+                continue
+            if fut is not None and fut not in pending:
+                errors[name] = str(fut.exception())
+            else:
+                errors[name] = "超过截止时间"
+            results[name] = COLLECTORS[name][0]()
+        if pending:
+            for fut in pending:
+                fut.cancel()
+            # 超过截止时间仍在执行的查询在服务端取消,避免拖到下一次
+            cancelled = self.db.cancel([owners[f] for f in pending])
+            self.logger.warning("[%s] 采集项 %s 超过截止时间,取消 %d 条执行中的查询", self.instance,
+                                ",".join(futures.get(f, "snapshot") for f in pending), cancelled)
+        for name, err in errors.items():
+            self.logger.warning("[%s] 采集项 %s 失败: %s", self.instance, name, err)
+        return results, errors
+
+    @staticmethod
+    def _standby_detail(repl: Dict[str, Any]) -> str:
+        """复制延迟告警详情:延迟最大的备库、状态、回放速率与预计追平时间"""
+        wal = "WAL 生成 {}/s".format(format_bytes(repl["wal_bps"])) if repl["wal_bps"] is not None else "WAL 生成速率待下次采集"
+        if repl["standby"] and not repl["standbys"]:
+            return "本机为备库,未回放 {};{}".format(format_bytes(repl["lag_bytes"]), wal)
+        parts = []
+        for s in repl["standbys"][:3]:
+            eta = "追平约 {}".format(format_duration(s["catchup_s"])) if s["catchup_s"] is not None else "未在追赶"
+            apply = format_bytes(s["apply_bps"]) + "/s" if s["apply_bps"] is not None else "-"
+            parts.append("{}({}) {} 回放落后 {} 回放 {} {}".format(
+                s.get("name"), s.get("client"), s.get("state"), format_bytes(s.get("replay_lag_bytes") or 0.0), apply, eta))
+        return "; ".join(parts + [wal]) if parts else "无已连接的备库;" + wal
+
+    @staticmethod
+    def _slot_detail(repl: Dict[str, Any]) -> str:
+        """复制槽告警详情:保留 WAL 最多的复制槽、是否活跃、增长速率与预计失效/写满时间"""
+        parts = []
+        for s in repl["slots"][:3]:
+            text = "{}({}{}) 保留 {}".format(s["slot_name"], s.get("slot_type"), "" if s.get("active") else ",未活跃",
+                                            format_bytes(s.get("retained_bytes") or 0.0))
+            if s.get("growth_bps"):
+                text += " 增长 {}/s".format(format_bytes(s["growth_bps"]))
+            if s.get("wal_status"):
+                text += " wal_status={}".format(s["wal_status"])
+            if s.get("hours_to_lost") is not None:
+                text += " 约 {}h 后超出 max_slot_wal_keep_size".format(s["hours_to_lost"])
+            if s.get("hours_to_full") is not None:
+                text += " 约 {}h 后写满 WAL 所在卷".format(s["hours_to_full"])
+            parts.append(text)
+        return "; ".join(parts)
+
+    @staticmethod
+    def _wraparound_detail(vac: Dict[str, Any]) -> str:
+        """回卷告警详情:冻结年龄最大的库、事务号消耗速率与预计剩余时间,以及该库上运行中的 vacuum"""
+        d = vac["databases"][0]
+        detail = "{} age(datfrozenxid)={} mxid_age={}".format(d["datname"], d["xid_age"], d["mxid_age"])
+        if vac["xid_per_second"] is not None:
+            detail += ",消耗 {:.0f} xid/s".format(vac["xid_per_second"])
+        if vac["hours_to_wraparound"] is not None:
+            detail += ",约 {} 后回卷".format(format_duration(vac["hours_to_wraparound"] * 3600))
+        running = [v for v in vac["vacuums"] if v.get("datname") == d["datname"]]
+        if running:
+            detail += "; 运行中: " + ", ".join("{} {}%".format(v.get("relname"), v["pct"]) for v in running[:3])
+        if vac["holders"]:
+            h = vac["holders"][0]
+            detail += "; 最老 xmin 持有者 {} {} age={}".format(h.get("kind"), h.get("id"), h.get("xmin_age"))
+        return detail
+
+    @staticmethod
+    def _holder_detail(vac: Dict[str, Any]) -> str:
+        """xmin 视界告警详情:持有时间最长的持有者、类型、xmin 年龄与说明"""
+        holders = sorted(vac["holders"], key=lambda h: h["held_s"], reverse=True)[:3]
+        return "; ".join("{} {} [{}] xmin age={} 已持有 {} {}".format(
+            h.get("kind"), h.get("id"), h.get("datname"), h.get("xmin_age"), format_duration(h["held_s"]), (h.get("detail") or "")[:120])
+            for h in holders)
+
+    @staticmethod
+    def _growth_detail(growth_bytes_per_hour: float, hours_to_critical: Optional[float]) -> str:
+        """容量告警详情:增长速率与预计到达 CRITICAL 阈值的时间"""
+        detail = "增长 {:.1f} MB/小时".format(growth_bytes_per_hour / 1024.0 / 1024.0)
+        if hours_to_critical is None:
+            return detail + ",按当前速率不会到达 CRITICAL 阈值"
+        if hours_to_critical == 0:
+            return detail + ",已超过 CRITICAL 阈值"
+        return detail + ",预计 {} 后到达 CRITICAL 阈值".format(format_duration(hours_to_critical * 3600))
+
+    @staticmethod
+    def _lock_detail(locks: Dict[str, Any]) -> str:
+        """锁告警详情:最主要的根阻塞者及其身后的等待链,以及检测到的等待环"""
+        parts = []
+        if locks["roots"]:
+            r = locks["roots"][0]
+            parts.append("根阻塞 pid={} [{}] 事务 {}s,阻塞 {} 个会话(直接 {}),等待链 {} 层: {}".format(
+                r["pid"], r["state"], int(r["xact_age_s"]), r["blocked_count"], r["direct_count"], r["max_depth"], r["query"]))
+            if locks["root_total"] > 1:
+                parts.append("另有 {} 个根阻塞者".format(locks["root_total"] - 1))
+        elif locks["blocking"]:
+            parts.append(locks["blocking"][0]["blocked_query"])
+        if locks["cycles"]:
+            parts.append("等待环: {}".format(" ; ".join("->".join(str(p) for p in c) for c in locks["cycles"][:3])))
+        return "; ".join(parts)
+
+    def raise_alert(self, metric: str, value: Any, threshold: Any, severity: str, details: str, action: str) -> None:
+        """构建告警文本并交给告警管理器去重、合并"""
+        text = self.build_message(metric, value, threshold, severity, details, action)
+        self.alerts.fire(self.instance, metric, severity, text)
+
+    def evaluate_and_alert(self, due: Optional[Iterable[str]] = None) -> None:
+        """执行一轮采集与告警评估;启用自监控时记录整轮耗时,--profile 期间剖析本轮"""
+        if self.stats is None:
+            self._evaluate_and_alert(due)
+            return
+        with self.stats.timed("cycle", self.instance):
+            self.stats.call(self._evaluate_and_alert, due)
+        self.stats.cycle_done()
+
+    def _evaluate_and_alert(self, due: Optional[Iterable[str]] = None) -> None:
+        """评估各项指标并发送告警;指定 due 时只采集到期的采集项,其余指标的告警状态保持不变"""
+        results, errors = self.collect_all(due)
+        skipped = [name for name in COLLECTORS if name not in results]
+        for name in skipped:
+            results[name] = COLLECTORS[name][0]()
+        counts = results["connections"]
+        locks = results["locks"]
+        deadlocks_delta = results["deadlocks"]
+        cpu_delta_ms = results["cpu"]
+        mem_temp_delta = results["temp"]
+        shared_buffers_bytes = results["shared_buffers"]
+        slow_queries = results["slow_queries"]
+        bloat = results["bloat"]
+        repl = results["replication"]
+        repl_lag = repl["lag_s"]
+        vac = results["vacuum"]
+        disk = results["disk"]
+        statements = results["statements"]
+        host = results["host"]
+        host_summary = host["summary"] or {}
+        waits = results["wait_events"]
+        wait_top = next((e for e in waits["events"] if e["event"] != "CPU"), None)
+        logs = results["logs"]
+        top_exec = statements.get("exec_ms", [])
+        failed = [name for name in COLLECTORS if name in errors]
+        # 主机与等待事件汇总只读进程内缓冲,本次执行的其余采集项全部失败即视为数据库不可用
+        ran_db = [name for name in COLLECTORS if name not in skipped and name not in LOCAL_COLLECTORS]
+        db_down = bool(ran_db) and all(name in errors for name in ran_db)
+
+        self.alerts.begin_cycle(self.instance)
+        try:
+            self.alerts.hold(self.instance, [m for name in failed + skipped for m in COLLECTORS[name][1]])
+            if db_down:
+                self.raise_alert("采集失败", len(failed), {}, "CRITICAL", errors[ran_db[0]], "检查数据库可用性与网络")
+            sev = self._severity("connections_total", counts["total"])
+            if sev:
+                details = "total={} active={} idle={}".format(counts["total"], counts["active"], counts["idle"])
+                self.raise_alert("连接总数", counts["total"], self._threshold("connections_total"), sev, details, "启用连接池或减少长连接")
+            sev = self._severity("connections_active", counts["active"])
+            if sev:
+                details = "active={} idle={}".format(counts["active"], counts["idle"])
+                self.raise_alert("活跃连接", counts["active"], self._threshold("connections_active"), sev, details, "排查慢查询与热点锁等待")
+            lock_detail = self._lock_detail(locks)
+            sev = self._severity("lock_wait_ms", locks["max_wait_ms"])
+            if sev:
+                self.raise_alert("锁等待", int(locks["max_wait_ms"]), self._threshold("lock_wait_ms"), sev, lock_detail, "定位阻塞会话并优化或终止")
+            sev = self._severity("lock_blocked_sessions", float(locks["blocked_total"]))
+            if sev:
+                self.raise_alert("锁阻塞会话数", locks["blocked_total"], self._threshold("lock_blocked_sessions"), sev, lock_detail, "优先处理根阻塞会话(提交/回滚或终止)")
+            sev = self._severity("deadlocks", float(deadlocks_delta))
+            if sev:
+                self.raise_alert("死锁次数(增量)", deadlocks_delta, self._threshold("deadlocks"), sev, "最近周期发生死锁", "检查并优化并发事务顺序")
+            slow_total = sum(g["count"] for g in slow_queries)
+            sev = self._severity("slow_query_count", float(slow_total))
+            if sev and slow_queries:
+                detail = "; ".join("fingerprint={} {}个 最长{}ms [{}] {}".format(
+                    g["fingerprint"], g["count"], int(g["max_runtime_ms"]), g["datname"], g["query"][:120])
+                    for g in slow_queries[:3])
+                self.raise_alert("慢查询数量", slow_total, self._threshold("slow_query_count"), sev, detail, "为慢查询添加索引或重写SQL")
+            sev = self._severity("bloat_pct", bloat["max_pct"])
+            if sev:
+                self.raise_alert("膨胀比例(最大)", bloat["max_pct"], self._threshold("bloat_pct"), sev, "建议对高膨胀表执行 VACUUM/重建索引", "规划维护窗口执行整理")
+            sev = self._severity("replication_lag_sec", repl_lag)
+            if sev:
+                self.raise_alert("复制延迟(秒)", int(repl_lag), self._threshold("replication_lag_sec"), sev, self._standby_detail(repl), "检查网络/磁盘性能与WAL生成速率")
+            sev = self._severity("replication_lag_bytes", repl["lag_bytes"])
+            if sev:
+                self.raise_alert("复制延迟(字节)", int(repl["lag_bytes"]), self._threshold("replication_lag_bytes"), sev,
+                                 self._standby_detail(repl), "检查备库回放速度、网络带宽与 WAL 生成速率")
+            sev = self._severity("replication_slot_retained_bytes", repl["slot_retained_bytes_max"])
+            if sev and repl["slots"]:
+                self.raise_alert("复制槽保留WAL(字节)", int(repl["slot_retained_bytes_max"]), self._threshold("replication_slot_retained_bytes"), sev,
+                                 self._slot_detail(repl), "恢复复制槽的消费者,或删除不再使用的复制槽")
+            sev = self._severity("wraparound_pct", vac["wraparound_pct"])
+            if sev and vac["databases"]:
+                self.raise_alert("事务ID回卷余量(%)", vac["wraparound_pct"], self._threshold("wraparound_pct"), sev,
+                                 self._wraparound_detail(vac), "对冻结年龄最大的库/表执行 VACUUM (FREEZE),先清除阻塞 xmin 的持有者")
+            sev = self._severity("xmin_holder_seconds", vac["xmin_holder_max_s"])
+            if sev and vac["holders"]:
+                self.raise_alert("xmin视界持有(秒)", int(vac["xmin_holder_max_s"]), self._threshold("xmin_holder_seconds"), sev,
+                                 self._holder_detail(vac), "结束长事务、提交/回滚预备事务或删除废弃的复制槽")
+            sev = self._severity("vacuum_eta_seconds", vac["vacuum_eta_max_s"])
+            if sev and vac["vacuums"]:
+                v = vac["vacuums"][0]
+                detail = "{}[{}] {} {}% {}块/s,预计剩余 {}".format(
+                    v.get("relname"), v.get("datname"), v.get("phase"), v["pct"], int(v["blks_per_s"] or 0), format_duration(v["eta_s"] or 0))
+                self.raise_alert("vacuum预计剩余(秒)", int(vac["vacuum_eta_max_s"]), self._threshold("vacuum_eta_seconds"), sev, detail,
+                                 "调高 autovacuum_vacuum_cost_limit/maintenance_work_mem 或在低峰期手工 VACUUM")
+            sev = self._severity("disk_usage_database_bytes", float(disk["db_total_bytes"]))
+            if sev:
+                self.raise_alert("数据库总占用(字节)", disk["db_total_bytes"], self._threshold("disk_usage_database_bytes"), sev,
+                                 self._growth_detail(disk["db_growth_bytes_per_hour"], disk["db_hours_to_critical"]), "考虑分区归档或扩容存储")
+            sev = self._severity("disk_usage_tablespace_bytes", float(disk["ts_max_bytes"]))
+            if sev:
+                self.raise_alert("表空间占用最大(字节)", disk["ts_max_bytes"], self._threshold("disk_usage_tablespace_bytes"), sev,
+                                 self._growth_detail(disk["ts_max_growth_bytes_per_hour"], disk["ts_hours_to_critical"]), "扩容或迁移热数据到新表空间")
+            sev = self._severity("cpu_time_delta_ms", float(cpu_delta_ms))
+            if sev and cpu_delta_ms > 0:
+                self.raise_alert("CPU时间增量(ms)", int(cpu_delta_ms), self._threshold("cpu_time_delta_ms"), sev, "周期 CPU 累计时间较高", "优化高 CPU 消耗查询或增加并行度")
+            sev = self._severity("work_mem_pressure_bytes", float(mem_temp_delta))
+            if sev and mem_temp_delta > 0:
+                self.raise_alert("临时文件增量(字节)", int(mem_temp_delta), self._threshold("work_mem_pressure_bytes"), sev, "排序/哈希溢出到磁盘", "增大 work_mem 或优化查询管道")
+            top_ms = top_exec[0]["exec_ms"] if top_exec else 0.0
+            sev = self._severity("top_statement_exec_ms", float(top_ms))
+            if sev:
+                detail = "; ".join("queryid={} {}ms/{}次 {}".format(
+                    q["queryid"], int(q["exec_ms"]), int(q["calls"]), q["query"][:120]) for q in top_exec[:3])
+                self.raise_alert("单类语句耗时(ms)", int(top_ms), self._threshold("top_statement_exec_ms"), sev, detail, "优化 Top 语句或检查执行计划变化")
+            if host_summary:
+                sev = self._severity("host_cpu_pct", host_summary["cpu_pct"])
+                if sev:
+                    detail = "周期平均 {}%,峰值 {}%,iowait {}%".format(
+                        host_summary["cpu_pct"], host_summary["cpu_pct_max"], host_summary["iowait_pct"])
+                    if host["backends"]:
+                        b = host["backends"][0]
+                        detail += "; CPU 最高后端 pid={} {}ms [{}] {}".format(b["pid"], int(b["cpu_ms"]), b["datname"], b["query"][:120])
+                    self.raise_alert("主机CPU使用率(%)", host_summary["cpu_pct"], self._threshold("host_cpu_pct"), sev, detail, "排查高 CPU 查询或扩容")
+                sev = self._severity("host_mem_used_pct", host_summary["mem_used_pct"])
+                if sev:
+                    detail = "内存 {}%,交换区 {}%".format(host_summary["mem_used_pct"], host_summary["swap_used_pct"])
+                    self.raise_alert("主机内存使用率(%)", host_summary["mem_used_pct"], self._threshold("host_mem_used_pct"), sev, detail, "检查 work_mem/连接数或其他进程内存占用")
+                sev = self._severity("host_fs_used_pct", host_summary["fs_used_pct"])
+                if sev:
+                    detail = "; ".join("{} {}%".format(f["mount"], f["used_pct"]) for f in host["filesystems"])
+                    self.raise_alert("文件系统使用率(%)", host_summary["fs_used_pct"], self._threshold("host_fs_used_pct"), sev, detail, "清理日志/归档 WAL 或扩容磁盘")
+            top_wait_aas = wait_top["aas"] if wait_top else 0.0
+            sev = self._severity("wait_event_aas", top_wait_aas)
+            if sev and wait_top:
+                queries = [q for q in waits["top"] if q["event"] == wait_top["event"]][:3]
+                detail = "近 {}s 平均 {} 个会话等待 {}(全部活跃 {});".format(
+                    int(waits["window_s"]), wait_top["aas"], wait_top["event"], waits["aas_total"])
+                detail += "; ".join("queryid={} [{}] {}".format(q["queryid"], q["datname"], q["aas"]) for q in queries)
+                self.raise_alert("等待事件(平均会话数)", top_wait_aas, self._threshold("wait_event_aas"), sev, detail, "按等待事件类型排查 IO/锁/WAL 瓶颈")
+            sev = self._severity("log_slow_p95_ms", float(logs["slow_p95_ms_max"]))
+            if sev and logs["slow"]:
+                q = max(logs["slow"], key=lambda x: x["p95_ms"])
+                detail = "fingerprint={} {}次 p50={}ms p95={}ms max={}ms {}".format(
+                    q["fingerprint"], q["count"], q["p50_ms"], q["p95_ms"], q["max_ms"], q["query"][:120])
+                self.raise_alert("日志慢语句P95(ms)", q["p95_ms"], self._threshold("log_slow_p95_ms"), sev, detail, "优化该类语句或检查执行计划变化")
+            sev = self._severity("log_temp_bytes", float(logs["temp_bytes"]))
+            if sev:
+                detail = "{} 个临时文件".format(logs["temp_files"])
+                if logs["temp_top"]:
+                    q = logs["temp_top"][0]
+                    detail += "; 最多 fingerprint={} {} 字节 {}".format(q["fingerprint"], q["bytes"], q["query"][:120])
+                self.raise_alert("日志临时文件(字节)", logs["temp_bytes"], self._threshold("log_temp_bytes"), sev, detail, "增大 work_mem 或优化排序/哈希")
+            sev = self._severity("log_lock_waits", float(logs["lock_waits"]))
+            if sev:
+                detail = "最长 {}ms; {}".format(int(logs["lock_wait_max_ms"]), "; ".join(logs["lock_samples"][:2]))
+                self.raise_alert("日志锁等待次数", logs["lock_waits"], self._threshold("log_lock_waits"), sev, detail, "定位阻塞会话并缩短事务")
+            self.alerts.end_cycle(self.instance)
+        except Exception as e:
+            self.logger.error("评估告警失败: %s", str(e))
+        if self._owns_alerts:
+            self.alerts.flush()
+
+        if db_down:
+            raise DBUnavailableError("本周期数据库采集项全部失败: {}".format(errors[ran_db[0]]))
+        if "shared_buffers" not in failed and "shared_buffers" not in skipped:
+            self.prev_state["shared_buffers_bytes"] = shared_buffers_bytes
+        values = {
+            "connections_total": counts["total"],
+            "connections_active": counts["active"],
+            "connections_idle": counts["idle"],
+            "lock_max_wait_ms": locks["max_wait_ms"],
+            "lock_blocked_sessions": locks["blocked_total"],
+            "lock_root_blockers": locks["root_total"],
+            "lock_max_chain_depth": locks["max_depth"],
+            "deadlocks_delta": deadlocks_delta,
+            "slow_query_count": sum(g["count"] for g in slow_queries),
+            "bloat_max_pct": bloat["max_pct"],
+            "replication_lag_s": repl_lag,
+            "replication_lag_bytes": repl["lag_bytes"],
+            "wal_bytes_per_second": repl["wal_bps"],
+            "replication_standbys": len(repl["standbys"]),
+            "replication_slot_retained_bytes_max": repl["slot_retained_bytes_max"],
+            "replication_slots_inactive": repl["slots_inactive"],
+            "xid_age_max": vac["xid_age_max"],
+            "mxid_age_max": vac["mxid_age_max"],
+            "wraparound_pct": vac["wraparound_pct"],
+            "xid_per_second": vac["xid_per_second"],
+            "hours_to_wraparound": vac["hours_to_wraparound"],
+            "vacuum_running": len(vac["vacuums"]),
+            "vacuum_eta_max_s": vac["vacuum_eta_max_s"],
+            "xmin_horizon_age": vac["xmin_horizon_age"],
+            "xmin_holder_max_s": vac["xmin_holder_max_s"],
+            "disk_db_total_bytes": disk["db_total_bytes"],
+            "disk_ts_max_bytes": disk["ts_max_bytes"],
+            "disk_db_growth_bytes_per_hour": disk["db_growth_bytes_per_hour"],
+            "disk_ts_growth_bytes_per_hour": disk["ts_max_growth_bytes_per_hour"],
+            "disk_db_hours_to_critical": disk["db_hours_to_critical"],
+            "disk_ts_hours_to_critical": disk["ts_hours_to_critical"],
+            "host_cpu_pct": host_summary.get("cpu_pct"),
+            "host_cpu_pct_max": host_summary.get("cpu_pct_max"),
+            "host_iowait_pct": host_summary.get("iowait_pct"),
+            "host_mem_used_pct": host_summary.get("mem_used_pct"),
+            "host_swap_used_pct": host_summary.get("swap_used_pct"),
+            "host_load1": host_summary.get("load1"),
+            "host_disk_read_bps": host_summary.get("disk_read_bps"),
+            "host_disk_write_bps": host_summary.get("disk_write_bps"),
+            "host_disk_busy_pct_max": host_summary.get("disk_busy_pct_max"),
+            "host_fs_used_pct": host_summary.get("fs_used_pct"),
+            "backend_cpu_ms": sum(b["cpu_ms"] for b in host["backends"]) if self.backend_usage is not None else None,
+            "cpu_time_delta_ms": cpu_delta_ms,
+            "temp_bytes_delta": mem_temp_delta,
+            "shared_buffers_bytes": shared_buffers_bytes,
+            "top_statement_exec_ms": top_exec[0]["exec_ms"] if top_exec else 0.0,
+            "wait_aas_total": waits["aas_total"] if self.waits is not None else None,
+            "wait_top_event_aas": (wait_top["aas"] if wait_top else 0.0) if self.waits is not None else None,
+        }
+        if self.logs is not None:
+            values.update({
+                "log_slow_count": logs["slow_count"],
+                "log_slow_p95_ms_max": logs["slow_p95_ms_max"],
+                "log_temp_files": logs["temp_files"],
+                "log_temp_bytes": logs["temp_bytes"],
+                "log_lock_waits": logs["lock_waits"],
+                "log_lock_wait_max_ms": logs["lock_wait_max_ms"],
+                "log_autovacuum_count": logs["autovacuum_count"],
+                "log_autovacuum_max_s": logs["autovacuum_max_s"],
+                "csvlog_lag_bytes": logs["lag_bytes"],
+            })
+        for key in COUNTER_METRICS:
+            if key in self.prev_state:
+                values[key] = self.prev_state[key]
+        for name in failed:
+            for key in COLLECTORS[name][2]:
+                values.pop(key, None)
+                self.latest_values.pop(key, None)
+        for name in skipped:
+            for key in COLLECTORS[name][2]:
+                values.pop(key, None)
+        if "statements" not in skipped:
+            self._statement_families = statement_families(self.instance, statements)
+        if "replication" not in skipped:
+            self._replication_families = replication_families(self.instance, repl)
+        if "vacuum" not in skipped:
+            self._vacuum_families = vacuum_families(self.instance, vac)
+        if "wait_events" not in skipped:
+            self._wait_families = wait_event_families(self.instance, waits)
+        if "logs" not in skipped and self.logs is not None:
+            self._log_families = log_families(self.instance, logs)
+        self.record_metrics(values, self._statement_families + self._replication_families + self._vacuum_families + self._wait_families + self._log_families)
+
+    def close(self) -> None:
+        """释放自建的采集线程池;共享线程池由创建者关闭"""
+        if self._owns_pool:
+            self._collector_pool.shutdown(wait=False)
+
+    def run_due(self, now: Optional[float] = None) -> List[str]:
+        """执行已到期的采集项并评估告警,返回本次执行的采集项"""
+        due = self.schedule.pop_due(now)
+        if due:
+            self.evaluate_and_alert(due)
+        return due
+
+    def run(self, once: bool = False) -> None:
+        """运行监控循环:once 时执行一次全量采集,否则按各采集项的调度到期执行"""
+        while True:
+            start = time.monotonic()
+            due: Optional[List[str]] = None
+            try:
+                if once:
+                    self.evaluate_and_alert()
+                else:
+                    due = self.run_due()
+            except Exception as e:
+                self.logger.error("监控执行异常: %s\n%s", str(e), traceback.format_exc())
+            if once or due:
+                dur = time.monotonic() - start
+                stats = self.meta.stats()
+                self.logger.info("采集完成(%s),耗时 %.2fs,元数据缓存命中 %d 未命中 %d",
+                                 ",".join(due) if due else "全部", dur, stats["hits"], stats["misses"])
+            if once:
+                break
+            time.sleep(max(0.0, self.schedule.next_due() - time.monotonic()))
+
+
+class FleetScheduler:
+    """多实例并发调度器:每个实例独立 Monitor,由有界线程池并发采集"""
+    def __init__(self, monitors: List[Monitor], max_workers: int, logger: logging.Logger,
+                 alerts: Optional[AlertManager] = None, collector_pool: Optional[ThreadPoolExecutor] = None) -> None:
+        self.monitors = monitors
+        self.logger = logger
+        self.alerts = alerts
+        self.collector_pool = collector_pool
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="monitor_pg")
+        self.inflight: Dict[str, Future] = {}
+
+    def _run_target(self, mon: Monitor, scheduled: bool = False) -> float:
+        """采集单个实例,连接按需建立,返回耗时;scheduled 时只执行到期的采集项"""
+        start = time.time()
+        if mon.db.conn is None:
+            mon.db.connect()
+        if scheduled:
+            mon.run_due()
+        else:
+            mon.evaluate_and_alert()
+        return time.time() - start
+
+    def _finish(self, mon: Monitor, fut: Future) -> str:
+        """收取已结束的采集结果并记录日志"""
+        try:
+            dur = fut.result()
+            self.logger.info("[%s] 采集完成,耗时 %.2fs", mon.instance, dur)
+            return "ok"
+        except Exception as e:
+            mon.db.close()
+            self.logger.error("[%s] 监控执行异常: %s", mon.instance, str(e))
+            return "error"
+
+    def run_cycle(self, timeout: Optional[float] = None) -> Dict[str, str]:
+        """并发执行一轮采集,返回各实例状态(ok/error/timeout/skipped)"""
+        status: Dict[str, str] = {}
+        submitted: Dict[Future, Monitor] = {}
+        for mon in self.monitors:
+            fut = self.inflight.get(mon.instance)
+            if fut is not None and not fut.done():
+                # 上一轮仍未返回的实例本轮跳过,避免慢实例占满线程池
+                status[mon.instance] = "skipped"
+                self.logger.warning("[%s] 上一轮采集仍在进行,本轮跳过", mon.instance)
+                continue
+            fut = self.executor.submit(self._run_target, mon)
+            self.inflight[mon.instance] = fut
+            submitted[fut] = mon
+        done, pending = wait(list(submitted), timeout=timeout)
+        for fut in done:
+            mon = submitted[fut]
+            status[mon.instance] = self._finish(mon, fut)
+        for fut in pending:
+            mon = submitted[fut]
+            status[mon.instance] = "timeout"
+            self.logger.warning("[%s] 采集超过周期仍未完成", mon.instance)
+        if self.alerts is not None:
+            self.alerts.flush()
+        return status
+
+    def tick(self, now: Optional[float] = None) -> Dict[str, str]:
+        """调度一次:收取已结束实例的结果,再为空闲且有到期采集项的实例提交采集,不等待完成"""
+        status: Dict[str, str] = {}
+        for mon in self.monitors:
+            fut = self.inflight.get(mon.instance)
+            if fut is not None and fut.done():
+                del self.inflight[mon.instance]
+                status[mon.instance] = self._finish(mon, fut)
+        now = time.monotonic() if now is None else now
+        for mon in self.monitors:
+            if mon.instance not in self.inflight and mon.schedule.next_due() <= now + mon.schedule.coalesce_seconds:
+                self.inflight[mon.instance] = self.executor.submit(self._run_target, mon, True)
+        if self.alerts is not None:
+            self.alerts.flush()
+        return status
+
+    def next_wakeup(self) -> float:
+        """下一次需要调度的单调时钟时间;有实例在采集时至少每秒检查一次"""
+        now = time.monotonic()
+        wake = min((m.schedule.next_due() for m in self.monitors if m.instance not in self.inflight), default=math.inf)
+        if self.inflight:
+            wake = min(wake, now + 1.0)
+        return wake
+
+    def run(self, once: bool = False) -> None:
+        """运行多实例监控循环:once 时并发执行一轮全量采集,否则按各实例的采集项调度执行"""
+        interval = int(self.monitors[0].cfg.get("interval_seconds", 300)) if self.monitors else 300
+        try:
+            if once:
+                start = time.time()
+                status = self.run_cycle(timeout=interval)
+                failed = sum(1 for v in status.values() if v != "ok")
+                self.logger.info("采集周期完成,耗时 %.2fs,实例 %d 个,异常 %d 个", time.time() - start, len(status), failed)
+                return
+            while True:
+                self.tick()
+                time.sleep(min(60.0, max(0.05, self.next_wakeup() - time.monotonic())))
+        finally:
+            self.executor.shutdown(wait=False)
+
+
+def build_fleet(cfg: Dict[str, Any], sender: Union[AlertSender, AlertDispatcher], logger: logging.Logger,
+                store: Optional[MetricStore] = None, exporter: Optional[PrometheusExporter] = None,
+                host: Optional[HostSampler] = None, stats: Optional[SelfStats] = None) -> FleetScheduler:
+    """根据 db_targets 为每个实例构建独立的 DBClient 与 Monitor;各实例共享一个有界的采集线程池"""
+    alerts = AlertManager.from_config(cfg, sender, logger)
+    pool = ThreadPoolExecutor(max_workers=max(1, int(cfg["options"].get("collector_max_workers", 64))),
+                              thread_name_prefix="collector")
+    monitors = []
+    for target in cfg["db_targets"]:
+        target_cfg = dict(cfg)
+        target_cfg["db"] = target
+        db = DBClient(target_cfg, logger)
+        db.stats = stats
+        monitors.append(Monitor(target_cfg, db, sender, logger, alerts=alerts, store=store, exporter=exporter, host=host,
+                                stats=stats, collector_pool=pool))
+    return FleetScheduler(monitors, int(cfg["options"].get("fleet_max_workers", 16)), logger, alerts=alerts,
+                          collector_pool=pool)
+
+
+def start_custom_queries(cfg: Dict[str, Any], exporter: PrometheusExporter, monitors: List[Monitor],
+                         logger: logging.Logger) -> Optional[CustomQueryRunner]:
+    """按 exporter 配置启动自定义查询线程,查询文件不可用时只记录告警"""
+    ec = cfg["exporter"]
+    if not ec.get("queries_path"):
+        return None
+    try:
+        queries = load_custom_queries(ec["queries_path"], ec.get("custom_queries") or None)
+    except ConfigError as e:
+        logger.warning("自定义查询未启用: %s", str(e))
+        return None
+    runner = CustomQueryRunner(exporter, [(m.instance, m.db) for m in monitors], queries,
+                               float(ec["custom_queries_interval_seconds"]), logger)
+    runner.start()
+    return runner
+
+
+def main(argv: List[str]) -> int:
+    """主函数入口"""
+    import argparse
     parser = argparse.ArgumentParser(prog="monitor_pg", description="PostgreSQL 轻量监控与企业微信告警")
     parser.add_argument("--config", required=False, default=os.environ.get("MONITOR_PG_CONFIG", "monitor/config/config.json"))
     parser.add_argument("--once", action="store_true")
     parser.add_argument("--interval", type=int, default=None)
     parser.add_argument("--log-file", type=str, default=None)
+    parser.add_argument("--profile", type=int, default=0, metavar="N",
+                        help="对接下来 N 轮采集做 cProfile/tracemalloc 剖析,结果写入 --profile-dir")
+    parser.add_argument("--profile-dir", type=str, default=None)
     args = parser.parse_args(argv)
     cfg = validate_config(load_config(args.config))
     if args.interval:
@@ -487,11 +4979,90 @@ def main(argv: List[str]) -> int:
     if args.log_file:
         cfg["log_file"] = args.log_file
     logger = setup_logger(cfg["log_file"])
-    sender = AlertSender(cfg["webhook"]["url"])
-    db = DBClient(cfg, logger)
-    db.connect()
-    mon = Monitor(cfg, db, sender, logger)
-    mon.run(once=args.once)
+    hook = cfg["webhook"]
+    sender = AlertDispatcher(
+        AlertSender(hook["url"], timeout=int(hook["timeout_seconds"])),
+        logger,
+        queue_size=int(hook["queue_size"]),
+        outbox_path=hook["outbox_path"],
+        max_retries=int(hook["max_retries"]),
+        backoff_base_seconds=float(hook["backoff_base_seconds"]),
+        backoff_max_seconds=float(hook["backoff_max_seconds"]),
+        outbox_max_attempts=int(hook["outbox_max_attempts"]),
+        outbox_max_age_seconds=float(hook["outbox_max_age_seconds"]),
+        outbox_max_bytes=int(hook["outbox_max_bytes"]),
+    )
+    sc = cfg["self_stats"]
+    stats = None
+    if sc["enabled"] or args.profile:
+        stats = SelfStats(logger, sc["status_path"], float(sc["write_interval_seconds"]))
+        sender.stats = stats
+        sender.sender.stats = stats
+        if args.profile:
+            stats.start_profile(args.profile, args.profile_dir or cfg["state_dir"])
+    sender.start()
+    store = None
+    try:
+        store = MetricStore.from_config(cfg)
+    except Exception as e:
+        logger.error("时序存储不可用,增量将不会跨重启保存: %s", str(e))
+    exporter = PrometheusExporter(logger) if cfg["exporter"]["enabled"] else None
+    host = None
+    hc = cfg["host"]
+    if hc["enabled"] and os.path.exists("/proc/stat"):
+        host = HostSampler(float(hc["interval_seconds"]), float(hc["retention_seconds"]),
+                           mounts=hc["mounts"], disks=hc["disks"] or None, logger=logger)
+        host.start()
+    runner = None
+    monitors: List[Monitor] = []
+    fleet = None
+    try:
+        if cfg.get("db_targets"):
+            fleet = build_fleet(cfg, sender, logger, store=store, exporter=exporter, host=host, stats=stats)
+            monitors = fleet.monitors
+        else:
+            db = DBClient(cfg, logger)
+            db.stats = stats
+            try:
+                db.connect()
+            except ConfigError:
+                raise
+            except Exception as e:
+                logger.error("数据库暂不可用,将在采集周期内自动重连: %s", str(e))
+            monitors = [Monitor(cfg, db, sender, logger, store=store, exporter=exporter, host=host, stats=stats)]
+        if not args.once:
+            for mon in monitors:
+                if mon.waits is not None:
+                    mon.waits.start()
+        if exporter is not None:
+            if stats is not None:
+                exporter.status = stats.status
+            exporter.serve(cfg["exporter"]["listen"], int(cfg["exporter"]["port"]))
+            runner = start_custom_queries(cfg, exporter, monitors, logger)
+        if fleet is not None:
+            fleet.run(once=args.once)
+        else:
+            monitors[0].run(once=args.once)
+    finally:
+        if runner is not None:
+            runner.stop()
+        for mon in monitors:
+            if mon.waits is not None:
+                mon.waits.stop()
+            mon.save_baselines()
+            mon.close()
+        if fleet is not None and fleet.collector_pool is not None:
+            fleet.collector_pool.shutdown(wait=False)
+        if host is not None:
+            host.stop()
+        if exporter is not None:
+            exporter.shutdown()
+        sender.stop()
+        if stats is not None:
+            stats.finish_profile()
+            stats.write()
+        if store is not None:
+            store.close()
     return 0
 
 
@@ -0,0 +1,816 @@
+#!/usr/bin/env python3
+"""采集周期开销基准:回放录制/合成的目录快照,或在临时本地 PostgreSQL 上实测"""
+import argparse
+import csv
+import io
+import json
+import os
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import Any, Dict, List, Optional, Tuple
+
+MONITOR_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if MONITOR_DIR not in sys.path:
+    sys.path.insert(0, MONITOR_DIR)
+
+import monitor_pg  # noqa: E402
+
+
+DEFAULT_SCALE = {
+    "backends": 500,
+    "locks": 100,
+    "tables": 2000,
+    "indexes": 4000,
+    "databases": 20,
+    "tablespaces": 3,
+    "statements": 5000,
+}
+
+# 逐项回退查询 -> 快照字段,回放时两者返回同一份数据
+FALLBACK_FIELDS = {
+    monitor_pg.CONNECTION_COUNTS_SQL: "connections",
+    monitor_pg.LOCK_WAITS_SQL: "locks",
+    monitor_pg.SLOW_QUERIES_SQL: "slow_queries",
+    monitor_pg.TABLE_BLOAT_SQL: "table_bloat",
+    monitor_pg.DATABASE_SIZE_SQL: "databases",
+    monitor_pg.TABLESPACE_SIZE_SQL: "tablespaces",
+    monitor_pg.RELPAGES_ESTIMATE_SQL: "relpages_estimate",
+    monitor_pg.BACKENDS_SQL: "backends",
+    monitor_pg.REPLICATION_SQL: "replication",
+    monitor_pg.VACUUM_SQL: "vacuum",
+}
+
+
+def classify(sql: str) -> str:
+    """把 Monitor 发出的语句归类为夹具中的键"""
+    if sql.startswith("SELECT\n") and " AS postmaster_start_time" in sql:
+        return "snapshot"
+    if sql in FALLBACK_FIELDS:
+        return "snapshot." + FALLBACK_FIELDS[sql]
+    if "FROM pg_extension" in sql:
+        return "extensions"
+    if "pg_settings" in sql:
+        return "shared_buffers"
+    if "FROM pg_stat_statements s" in sql:
+        return "statements"
+    if "FROM pg_stat_statements WHERE queryid = ANY" in sql:
+        return "statement_texts"
+    if sql == monitor_pg.BLOAT_CANDIDATES_SQL:
+        return "bloat_candidates"
+    if sql in monitor_pg.BLOAT_SCAN_SQL.values():
+        return "bloat_scan"
+    return "other:" + " ".join(sql.split())[:60]
+
+
+def synthetic_fixture(scale: Dict[str, int], seed: int = 1) -> Dict[str, Any]:
+    """按规模生成与录制夹具同格式的目录快照"""
+    rnd = random.Random(seed)
+    n_backends = scale["backends"]
+    backends = [{
+        "pid": 10000 + i, "datname": "db{}".format(i % max(1, scale["databases"])), "usename": "app",
+        "state": "active" if i % 5 == 0 else "idle", "backend_start": 1700000000.0 + i,
+        "query": "SELECT * FROM t{} WHERE id = $1".format(i % max(1, scale["tables"])),
+    } for i in range(n_backends)]
+    locks = []
+    n_waiters = min(scale["locks"], max(0, n_backends - 1))
+    roots = max(1, n_waiters // 20) if n_waiters else 0
+    for i in range(roots):
+        locks.append({"pid": 10000 + i, "blocked_by": [], "wait_ms": 0, "state": "idle in transaction",
+                      "wait_event": None, "usename": "app", "datname": "db0", "xact_age_s": 120.0,
+                      "query": "UPDATE t0 SET v = v + 1"})
+    for i in range(roots, roots + n_waiters):
+        blocker = 10000 + rnd.randrange(i) if i > roots else 10000
+        locks.append({"pid": 10000 + i, "blocked_by": [blocker], "wait_ms": float(rnd.randrange(30000)),
+                      "state": "active", "wait_event": "transactionid", "usename": "app", "datname": "db0",
+                      "xact_age_s": 5.0, "query": "UPDATE t0 SET v = v + 1"})
+    tables = [{"relid": 16384 + i, "schemaname": "public", "relname": "t{}".format(i), "relkind": "r",
+               "amname": "heap", "relpages": rnd.randrange(1, 50000), "reltuples": float(rnd.randrange(1, 10 ** 6)),
+               "n_dead_tup": rnd.randrange(10 ** 4)} for i in range(scale["tables"])]
+    indexes = [{"relid": 116384 + i, "schemaname": "public", "relname": "t{}_idx{}".format(i % max(1, scale["tables"]), i),
+                "relkind": "i", "amname": "btree" if i % 10 else "gist", "relpages": rnd.randrange(1, 20000),
+                "reltuples": float(rnd.randrange(1, 10 ** 6)), "n_dead_tup": 0} for i in range(scale["indexes"])]
+    bloat = sorted(({"schemaname": "public", "relname": t["relname"], "n_live_tup": int(t["reltuples"]),
+                     "n_dead_tup": t["n_dead_tup"],
+                     "dead_ratio": round(100.0 * t["n_dead_tup"] / (t["reltuples"] + t["n_dead_tup"]), 2)}
+                    for t in tables), key=lambda r: r["dead_ratio"], reverse=True)[:20]
+    return {
+        "snapshot": {
+            "connections": {"total": n_backends, "active": n_backends // 5, "idle": n_backends - n_backends // 5},
+            "locks": locks,
+            "deadlocks_total": 0,
+            "temp_bytes_total": 0,
+            "postmaster_start_time": 1700000000.0,
+            "slow_queries": [{"pid": b["pid"], "usename": "app", "datname": b["datname"], "runtime_ms": 12000.0,
+                              "query": b["query"]} for b in backends[::50]],
+            "table_bloat": bloat,
+            "replication": {
+                "standby": False, "wal_lsn_bytes": 5.0e11, "lag_s": 0.5, "local_replay_lag_bytes": None,
+                "standbys": [{"name": "standby{}".format(i), "client": "10.0.0.{}".format(i + 2), "state": "streaming",
+                              "sent_lag_bytes": 0.0, "write_lag_bytes": 8192.0, "flush_lag_bytes": 16384.0,
+                              "replay_lag_bytes": 65536.0, "replay_lsn_bytes": 5.0e11 - 65536, "replay_lag_s": 0.5}
+                             for i in range(2)],
+                "slots": [{"slot_name": "standby{}".format(i), "slot_type": "physical", "database": "", "active": True,
+                           "wal_status": "reserved", "safe_wal_size": None, "retained_bytes": 65536.0,
+                           "confirmed_lag_bytes": None} for i in range(2)],
+            },
+            "vacuum": {
+                "next_xid": 900000000,
+                "databases": [{"datname": "db{}".format(i), "xid_age": rnd.randrange(10 ** 6, 2 * 10 ** 8),
+                               "mxid_age": rnd.randrange(0, 10 ** 6)} for i in range(scale["databases"])],
+                "vacuums": [{"pid": 20000, "datname": "db0", "relname": "public.t0", "phase": "scanning heap",
+                             "heap_blks_total": 100000, "heap_blks_scanned": 25000, "heap_blks_vacuumed": 0,
+                             "index_vacuum_count": 0, "auto": True, "running_s": 120.0}],
+                "holders": [{"kind": "backend", "id": str(b["pid"]), "datname": b["datname"], "xmin": "899990000",
+                             "xmin_age": 10000, "since": 1700000000.0, "detail": b["query"]} for b in backends[:5]],
+            },
+            "databases": [{"datname": "db{}".format(i), "size_bytes": rnd.randrange(10 ** 8, 10 ** 11)}
+                          for i in range(scale["databases"])],
+            "tablespaces": [{"spcname": "ts{}".format(i), "size_bytes": rnd.randrange(10 ** 9, 10 ** 12)}
+                            for i in range(scale["tablespaces"])],
+            "relpages_estimate": {"datname": "db0", "bytes": sum(t["relpages"] for t in tables) * 8192},
+            "backends": backends,
+        },
+        "queries": {
+            "extensions": [{"extname": e} for e in ("plpgsql", "pg_stat_statements", "pgstattuple")],
+            "shared_buffers": [{"setting": "16384", "unit": "8kB"}],
+            "statements": [{"queryid": 1000 + q, "calls": float(rnd.randrange(1, 1000)),
+                            "exec_ms": float(rnd.randrange(1, 10 ** 6)), "temp_blks": float(rnd.randrange(100)),
+                            "cpu_ms": 0.0} for q in range(scale["statements"])],
+            "bloat_candidates": tables + indexes,
+        },
+    }
+
+
+class ReplayDB:
+    """回放夹具的 DBClient 替身:统计往返次数、传输行数与字节数,可模拟网络往返延迟"""
+    def __init__(self, fixture: Dict[str, Any], rtt_ms: float = 0.0) -> None:
+        self.fixture = fixture
+        self.rtt_ms = rtt_ms
+        self.conn = object()
+        self.generation = 1
+        self.cycle = 0
+        self.local = threading.local()
+        self._lock = threading.Lock()
+        self.reset_counters()
+
+    def reset_counters(self) -> None:
+        """清零本周期统计"""
+        with getattr(self, "_lock", threading.Lock()):
+            self.round_trips: Dict[str, int] = {}
+            self.rows: Dict[str, int] = {}
+            self.bytes = 0
+            self.unknown: Dict[str, int] = {}
+
+    def connect(self) -> None:
+        self.generation += 1
+
+    def close(self) -> None:
+        pass
+
+    def budget(self, budget: Any) -> Any:
+        import contextlib
+        return contextlib.nullcontext()
+
+    def owner(self, owner: Any) -> Any:
+        import contextlib
+        return contextlib.nullcontext()
+
+    def cancel(self, owners: Any = None) -> int:
+        return 0
+
+    def _count(self, key: str, result: Any) -> None:
+        collector = getattr(self.local, "collector", "other")
+        if isinstance(result, list):
+            n = len(result)
+        elif isinstance(result, dict) and key == "snapshot":
+            # 快照一行内嵌的 JSON 数组按行计
+            n = 1 + sum(len(v) for v in result.values() if isinstance(v, list))
+        else:
+            n = 1 if result else 0
+        size = len(json.dumps(result, default=str))
+        with self._lock:
+            self.round_trips[collector] = self.round_trips.get(collector, 0) + 1
+            self.rows[collector] = self.rows.get(collector, 0) + n
+            self.bytes += size
+            if key.startswith("other:"):
+                self.unknown[key] = self.unknown.get(key, 0) + 1
+        if self.rtt_ms:
+            time.sleep(self.rtt_ms / 1000.0)
+
+    def _snapshot_field(self, name: str, params: Any) -> Any:
+        value = self.fixture["snapshot"].get(name)
+        if name in ("databases", "tablespaces") and value is not None and isinstance(params, dict):
+            key, fresh = ("datname", "fresh_databases") if name == "databases" else ("spcname", "fresh_tablespaces")
+            skip = set(params.get(fresh) or [])
+            value = [dict(r, size_bytes=None) if r[key] in skip else r for r in value]
+        return value
+
+    def _answer(self, sql: str, params: Any) -> Tuple[str, Any]:
+        key = classify(sql)
+        q = self.fixture["queries"]
+        if key == "snapshot":
+            names = [n for n, frag in monitor_pg.SNAPSHOT_FRAGMENTS.items() if "{} AS {}".format(frag, n) in sql]
+            return key, {n: self._snapshot_field(n, params) for n in names}
+        if key.startswith("snapshot."):
+            return key, self._snapshot_field(key.split(".", 1)[1], params)
+        if key == "statements":
+            # 累计值随周期线性增长,使每个周期都有增量
+            k = self.cycle + 1
+            return key, [dict(r, calls=r["calls"] * k, exec_ms=r["exec_ms"] * k, temp_blks=r["temp_blks"] * k)
+                         for r in q.get("statements", [])]
+        if key == "statement_texts":
+            ids = params[0] if params else []
+            return key, [{"queryid": i, "query": "SELECT /* {} */ 1".format(i)} for i in ids]
+        if key == "bloat_scan":
+            return key, [{"bloat_pct": float(int(params[0]) % 60)}]
+        if key.startswith("other:"):
+            return key, []
+        return key, q.get(key, [])
+
+    def execute(self, sql: str, params: Any = None) -> List[Dict[str, Any]]:
+        key, result = self._answer(sql, params)
+        rows = result if isinstance(result, list) else ([result] if result else [])
+        self._count(key, rows)
+        return [dict(r) for r in rows]
+
+    def execute_one(self, sql: str, params: Any = None) -> Optional[Dict[str, Any]]:
+        key, result = self._answer(sql, params)
+        row = result[0] if isinstance(result, list) and result else (result if isinstance(result, dict) else None)
+        self._count(key, row)
+        return dict(row) if row else None
+
+    def execute_guarded(self, sql: str, params: Any = None, statement_timeout_ms: int = 0,
+                        lock_timeout_ms: int = 0) -> List[Dict[str, Any]]:
+        return self.execute(sql, params)
+
+
+class CountingDB(ReplayDB):
+    """包装真实 DBClient 的计数代理,可把返回结果录制为回放夹具"""
+    def __init__(self, db: monitor_pg.DBClient, record: bool = False) -> None:
+        super().__init__({"snapshot": {}, "queries": {}})
+        self.db = db
+        self.record = record
+
+    @property
+    def generation(self) -> int:  # type: ignore[override]
+        return self.db.generation
+
+    @generation.setter
+    def generation(self, value: int) -> None:
+        pass
+
+    @property
+    def conn(self) -> Any:  # type: ignore[override]
+        return self.db.conn
+
+    @conn.setter
+    def conn(self, value: Any) -> None:
+        pass
+
+    def connect(self) -> None:
+        self.db.connect()
+
+    def close(self) -> None:
+        self.db.close()
+
+    def budget(self, budget: Any) -> Any:
+        return self.db.budget(budget)
+
+    def owner(self, owner: Any) -> Any:
+        return self.db.owner(owner)
+
+    def cancel(self, owners: Any = None) -> int:
+        return self.db.cancel(owners)
+
+    def _keep(self, key: str, result: Any) -> None:
+        if not self.record:
+            return
+        if key == "snapshot":
+            self.fixture["snapshot"].update(result or {})
+        elif key.startswith("snapshot."):
+            self.fixture["snapshot"][key.split(".", 1)[1]] = result
+        elif key not in ("statement_texts", "bloat_scan") and not key.startswith("other:"):
+            self.fixture["queries"][key] = result
+
+    def execute(self, sql: str, params: Any = None) -> List[Dict[str, Any]]:
+        rows = self.db.execute(sql, params)
+        key = classify(sql)
+        self._keep(key, rows)
+        self._count(key, rows)
+        return rows
+
+    def execute_one(self, sql: str, params: Any = None) -> Optional[Dict[str, Any]]:
+        row = self.db.execute_one(sql, params)
+        key = classify(sql)
+        self._keep(key, row if key.startswith("snapshot") else ([row] if row else []))
+        self._count(key, row)
+        return row
+
+    def execute_guarded(self, sql: str, params: Any = None, statement_timeout_ms: int = 15000,
+                        lock_timeout_ms: int = 1000) -> List[Dict[str, Any]]:
+        rows = self.db.execute_guarded(sql, params, statement_timeout_ms, lock_timeout_ms)
+        self._count(classify(sql), rows)
+        return rows
+
+
+class NullSender:
+    """只计数的告警发送器"""
+    def __init__(self) -> None:
+        self.messages = 0
+
+    def submit(self, message: Dict[str, Any]) -> None:
+        self.messages += 1
+
+    def safe_send(self, content: str, retries: int = 3, backoff_seconds: int = 2) -> None:
+        self.messages += 1
+
+
+class InstrumentedMonitor(monitor_pg.Monitor):
+    """记录每个采集项耗时,并让数据库替身知道当前语句属于哪个采集项"""
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.collector_ms: Dict[str, List[float]] = {}
+
+    def _run_collector(self, name: str, fn: Any) -> Any:
+        self.db.local.collector = name
+        start = time.perf_counter()
+        try:
+            return super()._run_collector(name, fn)
+        finally:
+            self.collector_ms.setdefault(name, []).append((time.perf_counter() - start) * 1000.0)
+            self.db.local.collector = "other"
+
+
+def bench_config(db_section: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """基准使用的配置:全部采集项开启,存储与导出关闭"""
+    return monitor_pg.validate_config({
+        "db": db_section or {"host": "bench", "port": 5432, "dbname": "db0", "user": "bench"},
+        "webhook": {"url": "https://example.invalid"},
+        "thresholds": {"connections_total": {"warning": 10 ** 9}},
+        "store": {"enabled": False},
+        "options": {"use_pg_stat_kcache": False},
+    })
+
+
+def _pct(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 3) if ordered else 0.0
+
+
+def run_benchmark(db: ReplayDB, cycles: int = 5, warmup: int = 1, alloc_cycles: int = 1,
+                  cfg: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """执行若干周期的 evaluate_and_alert,返回每周期耗时、往返次数、行数与 Python 分配统计"""
+    logger = monitor_pg.logging.getLogger("bench")
+    logger.setLevel(monitor_pg.logging.ERROR)
+    mon = InstrumentedMonitor(cfg or bench_config(), db, NullSender(), logger)  # type: ignore[arg-type]
+    for _ in range(warmup):
+        mon.evaluate_and_alert()
+        db.cycle += 1
+    mon.collector_ms.clear()
+    wall: List[float] = []
+    trips: List[int] = []
+    rows: List[int] = []
+    sent: List[int] = []
+    per_collector: Dict[str, Dict[str, List[int]]] = {}
+    for _ in range(cycles):
+        db.reset_counters()
+        start = time.perf_counter()
+        mon.evaluate_and_alert()
+        wall.append((time.perf_counter() - start) * 1000.0)
+        db.cycle += 1
+        trips.append(sum(db.round_trips.values()))
+        rows.append(sum(db.rows.values()))
+        sent.append(db.bytes)
+        for name in set(db.round_trips) | set(db.rows):
+            c = per_collector.setdefault(name, {"round_trips": [], "rows": []})
+            c["round_trips"].append(db.round_trips.get(name, 0))
+            c["rows"].append(db.rows.get(name, 0))
+    collectors = {}
+    for name, samples in sorted(mon.collector_ms.items()):
+        counts = per_collector.get(name, {"round_trips": [0], "rows": [0]})
+        collectors[name] = {
+            "p50_ms": _pct(samples, 0.5),
+            "max_ms": round(max(samples), 3),
+            "round_trips": round(statistics.mean(counts["round_trips"]), 2),
+            "rows": round(statistics.mean(counts["rows"]), 1),
+        }
+    # tracemalloc 开销很大,单独计量,不影响上面的耗时
+    peak = retained = 0
+    if alloc_cycles:
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            for _ in range(alloc_cycles):
+                if hasattr(tracemalloc, "reset_peak"):
+                    tracemalloc.reset_peak()
+                mon.evaluate_and_alert()
+                db.cycle += 1
+                current, cycle_peak = tracemalloc.get_traced_memory()
+                peak = max(peak, cycle_peak - before)
+            retained = tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+    return {
+        "cycle": {
+            "p50_ms": _pct(wall, 0.5),
+            "p95_ms": _pct(wall, 0.95),
+            "max_ms": round(max(wall), 3),
+            "round_trips": round(statistics.mean(trips), 2),
+            "rows": round(statistics.mean(rows), 1),
+            "bytes": int(statistics.mean(sent)),
+        },
+        "collectors": collectors,
+        "alloc": {"peak_kb": round(peak / 1024.0, 1), "retained_kb": round(retained / 1024.0, 1)},
+        "unknown_queries": dict(db.unknown),
+        "cycles": cycles,
+    }
+
+
+# 超过基线 (1 + 容差) 即视为回归的指标;往返次数与行数是确定值,耗时与分配有噪声
+REGRESSION_KEYS = [("cycle", "round_trips"), ("cycle", "rows"), ("cycle", "p50_ms"), ("alloc", "peak_kb")]
+
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """与基线结果比较,返回回归项说明"""
+    problems = []
+    for section, key in REGRESSION_KEYS:
+        old = baseline.get(section, {}).get(key)
+        new = result.get(section, {}).get(key)
+        if old is None or new is None:
+            continue
+        if new > old * (1 + tolerance) and new - old > 1e-9:
+            problems.append("{}.{}: {} -> {} (+{:.0f}%)".format(section, key, old, new, 100.0 * (new - old) / old if old else 100.0))
+    return problems
+
+
+def bench_exporter(instances: int = 50, scrapers: int = 8, scrapes: int = 100) -> Dict[str, Any]:
+    """并发抓取 /metrics:多个实例的核心指标渲染进缓存后,测量服务端单次处理耗时"""
+    logger = monitor_pg.logging.getLogger("bench")
+    logger.setLevel(monitor_pg.logging.ERROR)
+    exporter = monitor_pg.PrometheusExporter(logger)
+    db = ReplayDB(synthetic_fixture(dict(DEFAULT_SCALE, backends=50, tables=100, indexes=200, statements=100)))
+    for i in range(instances):
+        mon = monitor_pg.Monitor(bench_config(), db, NullSender(), logger, exporter=exporter)  # type: ignore[arg-type]
+        mon.instance = "pg{}".format(i)
+        mon.evaluate_and_alert()
+    host, port = exporter.serve("127.0.0.1", 0)
+
+    def scraper() -> None:
+        import http.client
+        conn = http.client.HTTPConnection(host, port, timeout=5)
+        try:
+            for _ in range(scrapes):
+                conn.request("GET", "/metrics")
+                conn.getresponse().read()
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=scraper) for _ in range(scrapers)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - start
+    exporter.shutdown()
+    durations = [d * 1e6 for d in exporter.scrape_durations]
+    return {"scrapes": len(durations), "payload_bytes": len(exporter.payload()), "p50_us": _pct(durations, 0.5),
+            "p99_us": _pct(durations, 0.99), "scrapes_per_s": round(len(durations) / wall, 1)}
+
+
+def bench_statements(rows: int = 100000, capacity: int = 20000) -> Dict[str, Any]:
+    """pg_stat_statements 增量:超出容量的一轮 update 的耗时"""
+    tracker = monitor_pg.StatementsTracker(capacity=capacity, top_n=10)
+    first = [(qid, 1.0, float(qid % 997), float(qid % 13), 0.0) for qid in range(rows)]
+    tracker.update(first)
+    bumped = [(q, c + 2, e + (q % 5003), t, k) for q, c, e, t, k in first]
+    start = time.perf_counter()
+    tracker.update(bumped)
+    elapsed = time.perf_counter() - start
+    return {"rows": rows, "tracked": len(tracker), "update_ms": round(elapsed * 1000.0, 1),
+            "rows_per_s": round(rows / elapsed)}
+
+
+def synthetic_lock_rows(n: int, seed: int = 1) -> List[Dict[str, Any]]:
+    """每 50 个会话一棵阻塞树,每 1000 个会话夹带一个两节点等待环"""
+    rnd = random.Random(seed)
+    rows = []
+    for pid in range(1, n + 1):
+        offset = (pid - 1) % 50
+        if offset == 0:
+            blocked_by: List[int] = []
+        elif pid % 1000 == 2:
+            blocked_by = [pid + 1]
+        elif pid % 1000 == 3:
+            blocked_by = [pid - 1, pid - 2]
+        else:
+            blocked_by = [pid - rnd.randint(1, offset)]
+        rows.append({"pid": pid, "blocked_by": blocked_by, "wait_ms": float(rnd.randrange(60000)) if blocked_by else 0.0,
+                     "state": "active", "wait_event": "relation" if blocked_by else None, "usename": "app",
+                     "datname": "db", "xact_age_s": 60.0, "query": "q"})
+    return rows
+
+
+def bench_lock_graph(sizes: Tuple[int, ...] = (10000, 50000), repeat: int = 3) -> Dict[str, Any]:
+    """锁等待图分析:不同行数下取多次中的最快一次,给出单行耗时"""
+    out: Dict[str, Any] = {}
+    for n in sizes:
+        rows = synthetic_lock_rows(n, seed=n)
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            monitor_pg.analyze_lock_waits(rows)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        assert best is not None
+        out["rows_{}_ms".format(n)] = round(best * 1000.0, 1)
+        out["rows_{}_us_per_row".format(n)] = round(best / n * 1e6, 3)
+    return out
+
+
+def bench_csvlog(records: int = 40000, chunk_bytes: int = 1024 * 1024) -> Dict[str, Any]:
+    """csvlog 跟踪:解析慢语句日志的速度(MB/s 与记录/s)"""
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    for i in range(records):
+        writer.writerow(["2024-01-01 00:00:00.000 CST", "app", "app", "1234", "127.0.0.1:5000", "65a1.4d2", "1", "SELECT",
+                         "2024-01-01 00:00:00 CST", "3/0", "0", "LOG", "00000",
+                         "duration: {}.5 ms  statement: SELECT * FROM t{} WHERE id = {}".format(i % 5000, i % 50, i),
+                         "", "", "", "", "", "", "", "", "psql", "client backend", "", "0"])
+    data = buf.getvalue().encode("utf-8")
+    directory = tempfile.mkdtemp(prefix="monitor_pg_bench_csvlog_")
+    try:
+        with open(os.path.join(directory, "postgresql-1.csv"), "wb") as f:
+            f.write(data)
+        follower = monitor_pg.CsvLogFollower(directory, "*.csv", chunk_bytes=chunk_bytes, start_at_end=False)
+        start = time.perf_counter()
+        follower.poll()
+        elapsed = time.perf_counter() - start
+        parsed = follower.drain()["slow_count"]
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return {"records": parsed, "bytes": len(data), "mb_per_s": round(len(data) / 1048576.0 / elapsed, 1),
+            "records_per_s": round(parsed / elapsed)}
+
+
+def bench_normalizer(queries: int = 100000) -> Dict[str, Any]:
+    """语句归一化:10 万条不同字面量的语句首次归一化与命中缓存的速度"""
+    texts = ["SELECT o.id, o.total FROM orders o JOIN customers c ON c.id = o.customer_id "
+             "WHERE c.region = 'r{}' AND o.status IN ({}) LIMIT {}".format(i % 97, ", ".join(str(i % 7) * (i % 5 + 1)), i)
+             for i in range(queries)]
+    normalizer = monitor_pg.QueryNormalizer(capacity=queries)
+    start = time.perf_counter()
+    for q in texts:
+        normalizer.fingerprint(q)
+    cold = time.perf_counter() - start
+    start = time.perf_counter()
+    for q in texts:
+        normalizer.fingerprint(q)
+    cached = time.perf_counter() - start
+    return {"queries": queries, "cold_per_s": round(queries / cold), "cached_per_s": round(queries / cached)}
+
+
+def bench_baseline(series: int = 500, updates: int = 200) -> Dict[str, Any]:
+    """流式基线:每个周期一次遍历更新全部序列的速度与状态大小"""
+    names = ["m{}".format(i) for i in range(series)]
+    engine = monitor_pg.BaselineEngine(names)
+    values = {n: float(i) for i, n in enumerate(names)}
+    start = time.perf_counter()
+    for k in range(updates):
+        engine.update(values, 1700000000 + k * 15)
+    elapsed = time.perf_counter() - start
+    state = sum(a.buffer_info()[1] * a.itemsize for _, a, _ in engine._arrays())
+    return {"series": series, "series_updates_per_s": round(series * updates / elapsed), "state_kb": state // 1024}
+
+
+def bench_fleet(targets: int = 10, rtt_ms: float = 50.0, slow_rtt_ms: float = 300.0) -> Dict[str, Any]:
+    """多实例并发采集:一个慢实例与若干快实例,一轮耗时应接近最慢实例而不是各实例之和"""
+    logger = monitor_pg.logging.getLogger("bench")
+    logger.setLevel(monitor_pg.logging.ERROR)
+    fixture = synthetic_fixture(dict(DEFAULT_SCALE, backends=50, tables=100, indexes=200, statements=100))
+    monitors = []
+    for i in range(targets):
+        cfg = bench_config({"name": "pg{}".format(i), "host": "h{}".format(i), "port": 5432, "dbname": "db0", "user": "bench"})
+        db = ReplayDB(fixture, rtt_ms=slow_rtt_ms if i == targets - 1 else rtt_ms)
+        monitors.append(monitor_pg.Monitor(cfg, db, NullSender(), logger))  # type: ignore[arg-type]
+    fleet = monitor_pg.FleetScheduler(monitors, targets, logger)
+    try:
+        fleet.run_cycle()
+        durations = []
+        for _ in range(3):
+            start = time.perf_counter()
+            fleet.run_cycle()
+            durations.append((time.perf_counter() - start) * 1000.0)
+        # 对照:逐个实例串行采集的总耗时与最慢实例单独的耗时
+        serial = []
+        for mon in monitors:
+            start = time.perf_counter()
+            mon.evaluate_and_alert()
+            serial.append((time.perf_counter() - start) * 1000.0)
+    finally:
+        fleet.executor.shutdown()
+        for mon in monitors:
+            mon.close()
+    return {"targets": targets, "cycle_ms": _pct(durations, 0.5), "slowest_target_ms": round(max(serial), 3),
+            "serial_sum_ms": round(sum(serial), 3)}
+
+
+# --component 可选的组件基准:与采集周期无关的单个模块吞吐
+COMPONENTS = {
+    "exporter": bench_exporter,
+    "statements": bench_statements,
+    "lock_graph": bench_lock_graph,
+    "csvlog": bench_csvlog,
+    "normalizer": bench_normalizer,
+    "baseline": bench_baseline,
+    "fleet": bench_fleet,
+}
+
+
+def run_components(names: List[str]) -> Dict[str, Any]:
+    """依次执行指定的组件基准"""
+    return {name: COMPONENTS[name]() for name in names}
+
+
+class ThrowawayPostgres:
+    """临时 PostgreSQL 实例:initdb 到临时目录,只监听 Unix socket,结束后删除"""
+    def __init__(self, bin_dir: str = "") -> None:
+        self.bin_dir = bin_dir
+        self.dir = ""
+        self.port = 0
+
+    def _bin(self, name: str) -> str:
+        path = os.path.join(self.bin_dir, name) if self.bin_dir else shutil.which(name)
+        if not path or not os.path.exists(path):
+            raise RuntimeError("找不到 {},请用 --pg-bin 指定 PostgreSQL bin 目录".format(name))
+        return path
+
+    def start(self, max_connections: int = 100) -> Dict[str, Any]:
+        """初始化并启动实例,返回 db 配置段"""
+        self.dir = tempfile.mkdtemp(prefix="monitor_pg_bench_")
+        data = os.path.join(self.dir, "data")
+        subprocess.run([self._bin("initdb"), "-D", data, "-U", "postgres", "--auth=trust", "-E", "UTF8"],
+                       check=True, stdout=subprocess.DEVNULL)
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            self.port = s.getsockname()[1]
+        opts = "-p {} -k {} -c listen_addresses='' -c fsync=off -c max_connections={}".format(
+            self.port, self.dir, max_connections)
+        ctl = [self._bin("pg_ctl"), "-D", data, "-l", os.path.join(self.dir, "postgres.log"), "-w"]
+        if subprocess.run(ctl + ["-o", opts + " -c shared_preload_libraries=pg_stat_statements", "start"],
+                          stdout=subprocess.DEVNULL).returncode != 0:
+            subprocess.run(ctl + ["-o", opts, "start"], check=True, stdout=subprocess.DEVNULL)
+        return {"host": self.dir, "port": self.port, "dbname": "postgres", "user": "postgres"}
+
+    def stop(self) -> None:
+        """停止实例并删除目录"""
+        if not self.dir:
+            return
+        subprocess.run([self._bin("pg_ctl"), "-D", os.path.join(self.dir, "data"), "-m", "immediate", "stop"],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def live_connections(scale: Dict[str, int]) -> int:
+    """实测模式需要的 max_connections:populate 保持的会话、监控连接池与超级用户保留连接,再留少量余量"""
+    held = max(scale["backends"], 2 + scale["locks"] if scale["tables"] and scale["locks"] else 1)
+    return held + monitor_pg.DEFAULT_POOL_SIZE + 3 + 10
+
+
+def populate(db_section: Dict[str, Any], scale: Dict[str, int]) -> List[Any]:
+    """按规模建表、建索引与库,并制造锁等待;返回需要在结束时关闭的连接"""
+    import psycopg2
+    dsn = "host={host} port={port} dbname={dbname} user={user}".format(**db_section)
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    cur = conn.cursor()
+    for ext in ("pg_stat_statements", "pgstattuple"):
+        try:
+            cur.execute("CREATE EXTENSION IF NOT EXISTS {}".format(ext))
+        except Exception:
+            pass
+    per_table = max(0, scale["indexes"] // max(1, scale["tables"]))
+    for i in range(scale["tables"]):
+        cur.execute("CREATE TABLE t{0} (id int PRIMARY KEY, v int, pad text)".format(i))
+        cur.execute("INSERT INTO t{0} SELECT g, g, repeat('x', 100) FROM generate_series(1, 100) g".format(i))
+        for j in range(per_table):
+            cur.execute("CREATE INDEX ON t{0} (v, id)".format(i) if j % 2 else "CREATE INDEX ON t{0} (pad)".format(i))
+    for i in range(1, scale["databases"]):
+        cur.execute("CREATE DATABASE bench_db{}".format(i))
+    cur.execute("ANALYZE")
+    # 一个会话持锁,locks 个会话排队等待,形成锁等待图
+    keep = [conn]
+    if scale["tables"] and scale["locks"]:
+        holder = psycopg2.connect(dsn)
+        holder.cursor().execute("BEGIN; LOCK TABLE t0 IN ACCESS EXCLUSIVE MODE")
+        keep.append(holder)
+        for _ in range(scale["locks"]):
+            waiter = psycopg2.connect(dsn)
+            waiter.autocommit = True
+            keep.append(waiter)
+            threading.Thread(target=_swallow, args=(waiter, "SELECT count(*) FROM t0"), daemon=True).start()
+    extra = max(0, scale["backends"] - len(keep))
+    for _ in range(extra):
+        keep.append(psycopg2.connect(dsn))
+    return keep
+
+
+def _swallow(conn: Any, sql: str) -> None:
+    try:
+        conn.cursor().execute(sql)
+    except Exception:
+        pass
+
+
+def main(argv: List[str]) -> int:
+    """命令行入口"""
+    parser = argparse.ArgumentParser(prog="bench_monitor_pg", description="测量一个采集周期的数据库往返、传输行数、耗时与内存分配")
+    for key, value in DEFAULT_SCALE.items():
+        parser.add_argument("--" + key, type=int, default=value)
+    parser.add_argument("--cycles", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--rtt-ms", type=float, default=0.0, help="回放模式下每次往返模拟的网络延迟")
+    parser.add_argument("--fixture", default="", help="回放录制的夹具(JSON)而不是合成数据")
+    parser.add_argument("--save-fixture", default="", help="把本次使用的夹具写入文件")
+    parser.add_argument("--live", action="store_true",
+                        help="在临时本地 PostgreSQL 上实测(需要 initdb/pg_ctl 与 psycopg2);实例按 max(--backends, --locks + 2) "
+                             "加监控连接池与余量设置 max_connections,受内核信号量与内存限制")
+    parser.add_argument("--pg-bin", default="", help="PostgreSQL bin 目录")
+    parser.add_argument("--output", default="bench_monitor_pg.json")
+    parser.add_argument("--baseline", default="", help="与此前的结果比较,超过容差时返回非零")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--component", action="append", choices=sorted(COMPONENTS), default=[],
+                        help="只测量指定组件的吞吐(可重复),不执行采集周期")
+    args = parser.parse_args(argv)
+    if args.component:
+        components = run_components(args.component)
+        for name, stats in components.items():
+            print("{}: {}".format(name, ", ".join("{} {}".format(k, v) for k, v in sorted(stats.items()))))
+        with open(args.output, "w") as f:
+            json.dump({"components": components, "meta": {"python": sys.version.split()[0], "timestamp": int(time.time())}},
+                      f, indent=2, sort_keys=True)
+        return 0
+    scale = {key: getattr(args, key) for key in DEFAULT_SCALE}
+    pg = None
+    keep: List[Any] = []
+    try:
+        if args.live:
+            pg = ThrowawayPostgres(args.pg_bin)
+            section = pg.start(live_connections(scale))
+            keep = populate(section, scale)
+            cfg = bench_config(section)
+            client = monitor_pg.DBClient(cfg, monitor_pg.logging.getLogger("bench"))
+            client.connect()
+            db: ReplayDB = CountingDB(client, record=bool(args.save_fixture))
+            result = run_benchmark(db, args.cycles, args.warmup, cfg=cfg)
+            client.close()
+        else:
+            if args.fixture:
+                with open(args.fixture) as f:
+                    fixture = json.load(f)
+            else:
+                fixture = synthetic_fixture(scale)
+            db = ReplayDB(fixture, rtt_ms=args.rtt_ms)
+            result = run_benchmark(db, args.cycles, args.warmup)
+        if args.save_fixture:
+            with open(args.save_fixture, "w") as f:
+                json.dump(db.fixture, f, default=str)
+    finally:
+        for conn in keep:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        if pg is not None:
+            pg.stop()
+    result["meta"] = {
+        "mode": "live" if args.live else ("fixture" if args.fixture else "synthetic"),
+        "scale": scale,
+        "rtt_ms": args.rtt_ms,
+        "python": sys.version.split()[0],
+        "timestamp": int(time.time()),
+    }
+    with open(args.output, "w") as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+    c = result["cycle"]
+    print("周期 p50 {}ms p95 {}ms,往返 {} 次,{} 行,{} 字节,分配峰值 {}KB -> {}".format(
+        c["p50_ms"], c["p95_ms"], c["round_trips"], c["rows"], c["bytes"], result["alloc"]["peak_kb"], args.output))
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = compare(result, json.load(f), args.tolerance)
+        for p in problems:
+            print("回归: " + p)
+        return 1 if problems else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,7 +1,18 @@
+import contextlib
+import csv
+import io
+import http.client
+import json
 import os
+import random
 import sys
+import tempfile
+import threading
+import time
 import types
 import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
 
 # 允许从项目根路径导入脚本
 ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
@@ -11,6 +22,185 @@ if MONITOR_DIR not in sys.path:
 
 import monitor_pg  # noqa: E402
 
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+if TESTS_DIR not in sys.path:
+    sys.path.insert(0, TESTS_DIR)
+
+from bench_monitor_pg import synthetic_lock_rows  # noqa: E402
+
+
+def make_cfg(**overrides):
+    """构造最小可用配置"""
+    cfg = {
+        "db": {"host": "localhost", "port": 5432, "dbname": "postgres", "user": "postgres"},
+        "webhook": {"url": "https://example.invalid"},
+        "thresholds": {"connections_total": {"warning": 10, "critical": 20}},
+    }
+    cfg.update(overrides)
+    return monitor_pg.validate_config(cfg)
+
+
+class FakeDB:
+    """记录往返次数的数据库替身,批量快照语句返回 snapshot_row"""
+    def __init__(self, snapshot_row=None, fail_snapshot=False, latency=0.0, extensions=("plpgsql",)):
+        self.snapshot_row = snapshot_row or {}
+        self.extensions = list(extensions)
+        self.generation = 1
+        self.fail_snapshot = fail_snapshot
+        self.latency = latency
+        self.calls = []
+        self.budgets = []
+        self.cancelled = 0
+        self.conn = object()
+
+    def connect(self):
+        self.conn = object()
+        self.generation += 1
+
+    def close(self):
+        self.conn = None
+
+    def budget(self, budget):
+        self.budgets.append(budget)
+        return contextlib.nullcontext()
+
+    def owner(self, owner):
+        return contextlib.nullcontext()
+
+    def cancel(self, owners=None):
+        self.cancelled += 1
+        return 1
+
+    def execute_one(self, sql, params=None):
+        self.calls.append(sql)
+        time.sleep(self.latency)
+        if "AS postmaster_start_time" in sql:
+            if self.fail_snapshot:
+                raise RuntimeError("snapshot failed")
+            return dict(self.snapshot_row)
+        if "FROM pg_stat_activity" in sql:
+            return {"total": 3, "active": 1, "idle": 2}
+        if "pg_is_in_recovery" in sql:
+            return {"standby": False}
+        if "pg_settings" in sql:
+            return {"setting": "16384", "unit": "8kB"}
+        return {"deadlocks": 0, "temp_bytes": 0, "cpu_ms": 0}
+
+    def execute(self, sql, params=None):
+        self.calls.append(sql)
+        time.sleep(self.latency)
+        if "FROM pg_extension" in sql:
+            return [{"extname": e} for e in self.extensions]
+        return []
+
+
+class GatedDB(FakeDB):
+    """批量快照先经过 gate() 的数据库替身,用屏障或事件确定性地检验并发,不依赖耗时"""
+    def __init__(self, gate):
+        super().__init__(snapshot_row())
+        self.gate = gate
+
+    def execute_one(self, sql, params=None):
+        if "AS postmaster_start_time" in sql:
+            self.gate()
+        return super().execute_one(sql, params)
+
+
+class FakeConn:
+    """psycopg2 连接替身:记录语句,可模拟执行中断线"""
+    def __init__(self, owner):
+        self.owner = owner
+        self.closed = 0
+        self.statements = []
+        self.cancels = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def cancel(self):
+        self.cancels += 1
+
+    def close(self):
+        self.closed = 1
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        self.conn.statements.append((sql, params))
+        if sql.startswith("SELECT") and self.conn.owner.drop_next:
+            self.conn.owner.drop_next = False
+            self.conn.closed = 2
+            raise RuntimeError("server closed the connection unexpectedly")
+        if sql.startswith("SELECT") and self.conn.owner.hold is not None:
+            self.conn.owner.hold.wait(2)
+
+    def fetchall(self):
+        return [{"ok": 1}]
+
+    def fetchone(self):
+        return {"ok": 1}
+
+
+class PooledClient(monitor_pg.DBClient):
+    """以 FakeConn 代替真实连接的 DBClient"""
+    def __init__(self, cfg, logger):
+        super().__init__(cfg, logger)
+        self.opened = []
+        self.refuse = False
+        self.drop_next = False
+        self.hold = None
+
+    def _open(self):
+        if self.refuse:
+            raise RuntimeError("connection refused")
+        conn = FakeConn(self)
+        self.opened.append(conn)
+        return conn
+
+
+class RecordingSender:
+    """记录告警内容的发送器替身"""
+    def __init__(self):
+        self.messages = []
+
+    def safe_send(self, content, retries=3, backoff_seconds=2):
+        self.messages.append(content)
+
+    def submit(self, message):
+        body = message.get("markdown") or message.get("text")
+        self.messages.append(body["content"])
+
+
+def snapshot_row(**overrides):
+    """构造批量快照语句的返回行"""
+    row = {
+        "connections": {"total": 25, "active": 2, "idle": 23},
+        "locks": [],
+        "deadlocks_total": 0,
+        "temp_bytes_total": 0,
+        "postmaster_start_time": 1700000000.0,
+        "slow_queries": [],
+        "table_bloat": [],
+        "replication": {"standby": False, "wal_lsn_bytes": 1.0e9, "lag_s": 0, "local_replay_lag_bytes": None,
+                        "standbys": [], "slots": []},
+        "vacuum": {"next_xid": 1000, "databases": [{"datname": "postgres", "xid_age": 100, "mxid_age": 0}],
+                   "vacuums": [], "holders": []},
+        "databases": [{"datname": "postgres", "size_bytes": 1024}],
+        "tablespaces": [{"spcname": "pg_default", "size_bytes": 2048}],
+        "relpages_estimate": {"datname": "postgres", "bytes": 512},
+    }
+    row.update(overrides)
+    return row
+
 
 class TestConfigValidation(unittest.TestCase):
     """配置验证测试"""
@@ -57,6 +247,1773 @@ class TestMessageFormat(unittest.TestCase):
         self.assertIn("WARNING", msg)
 
 
+class TestSnapshot(unittest.TestCase):
+    """批量快照采集测试"""
+    def setUp(self):
+        self.logger = monitor_pg.setup_logger("/tmp/monitor_pg_test.log")
+
+    def test_cycle_uses_single_round_trip(self):
+        db = FakeDB(snapshot_row())
+        sender = RecordingSender()
+        mon = monitor_pg.Monitor(make_cfg(), db, sender, self.logger)
+        mon.evaluate_and_alert()
+        db.calls = []
+        mon.evaluate_and_alert()
+        self.assertEqual(len(db.calls), 1)
+        self.assertEqual(mon.snapshot.connections["total"], 25)
+        self.assertEqual(mon.get_disk_usage()["ts_max_bytes"], 2048)
+        self.assertEqual(len(sender.messages), 1)
+        self.assertIn("CRITICAL", sender.messages[0])
+
+    def test_kcache_joins_batch_once_known_installed(self):
+        db = FakeDB(snapshot_row(cpu_ms_total=500), extensions=["pg_stat_kcache"])
+        mon = monitor_pg.Monitor(make_cfg(), db, RecordingSender(), self.logger)
+        self.assertIn("cpu_ms_total", mon.snapshot_fragments())
+        mon.collect_snapshot()
+        self.assertEqual(mon.snapshot.cpu_ms_total, 500)
+        mon = monitor_pg.Monitor(make_cfg(), FakeDB(snapshot_row()), RecordingSender(), self.logger)
+        self.assertNotIn("cpu_ms_total", mon.snapshot_fragments())
+
+    def test_snapshot_failure_falls_back_to_getters(self):
+        db = FakeDB(fail_snapshot=True)
+        mon = monitor_pg.Monitor(make_cfg(), db, RecordingSender(), self.logger)
+        mon.evaluate_and_alert()
+        self.assertIsNone(mon.snapshot)
+        self.assertGreater(len(db.calls), 1)
+
+    def test_fragments_compose_into_one_statement(self):
+        for name, frag in monitor_pg.SNAPSHOT_FRAGMENTS.items():
+            self.assertNotIn("%s", frag, name)
+        self.assertIn("%%pg_stat_activity%%", monitor_pg.SNAPSHOT_FRAGMENTS["slow_queries"])
+
+
+class TestMetadataCache(unittest.TestCase):
+    """元数据缓存测试"""
+    def setUp(self):
+        self.logger = monitor_pg.setup_logger("/tmp/monitor_pg_test.log")
+
+    def _lookups(self, db):
+        return [c for c in db.calls if "pg_extension" in c or "pg_settings" in c]
+
+    def test_setting_units(self):
+        self.assertEqual(monitor_pg.setting_to_bytes("16384", "8kB"), 134217728)
+        self.assertEqual(monitor_pg.setting_to_bytes("4", "MB"), 4194304)
+        self.assertEqual(monitor_pg.setting_to_bytes("100", None), 100)
+
+    def test_lookups_cached_across_cycles(self):
+        db = FakeDB(snapshot_row())
+        mon = monitor_pg.Monitor(make_cfg(), db, RecordingSender(), self.logger)
+        for _ in range(3):
+            mon.evaluate_and_alert()
+        self.assertEqual(len(self._lookups(db)), 2)
+        self.assertEqual(mon.get_shared_buffers_bytes(), 134217728)
+        stats = mon.meta.stats()
+        self.assertEqual(stats["misses"], 2)
+        self.assertGreaterEqual(stats["hits"], 5)
+
+    def test_invalidated_on_reconnect_and_restart(self):
+        db = FakeDB(snapshot_row())
+        mon = monitor_pg.Monitor(make_cfg(), db, RecordingSender(), self.logger)
+        mon.evaluate_and_alert()
+        db.connect()
+        mon.evaluate_and_alert()
+        self.assertEqual(len(self._lookups(db)), 4)
+        db.snapshot_row["postmaster_start_time"] = 1800000000.0
+        mon.evaluate_and_alert()
+        mon.evaluate_and_alert()
+        self.assertEqual(len(self._lookups(db)), 6)
+
+    def test_ttl_expiry(self):
+        cache = monitor_pg.MetadataCache(ttl_seconds=0.0)
+        loads = []
+        cache.get("k", lambda: loads.append(1))
+        cache.get("k", lambda: loads.append(1))
+        self.assertEqual(len(loads), 2)
+
+
+class FlakySender:
+    """可控成功/失败与延迟的底层发送器替身"""
+    def __init__(self, ok=True, latency=0.0):
+        self.ok = ok
+        self.latency = latency
+        self.delivered = []
+        self.attempts = 0
+
+    def send_payload(self, message):
+        self.attempts += 1
+        time.sleep(self.latency)
+        if self.ok:
+            self.delivered.append(message)
+            return True, "ok"
+        return False, "unavailable"
+
+
+class TestAlertDispatcher(unittest.TestCase):
+    """后台告警投递测试"""
+    def setUp(self):
+        self.logger = monitor_pg.setup_logger("/tmp/monitor_pg_test.log")
+        self.tmp = tempfile.TemporaryDirectory()
+        self.outbox = os.path.join(self.tmp.name, "outbox.jsonl")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _dispatcher(self, sender, **kw):
+        kw.setdefault("backoff_base_seconds", 0.01)
+        kw.setdefault("backoff_max_seconds", 0.02)
+        return monitor_pg.AlertDispatcher(sender, self.logger, outbox_path=self.outbox, **kw)
+
+    def _outbox_lines(self):
+        if not os.path.isfile(self.outbox):
+            return []
+        with open(self.outbox, encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+
+    def test_submit_never_blocks_on_webhook_latency(self):
+        sender = FlakySender(latency=0.5)
+        d = self._dispatcher(sender)
+        d.start()
+        start = time.monotonic()
+        for i in range(11):
+            d.safe_send("alert {}".format(i))
+        self.assertLess(time.monotonic() - start, 0.05)
+        d.stop(timeout=0.1)
+        self.assertEqual(len(sender.delivered) + len(self._outbox_lines()), 11)
+
+    def test_failed_delivery_spills_and_replays(self):
+        sender = FlakySender(ok=False)
+        d = self._dispatcher(sender, max_retries=3)
+        d.start()
+        d.safe_send("disk full")
+        d.stop(timeout=1.0)
+        self.assertEqual(sender.attempts, 3)
+        self.assertEqual(self._outbox_lines()[0]["message"]["text"]["content"], "disk full")
+        sender.ok = True
+        d = self._dispatcher(sender)
+        d.start()
+        d.stop(timeout=1.0)
+        self.assertEqual(len(sender.delivered), 1)
+        self.assertEqual(self._outbox_lines(), [])
+
+    def test_rejected_message_is_dropped_not_spilled(self):
+        sender = FlakySender(ok=False)
+        sender.send_payload = lambda message: (sender.delivered.append(message) or False, '{"errcode":93000,"errmsg":"invalid webhook url"}')
+        d = self._dispatcher(sender, max_retries=5)
+        d.start()
+        d.safe_send("bad key")
+        d.stop(timeout=1.0)
+        self.assertEqual(len(sender.delivered), 1)
+        self.assertEqual((d.dropped, self._outbox_lines()), (1, []))
+        self.assertTrue(monitor_pg.webhook_error_retryable('{"errcode":45009,"errmsg":"api freq out of limit"}'))
+        self.assertTrue(monitor_pg.webhook_error_retryable("HTTP 502: bad gateway"))
+        self.assertFalse(monitor_pg.webhook_error_retryable("HTTP 404: not found"))
+
+    def test_outbox_records_attempts_and_expires(self):
+        sender = FlakySender(ok=False)
+        d = self._dispatcher(sender, max_retries=1, outbox_max_attempts=2)
+        d.start()
+        d.safe_send("disk full")
+        d.stop(timeout=1.0)
+        rec = self._outbox_lines()[0]
+        self.assertEqual(rec["attempts"], 1)
+        first_ts = rec["first_ts"]
+        # 重启后补发仍失败,投递轮数累加,首次提交时间不变
+        d = self._dispatcher(sender, max_retries=1, outbox_max_attempts=2)
+        d.start()
+        d.stop(timeout=1.0)
+        rec = self._outbox_lines()[0]
+        self.assertEqual((rec["attempts"], rec["first_ts"]), (2, first_ts))
+        d = self._dispatcher(sender, max_retries=1, outbox_max_attempts=2)
+        d.start()
+        d.stop(timeout=1.0)
+        self.assertEqual((d.dropped, self._outbox_lines()), (1, []))
+        self.assertEqual(sender.attempts, 2)
+        # 超过保留时长的旧记录(无 attempts 字段的旧格式)同样丢弃
+        with open(self.outbox, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"ts": time.time() - 7200, "message": {"msgtype": "text"}}) + "\n")
+        d = self._dispatcher(sender, outbox_max_age_seconds=3600)
+        d.start()
+        d.stop(timeout=1.0)
+        self.assertEqual((d.dropped, self._outbox_lines()), (1, []))
+
+    def test_outbox_is_capped_keeping_newest(self):
+        d = self._dispatcher(FlakySender(), queue_size=1, outbox_max_bytes=2000)
+        for i in range(50):
+            d.safe_send("alert {}".format(i))
+        lines = self._outbox_lines()
+        self.assertLessEqual(os.path.getsize(self.outbox), 2000)
+        self.assertEqual(lines[-1]["message"]["text"]["content"], "alert 49")
+        self.assertEqual(d.dropped + len(lines), 49)
+
+    def test_full_queue_spills_to_outbox(self):
+        d = self._dispatcher(FlakySender(), queue_size=2)
+        for i in range(5):
+            d.safe_send("alert {}".format(i))
+        self.assertEqual(len(self._outbox_lines()), 3)
+
+    def test_backoff_is_jittered_and_capped(self):
+        delays = [monitor_pg.backoff_delay(10, 1.0, 60.0) for _ in range(200)]
+        self.assertTrue(all(0 <= v <= 60.0 for v in delays))
+        self.assertGreater(len(set(delays)), 100)
+        self.assertLessEqual(monitor_pg.backoff_delay(0, 1.0, 60.0), 1.0)
+
+
+class _ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestAlertSenderKeepAlive(unittest.TestCase):
+    """webhook 持久连接测试"""
+    def test_connection_reused(self):
+        connections = []
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                connections.append(self.client_address)
+                BaseHTTPRequestHandler.setup(self)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers["Content-Length"]))
+                body = b'{"errcode":0,"errmsg":"ok"}'
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = _ThreadingServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            sender = monitor_pg.AlertSender("http://127.0.0.1:{}/send?key=x".format(server.server_address[1]))
+            for _ in range(3):
+                ok, _ = sender.send_text("hello")
+                self.assertTrue(ok)
+            sender.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(len(connections), 1)
+
+
+class TestAlertManager(unittest.TestCase):
+    """告警去重、合并与恢复测试"""
+    def setUp(self):
+        self.logger = monitor_pg.setup_logger("/tmp/monitor_pg_test.log")
+        self.sender = RecordingSender()
+        self.mgr = monitor_pg.AlertManager(self.sender, self.logger, repeat_interval_seconds=600)
+
+    def _cycle(self, now, fired):
+        self.mgr.begin_cycle("pg1")
+        for metric, sev in fired:
+            self.mgr.fire("pg1", metric, sev, "[{}] {}".format(sev, metric), now=now)
+        self.mgr.end_cycle("pg1", now=now)
+        return self.mgr.flush()
+
+    def test_batches_one_cycle_into_one_message(self):
+        self.assertEqual(self._cycle(0, [("连接总数", "WARNING"), ("锁等待", "CRITICAL")]), 1)
+        self.assertIn("触发 2 条", self.sender.messages[0])
+        self.assertIn("锁等待", self.sender.messages[0])
+
+    def test_repeats_suppressed_within_window(self):
+        self._cycle(0, [("连接总数", "WARNING")])
+        self.assertEqual(self._cycle(300, [("连接总数", "WARNING")]), 0)
+        self.assertEqual(self.mgr.suppressed, 1)
+        self.assertEqual(self._cycle(601, [("连接总数", "WARNING")]), 1)
+
+    def test_escalation_bypasses_window(self):
+        self._cycle(0, [("连接总数", "WARNING")])
+        self.assertEqual(self._cycle(60, [("连接总数", "CRITICAL")]), 1)
+        self.assertIn("CRITICAL", self.sender.messages[-1])
+
+    def test_recovery_notice(self):
+        self._cycle(0, [("连接总数", "WARNING")])
+        self._cycle(120, [])
+        self.assertIn("[RESOLVED] 连接总数", self.sender.messages[-1])
+        self.assertEqual(self.mgr.firing, {})
+        self.assertEqual(self._cycle(180, []), 0)
+
+    def test_long_batches_split_by_size(self):
+        self.mgr.max_message_bytes = 200
+        self._cycle(0, [("指标{}".format(i) * 5, "WARNING") for i in range(10)])
+        self.assertGreater(len(self.sender.messages), 1)
+        self.assertTrue(all(len(m.encode("utf-8")) <= 200 for m in self.sender.messages))
+
+
+class TestMetricStore(unittest.TestCase):
+    """本地时序存储测试"""
+    def setUp(self):
+        self.logger = monitor_pg.setup_logger("/tmp/monitor_pg_test.log")
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "metrics.db")
+        self.store = monitor_pg.MetricStore(self.path, raw_retention_hours=1, rollup_seconds=600,
+                                            rollup_retention_days=1, compact_interval_seconds=10 ** 9)
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp.cleanup()
+
+    def test_range_query_and_latest(self):
+        for i in range(10):
+            self.store.append("pg1", {"connections_total": i, "deadlocks_total": 100 + i}, ts=1000 + i * 60)
+        self.assertEqual(self.store.latest("pg1", "deadlocks_total"), (1540.0, 109.0))
+        points = self.store.query_range("pg1", "connections_total", 1060, 1180)
+        self.assertEqual([v for _, v in points], [1.0, 2.0, 3.0])
+        self.assertIsNone(self.store.latest("pg2", "connections_total"))
+        with open(os.path.join(self.tmp.name, "metrics.db"), "rb") as f:
+            self.assertTrue(f.read(16).startswith(b"SQLite format 3"))
+
+    def test_compaction_downsamples_and_expires(self):
+        base = 1200000
+        for i in range(360):
+            self.store.append("pg1", {"v": float(i)}, ts=base + i * 10)
+        self.store.compact(now=base + 3600 + 1200)
+        points = self.store.query_range("pg1", "v", base, base + 3600)
+        raw_left = self.store.conn.execute("SELECT COUNT(*) FROM samples").fetchone()[0]
+        buckets = self.store.conn.execute("SELECT bucket, count, min, max, last FROM rollups ORDER BY bucket").fetchall()
+        self.assertEqual(raw_left, 360 - 120)
+        self.assertEqual(buckets[0], (base, 60, 0.0, 59.0, 59.0))
+        self.assertEqual(points[0], (float(base), 29.5))
+        self.assertEqual(len(points), 2 + 240)
+        self.store.compact(now=base + 3 * 86400)
+        self.assertEqual(self.store.conn.execute("SELECT COUNT(*) FROM rollups").fetchone()[0], 0)
+        self.assertEqual(self.store.conn.execute("SELECT COUNT(*) FROM samples").fetchone()[0], 0)
+
+    def test_deltas_survive_restart(self):
+        cfg = make_cfg()
+        db = FakeDB(snapshot_row(deadlocks_total=40, temp_bytes_total=1000))
+        mon = monitor_pg.Monitor(cfg, db, RecordingSender(), self.logger, store=self.store)
+        mon.evaluate_and_alert()
+        self.assertEqual(mon.latest_values["deadlocks_delta"], 0)
+        db.snapshot_row.update(deadlocks_total=41, temp_bytes_total=1500)
+        restarted = monitor_pg.Monitor(cfg, db, RecordingSender(), self.logger, store=self.store)
+        self.assertEqual(restarted.get_deadlocks_delta() if restarted.collect_snapshot() else None, 1)
+        self.assertEqual(restarted.get_memory_pressure_delta_bytes(), 500)
+
+    def test_stale_counters_not_seeded(self):
+        self.store.append("localhost:5432/postgres", {"deadlocks_total": 5}, ts=time.time() - 86400)
+        mon = monitor_pg.Monitor(make_cfg(), FakeDB(), RecordingSender(), self.logger, store=self.store)
+        self.assertNotIn("deadlocks_total", mon.prev_state)
+
+
+class TestBaseline(unittest.TestCase):
+    """流式基线与偏离告警测试"""
+    def setUp(self):
+        self.logger = monitor_pg.setup_logger("/tmp/monitor_pg_test.log")
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_seasonal_buckets_learn_busy_hours(self):
+        engine = monitor_pg.BaselineEngine(["connections_active"], min_samples=20)
+        rng = random.Random(7)
+        start = 1700000000
+        busy = monitor_pg.hour_of_week(start)
+        for ts in range(start, start + 4 * 7 * 86400, 300):
+            level = 100.0 if monitor_pg.hour_of_week(ts) == busy else 10.0
+            engine.update({"connections_active": level + rng.uniform(-3, 3), "untracked": 1.0}, ts)
+        dev = {"warning": 3, "critical": 5}
+        peak = engine.expected("connections_active", start + 4 * 7 * 86400)
+        night = engine.expected("connections_active", start + 4 * 7 * 86400 + 12 * 3600)
+        self.assertTrue(peak["seasonal"])
+        self.assertAlmostEqual(peak["mean"], 100.0, delta=3)
+        self.assertAlmostEqual(night["mean"], 10.0, delta=3)
+        self.assertIsNone(monitor_pg.baseline_severity(104.0, dev, peak))
+        self.assertEqual(monitor_pg.baseline_severity(40.0, dev, night), "CRITICAL")
+        self.assertIsNone(monitor_pg.baseline_severity(2.0, dev, night))
+        self.assertIsNone(engine.expected("untracked"))
+
+    def test_sketch_quantiles(self):
+        engine = monitor_pg.BaselineEngine(["v"], min_samples=1)
+        for i in range(1, 1001):
+            engine.update({"v": float(i)}, 1700000000 + i)
+        base = engine.expected("v", 1700001000)
+        self.assertAlmostEqual(base["p50"], 500, delta=60)
+        self.assertAlmostEqual(base["p99"], 990, delta=110)
+
+    def test_state_round_trip_aligned_by_series_name(self):
+        path = os.path.join(self.tmp.name, "baseline.bin")
+        engine = monitor_pg.BaselineEngine(["a", "b"], min_samples=5)
+        for i in range(50):
+            engine.update({"a": 1.0, "b": 40.0 + i % 5}, 1700000000 + i * 15)
+        engine.save(path)
+        restored = monitor_pg.BaselineEngine(["b", "c"], min_samples=5)
+        self.assertEqual(restored.load(path), 1)
+        self.assertEqual(restored.expected("b", 1700000750), engine.expected("b", 1700000750))
+        self.assertIsNone(restored.expected("c"))
+        with self.assertRaises(ValueError):
+            monitor_pg.BaselineEngine(["b"], sketch_buckets=100).load(path)
+
+    def test_deviation_thresholds_replace_static_once_learned(self):
+        cfg = make_cfg(state_dir=self.tmp.name, baseline={"min_samples": 5},
+                       thresholds={"connections_active": {"warning": 5, "deviation": {"warning": 3, "critical": 6}}})
+        db = FakeDB(snapshot_row(connections={"total": 30, "active": 20, "idle": 10}))
+        sender = RecordingSender()
+        mon = monitor_pg.Monitor(cfg, db, sender, self.logger)
+        # 基线未就绪时按静态阈值
+        mon.evaluate_and_alert()
+        self.assertEqual(len(sender.messages), 1)
+        now = time.time()
+        for i in range(40):
+            mon.baselines.update({"connections_active": 20.0 + i % 3}, now + 1 + i * 0.01)
+        sender.messages = []
+        mon.evaluate_and_alert()
+        self.assertEqual(len(sender.messages), 1)
+        self.assertIn("活跃连接 已恢复", sender.messages[0])
+        sender.messages = []
+        db.snapshot_row["connections"] = {"total": 70, "active": 60, "idle": 10}
+        mon.evaluate_and_alert()
+        self.assertEqual(len(sender.messages), 1)
+        self.assertIn("CRITICAL", sender.messages[0])
+        self.assertIn("均值", sender.messages[0])
+        families = monitor_pg.baseline_families(mon.instance, mon.baselines)
+        self.assertIn(({"instance": mon.instance, "metric": "connections_active", "stat": "mean"},
+                       mon.baselines.expected("connections_active")["mean"]), families[0].samples)
+        mon.save_baselines()
+        restarted = monitor_pg.Monitor(cfg, db, RecordingSender(), self.logger)
+        self.assertEqual(restarted.baselines.expected("connections_active", now),
+                         mon.baselines.expected("connections_active", now))
+
+    def test_one_pass_update_keeps_fixed_state(self):
+        names = ["m{}".format(i) for i in range(500)]
+        engine = monitor_pg.BaselineEngine(names)
+        state_bytes = sum(a.buffer_info()[1] * a.itemsize for _, a, _ in engine._arrays())
+        values = {n: float(i) for i, n in enumerate(names)}
+        for k in range(200):
+            engine.update(values, 1700000000 + k * 15)
+        # 更新速度见 bench_monitor_pg.py --component baseline
+        self.assertEqual(sum(a.buffer_info()[1] * a.itemsize for _, a, _ in engine._arrays()), state_bytes)
+
+
+class TestPrometheusExporter(unittest.TestCase):
+    """Prometheus 导出测试"""
+    def setUp(self):
+        self.logger = monitor_pg.setup_logger("/tmp/monitor_pg_test.log")
+
+    def test_render_text_format(self):
+        text = monitor_pg.render_prometheus([
+            monitor_pg.MetricFamily("pg_x", "gauge", "x", [({"instance": 'a"b'}, 1)]),
+            monitor_pg.MetricFamily("pg_x", "gauge", "x", [({"instance": "c"}, 2.5)]),
+        ]).decode("utf-8")
+        self.assertEqual(text.count("# TYPE pg_x gauge"), 1)
+        self.assertIn('pg_x{instance="a\\"b"} 1.0', text)
+        self.assertIn('pg_x{instance="c"} 2.5', text)
+
+    def test_cycle_updates_cache(self):
+        exporter = monitor_pg.PrometheusExporter(self.logger)
+        mon = monitor_pg.Monitor(make_cfg(), FakeDB(snapshot_row()), RecordingSender(), self.logger, exporter=exporter)
+        mon.evaluate_and_alert()
+        text = exporter.payload().decode("utf-8")
+        self.assertIn('pg_monitor_connections_total{instance="localhost:5432/postgres"} 25.0', text)
+        self.assertIn("# TYPE pg_monitor_deadlocks_total counter", text)
+
+    def test_custom_queries_from_template(self):
+        try:
+            import yaml  # noqa: F401
+        except ImportError:
+            self.skipTest("PyYAML 未安装")
+        path = os.path.join(ROOT, "config", "queries.yaml.template")
+        names = ["pg_stat_io", "pg_stat_wal", "pg_stat_checkpointer", "pg_replication_slots"]
+        queries = monitor_pg.load_custom_queries(path, names)
+        self.assertEqual(sorted(queries), sorted(names))
+        fams = monitor_pg.CustomQueryRunner.to_families("pg1", "pg_stat_io", queries["pg_stat_io"], [
+            {"backend_type": "client backend", "object": "relation", "context": "normal",
+             "reads": 10, "writes": 2, "extends": None, "hits": 99},
+        ])
+        by_name = {f.name: f for f in fams}
+        self.assertEqual(by_name["pg_stat_io_reads"].type, "counter")
+        labels, value = by_name["pg_stat_io_reads"].samples[0]
+        self.assertEqual((labels["backend_type"], labels["instance"], value), ("client backend", "pg1", 10.0))
+        self.assertEqual(by_name["pg_stat_io_extends"].samples, [])
+
+    def test_failed_custom_query_retried_after_reconnect(self):
+        class Target:
+            conn = object()
+            generation = 1
+            fail = True
+            calls = 0
+
+            def execute(self, sql, params=None):
+                self.calls += 1
+                if self.fail:
+                    raise RuntimeError("relation does not exist")
+                return [{"v": 1}]
+
+        db = Target()
+        exporter = monitor_pg.PrometheusExporter(self.logger)
+        spec = {"query": "SELECT 1 AS v", "metrics": [{"v": {"usage": "GAUGE"}}]}
+        runner = monitor_pg.CustomQueryRunner(exporter, [("pg1", db)], {"q": spec}, 60, self.logger)
+        for _ in range(5):
+            runner.run_once()
+        self.assertEqual(db.calls, 3)
+        db.fail = False
+        runner.run_once()
+        self.assertEqual(db.calls, 3)
+        db.generation = 2
+        runner.run_once()
+        self.assertEqual(db.calls, 4)
+        self.assertIn(b'q_v{instance="pg1"} 1.0', exporter.payload())
+
+    def test_concurrent_scrapes_served_from_cache(self):
+        exporter = monitor_pg.PrometheusExporter(self.logger)
+        db = FakeDB(snapshot_row())
+        for i in range(50):
+            mon = monitor_pg.Monitor(make_cfg(), db, RecordingSender(), self.logger, exporter=exporter)
+            mon.instance = "pg{}".format(i)
+            mon.evaluate_and_alert()
+        calls_before = len(db.calls)
+        host, port = exporter.serve("127.0.0.1", 0)
+        errors = []
+
+        def scraper():
+            conn = http.client.HTTPConnection(host, port, timeout=5)
+            try:
+                for _ in range(100):
+                    conn.request("GET", "/metrics")
+                    resp = conn.getresponse()
+                    if resp.status != 200 or not resp.read():
+                        errors.append(resp.status)
+            finally:
+                conn.close()
+
+        threads = [threading.Thread(target=scraper) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        exporter.shutdown()
+        self.assertEqual(errors, [])
+        # 抓取只返回预渲染字节,不访问数据库;处理耗时见 bench_monitor_pg.py --component exporter
+        self.assertEqual(len(db.calls), calls_before)
+        self.assertEqual(len(exporter.scrape_durations), 800)
+
+
+class BloatDB(FakeDB):
+    """带 pgstattuple 的数据库替身,记录每次受保护扫描的关系"""
+    def __init__(self, candidates, fail_relids=()):
+        super().__init__(snapshot_row=snapshot_row(), extensions=("plpgsql", "pgstattuple"))
+        self.candidates = candidates
+        self.fail_relids = set(fail_relids)
+        self.scanned = []
+        self.timeouts = []
+
+    def execute(self, sql, params=None):
+        if "FROM pg_class c" in sql:
+            self.calls.append(sql)
+            return [dict(c) for c in self.candidates]
+        return super().execute(sql, params)
+
+    def execute_guarded(self, sql, params=None, statement_timeout_ms=0, lock_timeout_ms=0):
+        relid = params[0]
+        self.scanned.append((relid, sql.split(" FROM ")[-1].split("(")[0]))
+        self.timeouts.append((statement_timeout_ms, lock_timeout_ms))
+        if relid in self.fail_relids:
+            raise RuntimeError("canceling statement due to statement timeout")
+        return [{"bloat_pct": float(relid)}]
+
+
+def bloat_candidate(relid, relpages, relkind="r", amname="heap", n_dead_tup=0, reltuples=1000.0):
+    """构造膨胀候选行"""
+    return {"relid": relid, "schemaname": "public", "relname": "rel{}".format(relid), "relkind": relkind,
+            "amname": amname, "relpages": relpages, "reltuples": reltuples, "n_dead_tup": n_dead_tup}
+
+
+class TestBloatScanner(unittest.TestCase):
+    """增量膨胀扫描测试"""
+    def test_plan_respects_page_budget_and_prefers_unscanned(self):
+        scanner = monitor_pg.BloatScanner(budget_pages=1000, stale_after_seconds=100)
+        scanner.set_candidates([bloat_candidate(1, 600), bloat_candidate(2, 500), bloat_candidate(3, 300)], now=0)
+        self.assertEqual([c["relid"] for c in scanner.plan(0)], [1, 3])
+        for c in scanner.plan(0):
+            scanner.record(c, 10.0, now=0)
+        self.assertEqual([c["relid"] for c in scanner.plan(3)], [2])
+        scanner.record(scanner.candidates[2], 5.0, now=3)
+        # 刚扫描过的关系在短时间内不会重复扫描
+        self.assertEqual(scanner.plan(4), [])
+
+    def test_single_oversized_relation_still_scanned(self):
+        scanner = monitor_pg.BloatScanner(budget_pages=10)
+        scanner.set_candidates([bloat_candidate(1, 5000)], now=0)
+        self.assertEqual([c["relid"] for c in scanner.plan(0)], [1])
+
+    def test_unsupported_index_methods_are_not_candidates(self):
+        self.assertIn("am.amname IN ('btree', 'hash', 'gist')", monitor_pg.BLOAT_CANDIDATES_SQL)
+        db = BloatDB([bloat_candidate(10, 200), bloat_candidate(20, 200, relkind="i", amname="gin"),
+                      bloat_candidate(30, 200, relkind="i", amname="brin")])
+        mon = monitor_pg.Monitor(make_cfg(), db, RecordingSender(), monitor_pg.logging.getLogger("test"))
+        mon.get_bloat()
+        mon.get_bloat()
+        self.assertEqual([relid for relid, _ in db.scanned], [10])
+        self.assertEqual(sorted(mon.bloat_scanner.candidates), [10])
+
+    def test_churn_raises_priority_and_dropped_relations_forgotten(self):
+        scanner = monitor_pg.BloatScanner(budget_pages=100, stale_after_seconds=100)
+        a, b = bloat_candidate(1, 100), bloat_candidate(2, 100)
+        scanner.set_candidates([a, b], now=0)
+        scanner.record(a, 1.0, now=0)
+        scanner.record(b, 1.0, now=0)
+        scanner.set_candidates([a, bloat_candidate(2, 100, n_dead_tup=800)], now=50)
+        self.assertEqual([c["relid"] for c in scanner.plan(50)], [2])
+        scanner.set_candidates([a], now=60)
+        self.assertNotIn(2, scanner.cache)
+
+    def test_monitor_scans_incrementally_with_guards(self):
+        candidates = [bloat_candidate(10, 200), bloat_candidate(20, 200, relkind="i", amname="btree"),
+                      bloat_candidate(30, 200, relkind="i", amname="gist")]
+        db = BloatDB(candidates, fail_relids={30})
+        cfg = make_cfg(bloat_scan={"budget_pages": 400, "statement_timeout_ms": 5000, "lock_timeout_ms": 200})
+        mon = monitor_pg.Monitor(cfg, db, RecordingSender(), monitor_pg.logging.getLogger("test"))
+        first = mon.get_bloat()
+        self.assertEqual(len(db.scanned), 2)
+        self.assertEqual(set(db.timeouts), {(5000, 200)})
+        mon.get_bloat()
+        self.assertEqual(len(db.scanned), 3)
+        methods = dict(db.scanned)
+        self.assertEqual(methods, {10: "pgstattuple_approx", 20: "pgstatindex", 30: "pgstattuple"})
+        bloat = mon.get_bloat()
+        self.assertEqual(len(db.scanned), 3)
+        self.assertEqual(bloat["max_pct"], 20.0)
+        self.assertEqual([r["relname"] for r in bloat["index"]], ["rel20"])
+        self.assertGreater(first["max_pct"], 0)
+        self.assertEqual(sum(1 for sql in db.calls if "FROM pg_class c" in sql), 1)
+
+
+def lock_row(pid, blocked_by=(), wait_ms=0.0, state="active", query="q"):
+    """构造锁等待查询的返回行"""
+    return {"pid": pid, "blocked_by": list(blocked_by), "wait_ms": wait_ms, "state": state,
+            "wait_event": "relation" if blocked_by else None, "usename": "app", "datname": "db",
+            "xact_age_s": 60.0, "query": query}
+
+
+class TestLockGraph(unittest.TestCase):
+    """锁等待图分析测试"""
+    def test_roots_depth_and_transitive_counts(self):
+        rows = [
+            lock_row(1, state="idle in transaction", query="UPDATE a"),
+            lock_row(2, [1], 9000), lock_row(3, [1], 8000),
+            lock_row(4, [2], 5000), lock_row(5, [4, 3], 1000),
+            lock_row(6, [0], 200),
+        ]
+        g = monitor_pg.analyze_lock_waits(rows)
+        self.assertEqual(g["blocked_total"], 5)
+        self.assertEqual(g["max_depth"], 3)
+        self.assertEqual(g["max_wait_ms"], 9000)
+        self.assertEqual(g["cycles"], [])
+        top = g["roots"][0]
+        self.assertEqual((top["pid"], top["blocked_count"], top["direct_count"], top["max_depth"]), (1, 4, 2, 3))
+        self.assertEqual(top["state"], "idle in transaction")
+        self.assertEqual(g["roots"][1]["state"], "prepared transaction")
+        self.assertEqual(g["blocking"][0]["blocked_pid"], 2)
+
+    def test_cycles_detected_with_external_root(self):
+        rows = [lock_row(1), lock_row(2, [3, 1], 100), lock_row(3, [2], 100), lock_row(4, [4], 50), lock_row(5, [3], 10)]
+        g = monitor_pg.analyze_lock_waits(rows)
+        self.assertEqual(g["cycles"], [[2, 3], [4]])
+        self.assertEqual([(r["pid"], r["blocked_count"]) for r in g["roots"]], [(1, 3)])
+        self.assertEqual(g["max_depth"], 2)
+
+    def test_monitor_alert_names_root_blocker(self):
+        rows = [lock_row(7, state="idle in transaction", query="ALTER TABLE t"),
+                lock_row(8, [7], 20000), lock_row(9, [8], 16000)]
+        cfg = make_cfg(thresholds={"lock_wait_ms": {"warning": 5000, "critical": 15000}})
+        sender = RecordingSender()
+        mon = monitor_pg.Monitor(cfg, FakeDB(snapshot_row(locks=rows)), sender, monitor_pg.logging.getLogger("test"))
+        mon.evaluate_and_alert()
+        self.assertIn("根阻塞 pid=7 [idle in transaction]", sender.messages[0])
+        self.assertIn("阻塞 2 个会话", sender.messages[0])
+        self.assertEqual(mon.latest_values["lock_max_chain_depth"], 2)
+
+    def test_synthetic_trees_and_cycles(self):
+        # 与 bench_monitor_pg.py --component lock_graph 同一生成器;耗时只在基准中测量
+        n = 2000
+        g = monitor_pg.analyze_lock_waits(synthetic_lock_rows(n, seed=n))
+        self.assertEqual(g["blocked_total"], n - n // 50)
+        self.assertEqual(g["root_total"], n // 50)
+        self.assertEqual(len(g["cycles"]), n // 1000)
+
+
+class TestSizeTracker(unittest.TestCase):
+    """自适应容量刷新与增长预测测试"""
+    GB = 1024 ** 3
+
+    def _tracker(self):
+        return monitor_pg.SizeTracker(min_refresh_seconds=300, max_refresh_seconds=21600, refresh_growth_pct=1.0)
+
+    def test_refresh_interval_follows_growth(self):
+        tr = self._tracker()
+        tr.update("database", [("fast", 100 * self.GB), ("flat", 100 * self.GB)], now=0)
+        # 尚无增长速率时按最短间隔刷新
+        self.assertEqual(tr.fresh("database", 299), ["fast", "flat"])
+        self.assertEqual(tr.fresh("database", 300), [])
+        tr.update("database", [("fast", 110 * self.GB), ("flat", 100 * self.GB)], now=3600)
+        self.assertEqual(tr.objects["database"]["flat"]["next_refresh_at"], 3600 + 21600)
+        # 每小时增长 10GB,1% (1.1GB) 约 6.6 分钟
+        self.assertAlmostEqual(tr.objects["database"]["fast"]["next_refresh_at"] - 3600, 396, delta=1)
+        self.assertEqual(tr.fresh("database", 3600 + 400), ["flat"])
+
+    def test_estimates_between_refreshes(self):
+        tr = self._tracker()
+        tr.update("database", [("cur", 10 * self.GB), ("other", 10 * self.GB), ("gone", 1)], now=0,
+                  relpages={"cur": 8 * self.GB})
+        tr.update("database", [("cur", 11 * self.GB), ("other", 12 * self.GB)], now=3600,
+                  relpages={"cur": 9 * self.GB})
+        tr.update("database", [("cur", None), ("other", None)], now=5400, relpages={"cur": 9.5 * self.GB})
+        rows = {r["datname"]: r for r in tr.report("database", 5400)}
+        self.assertEqual(set(rows), {"cur", "other"})
+        self.assertEqual(rows["cur"]["size_bytes"], int(11.5 * self.GB))
+        self.assertEqual(rows["other"]["size_bytes"], 13 * self.GB)
+        self.assertTrue(rows["other"]["estimated"])
+        self.assertEqual(rows["other"]["growth_bytes_per_hour"], 2 * self.GB)
+
+    def test_hours_to_threshold(self):
+        self.assertEqual(monitor_pg.hours_to_threshold(80, 5, 100), 4.0)
+        self.assertEqual(monitor_pg.hours_to_threshold(120, 5, 100), 0.0)
+        self.assertIsNone(monitor_pg.hours_to_threshold(80, 0, 100))
+        self.assertIsNone(monitor_pg.hours_to_threshold(80, 5, None))
+
+    def test_monitor_skips_fresh_sizes_and_forecasts(self):
+        cfg = make_cfg(thresholds={"disk_usage_database_bytes": {"warning": 1500, "critical": 5000}})
+        db = FakeDB(snapshot_row(databases=[{"datname": "postgres", "size_bytes": 1024}]))
+        sender = RecordingSender()
+        mon = monitor_pg.Monitor(cfg, db, sender, monitor_pg.logging.getLogger("test"))
+        mon.evaluate_and_alert()
+        self.assertEqual(mon._snapshot_params()["fresh_databases"], ["postgres"])
+        mon.sizes.objects["database"]["postgres"]["full_at"] -= 3600
+        mon.sizes.objects["database"]["postgres"]["next_refresh_at"] = 0
+        db.snapshot_row = snapshot_row(databases=[{"datname": "postgres", "size_bytes": 2048}])
+        mon.evaluate_and_alert()
+        self.assertEqual(mon.latest_values["disk_db_growth_bytes_per_hour"], 1024)
+        self.assertEqual(mon.latest_values["disk_db_hours_to_critical"], 2.9)
+        self.assertIn("预计 2h54m 后到达 CRITICAL 阈值", sender.messages[-1])
+
+
+class FakeProc:
+    """临时目录中的 /proc 替身"""
+    def __init__(self):
+        self.root = tempfile.mkdtemp()
+        self.write_host(cpu=(100, 0, 100, 800, 0, 0, 0, 0), sectors=(0, 0), ticks=0)
+
+    def write(self, name, text):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(text)
+
+    def write_host(self, cpu, sectors, ticks, avail_kb=4000000):
+        self.write("stat", "cpu  {} 0 0\ncpu0 1 2 3 4 5 6 7 8\n".format(" ".join(str(v) for v in cpu)))
+        self.write("meminfo", "MemTotal:       8000000 kB\nMemFree:        1000000 kB\n"
+                              "MemAvailable:   {} kB\nSwapTotal:      1000 kB\nSwapFree:       750 kB\n".format(avail_kb))
+        self.write("loadavg", "1.50 1.00 0.50 2/300 12345\n")
+        self.write("diskstats", "   8       0 sda 10 0 {} 5 20 0 {} 9 0 {} 30 0 0 0 0\n"
+                                "   8       1 sda1 10 0 999999 5 20 0 999999 9 0 99999 30 0 0 0 0\n".format(sectors[0], sectors[1], ticks))
+
+    def write_pid(self, pid, utime, stime, starttime, read_bytes=0, write_bytes=0):
+        fields = ["S"] + ["0"] * 10 + [str(utime), str(stime)] + ["0"] * 6 + [str(starttime)] + ["0"] * 10
+        self.write("{}/stat".format(pid), "{} (postgres: app db (x)) {}\n".format(pid, " ".join(fields)))
+        self.write("{}/io".format(pid), "rchar: 1\nwchar: 1\nread_bytes: {}\nwrite_bytes: {}\n".format(read_bytes, write_bytes))
+
+
+class TestHostSampler(unittest.TestCase):
+    """进程内主机采样测试"""
+    def test_ring_buffer_wraps_and_filters(self):
+        ring = monitor_pg.RingBuffer(("ts", "v"), 3)
+        for i in range(1, 6):
+            ring.append((float(i), float(i * 10)))
+        self.assertEqual(len(ring), 3)
+        self.assertEqual(ring.rows(), [(3.0, 30.0), (4.0, 40.0), (5.0, 50.0)])
+        self.assertEqual(ring.rows(since=4.0), [(5.0, 50.0)])
+        self.assertEqual(ring.latest(), {"ts": 5.0, "v": 50.0})
+
+    def test_sample_rates_from_proc(self):
+        proc = FakeProc()
+        sampler = monitor_pg.HostSampler(interval_seconds=2, retention_seconds=10, mounts=[proc.root],
+                                         disks=["sda"], proc_root=proc.root)
+        self.assertIsNone(sampler.sample(now=100.0))
+        # 2 秒内: user+system 增加 300, idle 增加 600, iowait 增加 100
+        proc.write_host(cpu=(250, 0, 250, 1400, 100, 0, 0, 0), sectors=(4096, 8192), ticks=1500)
+        row = sampler.sample(now=102.0)
+        self.assertAlmostEqual(row["cpu_pct"], 30.0)
+        self.assertAlmostEqual(row["iowait_pct"], 10.0)
+        self.assertEqual(row["disk_read_bps"], 4096 * 512 / 2)
+        self.assertAlmostEqual(row["disk_busy_pct"], 75.0)
+        self.assertAlmostEqual(row["mem_used_pct"], 50.0)
+        self.assertAlmostEqual(row["swap_used_pct"], 25.0)
+        self.assertEqual(row["load1"], 1.5)
+        self.assertGreater(row["fs_used_pct"], 0)
+        summary = sampler.summary(since=0)
+        self.assertEqual(summary["samples"], 1)
+        self.assertEqual(summary["cpu_pct_max"], 30.0)
+        self.assertIsNone(sampler.summary(since=102.0))
+        self.assertEqual(sampler.ring.capacity, 6)
+
+    def test_stacked_devices_are_not_double_counted(self):
+        proc = FakeProc()
+        for dev, slaves in (("sda", ()), ("sdb", ()), ("dm-0", ("sda",)), ("md0", ("sdb",)), ("vdm", ()), ("loop0", ())):
+            os.makedirs(os.path.join(proc.root, "block", dev, "slaves"), exist_ok=True)
+            for slave in slaves:
+                proc.write("block/{}/slaves/{}".format(dev, slave), "")
+        sampler = monitor_pg.HostSampler(mounts=[proc.root], proc_root=proc.root, sys_root=proc.root)
+        self.assertEqual(sampler._disks, {"sda", "sdb", "vdm"})
+        proc.write("diskstats", "   8       0 sda 10 0 100 5 20 0 200 9 0 10 30 0 0 0 0\n"
+                                "   8      16 sdb 10 0 100 5 20 0 200 9 0 10 30 0 0 0 0\n"
+                                " 253       0 dm-0 10 0 100 5 20 0 200 9 0 10 30 0 0 0 0\n"
+                                "   9       0 md0 10 0 100 5 20 0 200 9 0 10 30 0 0 0 0\n")
+        read, write, ticks = sampler._disk()
+        self.assertEqual((read, write, sorted(ticks)), (200, 400, ["sda", "sdb"]))
+
+    def test_backend_usage_deltas(self):
+        proc = FakeProc()
+        usage = monitor_pg.BackendUsage(proc_root=proc.root)
+        usage.ticks_per_second = 100.0
+        proc.write_pid(11, 100, 50, 7000, read_bytes=4096)
+        proc.write_pid(12, 10, 10, 7100)
+        backends = [{"pid": 11, "backend_start": 10.0, "query": "SELECT big"}, {"pid": 12, "backend_start": 20.0}]
+        self.assertEqual(usage.update(backends, now=100.0), [])
+        proc.write_pid(11, 300, 100, 7000, read_bytes=4096 + 8192, write_bytes=512)
+        # pid 12 被新的后端复用(starttime 改变),且在上次采集之后才启动
+        proc.write_pid(12, 5, 5, 9000)
+        proc.write_pid(13, 1, 0, 9100)
+        backends = [{"pid": 11, "backend_start": 10.0, "query": "SELECT big"},
+                    {"pid": 12, "backend_start": 150.0}, {"pid": 13, "backend_start": 150.0}, {"pid": 14}]
+        top = usage.update(backends, now=200.0)
+        self.assertEqual([(u["pid"], u["cpu_ms"]) for u in top], [(11, 2500.0), (12, 100.0), (13, 10.0)])
+        self.assertEqual((top[0]["read_bytes"], top[0]["write_bytes"], top[0]["query"]), (8192, 512, "SELECT big"))
+
+    def test_monitor_reports_host_and_attributes_backends(self):
+        proc = FakeProc()
+        sampler = monitor_pg.HostSampler(mounts=[proc.root], disks=["sda"], proc_root=proc.root)
+        now = time.time()
+        sampler.sample(now=now - 2)
+        proc.write_host(cpu=(1000, 0, 0, 800, 0, 0, 0, 0), sectors=(0, 0), ticks=0)
+        sampler.sample(now=now)
+        cfg = make_cfg(thresholds={"host_cpu_pct": {"warning": 80, "critical": 95}})
+        db = FakeDB(snapshot_row(backends=[{"pid": 21, "datname": "app", "backend_start": 0, "query": "SELECT spin()"}]))
+        mon = monitor_pg.Monitor(cfg, db, RecordingSender(), monitor_pg.logging.getLogger("test"), host=sampler)
+        mon._host_since = now - 10
+        mon.backend_usage = monitor_pg.BackendUsage(proc_root=proc.root)
+        mon.backend_usage.ticks_per_second = 100.0
+        proc.write_pid(21, 0, 0, 1)
+        mon.backend_usage.update([{"pid": 21}], now=now - 1)
+        proc.write_pid(21, 150, 0, 1)
+        mon.evaluate_and_alert()
+        self.assertEqual(mon.latest_values["host_cpu_pct"], 100.0)
+        self.assertEqual(mon.latest_values["backend_cpu_ms"], 1500.0)
+        self.assertIn("CPU 最高后端 pid=21 1500ms [app] SELECT spin()", mon.sender.messages[0])
+        self.assertIn("backends", mon.snapshot_fragments())
+        remote = monitor_pg.Monitor(make_cfg(db={"host": "10.0.0.5", "port": 5432, "dbname": "postgres", "user": "u"},
+                                             thresholds={"host_cpu_pct": {"warning": 80}}),
+                                    FakeDB(snapshot_row()), RecordingSender(), monitor_pg.logging.getLogger("test"), host=sampler)
+        self.assertIsNone(remote.backend_usage)
+        # 远程实例不附带监控机的主机指标,也就不会以远程实例的名义触发主机告警
+        remote.evaluate_and_alert()
+        self.assertIsNone(remote.latest_values["host_cpu_pct"])
+        self.assertNotIn("主机CPU", "".join(remote.sender.messages))
+        shared = monitor_pg.Monitor(
+            make_cfg(db={"host": "10.0.0.5", "port": 5432, "dbname": "postgres", "user": "u", "host_shared": True}),
+            FakeDB(snapshot_row()), RecordingSender(), monitor_pg.logging.getLogger("test"), host=sampler)
+        shared._host_since = now - 10
+        shared.evaluate_and_alert()
+        self.assertEqual(shared.latest_values["host_cpu_pct"], 100.0)
+
+
+class TestStatementsTracker(unittest.TestCase):
+    """pg_stat_statements 增量 Top-N 测试"""
+    def _rows(self, n, scale, seed):
+        rnd = random.Random(seed)
+        return [(qid, float(qid % 7 + 1) * scale, float(rnd.randrange(1000)) * scale, 0.0, float(qid % 3) * scale)
+                for qid in range(1, n + 1)]
+
+    def test_deltas_and_top_n_match_brute_force(self):
+        tracker = monitor_pg.StatementsTracker(capacity=1000, top_n=5)
+        first = self._rows(500, 1, seed=1)
+        self.assertEqual(tracker.update(first)["exec_ms"], [])
+        second = [(q, c * 3, e + float(q * 3 % 997), t, k) for q, c, e, t, k in first]
+        top = tracker.update(second)
+        expected = sorted((float(q * 3 % 997), q) for q, _, _, _, _ in first)[-5:][::-1]
+        self.assertEqual([(i["exec_ms"], i["queryid"]) for i in top["exec_ms"]], expected)
+        self.assertEqual(top["exec_ms"][0]["calls"], first[top["exec_ms"][0]["queryid"] - 1][1] * 2)
+
+    def test_reset_new_entries_and_reclaim(self):
+        tracker = monitor_pg.StatementsTracker(capacity=3, top_n=3)
+        tracker.update([(1, 10, 100, 0, 0), (2, 10, 100, 0, 0)])
+        top = tracker.update([(1, 2, 30, 0, 0), (3, 4, 50, 0, 0)])
+        self.assertEqual({i["queryid"]: i["exec_ms"] for i in top["exec_ms"]}, {1: 30, 3: 50})
+        self.assertEqual(len(tracker), 2)
+        tracker.update([(4, 1, 1, 0, 0), (5, 1, 1, 0, 0), (6, 1, 1, 0, 0), (7, 1, 1, 0, 0)])
+        self.assertEqual(len(tracker), 3)
+        self.assertEqual(tracker.dropped, 1)
+        # 上一周期有截断,新出现的条目可能是刚进入前 capacity 的旧条目,只建立基线
+        self.assertEqual(tracker.update([(8, 100, 10000, 0, 0), (4, 2, 2, 0, 0)])["exec_ms"][0]["queryid"], 4)
+
+    def test_over_capacity_keeps_heaviest_statements(self):
+        tracker = monitor_pg.StatementsTracker(capacity=3, top_n=2)
+        light = [(q, 1.0, 1.0, 0.0, 0.0) for q in range(1, 6)]
+        tracker.update(light + [(99, 10.0, 5000.0, 0.0, 0.0)])
+        self.assertEqual(len(tracker), 3)
+        self.assertIn(99, tracker._slot_of)
+        top = tracker.update([(q, 2.0, 2.0, 0.0, 0.0) for q in range(1, 6)] + [(99, 20.0, 9000.0, 0.0, 0.0)])
+        self.assertEqual(top["exec_ms"][0]["queryid"], 99)
+        self.assertEqual(top["exec_ms"][0]["exec_ms"], 4000.0)
+        # 新出现的重语句替换掉较轻的条目,下一周期即给出增量
+        tracker.update([(7, 5.0, 8000.0, 0.0, 0.0)] + [(q, 3.0, 3.0, 0.0, 0.0) for q in range(1, 6)] + [(99, 30.0, 9500.0, 0.0, 0.0)])
+        self.assertIn(7, tracker._slot_of)
+        top = tracker.update([(7, 6.0, 8600.0, 0.0, 0.0), (99, 31.0, 9600.0, 0.0, 0.0)] + [(q, 4.0, 4.0, 0.0, 0.0) for q in range(1, 6)])
+        self.assertEqual([(i["queryid"], i["exec_ms"]) for i in top["exec_ms"]], [(7, 600.0), (99, 100.0)])
+
+    def test_100k_statement_rows_keep_fixed_state(self):
+        tracker = monitor_pg.StatementsTracker(capacity=20000, top_n=10)
+        state_bytes = sum(a.buffer_info()[1] * a.itemsize for a in tracker._prev.values())
+        rows = [(qid, 1.0, float(qid % 997), float(qid % 13), 0.0) for qid in range(100000)]
+        tracker.update(rows)
+        bumped = [(q, c + 2, e + (q % 5003), t, k) for q, c, e, t, k in rows]
+        top = tracker.update(bumped)
+        self.assertEqual(len(top["exec_ms"]), 10)
+        self.assertEqual(len(tracker), 20000)
+        self.assertEqual(sum(a.buffer_info()[1] * a.itemsize for a in tracker._prev.values()), state_bytes)
+
+    def test_monitor_collects_and_alerts_top_statements(self):
+        logger = monitor_pg.setup_logger("/tmp/monitor_pg_test.log")
+        db = FakeDB(snapshot_row(), extensions=["pg_stat_statements"])
+        stats = {"exec_ms": 1000.0, "calls": 10}
+        db.execute = lambda sql, params=None: (
+            [{"extname": "pg_stat_statements"}] if "pg_extension" in sql else
+            [{"queryid": 42, "query": "SELECT * FROM t WHERE id = $1"}] if "ANY(" in sql else
+            [{"queryid": 42, "calls": stats["calls"], "exec_ms": stats["exec_ms"], "temp_blks": 0, "cpu_ms": 0}]
+        )
+        cfg = make_cfg(thresholds={"top_statement_exec_ms": {"warning": 5000}})
+        sender = RecordingSender()
+        mon = monitor_pg.Monitor(cfg, db, sender, logger)
+        mon.evaluate_and_alert()
+        stats.update(exec_ms=9000.0, calls=12)
+        mon.evaluate_and_alert()
+        self.assertEqual(mon.latest_values["top_statement_exec_ms"], 8000.0)
+        self.assertIn("queryid=42", sender.messages[-1])
+        self.assertIn("SELECT * FROM t", sender.messages[-1])
+
+
+class TestReplication(unittest.TestCase):
+    """复制字节差与吞吐跟踪测试"""
+    MB = 1024.0 * 1024.0
+
+    def setUp(self):
+        self.logger = monitor_pg.setup_logger("/tmp/monitor_pg_test.log")
+
+    def _row(self, wal, replay, retained, startup_lag=None):
+        return {
+            "standby": False, "wal_lsn_bytes": wal, "lag_s": 0.0, "local_replay_lag_bytes": None,
+            "standbys": [
+                {"name": "s1", "client": "10.0.0.2", "state": "streaming", "sent_lag_bytes": 0.0, "write_lag_bytes": 0.0,
+                 "flush_lag_bytes": 0.0, "replay_lag_bytes": wal - replay, "replay_lsn_bytes": replay, "replay_lag_s": None},
+                {"name": "s2", "client": "10.0.0.3", "state": "startup", "sent_lag_bytes": None, "write_lag_bytes": None,
+                 "flush_lag_bytes": None, "replay_lag_bytes": startup_lag, "replay_lsn_bytes": None, "replay_lag_s": None},
+            ],
+            "slots": [
+                {"slot_name": "old_standby", "slot_type": "physical", "database": "", "active": False, "wal_status": "extended",
+                 "safe_wal_size": 3600 * self.MB, "retained_bytes": retained, "confirmed_lag_bytes": None},
+                {"slot_name": "s1", "slot_type": "physical", "database": "", "active": True, "wal_status": "reserved",
+                 "safe_wal_size": None, "retained_bytes": wal - replay, "confirmed_lag_bytes": None},
+            ],
+        }
+
+    def test_rates_catchup_and_slot_forecasts(self):
+        tracker = monitor_pg.ReplicationTracker()
+        first = tracker.update(self._row(1000 * self.MB, 980 * self.MB, 100 * self.MB), 1000.0, wal_free_bytes=7200 * self.MB)
+        self.assertIsNone(first["wal_bps"])
+        self.assertIsNone(first["standbys"][0]["catchup_s"])
+        out = tracker.update(self._row(1010 * self.MB, 1000 * self.MB, 110 * self.MB), 1010.0, wal_free_bytes=7200 * self.MB)
+        self.assertEqual(out["wal_bps"], self.MB)
+        s1 = out["standbys"][0]
+        self.assertEqual((s1["name"], s1["apply_bps"], s1["catchup_s"]), ("s1", 2 * self.MB, 10.0))
+        # 刚连接的备库各位置为 NULL,不当作 0 延迟参与汇总
+        self.assertIsNone(out["standbys"][1]["catchup_s"])
+        self.assertEqual(out["lag_bytes"], 10 * self.MB)
+        slot = out["slots"][0]
+        self.assertEqual((slot["slot_name"], slot["growth_bps"]), ("old_standby", self.MB))
+        self.assertEqual((slot["hours_to_lost"], slot["hours_to_full"]), (1.0, 2.0))
+        self.assertEqual((out["slot_retained_bytes_max"], out["slots_inactive"]), (110 * self.MB, 1))
+        # 位置回退(备库重建)时不给出速率
+        again = tracker.update(self._row(1020 * self.MB, 10 * self.MB, 120 * self.MB), 1020.0)
+        self.assertIsNone(again["standbys"][0]["apply_bps"])
+        self.assertIsNone(again["slots"][0]["hours_to_full"])
+
+    def test_standby_reports_its_own_replay_lag(self):
+        out = monitor_pg.ReplicationTracker().update(
+            {"standby": True, "wal_lsn_bytes": 5.0e9, "lag_s": 3.0, "local_replay_lag_bytes": 4096.0, "standbys": [], "slots": []}, 1.0)
+        self.assertEqual((out["standby"], out["lag_bytes"], out["lag_s"]), (True, 4096.0, 3.0))
+        self.assertIn("本机为备库", monitor_pg.Monitor._standby_detail(out))
+
+    def test_monitor_alerts_on_inactive_slot_and_exports_per_slot(self):
+        cfg = make_cfg(thresholds={"replication_slot_retained_bytes": {"warning": 50 * self.MB},
+                                   "replication_lag_bytes": {"warning": 100 * self.MB}})
+        db = FakeDB(snapshot_row(connections={"total": 1, "active": 1, "idle": 0},
+                                 replication=self._row(1000 * self.MB, 990 * self.MB, 100 * self.MB, startup_lag=None)))
+        sender = RecordingSender()
+        mon = monitor_pg.Monitor(cfg, db, sender, self.logger)
+        mon.evaluate_and_alert()
+        self.assertEqual(len(sender.messages), 1)
+        self.assertIn("old_standby(physical,未活跃) 保留 100.0MB", sender.messages[0])
+        self.assertEqual(mon.latest_values["replication_slots_inactive"], 1)
+        self.assertEqual(mon.latest_values["replication_lag_bytes"], 10 * self.MB)
+        self.assertEqual(mon.latest_values["replication_standbys"], 2)
+        families = {f.name: f for f in mon._replication_families}
+        retained = families["pg_monitor_replication_slot_retained_bytes"].samples
+        self.assertIn(({"instance": mon.instance, "slot": "old_standby", "slot_type": "physical", "active": "0"}, 100 * self.MB), retained)
+        kinds = [l["kind"] for l, _ in families["pg_monitor_replication_standby_lag_bytes"].samples]
+        self.assertEqual(kinds, ["sent", "write", "flush", "replay"])
+
+
+class TestVacuum(unittest.TestCase):
+    """冻结年龄、vacuum 进度与 xmin 视界跟踪测试"""
+    def setUp(self):
+        self.logger = monitor_pg.setup_logger("/tmp/monitor_pg_test.log")
+
+    def _row(self, next_xid, scanned, xmin="500", xid_age=10 ** 9):
+        return {
+            "next_xid": next_xid,
+            "databases": [{"datname": "small", "xid_age": 1000, "mxid_age": 0},
+                          {"datname": "big", "xid_age": xid_age, "mxid_age": 5000}],
+            "vacuums": [{"pid": 42, "datname": "big", "relname": "public.orders", "phase": "scanning heap",
+                         "heap_blks_total": 10000, "heap_blks_scanned": scanned, "heap_blks_vacuumed": 0,
+                         "index_vacuum_count": 0, "auto": True, "running_s": 100.0}],
+            "holders": [{"kind": "backend", "id": "77", "datname": "big", "xmin": xmin, "xmin_age": 3000,
+                         "since": 900.0, "detail": "idle in transaction: SELECT 1"},
+                        {"kind": "slot", "id": "old_slot", "datname": "", "xmin": "400", "xmin_age": 3100,
+                         "since": None, "detail": "physical inactive"}],
+        }
+
+    def test_xid_rate_vacuum_eta_and_holder_continuity(self):
+        tracker = monitor_pg.VacuumTracker()
+        first = tracker.update(self._row(10 ** 6, 1000), 1000.0)
+        self.assertIsNone(first["xid_per_second"])
+        self.assertIsNone(first["hours_to_wraparound"])
+        self.assertEqual(first["databases"][0]["datname"], "big")
+        # 首次见到按启动以来平均速率估计:1000 块 / 100 秒
+        self.assertEqual((first["vacuums"][0]["blks_per_s"], first["vacuums"][0]["eta_s"]), (10.0, 900.0))
+        self.assertEqual({h["id"]: h["held_s"] for h in first["holders"]}, {"77": 100.0, "old_slot": 0.0})
+        self.assertEqual(first["xmin_horizon_age"], 3100)
+
+        out = tracker.update(self._row(10 ** 6 + 36000, 3000), 1010.0)
+        self.assertEqual(out["xid_per_second"], 3600.0)
+        self.assertEqual(out["hours_to_wraparound"], round((2 ** 31 - 10 ** 9) / 3600.0 / 3600.0, 1))
+        self.assertEqual(out["wraparound_pct"], round(100.0 * 10 ** 9 / 2 ** 31, 2))
+        v = out["vacuums"][0]
+        self.assertEqual((v["blks_per_s"], v["eta_s"], v["pct"]), (200.0, 35.0, 30.0))
+        self.assertEqual({h["id"]: h["held_s"] for h in out["holders"]}, {"77": 110.0, "old_slot": 10.0})
+        self.assertEqual(out["xmin_holder_max_s"], 110.0)
+
+        # 会话换了新的 xmin 后持有时长重新计算
+        again = tracker.update(self._row(10 ** 6 + 36000, 3000, xmin="600"), 1020.0)
+        held = {h["id"]: h["held_s"] for h in again["holders"]}
+        self.assertEqual(held, {"77": 0.0, "old_slot": 20.0})
+        self.assertEqual(again["xid_per_second"], 0.0)
+        self.assertIsNone(again["hours_to_wraparound"])
+
+    def test_backend_without_fixed_xmin_counts_from_first_observation(self):
+        self.assertIn("WHEN backend_xid IS NOT NULL OR state LIKE 'idle in transaction%%'", monitor_pg.VACUUM_SQL)
+        tracker = monitor_pg.VacuumTracker()
+        row = self._row(10 ** 6, 1000)
+        # 读已提交的长事务:SQL 不返回事务开始时间,重启后不会把整个事务时长算作持有时长
+        row["holders"] = [dict(row["holders"][0], since=None, detail="active app SELECT pg_sleep(1)")]
+        self.assertEqual(tracker.update(row, 1000.0)["holders"][0]["held_s"], 0.0)
+        self.assertEqual(tracker.update(row, 1030.0)["holders"][0]["held_s"], 30.0)
+
+    def test_monitor_alerts_on_wraparound_and_long_holder(self):
+        cfg = make_cfg(thresholds={"wraparound_pct": {"warning": 40, "critical": 75},
+                                   "xmin_holder_seconds": {"warning": 60}})
+        db = FakeDB(snapshot_row(connections={"total": 1, "active": 1, "idle": 0}, vacuum=self._row(10 ** 6, 1000)))
+        sender = RecordingSender()
+        mon = monitor_pg.Monitor(cfg, db, sender, self.logger)
+        mon.evaluate_and_alert()
+        joined = "\n".join(sender.messages)
+        self.assertIn("触发 2 条", joined)
+        self.assertIn("big age(datfrozenxid)=1000000000", joined)
+        self.assertIn("运行中: public.orders 10.0%", joined)
+        self.assertIn("backend 77 [big] xmin age=3000", joined)
+        self.assertEqual(mon.latest_values["xid_age_max"], 10 ** 9)
+        self.assertEqual(mon.latest_values["vacuum_running"], 1)
+        families = {f.name: f for f in mon._vacuum_families}
+        self.assertIn(({"instance": mon.instance, "datname": "big"}, 10 ** 9),
+                      families["pg_monitor_database_xid_age"].samples)
+
+
+class TestCollectorSchedule(unittest.TestCase):
+    def setUp(self):
+        self.logger = monitor_pg.logging.getLogger("test")
+
+    def test_heap_orders_collectors_by_own_interval(self):
+        sched = monitor_pg.CollectorSchedule({"locks": 5, "disk": 900}, {"locks": 5, "disk": 120}, now=0.0)
+        self.assertEqual(sorted(sched.pop_due(0.0)), ["disk", "locks"])
+        self.assertEqual(sched.pop_due(4.0), [])
+        self.assertEqual(sched.next_due(), 5.0)
+        self.assertEqual(sched.pop_due(5.0), ["locks"])
+        # 落后多个周期时只补跑一次,并从当前时间重新计时
+        self.assertEqual(sched.pop_due(100.0), ["locks"])
+        self.assertEqual(sched.next_due(), 105.0)
+        self.assertEqual(sched.pop_due(900.0), ["locks", "disk"])
+        self.assertEqual(sched.deadline(["locks", "disk"]), 120)
+
+    def test_jitter_does_not_drift_and_near_due_are_coalesced(self):
+        sched = monitor_pg.CollectorSchedule({"a": 10, "b": 11}, {"a": 10, "b": 11}, jitter_pct=20,
+                                             coalesce_seconds=1.0, now=0.0, rnd=random.Random(7))
+        sched.pop_due(0.0)
+        fired = []
+        now = 0.0
+        while now < 1000:
+            now = sched.next_due()
+            for name in sched.pop_due(now):
+                fired.append((name, now))
+        a_times = [t for n, t in fired if n == "a"]
+        # 每次触发都落在计划时间之后的抖动窗口内,计划时间本身不累积抖动
+        for i, t in enumerate(a_times[:50], start=1):
+            self.assertGreaterEqual(t, 10 * i - 1.0)
+            self.assertLessEqual(t, 10 * i + 2.0)
+        self.assertTrue(any(n == "b" and any(t == ta for ta in a_times) for n, t in fired))
+
+    def test_run_due_collects_only_due_fragments_and_holds_other_alerts(self):
+        db = FakeDB(snapshot_row())
+        cfg = make_cfg(schedule={"jitter_pct": 0})
+        sender = RecordingSender()
+        mon = monitor_pg.Monitor(cfg, db, sender, self.logger)
+        mon.schedule = monitor_pg.CollectorSchedule.from_config(cfg, now=0.0)
+        self.assertEqual(len(mon.run_due(0.0)), len(monitor_pg.COLLECTORS))
+        self.assertEqual(len(sender.messages), 1)
+        self.assertIn((mon.instance, "连接总数"), mon.alerts.firing)
+        db.calls.clear()
+        db.snapshot_row = snapshot_row(connections={"total": 1, "active": 1, "idle": 0})
+        self.assertEqual(mon.run_due(5.0), ["locks"])
+        snapshot_sql = [sql for sql in db.calls if "AS postmaster_start_time" in sql]
+        self.assertEqual(len(snapshot_sql), 1)
+        self.assertIn(" AS locks", snapshot_sql[0])
+        self.assertNotIn(" AS connections", snapshot_sql[0])
+        self.assertNotIn(" AS databases", snapshot_sql[0])
+        # 连接数未到期,告警既不恢复也不重发,导出值沿用上次
+        self.assertIn((mon.instance, "连接总数"), mon.alerts.firing)
+        self.assertEqual(len(sender.messages), 1)
+        self.assertEqual(mon.latest_values["connections_total"], 25)
+        self.assertEqual(sorted(mon.run_due(15.0)), ["connections", "locks", "logs", "replication", "slow_queries"])
+        self.assertNotIn((mon.instance, "连接总数"), mon.alerts.firing)
+
+    def test_unknown_collector_in_schedule_rejected(self):
+        with self.assertRaises(monitor_pg.ConfigError):
+            make_cfg(schedule={"collectors": {"nope": {"interval_seconds": 5}}})
+
+
+class TestWaitEvents(unittest.TestCase):
+    def setUp(self):
+        self.logger = monitor_pg.logging.getLogger("test")
+
+    def test_window_expires_buckets_and_reclaims_slots(self):
+        w = monitor_pg.WaitEventWindow(capacity=3, window_seconds=10, buckets=5)
+        w.add(("IO:DataFileRead", 1, "db"), 2.0, 0.0)
+        w.add(("LWLock:WALWrite", 2, "db"), 1.0, 3.0)
+        # 槽位用尽(0 号保留给 Other)后新键计入 Other
+        w.add(("Lock:relation", 3, "db"), 4.0, 3.5)
+        self.assertEqual(w.dropped, 1)
+        self.assertEqual(w.top(5, 4.0)[0], (monitor_pg.WaitEventWindow.OTHER, 4.0))
+        self.assertEqual(w.by_event(9.0)["IO:DataFileRead"], 2.0)
+        # 第 0 个桶在 10s 后过期,键被回收
+        self.assertNotIn("IO:DataFileRead", w.by_event(10.5))
+        self.assertEqual(len(w), 2)
+        self.assertEqual(w.by_event(14.0), {})
+        self.assertEqual(len(w), 1)
+        w.add(("IO:DataFileRead", 1, "db"), 1.0, 15.0)
+        self.assertEqual(w.by_event(15.0), {"IO:DataFileRead": 1.0})
+
+    def test_activity_samples_weighted_by_elapsed_time(self):
+        rows = [{"event": "IO:DataFileRead", "queryid": 42, "datname": "app", "n": 3.0},
+                {"event": "CPU", "queryid": 7, "datname": "app", "n": 1.0}]
+        db = FakeDB()
+        db.execute = lambda sql, params=None: [dict(r) for r in rows]
+        sampler = monitor_pg.WaitEventSampler(db, lambda: ("activity", "SQL"), interval_seconds=0.5,
+                                              window=monitor_pg.WaitEventWindow(16, 60, 12))
+        for i in range(21):
+            sampler.sample(now=100.0 + i * 0.5)
+        report = sampler.report(now=110.0)
+        self.assertEqual(report["events"][0]["event"], "IO:DataFileRead")
+        self.assertAlmostEqual(report["events"][0]["aas"], 3.0, places=1)
+        self.assertAlmostEqual(report["aas_total"], 4.0, places=1)
+        self.assertEqual(report["top"][0]["queryid"], 42)
+
+    def test_profile_counts_are_differenced_per_pid(self):
+        state = {"n": 100.0}
+        db = FakeDB()
+        db.execute = lambda sql, params=None: [
+            {"pid": 1, "event": "LWLock:WALWrite", "queryid": 9, "datname": "app", "n": state["n"], "period_ms": 10.0}]
+        sampler = monitor_pg.WaitEventSampler(db, lambda: ("profile", "SQL"), window=monitor_pg.WaitEventWindow(16, 60, 6))
+        sampler.sample(now=0.0)
+        self.assertEqual(sampler.window.by_event(0.0), {})
+        state["n"] = 600.0
+        sampler.sample(now=5.0)
+        self.assertAlmostEqual(sampler.window.by_event(5.0)["LWLock:WALWrite"], 5.0)
+
+    def test_top_wait_event_alerts_and_exports(self):
+        class WaitDB(FakeDB):
+            def execute(self, sql, params=None):
+                if "wait_event_type" in sql:
+                    self.calls.append(sql)
+                    return [{"event": "IO:DataFileRead", "queryid": 0, "datname": "app", "n": 6.0},
+                            {"event": "CPU", "queryid": 0, "datname": "app", "n": 20.0}]
+                return super().execute(sql, params)
+
+        db = WaitDB(snapshot_row(connections={"total": 1, "active": 1, "idle": 0}))
+        cfg = make_cfg(thresholds={"wait_event_aas": {"warning": 4, "critical": 8}})
+        sender = RecordingSender()
+        mon = monitor_pg.Monitor(cfg, db, sender, self.logger)
+        self.assertIn("0::bigint AS queryid", mon._wait_sampling_source()[1])
+        mon.waits.sample()
+        mon.evaluate_and_alert()
+        self.assertEqual(len(sender.messages), 1)
+        self.assertIn("IO:DataFileRead", sender.messages[0])
+        # CPU 不参与等待事件告警,但计入平均活跃会话数
+        self.assertAlmostEqual(mon.latest_values["wait_top_event_aas"], 6.0, places=1)
+        self.assertAlmostEqual(mon.latest_values["wait_aas_total"], 26.0, places=0)
+        self.assertIn("event_aas", "".join(f.name for f in mon._wait_families))
+
+
+def csvlog_line(message, query="", db="app", severity="LOG"):
+    """构造一条 PG14 格式(26 列)的 csvlog 记录"""
+    row = ["2024-01-01 00:00:00.000 CST", "app", db, "1234", "127.0.0.1:5000", "65a1.4d2", "1", "SELECT",
+           "2024-01-01 00:00:00 CST", "3/0", "0", severity, "00000", message, "", "", "", "", "", query, "", "",
+           "psql", "client backend", "", "0"]
+    buf = io.StringIO()
+    csv.writer(buf, lineterminator="\n").writerow(row)
+    return buf.getvalue()
+
+
+class TestCsvLog(unittest.TestCase):
+    def setUp(self):
+        self.logger = monitor_pg.logging.getLogger("test")
+        self.dir = tempfile.mkdtemp()
+        self.state = os.path.join(self.dir, "state", "offset.json")
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def _write(self, name, text, mtime=None, mode="a"):
+        path = os.path.join(self.dir, name)
+        with open(path, mode, encoding="utf-8") as f:
+            f.write(text)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def _follower(self, **kw):
+        kw.setdefault("start_at_end", False)
+        return monitor_pg.CsvLogFollower(self.dir, "*.csv", state_path=self.state, logger=self.logger, **kw)
+
+    def test_normalize_groups_literals(self):
+        a = monitor_pg.normalize_query("SELECT * FROM t WHERE id = 1 AND name = 'x''y' /* app */")
+        b = monitor_pg.normalize_query("select *  from t\nwhere id = 42 and name = 'z'")
+        self.assertEqual(a, b)
+        self.assertEqual(monitor_pg.normalize_query("SELECT 1 FROM t WHERE id IN (1, 2, 3) AND v = $1"),
+                         "select ? from t where id in (...) and v = ?")
+        self.assertEqual(len(monitor_pg.query_fingerprint(a)), 16)
+
+    def test_histogram_quantiles_within_bucket_error(self):
+        h = monitor_pg.LogHistogram()
+        for v in range(1, 1001):
+            h.add(float(v))
+        for q, exact in ((0.5, 500.5), (0.95, 950.05), (0.99, 990.01)):
+            self.assertLess(abs(h.quantile(q) - exact) / exact, 0.06)
+        self.assertEqual(h.quantile(1.0), 1000.0)
+
+    def test_parses_records_across_partial_writes_and_multiline_fields(self):
+        multi = csvlog_line('duration: 1500.5 ms  statement: SELECT *\nFROM t WHERE "Id" = 7')
+        path = self._write("postgresql-1.csv", csvlog_line("duration: 1000.0 ms  statement: SELECT * FROM t WHERE \"Id\" = 1")
+                           + multi[:40], mtime=1000)
+        f = self._follower()
+        f.poll()
+        report = f.drain()
+        self.assertEqual(report["slow_count"], 1)
+        # 残缺的多行记录保留到下次再读
+        self._write("postgresql-1.csv", multi[40:]
+                    + csvlog_line('temporary file: path "base/pgsql_tmp/pgsql_tmp1234.0", size 2048', query="SELECT * FROM big ORDER BY 1")
+                    + csvlog_line("process 99 still waiting for ShareLock on transaction 5 after 1000.123 ms")
+                    + csvlog_line("process 99 acquired ShareLock on transaction 5 after 4000.5 ms")
+                    + csvlog_line('automatic vacuum of table "app.public.t": index scans: 1\nsystem usage: CPU: user: 0.10 s, system: 0.01 s, elapsed: 12.50 s'))
+        f.poll()
+        report = f.drain()
+        self.assertEqual(report["slow_count"], 1)
+        self.assertEqual(report["slow"][0]["max_ms"], 1500.5)
+        self.assertIn("from t where", report["slow"][0]["query"])
+        self.assertEqual((report["temp_files"], report["temp_bytes"]), (1, 2048))
+        self.assertEqual(report["temp_top"][0]["query"], "select * from big order by ?")
+        self.assertEqual((report["lock_waits"], report["lock_wait_max_ms"]), (1, 4000.5))
+        self.assertEqual(report["autovacuum_top"], [{"table": "vacuum app.public.t", "elapsed_s": 12.5}])
+        self.assertEqual(report["lag_bytes"], 0)
+        self.assertEqual(f.offset, os.path.getsize(path))
+
+    def test_rotation_and_persisted_offset(self):
+        self._write("postgresql-1.csv", csvlog_line("duration: 1000 ms  statement: SELECT 1"), mtime=1000)
+        f = self._follower()
+        f.poll()
+        self.assertEqual(f.drain()["slow_count"], 1)
+        self._write("postgresql-1.csv", csvlog_line("duration: 1000 ms  statement: SELECT 2"), mtime=1001)
+        self._write("postgresql-2.csv", csvlog_line("duration: 3000 ms  statement: SELECT 3"), mtime=1002)
+        f.poll()
+        self.assertEqual(f.drain()["slow_count"], 2)
+        self.assertTrue(f.path.endswith("postgresql-2.csv"))
+        # 重启后从保存的位置继续,不重复计数
+        self._write("postgresql-2.csv", csvlog_line("duration: 1000 ms  statement: SELECT 4"), mtime=1003)
+        g = self._follower(start_at_end=True)
+        g.poll()
+        self.assertEqual(g.drain()["slow_count"], 1)
+        # log_truncate_on_rotation 复用同名文件:长度变短时从头读取
+        self._write("postgresql-2.csv", csvlog_line("duration: 5 ms  statement: SELECT 5"), mode="w")
+        g.poll()
+        self.assertEqual(g.drain()["slow_count"], 1)
+
+    def test_large_log_read_in_chunks(self):
+        lines = "".join(csvlog_line("duration: {}.5 ms  statement: SELECT * FROM t{} WHERE id = {}".format(
+            i % 5000, i % 50, i)) for i in range(40000))
+        self._write("postgresql-1.csv", lines, mtime=1000)
+        f = self._follower(chunk_bytes=1024 * 1024)
+        # 解析速度见 bench_monitor_pg.py --component csvlog
+        self.assertEqual(f.poll(), len(lines.encode("utf-8")))
+        report = f.drain(top_n=5)
+        self.assertEqual(report["slow_count"], 40000)
+        self.assertEqual(len(report["slow"]), 5)
+        self.assertEqual(report["lag_bytes"], 0)
+
+    def test_poll_stops_at_time_budget_and_skips_overlapping_runs(self):
+        self._write("postgresql-1.csv", "".join(csvlog_line("duration: 1000 ms  statement: SELECT {}".format(i))
+                                                for i in range(2000)), mtime=1000)
+        f = self._follower(chunk_bytes=4096, max_seconds_per_poll=1e-9)
+        polls = 0
+        while f.poll():
+            polls += 1
+        self.assertGreater(polls, 1)
+        self.assertEqual(f.drain()["slow_count"], 2000)
+        cfg = make_cfg(csvlog={"enabled": True, "directory": self.dir, "start_at_end": False, "state_path": self.state + ".mon"})
+        mon = monitor_pg.Monitor(cfg, FakeDB(snapshot_row()), RecordingSender(), self.logger)
+        self.assertEqual(mon.logs.max_seconds_per_poll, mon.schedule.deadlines["logs"] / 2)
+        with mon.logs.lock:
+            with self.assertRaises(RuntimeError):
+                mon.get_log_events()
+        self.assertEqual(mon.get_log_events()["slow_count"], 2000)
+
+    def test_monitor_alerts_on_logged_durations(self):
+        self._write("postgresql-1.csv", "".join(csvlog_line("duration: {} ms  statement: SELECT * FROM orders WHERE id = {}".format(
+            9000 + i, i)) for i in range(20)), mtime=1000)
+        cfg = make_cfg(csvlog={"enabled": True, "directory": self.dir, "start_at_end": False, "state_path": self.state},
+                       thresholds={"log_slow_p95_ms": {"warning": 5000}})
+        sender = RecordingSender()
+        mon = monitor_pg.Monitor(cfg, FakeDB(snapshot_row(connections={"total": 1, "active": 1, "idle": 0})), sender, self.logger)
+        mon.evaluate_and_alert()
+        self.assertEqual(len(sender.messages), 1)
+        self.assertIn("select * from orders where id = ?", sender.messages[0])
+        self.assertEqual(mon.latest_values["log_slow_count"], 20)
+        self.assertTrue(os.path.exists(self.state))
+
+
+class TestSlowQueries(unittest.TestCase):
+    """慢查询排除下推与指纹归并测试"""
+    def setUp(self):
+        self.logger = monitor_pg.setup_logger("/tmp/monitor_pg_test.log")
+
+    def test_excludes_pushed_into_sql_as_escaped_like_patterns(self):
+        self.assertEqual(monitor_pg.like_contains("VACUUM"), "%VACUUM%")
+        self.assertEqual(monitor_pg.like_contains("50%_x\\y"), "%50\\%\\_x\\\\y%")
+        self.assertIn("NOT LIKE ALL (%(slow_query_excludes)s::text[])", monitor_pg.SLOW_QUERIES_SQL)
+        db = FakeDB(fail_snapshot=True)
+        params = []
+        db.execute = lambda sql, p=None: params.append(p) or []
+        mon = monitor_pg.Monitor(make_cfg(slow_query_exclude_patterns=["VACUUM", "", "pg_dump"]), db, RecordingSender(), self.logger)
+        self.assertEqual(mon.get_slow_queries(), [])
+        self.assertEqual(params[-1], {"slow_query_ms": 5000, "slow_query_excludes": ["%VACUUM%", "%pg\\_dump%"]})
+
+    def test_running_statements_grouped_by_fingerprint(self):
+        rows = [{"pid": 100 + i, "datname": "app", "runtime_ms": 6000.0 + i * 100,
+                 "query": "SELECT * FROM orders WHERE id IN ({}) AND note = 'n{}'".format(", ".join(["1"] * (i + 2)), i)}
+                for i in range(8)]
+        rows.append({"pid": 9, "datname": "rpt", "runtime_ms": 9000.0, "query": "UPDATE stock SET n = n - 1 WHERE sku = 7"})
+        cfg = make_cfg(thresholds={"slow_query_count": {"warning": 5}})
+        sender = RecordingSender()
+        mon = monitor_pg.Monitor(cfg, FakeDB(snapshot_row(connections={"total": 1, "active": 1, "idle": 0}, slow_queries=rows)),
+                                 sender, self.logger)
+        mon.evaluate_and_alert()
+        groups = mon.get_slow_queries()
+        self.assertEqual([(g["count"], g["max_runtime_ms"]) for g in groups], [(1, 9000.0), (8, 6700.0)])
+        self.assertEqual(groups[1]["query"], "select * from orders where id in (...) and note = ?")
+        self.assertEqual(groups[1]["pids"], [100, 101, 102, 103, 104])
+        self.assertEqual(mon.latest_values["slow_query_count"], 9)
+        self.assertEqual(len(sender.messages), 1)
+        self.assertIn("{} 8个 最长6700ms [app]".format(groups[1]["fingerprint"]), sender.messages[0])
+
+    def test_normalizer_cache_is_bounded_lru(self):
+        n = monitor_pg.QueryNormalizer(capacity=2)
+        a = n.fingerprint("SELECT 1")
+        n.fingerprint("SELECT 2")
+        self.assertEqual(a, n.fingerprint("SELECT 1"))
+        self.assertEqual(a[1], n.fingerprint("SELECT 2")[1])
+        n.fingerprint("SELECT 3")
+        self.assertEqual(n.stats(), {"hits": 2, "misses": 3, "entries": 2})
+        # 最久未用的 SELECT 1 已被淘汰
+        n.fingerprint("SELECT 2")
+        self.assertEqual(n.stats()["misses"], 3)
+        n.fingerprint("SELECT 1")
+        self.assertEqual(n.stats()["misses"], 4)
+
+    def test_normalizer_cache_entries_independent_of_statement_size(self):
+        n = monitor_pg.QueryNormalizer(capacity=4)
+        huge = "INSERT INTO t VALUES " + ", ".join("({}, 'row {}')".format(i, i) for i in range(200000))
+        norm, fp = n.fingerprint(huge)
+        self.assertEqual(len(norm), monitor_pg.NORMALIZED_TEXT_MAX)
+        self.assertEqual(fp, monitor_pg.query_fingerprint(monitor_pg.normalize_query(huge)))
+        self.assertEqual(n.fingerprint(huge), (norm, fp))
+        self.assertEqual(n.stats()["hits"], 1)
+        # 缓存键是固定长度的摘要,不持有原文
+        self.assertEqual([len(k) for k in n._entries], [16])
+
+    def test_normalizer_collapses_literals_to_shapes(self):
+        queries = ["SELECT o.id, o.total FROM orders o JOIN customers c ON c.id = o.customer_id "
+                   "WHERE c.region = 'r{}' AND o.status IN ({}) LIMIT {}".format(i % 97, ", ".join(str(i % 7) * (i % 5 + 1)), i)
+                   for i in range(500)]
+        n = monitor_pg.QueryNormalizer(capacity=len(queries))
+        fps = {n.fingerprint(q)[1] for q in queries}
+        for q in queries:
+            n.fingerprint(q)
+        # 字面量被剥离,IN 列表折叠:只剩单值与多值两种形状;10 万条的速度见 bench_monitor_pg.py --component normalizer
+        self.assertEqual(len(fps), 2)
+        self.assertEqual(n.stats(), {"hits": len(queries), "misses": len(queries), "entries": len(queries)})
+
+
+class TestConnectionResilience(unittest.TestCase):
+    """连接池、重连退避与周期时间上限测试"""
+    def setUp(self):
+        self.logger = monitor_pg.logging.getLogger("test")
+
+    def test_pool_reuses_connections_and_sets_budget_only_on_change(self):
+        db = PooledClient(make_cfg(), self.logger)
+        db.connect()
+        db.execute("SELECT 1")
+        db.execute("SELECT 2")
+        with db.budget(monitor_pg.QueryBudget(30000, 500)):
+            db.execute("SELECT 3")
+            db.execute("SELECT 4")
+        self.assertEqual(len(db.opened), 1)
+        sets = [p for sql, p in db.opened[0].statements if sql.startswith("SET")]
+        self.assertEqual(sets, [(30000, 500)])
+        self.assertIn("keepalives=1", db._dsn())
+        self.assertIn("statement_timeout=10000", db._dsn())
+
+    def test_concurrent_queries_use_separate_connections_up_to_pool_size(self):
+        db = PooledClient(make_cfg(), self.logger)
+        db.pool_size = 2
+        db.connect()
+        db.hold = threading.Event()
+        threads = [threading.Thread(target=db.execute, args=("SELECT 1",)) for _ in range(3)]
+        for th in threads:
+            th.start()
+        time.sleep(0.2)
+        self.assertEqual(len(db.opened), 2)
+        self.assertEqual(db.cancel(), 2)
+        db.hold.set()
+        for th in threads:
+            th.join()
+        self.assertEqual(len(db._idle), 2)
+
+    def test_cancel_only_reaches_connections_of_given_owners(self):
+        db = PooledClient(make_cfg(), self.logger)
+        self.assertEqual(db.pool_size, monitor_pg.DEFAULT_POOL_SIZE)
+        db.connect()
+        db.hold = threading.Event()
+        overdue = object()
+
+        def collector():
+            with db.owner(overdue):
+                db.execute("SELECT 1")
+
+        # 等待事件采样等后台线程不声明归属
+        threads = [threading.Thread(target=collector), threading.Thread(target=db.execute, args=("SELECT 2",))]
+        for th in threads:
+            th.start()
+        time.sleep(0.2)
+        self.assertEqual(db.cancel([object()]), 0)
+        self.assertEqual(db.cancel([overdue]), 1)
+        db.hold.set()
+        for th in threads:
+            th.join()
+        by_sql = {c.statements[-1][0]: c.cancels for c in db.opened}
+        self.assertEqual(by_sql, {"SELECT 1": 1, "SELECT 2": 0})
+        self.assertEqual(db._owners, {})
+
+    def test_reconnects_after_drop_and_backs_off_when_refused(self):
+        random.seed(3)
+        db = PooledClient(make_cfg(), self.logger)
+        db.connect()
+        db.drop_next = True
+        self.assertEqual(db.execute_one("SELECT 1"), {"ok": 1})
+        self.assertEqual(db.generation, 2)
+        db.opened[-1].closed = 2
+        db.refuse = True
+        attempts = []
+        refused_open = db._open
+        db._open = lambda: attempts.append(1) or refused_open()
+        with self.assertRaises(monitor_pg.DBUnavailableError):
+            db.execute("SELECT 1")
+        with self.assertRaises(monitor_pg.DBUnavailableError):
+            db.execute("SELECT 1")
+        self.assertEqual(len(attempts), 1)
+        db._retry_at = 0.0
+        db.refuse = False
+        db.execute("SELECT 1")
+        self.assertEqual(db.generation, 3)
+
+    def test_hung_collector_bounded_and_its_alerts_held(self):
+        class SlowDiskDB(FakeDB):
+            def execute(self, sql, params=None):
+                if "pg_database_size" in sql:
+                    time.sleep(1.0)
+                return super().execute(sql, params)
+
+        db = SlowDiskDB(snapshot_row())
+        cfg = make_cfg(thresholds={"disk_usage_database_bytes": {"warning": 100}},
+                       timeouts={"cycle_seconds": 0.3})
+        sender = RecordingSender()
+        mon = monitor_pg.Monitor(cfg, db, sender, self.logger)
+        mon.evaluate_and_alert()
+        self.assertEqual(len(sender.messages), 1)
+        db.snapshot_row = snapshot_row(databases=None)
+        start = time.time()
+        mon.evaluate_and_alert()
+        self.assertLess(time.time() - start, 0.6)
+        self.assertEqual(db.cancelled, 1)
+        self.assertIn((mon.instance, "数据库总占用(字节)"), mon.alerts.firing)
+        self.assertEqual(len(sender.messages), 1)
+        self.assertNotIn("disk_db_total_bytes", mon.latest_values)
+        self.assertIn("connections_total", mon.latest_values)
+
+    def test_all_collectors_failing_raises_and_alerts(self):
+        class DownDB(FakeDB):
+            def execute_one(self, sql, params=None):
+                raise monitor_pg.DBUnavailableError("数据库连接失败: refused")
+
+            def execute(self, sql, params=None):
+                raise monitor_pg.DBUnavailableError("数据库连接失败: refused")
+
+        sender = RecordingSender()
+        mon = monitor_pg.Monitor(make_cfg(), DownDB(), sender, self.logger)
+        with self.assertRaises(monitor_pg.DBUnavailableError):
+            mon.evaluate_and_alert()
+        self.assertEqual(len(sender.messages), 1)
+        self.assertIn("采集失败", sender.messages[0])
+
+
+class TestSelfStats(unittest.TestCase):
+    """自监控统计、状态文件与剖析测试"""
+    def setUp(self):
+        self.logger = monitor_pg.logging.getLogger("test")
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_cycle_records_collectors_and_writes_status(self):
+        path = os.path.join(self.tmp.name, "status.json")
+        stats = monitor_pg.SelfStats(self.logger, path, write_interval_seconds=0)
+        mon = monitor_pg.Monitor(make_cfg(), FakeDB(snapshot_row()), RecordingSender(), self.logger, stats=stats)
+        mon.evaluate_and_alert()
+        mon.evaluate_and_alert()
+        with open(path, encoding="utf-8") as f:
+            status = json.load(f)
+        self.assertEqual(status["cycle"][mon.instance]["count"], 2)
+        self.assertEqual(status["collector"]["snapshot"]["count"], 2)
+        self.assertEqual(status["collector"]["connections"]["count"], 2)
+        self.assertGreaterEqual(status["collector"]["connections"]["max_ms"], status["collector"]["connections"]["p50_ms"])
+        self.assertEqual(status["process"]["pid"], os.getpid())
+        if os.path.exists("/proc/self/statm"):
+            self.assertGreater(status["process"]["rss_bytes"], 0)
+
+    def test_queries_are_attributed_to_collector_with_rows_and_errors(self):
+        stats = monitor_pg.SelfStats()
+        db = PooledClient(make_cfg(), self.logger)
+        db.stats = stats
+        db.connect()
+        with stats.timed("collector", "locks", scope=True):
+            db.execute("SELECT 1")
+            db.execute("SELECT 1")
+        db.drop_next = True
+        db.refuse = True
+        with self.assertRaises(monitor_pg.DBUnavailableError):
+            db.execute_one("SELECT 2")
+        queries = stats.status()["query"]
+        locks = [q for q in queries.values() if q["collector"] == "locks"]
+        self.assertEqual([(q["sql"], q["count"], q["rows"]) for q in locks], [("SELECT 1", 2, 2)])
+        other = [q for q in queries.values() if q["collector"] == "background"]
+        self.assertEqual((other[0]["count"], other[0]["errors"]), (1, 1))
+
+    def test_dispatcher_records_retries_and_failures(self):
+        stats = monitor_pg.SelfStats()
+        d = monitor_pg.AlertDispatcher(FlakySender(ok=False), self.logger, max_retries=3,
+                                       backoff_base_seconds=0.01, backoff_max_seconds=0.02)
+        d.stats = stats
+        d.start()
+        d.safe_send("disk full")
+        d.stop(timeout=1.0)
+        webhook = stats.status()["webhook"]
+        self.assertEqual((webhook["deliver"]["retries"], webhook["deliver"]["failed"]), (2, 1))
+        self.assertEqual(webhook["outbox"]["spilled"], 1)
+
+    def test_profile_writes_pstats_and_allocation_summary(self):
+        stats = monitor_pg.SelfStats(self.logger)
+        stats.start_profile(1, self.tmp.name)
+        mon = monitor_pg.Monitor(make_cfg(), FakeDB(snapshot_row()), RecordingSender(), self.logger, stats=stats)
+        mon.evaluate_and_alert()
+        files = sorted(os.listdir(self.tmp.name))
+        self.assertEqual([os.path.splitext(f)[1] for f in files], [".pstats", ".txt"])
+        with open(os.path.join(self.tmp.name, files[1]), encoding="utf-8") as f:
+            text = f.read()
+        self.assertIn("_evaluate_and_alert", text)
+        self.assertIn("tracemalloc", text)
+        # 剖析结束后不再记录
+        mon.evaluate_and_alert()
+        self.assertEqual(len(os.listdir(self.tmp.name)), 2)
+        self.assertIsNone(stats.finish_profile())
+
+    def test_status_endpoint(self):
+        stats = monitor_pg.SelfStats()
+        stats.observe("collector", "locks", 0.002)
+        exporter = monitor_pg.PrometheusExporter(self.logger)
+        exporter.status = stats.status
+        host, port = exporter.serve("127.0.0.1", 0)
+        try:
+            conn = http.client.HTTPConnection(host, port, timeout=5)
+            conn.request("GET", "/status")
+            resp = conn.getresponse()
+            body = json.loads(resp.read().decode("utf-8"))
+            conn.close()
+        finally:
+            exporter.shutdown()
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(body["collector"]["locks"]["count"], 1)
+
+
+class TestFleet(unittest.TestCase):
+    """多实例并发采集测试"""
+    def setUp(self):
+        self.logger = monitor_pg.setup_logger("/tmp/monitor_pg_test.log")
+
+    def _fleet(self, dbs, max_workers):
+        cfg = make_cfg(db_targets=[{"name": "pg{}".format(i), "host": "h{}".format(i)} for i in range(len(dbs))])
+        self.sender = RecordingSender()
+        alerts = monitor_pg.AlertManager(self.sender, self.logger)
+        monitors = []
+        for target, db in zip(cfg["db_targets"], dbs):
+            target_cfg = dict(cfg)
+            target_cfg["db"] = target
+            monitors.append(monitor_pg.Monitor(target_cfg, db, self.sender, self.logger, alerts=alerts))
+        return monitor_pg.FleetScheduler(monitors, max_workers, self.logger, alerts=alerts)
+
+    def test_targets_inherit_db_defaults(self):
+        cfg = make_cfg(db_targets=[{"host": "a"}, {"name": "b", "host": "b", "port": 5433}])
+        self.assertEqual(cfg["db_targets"][0]["name"], "a:5432/postgres")
+        self.assertEqual(cfg["db_targets"][1]["user"], "postgres")
+        with self.assertRaises(monitor_pg.ConfigError):
+            make_cfg(db_targets=[{"host": "a"}, {"host": "a"}])
+
+    def test_targets_collected_concurrently(self):
+        # 每个实例的快照都停在同一道屏障上:只有全部实例同时在执行时才能放行,串行执行会超时
+        barrier = threading.Barrier(10, timeout=5)
+        broken = []
+
+        def gate():
+            try:
+                barrier.wait()
+            except threading.BrokenBarrierError:
+                broken.append(1)
+
+        fleet = self._fleet([GatedDB(gate) for _ in range(10)], max_workers=10)
+        status = fleet.run_cycle()
+        fleet.executor.shutdown()
+        self.assertEqual(set(status.values()), {"ok"})
+        self.assertEqual(broken, [])
+
+    def test_dead_and_hung_hosts_do_not_block_others(self):
+        release = threading.Event()
+        dbs = [FakeDB(snapshot_row()), GatedDB(lambda: release.wait(5)), FakeDB(snapshot_row())]
+        dbs[2].conn = None
+        dbs[2].connect = lambda: (_ for _ in ()).throw(RuntimeError("connection refused"))
+        fleet = self._fleet(dbs, max_workers=3)
+        try:
+            # 挂起的实例仍停在闸门处,其余实例照常完成
+            status = fleet.run_cycle(timeout=0.2)
+            self.assertEqual(status, {"pg0": "ok", "pg1": "timeout", "pg2": "error"})
+            self.assertEqual(fleet.run_cycle(timeout=0.2)["pg1"], "skipped")
+            self.assertFalse(release.is_set())
+        finally:
+            release.set()
+            fleet.executor.shutdown()
+
+    def test_build_fleet_shares_one_bounded_collector_pool(self):
+        cfg = make_cfg(db_targets=[{"name": "pg{}".format(i), "host": "h{}".format(i)} for i in range(20)],
+                       options={"collector_max_workers": 6, "fleet_max_workers": 4})
+        fleet = monitor_pg.build_fleet(cfg, RecordingSender(), self.logger)
+        pools = {id(m._collector_pool) for m in fleet.monitors}
+        self.assertEqual(pools, {id(fleet.collector_pool)})
+        self.assertEqual(fleet.collector_pool._max_workers, 6)
+        for mon in fleet.monitors:
+            mon.db = FakeDB(snapshot_row())
+        before = threading.active_count()
+        status = fleet.run_cycle()
+        self.assertEqual(set(status.values()), {"ok"})
+        self.assertLessEqual(threading.active_count() - before, 6 + 4)
+        # 共享线程池不随单个实例关闭
+        fleet.monitors[0].close()
+        fleet.monitors[1].evaluate_and_alert()
+        fleet.executor.shutdown()
+        fleet.collector_pool.shutdown()
+
+    def test_targets_keep_separate_deltas(self):
+        dbs = [FakeDB(snapshot_row(deadlocks_total=5)), FakeDB(snapshot_row(deadlocks_total=9))]
+        fleet = self._fleet(dbs, max_workers=2)
+        fleet.run_cycle()
+        fleet.executor.shutdown()
+        self.assertEqual([m.prev_state["deadlocks_total"] for m in fleet.monitors], [5, 9])
+
+    def test_alerts_from_all_targets_merged_per_cycle(self):
+        fleet = self._fleet([FakeDB(snapshot_row()) for _ in range(3)], max_workers=3)
+        fleet.run_cycle()
+        fleet.run_cycle()
+        fleet.executor.shutdown()
+        self.assertEqual(len(self.sender.messages), 1)
+        self.assertIn("触发 3 条", self.sender.messages[0])
+
+
+class TestBenchmarkHarness(unittest.TestCase):
+    def test_replay_reports_round_trips_and_writes_json(self):
+        import bench_monitor_pg
+        with tempfile.TemporaryDirectory() as d:
+            out = os.path.join(d, "bench.json")
+            args = ["--backends", "50", "--locks", "10", "--tables", "40", "--indexes", "80",
+                    "--databases", "3", "--statements", "100", "--cycles", "2", "--output", out]
+            self.assertEqual(bench_monitor_pg.main(args), 0)
+            with open(out) as f:
+                result = json.load(f)
+            # 第二次以自身为基线,不应判定为回归
+            self.assertEqual(bench_monitor_pg.main(args + ["--baseline", out, "--tolerance", "10"]), 0)
+        self.assertEqual(result["meta"]["mode"], "synthetic")
+        self.assertEqual(result["unknown_queries"], {})
+        # 连接、锁等指标都来自合并后的一次快照往返
+        self.assertEqual(result["collectors"]["snapshot"]["round_trips"], 1)
+        self.assertEqual(result["collectors"]["connections"]["round_trips"], 0)
+        self.assertGreater(result["cycle"]["rows"], 100)
+        self.assertIn("peak_kb", result["alloc"])
+
+    def test_compare_flags_regressions(self):
+        import bench_monitor_pg
+        base = {"cycle": {"round_trips": 5, "rows": 100, "p50_ms": 10.0}, "alloc": {"peak_kb": 100.0}}
+        new = {"cycle": {"round_trips": 9, "rows": 100, "p50_ms": 11.0}, "alloc": {"peak_kb": 100.0}}
+        problems = bench_monitor_pg.compare(new, base, 0.25)
+        self.assertEqual(len(problems), 1)
+        self.assertTrue(problems[0].startswith("cycle.round_trips"))
+
+
 if __name__ == "__main__":
     unittest.main()
 